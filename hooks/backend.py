@@ -125,6 +125,7 @@ class GuiServerMixin(object):
             gzip=config['gzip-compression'],
             gtm_enabled=config['gtm-enabled'],
             gisf_enabled=config['gisf-enabled'],
+            graceful=config['graceful-restart'],
             charmstore_url=config['charmstore-url'],
             charmstore_version=config['charmstore-version'])
 
@@ -36,7 +36,11 @@ from charmhelpers.core.hookenv import (
     log,
     open_port,
 )
-from charmhelpers.core.host import service
+from charmhelpers.core.host import (
+    init_is_systemd,
+    service,
+    service_running,
+)
 from shelltoolbox import (
     apt_get_install,
     install_extra_repositories,
@@ -315,7 +319,8 @@ def write_builtin_server_startup(
         env_password=None, env_uuid=None, juju_version=None, debug=False,
         port=None, jem_location=None, jem_version=None,
         interactive_login=False, gzip=True, gtm_enabled=False,
-        gisf_enabled=False, charmstore_url=None, charmstore_version=None):
+        gisf_enabled=False, charmstore_url=None, charmstore_version=None,
+        graceful=False):
     """Generate the builtin server Upstart file."""
     log('Generating the builtin server Upstart file.')
     context = {
@@ -327,6 +332,7 @@ def write_builtin_server_startup(
         'env_uuid': env_uuid,
         'gisf_enabled': gisf_enabled,
         'gtm_enabled': gtm_enabled,
+        'graceful': graceful,
         'gzip': gzip,
         'http_proxy': os.environ.get('http_proxy'),
         'https_proxy': os.environ.get('https_proxy'),
@@ -365,8 +371,13 @@ def start_builtin_server(
         juju_version=None, debug=False, port=None, jem_location=None,
         jem_version=None, interactive_login=False, gzip=True,
         gtm_enabled=False, gisf_enabled=False, charmstore_url=None,
-        charmstore_version=None):
-    """Start the builtin server."""
+        charmstore_version=None, graceful=False):
+    """Start the builtin server.
+
+    If graceful is True and the server is already running under systemd, a
+    new server process takes over the listening sockets while the running one
+    is drained, instead of restarting the service.
+    """
     if (port is not None) and not port_in_range(port):
         # Do not use the user provided port if it is not valid.
         port = None
@@ -379,10 +390,19 @@ def start_builtin_server(
         interactive_login=interactive_login, gzip=gzip,
         gtm_enabled=gtm_enabled, gisf_enabled=gisf_enabled,
         charmstore_url=charmstore_url,
-        charmstore_version=charmstore_version)
+        charmstore_version=charmstore_version, graceful=graceful)
     log('Starting the builtin server.')
     with su('root'):
-        service(RESTART, GUISERVER)
+        if not init_is_systemd():
+            service(RESTART, GUISERVER)
+            return
+        # Load the possibly updated service file.
+        cmd_log(run('systemctl', 'daemon-reload'))
+        if not (graceful and service_running(GUISERVER)):
+            service(RESTART, GUISERVER)
+        elif not service(RELOAD, GUISERVER):
+            log('Unable to reload the builtin server: restarting it.')
+            service(RESTART, GUISERVER)
 
 
 def stop_builtin_server():
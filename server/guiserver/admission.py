@@ -0,0 +1,127 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server WebSocket admission control.
+
+Each browser session opens a connection to the Juju API: a misbehaving
+script or a reconnection storm could open thousands of them through the GUI
+server. This module defines the following objects:
+
+    - TokenBucket: a token bucket used to limit the rate of new sessions;
+    - Admission: decide whether a new WebSocket session is accepted, based on
+      the number of active sessions (overall and for each remote address) and
+      on the rate of new sessions.
+
+Limits are enforced per process: when running multiple workers, each worker
+applies its own limits.
+"""
+
+import time
+
+
+# Define the reasons why a session is rejected.
+REJECTED_MAX_SESSIONS = 'too many sessions'
+REJECTED_MAX_SESSIONS_PER_IP = 'too many sessions from this address'
+REJECTED_RATE = 'too many new sessions'
+
+
+class TokenBucket(object):
+    """A token bucket allowing rate events per second, up to burst at once.
+
+    The clock callable returns the current time in seconds.
+    """
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+
+    def consume(self):
+        """Consume a token. Return False if no tokens are available."""
+        now = self._clock()
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self._tokens + elapsed * self.rate, self.burst)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class Admission(object):
+    """Admission control for WebSocket sessions.
+
+    At most max_sessions sessions are active at the same time, at most
+    max_sessions_per_ip from the same remote address, and at most rate new
+    sessions are accepted per second (with bursts of up to rate sessions).
+    Use 0 to disable each limit.
+    """
+
+    def __init__(
+            self, max_sessions=0, max_sessions_per_ip=0, rate=0,
+            clock=time.time):
+        self.max_sessions = max_sessions
+        self.max_sessions_per_ip = max_sessions_per_ip
+        self._bucket = None
+        if rate:
+            self._bucket = TokenBucket(rate, max(rate, 1), clock)
+        self._sessions = 0
+        # Map remote addresses to their number of active sessions.
+        self._sessions_per_ip = {}
+        self._rejected = 0
+
+    def acquire(self, ip):
+        """Try to start a new session from the given remote address.
+
+        Return None if the session is accepted, in which case release must be
+        called when the session ends, or the reason why it is rejected.
+        """
+        reason = None
+        if self.max_sessions and self._sessions >= self.max_sessions:
+            reason = REJECTED_MAX_SESSIONS
+        elif (self.max_sessions_per_ip and
+              self._sessions_per_ip.get(ip, 0) >= self.max_sessions_per_ip):
+            reason = REJECTED_MAX_SESSIONS_PER_IP
+        elif (self._bucket is not None) and not self._bucket.consume():
+            reason = REJECTED_RATE
+        if reason is not None:
+            self._rejected += 1
+            return reason
+        self._sessions += 1
+        self._sessions_per_ip[ip] = self._sessions_per_ip.get(ip, 0) + 1
+        return None
+
+    def release(self, ip):
+        """End a session from the given remote address."""
+        count = self._sessions_per_ip.pop(ip, 0)
+        if not count:
+            return
+        self._sessions -= 1
+        if count > 1:
+            self._sessions_per_ip[ip] = count - 1
+
+    def get_info(self):
+        """Return a dict describing the current occupancy."""
+        return {
+            'sessions': self._sessions,
+            'max_sessions': self.max_sessions,
+            'addresses': len(self._sessions_per_ip),
+            'max_sessions_per_ip': self.max_sessions_per_ip,
+            'rate': 0 if self._bucket is None else self._bucket.rate,
+            'rejected': self._rejected,
+        }
@@ -17,7 +17,9 @@
 """Juju GUI server applications."""
 
 from distutils.version import LooseVersion
+import os
 import time
+import weakref
 
 from pyramid.config import Configurator
 from tornado import web
@@ -25,11 +27,17 @@ from tornado.options import options
 from tornado.wsgi import WSGIContainer
 
 from guiserver import (
+    admission,
     auth,
+    clients,
     handlers,
+    metrics,
+    snapshots,
     utils,
 )
-from guiserver.bundles.base import Deployer
+from guiserver.multiplexer import Multiplexer
+from guiserver.bundles import views
+from guiserver.bundles.base import make_deployer
 from jujugui import make_application
 
 
@@ -39,15 +47,33 @@ WEBSOCKET_TARGET_TEMPLATE = 'wss://{server}:{port}/model/{uuid}/api'
 WEBSOCKET_TARGET_TEMPLATE_PRE2 = 'wss://{server}:{port}/environment/{uuid}/api'
 
 
-def server():
+def server(deployer=None, connections=None):
     """Return the main server application.
 
     The server app is responsible for serving the WebSocket connection, the
     Juju GUI static files and the main index file for dynamic URLs.
+
+    If a deployer is not provided, a new bundle Deployer is created. A
+    deployer is usually provided when running multiple server workers (see
+    guiserver.bundles.ipc).
+
+    If provided, connections is the set where active WebSocket handlers are
+    registered. It is usually provided so that the connections can be closed
+    when the server is drained (see guiserver.graceful).
     """
-    # Set up the bundle deployer.
-    deployer = Deployer(options.apiurl, options.apiversion,
-                        options.charmworldurl)
+    if deployer is None:
+        # Set up the bundle deployer.
+        deployer = make_deployer(options)
+    if connections is None:
+        # Keep track of the active WebSocket connections. Handlers remove
+        # themselves when the browser disconnects: a weak set ensures
+        # handlers never connected are not kept alive.
+        connections = weakref.WeakSet()
+    pool = None
+    model_cache = None
+    ws_admission = None
+    tokens = None
+    changesets = None
     # Set up handlers.
     server_handlers = []
     if options.sandbox:
@@ -59,20 +85,99 @@ def server():
         ws_target_template = WEBSOCKET_TARGET_TEMPLATE
         if LooseVersion(options.jujuversion) < LooseVersion('2'):
             ws_target_template = WEBSOCKET_TARGET_TEMPLATE_PRE2
-        tokens = auth.AuthenticationTokenHandler()
+        tokens_path = changesets_path = None
+        if options.tokenstore:
+            tokens_path = os.path.join(options.tokenstore, 'auth')
+            changesets_path = os.path.join(options.tokenstore, 'changesets')
+        tokens = auth.AuthenticationTokenHandler(
+            capacity=options.tokencapacity, path=tokens_path)
+        changesets = views.make_changeset_store(
+            options.tokencapacity, path=changesets_path)
+        compression_options = None
+        if options.wscompression:
+            compression_options = {
+                'level': options.wscompressionlevel,
+                'window_bits': options.wscompressionwindowbits,
+                'min_size': options.wscompressionminsize,
+            }
+        keepalive_options = None
+        if options.wspinginterval:
+            keepalive_options = {
+                'interval': options.wspinginterval,
+                'timeout': options.wspingtimeout,
+            }
+        if options.wspoolsize:
+            # Keep connections to the Juju API ready to be used.
+            pool = clients.ConnectionPool(
+                size=options.wspoolsize,
+                compression_options=compression_options,
+                raw_text=options.wspassthrough,
+                keepalive_options=keepalive_options,
+                idle_timeout=options.wspoolidletimeout)
+        auth_backend = auth.get_backend(options.apiversion)
+        multiplexer = None
+        if options.wsmultiplex:
+            multiplexer = Multiplexer(
+                auth_backend, login_ttl=options.wslogincache)
+        if options.wscachesize:
+            # Keep the model snapshots in memory.
+            model_cache = snapshots.ModelCache(
+                options.wscachesize * 1024 * 1024)
+        if (options.wsmaxsessions or options.wsmaxsessionsperip or
+                options.wssessionrate):
+            # Limit the number of active and new WebSocket sessions.
+            ws_admission = admission.Admission(
+                max_sessions=options.wsmaxsessions,
+                max_sessions_per_ip=options.wsmaxsessionsperip,
+                rate=options.wssessionrate)
         websocket_handler_options = {
             # The Juju API backend url.
             'apiurl': options.apiurl,
             # The backend to use for user authentication.
-            'auth_backend': auth.get_backend(options.apiversion),
+            'auth_backend': auth_backend,
             # The Juju deployer to use for importing bundles.
             'deployer': deployer,
             # The tokens collection for authentication token requests.
             'tokens': tokens,
+            # The store of bundle change sets.
+            'changesets': changesets,
             # The WebSocket URL template the browser uses for the connection.
             'ws_source_template': WEBSOCKET_SOURCE_TEMPLATE,
             # The WebSocket URL template used for connecting to Juju.
             'ws_target_template': ws_target_template,
+            # The set of active WebSocket connections.
+            'connections': connections,
+            # The browser buffer limits used to pause and resume reading
+            # from the Juju API.
+            'high_watermark': options.wshighwatermark,
+            'low_watermark': options.wslowwatermark,
+            # The maximum number of messages queued while connecting to Juju,
+            # and what to do when more messages arrive.
+            'queue_size': options.wsqueuesize,
+            'overflow_policy': options.wsoverflowpolicy,
+            # The WebSocket compression options, or None if disabled.
+            'compression_options': compression_options,
+            # The multiplexer used to share Juju API connections between
+            # browsers, or None if disabled.
+            'multiplexer': multiplexer,
+            # The pool of connections to the Juju API, or None if disabled.
+            'pool': pool,
+            # Whether to reconnect to the Juju API when the connection is lost.
+            'reconnect': options.wsreconnect,
+            # Whether to coalesce the AllWatcher deltas sent to slow browsers.
+            'coalesce': options.wscoalesce,
+            # The cache of model snapshots, or None if disabled.
+            'model_cache': model_cache,
+            # Whether to proxy messages without decoding them.
+            'passthrough': options.wspassthrough,
+            # The limits on WebSocket sessions, or None if disabled.
+            'admission': ws_admission,
+            # The options used to ping the browser and the Juju API, or None
+            # if disabled.
+            'keepalive_options': keepalive_options,
+            # The seconds after which sessions with no browser messages are
+            # closed, or 0 if disabled.
+            'idle_timeout': options.wsidletimeout,
         }
         juju_proxy_handler_options = {
             'target_url': utils.ws_to_http(options.apiurl),
@@ -94,11 +199,17 @@ def server():
             (r'^/test/(.*)', web.StaticFileHandler, params),
         )
     info_handler_options = {
+        'admission': ws_admission,
         'apiurl': options.apiurl,
         'apiversion': options.apiversion,
+        'changesets': changesets,
+        'connections': connections,
         'deployer': deployer,
+        'model_cache': model_cache,
+        'pool': pool,
         'sandbox': options.sandbox,
         'start_time': int(time.time()),
+        'tokens': tokens,
     }
     wsgi_settings = {
         'jujugui.apiAddress': options.apiurl,
@@ -125,6 +236,11 @@ def server():
     server_handlers.extend([
         # Handle GUI server info.
         (r'^/gui-server-info', handlers.InfoHandler, info_handler_options),
+        # Handle GUI server metrics.
+        (r'^/gui-server-metrics', handlers.MetricsHandler, {
+            'registry': metrics.REGISTRY,
+            'connections': connections,
+        }),
         (r".*", web.FallbackHandler, dict(fallback=wsgi_app))
     ])
     return web.Application(server_handlers, debug=options.debug)
@@ -41,16 +41,21 @@ This module includes the pieces required to process user authentication.
     - AuthenticationTokenHandler: This handles authentication token creation
       and usage requests.  It is used both by the AuthMiddleware and by
       handlers.WebSocketHandler in the ``on_message`` and ``on_juju_message``
-      methods.
+      methods.  Tokens are kept in a token store (see guiserver.tokens),
+      optionally shared with other server processes.
 """
 
 import copy
 import datetime
 import logging
-import uuid
 
 from tornado.ioloop import IOLoop
 
+from guiserver.tokens import (
+    DEFAULT_CAPACITY,
+    make_store,
+)
+
 
 class User(object):
     """The current WebSocket user."""
@@ -87,10 +92,15 @@ class AuthMiddleware(object):
         self._write_message = write_message
         self._request_ids = {}
 
-    def in_progress(self):
+    def in_progress(self, request_id=None):
         """Return True if authentication is in progress, False otherwise.
+
+        If a request id is provided, only return True if it identifies a login
+        request still waiting for a response.
         """
-        return bool(self._request_ids)
+        if request_id is None:
+            return bool(self._request_ids)
+        return request_id in self._request_ids
 
     def process_request(self, data):
         """Parse the WebSocket data arriving from the client.
@@ -285,14 +295,21 @@ class AuthenticationTokenHandler(object):
             'ErrorCode': 'unauthorized access',
             'Response': {},
         }
+
+    If a path is provided, tokens are stored in that directory, so that a
+    token created by one server process can be used by the others.
     """
 
-    def __init__(self, max_life=datetime.timedelta(minutes=2), io_loop=None):
+    def __init__(
+            self, max_life=datetime.timedelta(minutes=2), io_loop=None,
+            capacity=DEFAULT_CAPACITY, path=None):
         self._max_life = max_life
         if io_loop is None:
             io_loop = IOLoop.current()
         self._io_loop = io_loop
-        self._data = {}
+        self._store = make_store(
+            max_life, path=path, capacity=capacity, name='auth',
+            io_loop=io_loop)
 
     def token_requested(self, data):
         """Does data represent a token creation request?  True or False."""
@@ -311,22 +328,13 @@ class AuthenticationTokenHandler(object):
                 ErrorCode='unauthorized access',
                 Response={}))
             return
-        token = uuid.uuid4().hex
-
-        def expire_token():
-            self._data.pop(token, None)
-            logging.info('auth: expired token {}'.format(token))
-        handle = self._io_loop.add_timeout(self._max_life, expire_token)
         now = datetime.datetime.utcnow()
         # Stashing these is a security risk.  We currently deem this risk to
         # be acceptably small.  Even keeping an authenticated websocket in
         # memory seems to be of a similar risk profile, and we cannot operate
         # without that.
-        self._data[token] = dict(
-            username=user.username,
-            password=user.password,
-            handle=handle
-            )
+        token = self._store.add(
+            dict(username=user.username, password=user.password))
         write_message({
             'RequestId': data['RequestId'],
             'Response': {
@@ -350,10 +358,9 @@ class AuthenticationTokenHandler(object):
     def process_authentication_request(self, data, write_message):
         """Get the credentials for the token, or send an error."""
         token = data['Params']['Token']
-        credentials = self._data.pop(token, None)
+        credentials = self._store.pop(token)
         if credentials is not None:
             logging.info('auth: using token {}'.format(token))
-            self._io_loop.remove_timeout(credentials['handle'])
             return credentials['username'], credentials['password']
         else:
             write_message({
@@ -375,3 +382,7 @@ class AuthenticationTokenHandler(object):
         response = data.setdefault('Response', {})
         response.update({'AuthTag': user.username, 'Password': user.password})
         return data
+
+    def get_info(self):
+        """Return a dict describing the stored tokens."""
+        return self._store.get_info()
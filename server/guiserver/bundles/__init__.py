@@ -21,8 +21,9 @@ bundles in juju-core. The base pieces of the infrastructure are placed in the
 base module:
 
     - base.Deployer: any object implementing the following interface:
-        - validate(user, name, bundle) -> Future (str or None);
-        - import_bundle(user, name, bundle) -> int (a deployment id);
+        - validate(user, name, bundle, apiurl=None) -> Future (str or None);
+        - import_bundle(user, name, bundle, apiurl=None) -> int (a deployment
+          id);
         - watch(deployment_id) -> int or None (a watcher id);
         - next(watcher_id) -> Future (changes or None);
         - status() -> list (of changes).
@@ -33,7 +34,9 @@ base module:
         - name: a string representing the name of the bundle to be imported; in
           the case of v3 bundles, this will be the name of the bundle within
           the basket, in v4 bundles, this will be the bundle ID;
-        - bundle: a YAML decoded object representing the bundle contents.
+        - bundle: a YAML decoded object representing the bundle contents;
+        - apiurl: the Juju API URL of the target model, or None to use the
+          default one. Deployments to different models can run in parallel.
       The watch and next interface methods are used to retrieve information
       about the status of the currently started/scheduled deployments.
 
@@ -52,7 +55,11 @@ base module:
 
       Note that the Deployer is not intended to store request related data: one
       instance is created once when the application is bootstrapped and used as
-      a singleton by all WebSocket requests;
+      a singleton by all WebSocket requests. When the GUI server runs multiple
+      worker processes, only one worker owns the Deployer: the others use an
+      ipc.DeployerClient, exposing the same interface but returning Futures
+      for all the methods, connected to the ipc.DeployerServer running in the
+      coordinating worker;
 
     - base.DeployMiddleware: process deployment requests arriving from the
       client, validate the requests' data and send the appropriate responses.
@@ -240,8 +247,18 @@ the watch request will always return only the last change:
         },
     }
 
-XXX frankban: a timeout to delete completed deployments history will be
-eventually implemented.
+The history of completed and cancelled deployments is not kept forever: by
+default, deployments are forgotten one day after they finished, or when more
+than 100 deployments are finished (see the deployhistoryage and deployhistory
+GUI server options). Watchers of forgotten deployments are removed as well,
+and a Next request using one of them returns an error response, e.g.:
+
+    {
+        'RequestId': 5,
+        'Response': {},
+        'Error': 'invalid request: watcher 47 expired: the deployment '
+                 'history is no longer available',
+    }
 
 Cancelling a deployment.
 ------------------------
@@ -23,7 +23,8 @@ bundle views and the Deployer itself. See the bundles package docstring for
 a detailed explanation of how these objects are used.
 """
 
-import time
+from collections import deque
+import functools
 
 from concurrent.futures import (
     process,
@@ -31,10 +32,15 @@ from concurrent.futures import (
 )
 from deployer import guiserver as blocking
 from tornado import gen
-from tornado.ioloop import IOLoop
+from tornado.ioloop import (
+    IOLoop,
+    PeriodicCallback,
+)
 from tornado.util import ObjectDict
 
+from guiserver.auth import User
 from guiserver.bundles import (
+    journal,
     utils,
     views,
 )
@@ -49,6 +55,14 @@ process.EXTRA_QUEUED_CALLS = 0
 # Juju API versions supported by the GUI server Deployer.
 # Tests use the first API version in this list.
 SUPPORTED_API_VERSIONS = ['go']
+# Define the default maximum number of cached bundle validation results.
+DEFAULT_VALIDATION_CACHE_SIZE = 100
+# Define the number of seconds bundle validation results are cached.
+VALIDATION_CACHE_TTL = 30
+# Define the default number of seconds the history of completed and cancelled
+# deployments is kept, and the default maximum number of such deployments.
+DEFAULT_HISTORY_AGE = 24 * 60 * 60
+DEFAULT_HISTORY_SIZE = 100
 
 
 class Deployer(object):
@@ -59,18 +73,46 @@ class Deployer(object):
     process.
 
     The validation and deployments steps are executed in separate processes.
-    It is possible to process only one bundle at the time.
+    Validations run in parallel, up to the given number of validate_workers,
+    and their results are cached for a short time, so that importing the same
+    bundle again into the same model does not require a new validation.
+    Deployments are queued per target model (identified by its Juju API URL):
+    deployments to different models run in parallel, up to the given number
+    of workers, while deployments to the same model are run one at the time.
+    A deployment is only submitted to the run executor when a worker is free,
+    so that queued deployments can always be cancelled, and the next one is
+    started as soon as a previous deployment completes.
+
+    If a journal directory is provided, deployments are recorded so that
+    their history is kept and unfinished deployments are resumed after a
+    restart (see guiserver.bundles.journal).
+
+    The history of completed and cancelled deployments is kept for
+    history_age seconds, up to history_size deployments (0 for no limit).
 
     Note that the Deployer is not intended to store request related state: it
     is instantiated once when the application is bootstrapped and used as a
     singleton by all WebSocket requests.
     """
 
-    def __init__(self, apiurl, apiversion, charmworldurl=None, io_loop=None):
+    def __init__(
+            self, apiurl, apiversion, charmworldurl=None, io_loop=None,
+            workers=1, validate_workers=1,
+            validation_cache_size=DEFAULT_VALIDATION_CACHE_SIZE,
+            journal_path=None, history_age=DEFAULT_HISTORY_AGE,
+            history_size=DEFAULT_HISTORY_SIZE):
         """Initialize the deployer.
 
-        The apiurl argument is the URL of the juju-core WebSocket server.
+        The apiurl argument is the URL of the juju-core WebSocket server, used
+        when requests do not specify the URL of the target model.
         The apiversion argument is the Juju API version (e.g. "go").
+        The workers argument is the maximum number of parallel deployments.
+        The validate_workers argument is the maximum number of parallel
+        validations, and validation_cache_size is the maximum number of
+        validation results cached (0 to disable the cache).
+        The journal_path argument is the optional directory where deployments
+        are recorded. The history_age and history_size arguments limit the
+        completed deployments history.
         """
         self._apiurl = apiurl
         self._apiversion = apiversion
@@ -82,30 +124,65 @@ class Deployer(object):
         self._io_loop = io_loop
 
         # Deployment validation and importing executors.
-        self._validate_executor = ProcessPoolExecutor(1)
-        self._run_executor = ProcessPoolExecutor(1)
-
+        self._validate_executor = ProcessPoolExecutor(validate_workers)
+        self._run_executor = ProcessPoolExecutor(workers)
+        self._workers = workers
+
+        # Recent validation results, keyed on the target model, the user and
+        # the bundle contents.
+        self._validation_cache = utils.ValidationCache(
+            validation_cache_size, VALIDATION_CACHE_TTL)
+
+        # Deployments are optionally recorded in a journal.
+        self._journal = None
+        listener = None
+        if journal_path is not None:
+            self._journal = journal.Journal(journal_path, io_loop=io_loop)
+            listener = self._journal.add_change
         # An observer instance is used to watch the deployments progress.
-        self._observer = utils.Observer()
-        # Queue stores the deployment identifiers corresponding to the
-        # currently started/queued jobs.
-        self._queue = []
-        # The futures attribute maps deployment identifiers to Futures.
+        self._observer = utils.Observer(
+            listener=listener, max_age=history_age, max_count=history_size)
+        # Map target Juju API URLs to the identifiers of the deployments
+        # started/queued for the corresponding model. Only the first
+        # deployment in each queue is submitted to the run executor.
+        self._queues = {}
+        # Map deployment identifiers to their target Juju API URLs.
+        self._targets = {}
+        # Map the identifiers of deployments not yet submitted to the run
+        # executor to the arguments used to start them.
+        self._pending = {}
+        # Deployments at the head of their model queue waiting for a free
+        # worker, in the order they became ready to run.
+        self._ready = deque()
+        # The futures attribute maps started deployment identifiers to Futures.
         self._futures = {}
 
         # Options used by the juju-deployer.
         self.importer_options = blocking.get_default_guiserver_options()
 
+        # Restore the deployments recorded by previous server processes, and
+        # periodically check for processes exited in the meanwhile, e.g.
+        # after draining the server for a graceful restart.
+        self._adopter = None
+        if self._journal is not None:
+            adopt = functools.partial(self._journal.adopt, self._restore)
+            adopt()
+            self._adopter = PeriodicCallback(
+                adopt, journal.ADOPT_INTERVAL * 1000, io_loop)
+            self._adopter.start()
+
     @gen.coroutine
-    def validate(self, user, bundle):
+    def validate(self, user, bundle, apiurl=None):
         """Validate the deployment bundle.
 
         The validation is executed in a separate process using the
-        juju-deployer library.
+        juju-deployer library. Successful results are cached for
+        VALIDATION_CACHE_TTL seconds.
 
         Three arguments are provided:
           - user: the current authenticated user;
-          - bundle: a YAML decoded object representing the bundle contents.
+          - bundle: a YAML decoded object representing the bundle contents;
+          - apiurl: the optional Juju API URL of the target model.
 
         Return a Future whose result is a string representing an error or None
         if no error occurred.
@@ -113,15 +190,35 @@ class Deployer(object):
         apiversion = self._apiversion
         if apiversion not in SUPPORTED_API_VERSIONS:
             raise gen.Return('unsupported API version: {}'.format(apiversion))
-        try:
-            yield self._validate_executor.submit(
-                blocking.validate, self._apiurl, user.username, user.password,
+        if apiurl is None:
+            apiurl = self._apiurl
+        key = utils.validation_key(apiurl, user.username, bundle)
+        future = None if key is None else self._validation_cache.get(key)
+        if future is None:
+            future = self._validate_executor.submit(
+                blocking.validate, apiurl, user.username, user.password,
                 bundle)
+            if key is not None:
+                self._validation_cache.put(key, future)
+                add_future(
+                    self._io_loop, future, self._validation_callback, key)
+        try:
+            yield future
         except Exception as err:
             raise gen.Return(str(err))
 
+    def _validation_callback(self, key, future):
+        """Remove the validation from the cache if it failed.
+
+        Failures, including network errors reaching the Juju environment,
+        are not cached, so that the next validation is executed again.
+        """
+        if future.exception() is not None:
+            self._validation_cache.discard(key, future)
+
     def import_bundle(
-            self, user, name, bundle, version, bundle_id, test_callback=None):
+            self, user, name, bundle, version, bundle_id, test_callback=None,
+            apiurl=None):
         """Schedule a deployment bundle import process.
 
         The deployment is executed in a separate process.
@@ -133,6 +230,9 @@ class Deployer(object):
           - version: the version of the bundle syntax as an integer number;
           - bundle_id: the ID of the bundle.  May be None.
 
+        The bundle is deployed to the model with the given Juju API URL, or to
+        the default one if apiurl is None.
+
         It is possible to also provide an optional test_callback that will be
         called when the deployment is completed. Note that this functionality
         is present only for tests: clients should not consider the
@@ -141,29 +241,105 @@ class Deployer(object):
 
         Return the deployment identifier assigned to this deployment process.
         """
-        # Start observing this deployment, retrieve the next available
-        # deployment id and notify its position at the end of the queue.
+        if apiurl is None:
+            apiurl = self._apiurl
+        # Start observing this deployment and retrieve the next available
+        # deployment id.
         deployment_id = self._observer.add_deployment()
-        self._observer.notify_position(deployment_id, len(self._queue))
-        # Add this deployment to the queue.
-        self._queue.append(deployment_id)
+        if self._journal is not None:
+            self._journal.add_import(
+                deployment_id, apiurl, user, name, bundle, version, bundle_id)
+        self._enqueue(
+            deployment_id, apiurl,
+            (user, name, bundle, version, bundle_id, test_callback))
+        return deployment_id
+
+    def _enqueue(self, deployment_id, apiurl, params):
+        """Add the given deployment to the end of its model queue.
+
+        Notify the deployment position in the queue, and start the deployment
+        if the queue was empty and a worker is available.
+        """
+        queue = self._queues.setdefault(apiurl, [])
+        self._observer.notify_position(deployment_id, len(queue))
+        queue.append(deployment_id)
+        self._targets[deployment_id] = apiurl
+        self._pending[deployment_id] = params
+        if len(queue) == 1:
+            self._ready.append(deployment_id)
+            self._schedule()
+
+    def _restore(self, deployments):
+        """Restore the deployments recorded by a previous server process.
+
+        Receive a list of (change, params) tuples (see
+        guiserver.bundles.journal.read). Unfinished deployments are scheduled
+        again.
+        """
+        for change, params in deployments:
+            deployment_id = self._observer.restore(change)
+            if params is None:
+                continue
+            user = User(
+                username=params['Username'], password=params['Password'],
+                is_authenticated=True)
+            apiurl = params['ApiUrl']
+            args = (
+                user, params['Name'], params['Bundle'], params['Version'],
+                params['BundleId'])
+            self._journal.add_import(deployment_id, apiurl, *args)
+            self._enqueue(deployment_id, apiurl, args + (None,))
+        self._collect()
+
+    def _schedule(self):
+        """Start ready deployments while there are free workers."""
+        while self._ready and len(self._futures) < self._workers:
+            self._start(self._ready.popleft())
+
+    def _start(self, deployment_id):
+        """Submit the given pending deployment to the run executor."""
+        user, name, bundle, version, bundle_id, test_callback = (
+            self._pending.pop(deployment_id))
         # Add the import bundle job to the run executor, and set up a callback
         # to be called when the import process completes.
         future = self._run_executor.submit(
             blocking.import_bundle,
-            self._apiurl, user.username, user.password, name, bundle, version,
-            self.importer_options)
+            self._targets[deployment_id], user.username, user.password, name,
+            bundle, version, self.importer_options)
         add_future(self._io_loop, future, self._import_callback,
                    deployment_id, bundle_id)
         self._futures[deployment_id] = future
         # If a customized callback is provided, schedule it as well.
         if test_callback is not None:
             add_future(self._io_loop, future, test_callback)
-        # Submit a sleeping job in order to avoid the next deployment job to be
-        # immediately put in the executor's call queue. This allows for
-        # cancelling scheduled jobs, even if the job is the next to be started.
-        self._run_executor.submit(time.sleep, 1)
-        return deployment_id
+
+    def _dequeue(self, deployment_id):
+        """Remove the given deployment from its model queue.
+
+        Notify the new position of all remaining deployments to the same
+        model, mark the next one as ready and start ready deployments if
+        workers are available.
+        """
+        apiurl = self._targets.pop(deployment_id)
+        queue = self._queues[apiurl]
+        was_head = queue[0] == deployment_id
+        queue.remove(deployment_id)
+        if queue:
+            for position, deploy_id in enumerate(queue):
+                self._observer.notify_position(deploy_id, position)
+            if was_head:
+                self._ready.append(queue[0])
+        else:
+            del self._queues[apiurl]
+        self._schedule()
+        self._collect()
+
+    def _collect(self):
+        """Remove the history of old completed and cancelled deployments."""
+        removed = self._observer.collect()
+        if self._journal is not None:
+            for deployment_id in removed:
+                self._journal.forget(deployment_id)
 
     def _import_callback(self, deployment_id, bundle_id, future):
         """Callback called when a deployment process is completed.
@@ -185,12 +361,10 @@ class Deployer(object):
                 success = False
             # Notify a deployment completed.
             self._observer.notify_completed(deployment_id, error=error)
-        # Remove the completed deployment job from the queue.
-        self._queue.remove(deployment_id)
+        # Remove the completed deployment job from the queue, possibly starting
+        # the next deployment to the same model.
         del self._futures[deployment_id]
-        # Notify the new position of all remaining deployments in the queue.
-        for position, deploy_id in enumerate(self._queue):
-            self._observer.notify_position(deploy_id, position)
+        self._dequeue(deployment_id)
         # Increment the Charmworld deployment count upon successful
         # deployment.
         if success and bundle_id is not None:
@@ -216,9 +390,15 @@ class Deployer(object):
         The given watcher identifier refers to a specific deployment process
         (see the self.watch() method above).
         Return a future whose result is a list of deployment changes.
+        Return None if the watcher identifier is not valid, or an error string
+        if the watched deployment history has been removed.
         """
         deployment_id = self._observer.watchers.get(watcher_id)
         if deployment_id is None:
+            if self._observer.expired(watcher_id):
+                return (
+                    'watcher {} expired: the deployment history is no longer '
+                    'available'.format(watcher_id))
             return
         watcher = self._observer.deployments[deployment_id]
         try:
@@ -232,6 +412,13 @@ class Deployer(object):
         Return None if the deployment has been correctly cancelled.
         Return an error string otherwise.
         """
+        if self._pending.pop(deployment_id, None) is not None:
+            # The deployment is waiting for its model queue or for a worker.
+            if deployment_id in self._ready:
+                self._ready.remove(deployment_id)
+            self._observer.notify_cancelled(deployment_id)
+            self._dequeue(deployment_id)
+            return
         future = self._futures.get(deployment_id)
         if future is None:
             return 'deployment not found or already completed'
@@ -241,10 +428,27 @@ class Deployer(object):
     def status(self):
         """Return a list containing the last known change for each deployment.
         """
+        self._collect()
         watchers = self._observer.deployments.values()
         return [i.getlast() for i in watchers]
 
 
+def make_deployer(options):
+    """Create and return a Deployer configured by the given server options.
+
+    The options object is usually tornado.options.options, as defined in
+    guiserver.manage.setup.
+    """
+    return Deployer(
+        options.apiurl, options.apiversion, options.charmworldurl,
+        workers=options.deployworkers,
+        validate_workers=options.validateworkers,
+        validation_cache_size=options.validatecache,
+        journal_path=options.deployjournal,
+        history_age=options.deployhistoryage,
+        history_size=options.deployhistory)
+
+
 class DeployMiddleware(object):
     """Handle the bundles deployment request/response process.
 
@@ -265,13 +469,17 @@ class DeployMiddleware(object):
         deployment = DeployMiddleware(user, deployer, write_response)
         if deployment.requested(data):
             deployment.process_request(data)
+
+    If provided, apiurl is the Juju API URL of the model the client is
+    connected to, where bundles are deployed.
     """
 
-    def __init__(self, user, deployer, write_response):
+    def __init__(self, user, deployer, write_response, apiurl=None):
         """Initialize the deployment middleware."""
         self._user = user
         self._deployer = deployer
         self._write_response = write_response
+        self._apiurl = apiurl
         self.routes = {
             'Import': views.import_bundle,
             'Watch': views.watch,
@@ -294,7 +502,8 @@ class DeployMiddleware(object):
         request_id = data['RequestId']
         params = data.get('Params', {})
         view = self.routes[data['Request']]
-        request = ObjectDict(params=params, user=self._user)
+        request = ObjectDict(
+            params=params, user=self._user, apiurl=self._apiurl)
         response = yield view(request, self._deployer)
         response['RequestId'] = request_id
         self._write_response(response)
@@ -317,12 +526,16 @@ class ChangeSetMiddleware(object):
         changeset = ChangeSetMiddleware(user, write_response)
         if changeset.requested(data):
             changeset.process_request(data)
+
+    If provided, changesets is the token store where change sets are kept
+    (see guiserver.bundles.views.make_changeset_store).
     """
 
-    def __init__(self, user, write_response):
+    def __init__(self, user, write_response, changesets=None):
         """Initialize the change set middleware."""
         self._user = user
         self._write_response = write_response
+        self._changesets = changesets
         self.routes = {
             'GetChanges': views.get_changes,
             'SetChanges': views.set_changes,
@@ -343,6 +556,6 @@ class ChangeSetMiddleware(object):
         params = data.get('Params', {})
         view = self.routes[data['Request']]
         request = ObjectDict(params=params, user=self._user)
-        response = yield view(request)
+        response = yield view(request, self._changesets)
         response['RequestId'] = request_id
         self._write_response(response)
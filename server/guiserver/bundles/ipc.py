@@ -0,0 +1,287 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bundle deployment inter-process communication.
+
+When the GUI server runs multiple worker processes, bundle deployments must
+still be handled by a single Deployer, so that deployment identifiers, queue
+positions and the deployments status are consistent across all workers.
+
+This module defines the two sides of a small IPC channel, based on newline
+delimited JSON messages exchanged over a UNIX socket:
+
+    - DeployerServer: a TCP server (listening on a UNIX socket) exposing the
+      Deployer instance owned by the coordinating worker;
+    - DeployerClient: an object implementing the Deployer interface (see the
+      bundles package docstring) used by all the other workers. Since calls
+      are remote, all its methods return Futures.
+
+A request looks like the following:
+
+    {'Id': 1, 'Method': 'watch', 'Args': [42]}
+
+The corresponding response is like the following:
+
+    {'Id': 1, 'Result': 47}
+
+If an error occurs while executing the Deployer method, the response includes
+an Error field describing the error.
+"""
+
+import functools
+import itertools
+import logging
+import socket
+
+from concurrent.futures import Future
+from tornado import escape
+from tornado.iostream import (
+    IOStream,
+    StreamClosedError,
+)
+from tornado.ioloop import IOLoop
+from tornado.tcpserver import TCPServer
+
+from guiserver.auth import User
+from guiserver.utils import (
+    add_future,
+    json_decode,
+    json_encode,
+)
+
+
+# Define the delimiter used to separate IPC messages.
+DELIMITER = b'\n'
+
+
+def _encode(data):
+    """JSON encode the given IPC message, including the delimiter."""
+    return escape.utf8(json_encode(data)) + DELIMITER
+
+
+class DeployerServer(TCPServer):
+    """Expose a Deployer instance to other processes.
+
+    Use this server like any other Tornado TCP server, e.g.:
+
+        server = DeployerServer(deployer)
+        server.add_socket(netutil.bind_unix_socket(path))
+    """
+
+    def __init__(self, deployer, io_loop=None):
+        super(DeployerServer, self).__init__(io_loop=io_loop)
+        self._deployer = deployer
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._methods = {
+            'validate': self._validate,
+            'import_bundle': self._import_bundle,
+            'watch': deployer.watch,
+            'next': deployer.next,
+            'cancel': deployer.cancel,
+            'status': deployer.status,
+        }
+
+    def _validate(self, username, password, bundle, apiurl=None):
+        """Validate the bundle on behalf of the given remote user."""
+        user = User(
+            username=username, password=password, is_authenticated=True)
+        return self._deployer.validate(user, bundle, apiurl=apiurl)
+
+    def _import_bundle(
+            self, username, password, name, bundle, version, bundle_id,
+            apiurl=None):
+        """Schedule a bundle import on behalf of the given remote user."""
+        user = User(
+            username=username, password=password, is_authenticated=True)
+        return self._deployer.import_bundle(
+            user, name, bundle, version, bundle_id, apiurl=apiurl)
+
+    def handle_stream(self, stream, address):
+        """Start reading requests from a newly connected worker."""
+        self._read_request(stream)
+
+    def _read_request(self, stream):
+        """Wait for the next request sent by the worker."""
+        try:
+            stream.read_until(
+                DELIMITER, functools.partial(self._on_request, stream))
+        except StreamClosedError:
+            pass
+
+    def _on_request(self, stream, message):
+        """Execute the requested Deployer method and send back the result."""
+        self._read_request(stream)
+        try:
+            data = json_decode(message)
+            request_id = data['Id']
+            method = self._methods[data['Method']]
+        except (KeyError, TypeError, ValueError):
+            logging.error('deployer server: invalid request: {!r}'.format(
+                message))
+            return
+        try:
+            result = method(*data.get('Args', []))
+        except Exception as err:
+            logging.exception(err)
+            return self._send(stream, {'Id': request_id, 'Error': str(err)})
+        if isinstance(result, Future):
+            return add_future(
+                self._io_loop, result, self._on_result, stream, request_id)
+        self._send(stream, {'Id': request_id, 'Result': result})
+
+    def _on_result(self, stream, request_id, future):
+        """Send the result of an asynchronous Deployer call."""
+        try:
+            result = future.result()
+        except Exception as err:
+            logging.exception(err)
+            return self._send(stream, {'Id': request_id, 'Error': str(err)})
+        self._send(stream, {'Id': request_id, 'Result': result})
+
+    def _send(self, stream, data):
+        """Send the given response to the worker, if still connected."""
+        if stream.closed():
+            return logging.warning(
+                'deployer server: discarding response: {!r}'.format(data))
+        stream.write(_encode(data))
+
+
+class DeployerClient(object):
+    """Proxy Deployer method calls to a DeployerServer.
+
+    The client lazily connects to the server listening on the given UNIX
+    socket path. If the connection is lost, pending calls are resolved with
+    a failure value and the connection is established again on the next call.
+    """
+
+    def __init__(self, path, io_loop=None):
+        self._path = path
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._stream = None
+        # Map request identifiers to (future, failure value) pairs.
+        self._pending = {}
+        self._counter = itertools.count()
+
+    def _connect(self):
+        """Connect to the Deployer server and return the resulting stream."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stream = IOStream(sock, io_loop=self._io_loop)
+        stream.set_close_callback(
+            functools.partial(self._on_close, stream))
+        stream.connect(
+            self._path, functools.partial(self._read_response, stream))
+        return stream
+
+    def _call(self, failure, method, *args):
+        """Call the given remote method passing args.
+
+        Return a Future whose result is the remote result. If the remote call
+        fails, the Future result is the given failure value.
+        """
+        future = Future()
+        if (self._stream is None) or self._stream.closed():
+            self._stream = self._connect()
+        request_id = self._counter.next()
+        self._pending[request_id] = (future, failure)
+        data = {'Id': request_id, 'Method': method, 'Args': args}
+        try:
+            self._stream.write(_encode(data))
+        except StreamClosedError:
+            self._on_close(self._stream)
+        return future
+
+    def _read_response(self, stream):
+        """Wait for the next response from the server."""
+        try:
+            stream.read_until(
+                DELIMITER, functools.partial(self._on_response, stream))
+        except StreamClosedError:
+            pass
+
+    def _on_response(self, stream, message):
+        """Resolve the Future corresponding to the received response.
+
+        If the response is not valid, the following responses can no longer
+        be matched with their requests: resolve all pending calls with their
+        failure values and close the connection.
+        """
+        try:
+            data = json_decode(message)
+            request_id = data['Id']
+        except (KeyError, TypeError, ValueError):
+            logging.error('deployer client: invalid response: {!r}'.format(
+                message))
+            self._on_close(stream)
+            stream.close()
+            return
+        self._read_response(stream)
+        future, failure = self._pending.pop(request_id, (None, None))
+        if future is None:
+            return
+        if 'Error' in data:
+            logging.error('deployer client: {} failure: {}'.format(
+                data['Id'], data['Error']))
+            return future.set_result(failure)
+        future.set_result(data['Result'])
+
+    def _on_close(self, stream):
+        """Resolve all pending calls with their failure values."""
+        if stream is not self._stream:
+            return
+        self._stream = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            logging.error('deployer client: connection to the deployer lost')
+        for future, failure in pending.values():
+            future.set_result(failure)
+
+    def validate(self, user, bundle, apiurl=None):
+        """See guiserver.bundles.base.Deployer.validate."""
+        return self._call(
+            'unable to reach the deployer', 'validate',
+            user.username, user.password, bundle, apiurl)
+
+    def import_bundle(
+            self, user, name, bundle, version, bundle_id, apiurl=None):
+        """See guiserver.bundles.base.Deployer.import_bundle.
+
+        Return a Future whose result is the deployment identifier, or None if
+        the deployment could not be scheduled.
+        """
+        return self._call(
+            None, 'import_bundle', user.username, user.password, name, bundle,
+            version, bundle_id, apiurl)
+
+    def watch(self, deployment_id):
+        """See guiserver.bundles.base.Deployer.watch."""
+        return self._call(None, 'watch', deployment_id)
+
+    def next(self, watcher_id):
+        """See guiserver.bundles.base.Deployer.next."""
+        return self._call(None, 'next', watcher_id)
+
+    def cancel(self, deployment_id):
+        """See guiserver.bundles.base.Deployer.cancel."""
+        return self._call(
+            'unable to reach the deployer', 'cancel', deployment_id)
+
+    def status(self):
+        """See guiserver.bundles.base.Deployer.status."""
+        return self._call([], 'status')
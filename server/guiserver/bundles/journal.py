@@ -0,0 +1,318 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bundle deployments journal.
+
+By default the Deployer (see guiserver.bundles.base) keeps deployments in
+memory, so that queued deployments and their history are lost when the GUI
+server is restarted. If a journal directory is configured, the Deployer
+records scheduled imports and deployment changes in a Journal:
+
+    - each server process appends JSON encoded records, one per line, to its
+      own journal file in the directory, while holding a lock on it;
+    - when the Deployer starts, and then periodically, journals left by
+      processes no longer running (i.e. not locked) are adopted: completed and
+      cancelled deployments are restored so that their status is still
+      reported, and unfinished ones are scheduled again. The adopted
+      deployments are recorded in the journal of the current process, and the
+      adopted journal is removed.
+
+Periodically looking for journals to adopt allows the successor of a server
+process draining after a graceful restart (see guiserver.graceful) to take
+over the deployments history when the previous process exits.
+
+Records are written in batches: queue position changes are buffered and
+written after a short delay, while scheduled imports and final changes are
+written immediately, so that completed deployments are never resumed.
+
+When most of the records in a journal refer to deployments whose history has
+been removed (see the Journal.forget method), the journal is compacted by
+replacing it with a new one only including the last change of each
+remaining deployment, and the import parameters of the unfinished ones.
+
+Since imports are resumed on behalf of their users, the journal includes the
+user credentials: journal files are only readable by the server user.
+"""
+
+from collections import OrderedDict
+import datetime
+import errno
+import fcntl
+import logging
+import os
+import uuid
+
+from tornado.ioloop import IOLoop
+
+from guiserver.bundles.utils import (
+    CANCELLED,
+    COMPLETED,
+    create_change,
+    SCHEDULED,
+)
+from guiserver.utils import (
+    json_decode,
+    json_encode,
+)
+
+
+# Define the default number of seconds position changes are buffered.
+DEFAULT_FLUSH_DELAY = 1
+# Define the number of seconds between checks for journals to adopt.
+ADOPT_INTERVAL = 10
+# Define the extension of journal file names.
+EXTENSION = '.journal'
+# Define the prefix of journal files being created.
+NEW_PREFIX = '.new-'
+# Define the statuses of deployments no longer in progress.
+FINAL_STATUSES = (COMPLETED, CANCELLED)
+# Define the minimum number of records in a journal before compacting it.
+COMPACT_THRESHOLD = 1000
+
+
+def _lock(fd):
+    """Try to acquire an exclusive lock on the given file descriptor.
+
+    Return True if the lock is acquired, False if another process holds it.
+    """
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as err:
+        if err.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+def read(path):
+    """Return the deployments recorded in the journal at the given path.
+
+    Return a list of (change, params) tuples sorted by deployment id, where
+    change is the last change of a deployment, and params is a dict of import
+    parameters if the deployment is not yet completed, None otherwise.
+    Invalid records, e.g. a last line partially written, are ignored.
+    """
+    changes = {}
+    imports = {}
+    with open(path, 'rb') as journal_file:
+        for line in journal_file:
+            try:
+                record = json_decode(line)
+            except ValueError:
+                logging.error('journal {}: invalid record'.format(path))
+                continue
+            if 'Import' in record:
+                params = record['Import']
+                imports[params['DeploymentId']] = params
+            elif 'Change' in record:
+                change = record['Change']
+                changes[change['DeploymentId']] = change
+    deployments = []
+    for deployment_id in sorted(set(changes).union(imports)):
+        params = imports.get(deployment_id)
+        change = changes.get(deployment_id)
+        if change is None:
+            # The deployment was scheduled, but its position was not written.
+            change = create_change(deployment_id, SCHEDULED)
+        if change['Status'] in FINAL_STATUSES:
+            params = None
+        elif params is None:
+            change = create_change(
+                deployment_id, COMPLETED,
+                error='unable to resume the deployment')
+        deployments.append((change, params))
+    return deployments
+
+
+class Journal(object):
+    """Record bundle deployments in a journal file in the given directory.
+
+    Position changes are written flush_delay seconds after being added.
+    Use the adopt method to restore the deployments recorded by server
+    processes no longer running.
+    """
+
+    def __init__(self, path, io_loop=None, flush_delay=DEFAULT_FLUSH_DELAY):
+        self.path = path
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._flush_delay = flush_delay
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self.filename = os.path.join(path, uuid.uuid4().hex + EXTENSION)
+        self._file = self._create()
+        self._buffer = []
+        self._timeout = None
+        # Map the identifiers of the deployments in the journal to their last
+        # [change, import parameters] pair.
+        self._state = OrderedDict()
+        # The number of records written to the journal file.
+        self._records = 0
+
+    def _create(self, records=()):
+        """Create and return a new locked file for this journal.
+
+        The file includes the given encoded records, and it replaces the
+        current journal file, if any.
+        """
+        # Lock the journal before it is visible, so that other processes never
+        # adopt it.
+        new_path = os.path.join(self.path, NEW_PREFIX + uuid.uuid4().hex)
+        fd = os.open(
+            new_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND,
+            0o600)
+        _lock(fd)
+        journal_file = os.fdopen(fd, 'ab')
+        if records:
+            journal_file.write('\n'.join(records) + '\n')
+            journal_file.flush()
+            os.fsync(fd)
+        os.rename(new_path, self.filename)
+        return journal_file
+
+    def add_import(
+            self, deployment_id, apiurl, user, name, bundle, version,
+            bundle_id):
+        """Record a scheduled bundle import."""
+        params = {
+            'DeploymentId': deployment_id,
+            'ApiUrl': apiurl,
+            'Username': user.username,
+            'Password': user.password,
+            'Name': name,
+            'Bundle': bundle,
+            'Version': version,
+            'BundleId': bundle_id,
+        }
+        self._state.setdefault(deployment_id, [None, None])[1] = params
+        self._append({'Import': params}, True)
+
+    def add_change(self, change):
+        """Record a deployment change.
+
+        Final changes are written immediately.
+        """
+        final = change['Status'] in FINAL_STATUSES
+        entry = self._state.setdefault(change['DeploymentId'], [None, None])
+        entry[0] = change
+        if final:
+            # Credentials are no longer required.
+            entry[1] = None
+        self._append({'Change': change}, final)
+
+    def forget(self, deployment_id):
+        """Stop tracking the given deployment.
+
+        The deployment is removed from the journal when compacting it.
+        """
+        self._state.pop(deployment_id, None)
+
+    def _append(self, record, flush):
+        """Add the given record, writing it immediately if flush is True."""
+        self._buffer.append(json_encode(record))
+        if flush:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = self._io_loop.add_timeout(
+                datetime.timedelta(seconds=self._flush_delay), self.flush)
+
+    def flush(self):
+        """Write the buffered records to the journal file."""
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self._buffer:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._file.flush()
+            self._records += len(self._buffer)
+            self._buffer = []
+        if (self._records >= COMPACT_THRESHOLD and
+                self._records > 2 * len(self._state)):
+            self.compact()
+
+    def compact(self):
+        """Replace the journal file with one only including tracked data."""
+        records = []
+        for change, params in self._state.values():
+            if params is not None:
+                records.append(json_encode({'Import': params}))
+            if change is not None:
+                records.append(json_encode({'Change': change}))
+        new_file = self._create(records)
+        self._file.close()
+        self._file = new_file
+        logging.debug('journal {}: compacted from {} to {} records'.format(
+            self.filename, self._records, len(records)))
+        self._records = len(records)
+
+    def adopt(self, restore):
+        """Adopt the journals left by processes no longer running.
+
+        For each journal, call restore with the deployments it includes (see
+        the read function above). The restore callable is supposed to record
+        the deployments in this journal. Then remove the adopted journal.
+        Return the number of adopted journals.
+        """
+        adopted = 0
+        for name in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, name)
+            if name.endswith(EXTENSION) and path != self.filename:
+                adopted += self._adopt(path, restore)
+            elif name.startswith(NEW_PREFIX):
+                # Remove journals left by processes failed while starting.
+                self._adopt(path, None)
+        return adopted
+
+    def _adopt(self, path, restore):
+        """Adopt the journal at the given path if not locked.
+
+        If restore is None, just remove the journal.
+        Return 1 if the journal has been adopted, 0 otherwise.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            # Another process adopted the journal.
+            return 0
+        try:
+            if not _lock(fd):
+                # The owner of the journal is still running.
+                return 0
+            try:
+                if os.stat(path).st_ino != os.fstat(fd).st_ino:
+                    return 0
+            except OSError:
+                return 0
+            if restore is not None:
+                restore(read(path))
+                self.flush()
+                os.fsync(self._file.fileno())
+                logging.info('journal {}: adopted'.format(path))
+            os.remove(path)
+            return 1
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """Write the buffered records and close the journal."""
+        self.flush()
+        self._file.close()
@@ -18,7 +18,8 @@
 
 import collections
 from functools import wraps
-import itertools
+import hashlib
+import json
 import logging
 import time
 import urllib
@@ -84,17 +85,38 @@ def message_from_error(exception):
 
 
 class Observer(object):
-    """Handle multiple deployment watchers."""
+    """Handle multiple deployment watchers.
 
-    def __init__(self):
+    If provided, the listener callable is called with each deployment change,
+    e.g. to record it in a journal (see guiserver.bundles.journal).
+
+    Completed and cancelled deployments, and their watchers, are removed by
+    the collect method when they are older than max_age seconds, or when
+    there are more than max_count of them. Use 0 for no limit.
+    """
+
+    def __init__(self, listener=None, max_age=0, max_count=0):
         # Map deployment identifiers to watchers.
         self.deployments = {}
         # Map watcher identifiers to deployment identifiers.
         self.watchers = {}
-        # This counter is used to generate deployment identifiers.
-        self._deployment_counter = itertools.count()
-        # This counter is used to generate watcher identifiers.
-        self._watcher_counter = itertools.count()
+        self._listener = listener
+        self.max_age = max_age
+        self.max_count = max_count
+        # The next identifier assigned to a deployment.
+        self._next_deployment_id = 0
+        # The next identifier assigned to a watcher.
+        self._next_watcher_id = 0
+        # Map deployment identifiers to the list of their watcher identifiers.
+        self._deployment_watchers = {}
+        # Map the identifiers of completed and cancelled deployments to the
+        # time they finished, oldest first.
+        self._finished = collections.OrderedDict()
+
+    def _notify(self, change):
+        """Pass the given change to the listener, if provided."""
+        if self._listener is not None:
+            self._listener(change)
 
     def add_deployment(self):
         """Start observing a deployment.
@@ -102,18 +124,46 @@ class Observer(object):
         Generate a deployment id and add it to self.deployments.
         Return the generated deployment id.
         """
-        deployment_id = self._deployment_counter.next()
+        deployment_id = self._next_deployment_id
+        self._next_deployment_id += 1
         self.deployments[deployment_id] = AsyncWatcher()
         logging.info('deployment {} scheduled'.format(deployment_id))
         return deployment_id
 
+    def restore(self, change):
+        """Start observing a deployment using its last known change.
+
+        The deployment keeps its identifier if not already used, otherwise a
+        new one is generated. Completed and cancelled deployments are only
+        kept for reporting their status.
+        Return the deployment id.
+        """
+        deployment_id = change['DeploymentId']
+        if deployment_id in self.deployments:
+            deployment_id = self._next_deployment_id
+            change = dict(change, DeploymentId=deployment_id)
+        self._next_deployment_id = max(
+            self._next_deployment_id, deployment_id + 1)
+        watcher = self.deployments[deployment_id] = AsyncWatcher()
+        if change['Status'] in (COMPLETED, CANCELLED):
+            watcher.close(change)
+            self._finished[deployment_id] = change['Time']
+        else:
+            watcher.put(change)
+        self._notify(change)
+        logging.info('deployment {} restored'.format(deployment_id))
+        return deployment_id
+
     def add_watcher(self, deployment_id):
         """Return a new watcher id for the given deployment id.
 
         Also add the generated watcher id to self.watchers.
         """
-        watcher_id = self._watcher_counter.next()
+        watcher_id = self._next_watcher_id
+        self._next_watcher_id += 1
         self.watchers[watcher_id] = deployment_id
+        self._deployment_watchers.setdefault(deployment_id, []).append(
+            watcher_id)
         logging.debug('deployment {} observed by watcher {}'.format(
             deployment_id, watcher_id))
         return watcher_id
@@ -128,6 +178,7 @@ class Observer(object):
         status = SCHEDULED if position else STARTED
         change = create_change(deployment_id, status, queue=position)
         watcher.put(change)
+        self._notify(change)
         logging.debug('deployment {} now in position {}'.format(
             deployment_id, position))
 
@@ -136,6 +187,8 @@ class Observer(object):
         watcher = self.deployments[deployment_id]
         change = create_change(deployment_id, CANCELLED)
         watcher.close(change)
+        self._finished[deployment_id] = change['Time']
+        self._notify(change)
         logging.info('deployment {} cancelled'.format(deployment_id))
 
     def notify_completed(self, deployment_id, error=None):
@@ -143,8 +196,110 @@ class Observer(object):
         watcher = self.deployments[deployment_id]
         change = create_change(deployment_id, COMPLETED, error=error)
         watcher.close(change)
+        self._finished[deployment_id] = change['Time']
+        self._notify(change)
         logging.info('deployment {} completed'.format(deployment_id))
 
+    def expired(self, watcher_id):
+        """Return True if the given watcher has been removed by collect."""
+        return (
+            isinstance(watcher_id, (int, long)) and
+            0 <= watcher_id < self._next_watcher_id and
+            watcher_id not in self.watchers)
+
+    def collect(self):
+        """Remove the history of old completed and cancelled deployments.
+
+        Return the list of removed deployment identifiers.
+        """
+        finished = self._finished
+        oldest = time.time() - self.max_age
+        removed = []
+        while finished:
+            deployment_id, finish_time = next(finished.iteritems())
+            too_many = self.max_count and len(finished) > self.max_count
+            too_old = self.max_age and finish_time <= oldest
+            if not (too_many or too_old):
+                break
+            del finished[deployment_id]
+            del self.deployments[deployment_id]
+            for watcher_id in self._deployment_watchers.pop(
+                    deployment_id, ()):
+                del self.watchers[watcher_id]
+            removed.append(deployment_id)
+            logging.debug('deployment {} history removed'.format(
+                deployment_id))
+        return removed
+
+
+class ValidationCache(object):
+    """A bounded LRU cache of bundle validation results.
+
+    Results are usually futures, stored as soon as the validation is started,
+    so that identical validations requested while the first one is still in
+    progress share its outcome. Failed validations are discarded by the
+    caller once the result is known. Entries expire after ttl seconds, so that
+    changes in the Juju environment are eventually taken into account. At
+    most capacity entries are stored (use 0 to disable caching): when adding
+    an entry to a full cache, the least recently used one is discarded.
+    The clock callable returns the current time in seconds.
+    """
+
+    def __init__(self, capacity, ttl, clock=time.time):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._clock = clock
+        # Map keys to (expiration time, result) tuples, least recently used
+        # first.
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return the result stored for the given key.
+
+        Return None if the key is not cached or it is expired.
+        """
+        entry = self._data.pop(key, None)
+        if (entry is None) or (entry[0] <= self._clock()):
+            return None
+        # Mark the entry as the most recently used.
+        self._data[key] = entry
+        return entry[1]
+
+    def put(self, key, result):
+        """Store the given result for the given key."""
+        if not self.capacity:
+            return
+        data = self._data
+        data.pop(key, None)
+        while len(data) >= self.capacity:
+            data.popitem(last=False)
+        data[key] = (self._clock() + self.ttl, result)
+
+    def discard(self, key, result):
+        """Remove the given result stored for the given key, if present.
+
+        Results stored later for the same key are preserved.
+        """
+        entry = self._data.get(key)
+        if (entry is not None) and (entry[1] is result):
+            del self._data[key]
+
+
+def validation_key(apiurl, username, bundle):
+    """Return the key used to cache the validation of the given bundle.
+
+    The key includes the target model and user, and a hash of the prepared
+    bundle contents. Return None if the bundle cannot be hashed.
+    """
+    try:
+        content = json.dumps(bundle, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return apiurl, username, hashlib.sha256(content).hexdigest()
+
 
 def prepare_bundle(bundle):
     """Validate and prepare the bundle.
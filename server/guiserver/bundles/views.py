@@ -26,7 +26,9 @@ the API client. Each view receives the following arguments:
       - request.params: a dict representing the parameters sent by the client;
       - request.user: the current user (an instance of guiserver.auth.User);
     - deployer: a Deployer instance, ready to be used to schedule/start/observe
-      bundle deployments.
+      bundle deployments. When running multiple server workers, this is a
+      DeployerClient, whose methods return Futures: for this reason views
+      always wrap the Deployer results using guiserver.utils.maybe_future.
 
 The response returned by views must be a Future containing the response data as
 a dict-like object, e.g.:
@@ -62,14 +64,12 @@ using "yield", and they must return their results using "raise response(...)"
 
 import datetime
 import logging
-import uuid
 
 from jujubundlelib import (
     changeset,
     validation,
 )
 from tornado import gen
-from tornado.ioloop import IOLoop
 import yaml
 
 from guiserver.bundles.utils import (
@@ -77,6 +77,11 @@ from guiserver.bundles.utils import (
     require_authenticated_user,
     response,
 )
+from guiserver.tokens import (
+    DEFAULT_CAPACITY,
+    make_store,
+)
+from guiserver.utils import maybe_future
 
 
 def _validate_import_params(params):
@@ -151,15 +156,17 @@ def import_bundle(request, deployer):
         error = 'invalid request: invalid bundle {}: {}'.format(name, err)
         raise response(error=error)
     # Validate the bundle against the current state of the Juju environment.
-    err = yield deployer.validate(request.user, bundle)
+    err = yield deployer.validate(request.user, bundle, apiurl=request.apiurl)
     if err is not None:
         raise response(error='invalid request: {}'.format(err))
     # Add the bundle deployment to the Deployer queue.
     logging.info(
         'import_bundle: scheduling deployment of v{} bundle {!r}'
         ''.format(version, name))
-    deployment_id = deployer.import_bundle(
-        request.user, name, bundle, version, id_)
+    deployment_id = yield maybe_future(deployer.import_bundle(
+        request.user, name, bundle, version, id_, apiurl=request.apiurl))
+    if deployment_id is None:
+        raise response(error='unable to schedule the deployment')
     raise response({'DeploymentId': deployment_id})
 
 
@@ -179,7 +186,7 @@ def watch(request, deployer):
     if deployment_id is None:
         raise response(error='invalid request: invalid data parameters')
     # Retrieve a watcher identifier from the Deployer.
-    watcher_id = deployer.watch(deployment_id)
+    watcher_id = yield maybe_future(deployer.watch(deployment_id))
     if watcher_id is None:
         raise response(error='invalid request: deployment not found')
     logging.info('watch: deployment {} being observed by watcher {}'.format(
@@ -205,9 +212,12 @@ def next(request, deployer):
         raise response(error='invalid request: invalid data parameters')
     # Wait for the Deployer to send changes.
     logging.info('next: requested changes for watcher {}'.format(watcher_id))
-    changes = yield deployer.next(watcher_id)
+    changes = yield maybe_future(deployer.next(watcher_id))
     if changes is None:
         raise response(error='invalid request: invalid watcher identifier')
+    if isinstance(changes, basestring):
+        # The deployment history has been removed.
+        raise response(error='invalid request: {}'.format(changes))
     logging.info('next: returning changes for watcher {}:\n{}'.format(
         watcher_id, changes))
     raise response({'Changes': changes})
@@ -229,7 +239,7 @@ def cancel(request, deployer):
     if deployment_id is None:
         raise response(error='invalid request: invalid data parameters')
     # Use the Deployer instance to cancel the deployment.
-    err = deployer.cancel(deployment_id)
+    err = yield maybe_future(deployer.cancel(deployment_id))
     if err is not None:
         raise response(error='invalid request: {}'.format(err))
     logging.info('cancel: deployment {} cancelled'.format(deployment_id))
@@ -247,24 +257,39 @@ def status(request, deployer):
         params = ', '.join(request.params)
         error = 'invalid request: invalid data parameters: {}'.format(params)
         raise response(error=error)
-    last_changes = deployer.status()
+    last_changes = yield maybe_future(deployer.status())
     logging.info('status: returning last changes')
     raise response({'LastChanges': last_changes})
 
 
-# Map bundle tokens to the corresponding set of changes and the expire handle.
-_bundle_changesets = {}
 # Define the expiration timeout for a bundle token.
 _bundle_max_life = datetime.timedelta(minutes=2)
 
 
+def make_changeset_store(capacity=DEFAULT_CAPACITY, io_loop=None, path=None):
+    """Return a token store suitable for bundle change sets.
+
+    If a path is provided, change sets are stored in that directory, and
+    shared with the other server processes using it.
+    """
+    return make_store(
+        _bundle_max_life, path=path, capacity=capacity,
+        name='set change set', io_loop=io_loop)
+
+
+# Map bundle tokens to the corresponding set of changes. This store is used
+# when the views are not provided one.
+_bundle_changesets = make_changeset_store()
+
+
 @gen.coroutine
 @require_authenticated_user
-def get_changes(request):
+def get_changes(request, changesets=None):
     """Return a list of changes required to deploy a bundle.
 
     The bundle can be specified by either passing its YAML content or its
     unique identifier previously stored with a SetChanges request (see below).
+    If provided, changesets is the token store where change sets are kept.
 
     Request: 'GetChanges'.
     Parameters example: {
@@ -282,14 +307,14 @@ def get_changes(request):
     token = params.get('Token')
     if token is not None:
         # Retrieve the change set using the provided token.
-        data = _bundle_changesets.pop(token, None)
-        if data is None:
+        if changesets is None:
+            changesets = _bundle_changesets
+        changes = changesets.pop(token)
+        if changes is None:
             error = 'unknown, fulfilled, or expired bundle token'
             raise response(error=error)
         logging.info('get change set: using token {}'.format(token))
-        io_loop = IOLoop.current()
-        io_loop.remove_timeout(data['handle'])
-        raise response({'Changes': data['changes']})
+        raise response({'Changes': changes})
 
     # Retrieve the change set using the provided bundle content.
     content = params.get('YAML')
@@ -304,11 +329,12 @@ def get_changes(request):
 
 @gen.coroutine
 @require_authenticated_user
-def set_changes(request):
+def set_changes(request, changesets=None):
     """Store a change set for the provided bundle YAML content.
 
     Return a unique identifier that can be used to retrieve the change set
     later. The token expires in two minutes and can be only used once.
+    If provided, changesets is the token store where change sets are kept.
 
     Request: 'SetChanges'.
     Parameters example: {
@@ -324,19 +350,10 @@ def set_changes(request):
         raise response({'Errors': errors})
 
     # Create and store the bundle token.
-    token = uuid.uuid4().hex
-
-    def expire_token():
-        _bundle_changesets.pop(token, None)
-        logging.info('set change set: expired token {}'.format(token))
-
-    io_loop = IOLoop.current()
-    handle = io_loop.add_timeout(_bundle_max_life, expire_token)
+    if changesets is None:
+        changesets = _bundle_changesets
     now = datetime.datetime.utcnow()
-    _bundle_changesets[token] = {
-        'changes': changes,
-        'handle': handle,
-    }
+    token = changesets.add(changes)
     raise response({
         'Token': token,
         'Created': now.isoformat() + 'Z',
@@ -16,13 +16,58 @@
 
 """Juju GUI server websocket clients."""
 
+from collections import (
+    Counter,
+    deque,
+)
+import functools
+import logging
+
 from tornado import (
     httpclient,
     websocket,
 )
+from tornado.ioloop import (
+    IOLoop,
+    PeriodicCallback,
+)
+from tornado.iostream import (
+    IOStream,
+    SSLIOStream,
+    StreamClosedError,
+)
+
+from guiserver.keepalive import Keepalive
+from guiserver.metrics import (
+    POOL_CONNECT_TIME,
+    POOL_REQUESTS,
+)
+from guiserver.protocols import (
+    WebSocketProtocol,
+    make_client_offer,
+    negotiate_client,
+)
+from guiserver.utils import (
+    add_future,
+    get_write_buffer_size,
+    maybe_future,
+)
+
 
+# Define the maximum number of received messages stored for read_message().
+READ_QUEUE_SIZE = 100
+# Define the default number of idle connections kept ready for each target.
+DEFAULT_POOL_SIZE = 2
+# Define the default number of seconds after which idle connections to a
+# target no longer requested are closed.
+DEFAULT_POOL_IDLE_TIMEOUT = 300
+# Define the number of seconds between checks for expired pool targets.
+POOL_SWEEP_INTERVAL = 10
 
-def websocket_connect(io_loop, url, on_message_callback, headers=None):
+
+def websocket_connect(
+        io_loop, url, on_message_callback, headers=None,
+        compression_options=None, raw_text=False, keepalive_options=None):
     """WebSocket client connection factory.
 
     The client factory receives the following arguments:
@@ -31,7 +76,15 @@ def websocket_connect(io_loop, url, on_message_callback, headers=None):
         - on_message_callback: a callback that will be called each time
           a new message is received by the client;
         - headers (optional): a dict of additional headers to include in the
-          client handshake.
+          client handshake;
+        - compression_options (optional): the permessage-deflate compression
+          options (see guiserver.protocols). If not provided, compression is
+          not requested;
+        - raw_text (optional): whether text messages are passed to the
+          callback as UTF-8 encoded byte strings instead of unicode strings;
+        - keepalive_options (optional): the ping interval and timeout used
+          to detect dead connections (see guiserver.keepalive). If not
+          provided, the server is not pinged.
 
     Return a Future whose result is a WebSocketClientConnection.
     """
@@ -39,31 +92,405 @@ def websocket_connect(io_loop, url, on_message_callback, headers=None):
         url, validate_cert=False, request_timeout=100)
     if headers is not None:
         request.headers.update(headers)
-    conn = WebSocketClientConnection(io_loop, request, on_message_callback)
+    conn = WebSocketClientConnection(
+        io_loop, request, on_message_callback,
+        compression_options=compression_options, raw_text=raw_text,
+        keepalive_options=keepalive_options)
     return conn.connect_future
 
 
+class _PausableStreamMixin(object):
+    """Allow an IOStream to stop listening for read events.
+
+    While reading is paused, data is left in the kernel socket buffers, so
+    that TCP flow control eventually slows down the remote sender.
+    """
+
+    _reading_paused = False
+
+    def pause_reading(self):
+        """Stop reading from the socket."""
+        self._reading_paused = True
+        self._remove_read_state()
+
+    def resume_reading(self):
+        """Start reading from the socket again."""
+        self._reading_paused = False
+        if (self._state is not None) and not self.closed():
+            self._add_io_state(self.io_loop.READ)
+
+    def _add_io_state(self, state):
+        """See tornado.iostream.BaseIOStream._add_io_state."""
+        if self._reading_paused:
+            state &= ~self.io_loop.READ
+        super(_PausableStreamMixin, self)._add_io_state(state)
+
+    def _handle_events(self, fd, events):
+        """See tornado.iostream.BaseIOStream._handle_events.
+
+        Tornado IOStreams listen for read events even if no reads are pending:
+        avoid this while reading is paused.
+        """
+        super(_PausableStreamMixin, self)._handle_events(fd, events)
+        self._remove_read_state()
+
+    def _remove_read_state(self):
+        """Stop listening for read events if reading is paused."""
+        READ = self.io_loop.READ
+        if (
+            self._reading_paused and
+            (self._state is not None) and
+            (self._state & READ) and
+            not self.closed()
+        ):
+            self._state &= ~READ
+            self.io_loop.update_handler(self.fileno(), self._state)
+
+
+class _PausableIOStream(_PausableStreamMixin, IOStream):
+    """An IOStream whose reading can be paused."""
+
+
+class _PausableSSLIOStream(_PausableStreamMixin, SSLIOStream):
+    """An SSLIOStream whose reading can be paused."""
+
+
+# Map Tornado stream classes to the corresponding pausable ones.
+_PAUSABLE_STREAMS = {
+    IOStream: _PausableIOStream,
+    SSLIOStream: _PausableSSLIOStream,
+}
+
+
 class WebSocketClientConnection(websocket.WebSocketClientConnection):
     """WebSocket client connection supporting secure WebSockets.
 
     Use this connection as described in
     <http://www.tornadoweb.org/en/stable/websocket.html#client-side-support>.
+
+    Reading from the WebSocket server can be paused and resumed, e.g. when
+    messages cannot be delivered as fast as they are received. Messages are
+    compressed if compression options are provided and the server supports
+    the permessage-deflate extension. If raw_text is True, text messages are
+    received as UTF-8 encoded byte strings. If keepalive options are
+    provided, the server is pinged when silent, and the connection is closed
+    if the server does not respond.
     """
 
-    def __init__(self, io_loop, request, on_message_callback):
+    def __init__(
+            self, io_loop, request, on_message_callback,
+            compression_options=None, raw_text=False, keepalive_options=None):
         """Client initializer.
 
         The WebSocket client receives all the arguments accepted by
-        tornado.websocket.WebSocketClientConnection and a callback that will be
-        called each time a new message is received by the client.
+        tornado.websocket.WebSocketClientConnection, a callback that will be
+        called each time a new message is received by the client, the
+        optional compression options, whether to use raw text messages and
+        the optional keepalive options.
         """
+        self._compression_options = compression_options
+        self._raw_text = raw_text
+        self._keepalive = Keepalive(
+            io_loop, self._ping, self._on_expired, keepalive_options,
+            paused=lambda: self.reading_paused)
+        offer = make_client_offer(compression_options)
+        if offer is not None:
+            request.headers['Sec-WebSocket-Extensions'] = offer
         super(WebSocketClientConnection, self).__init__(io_loop, request)
         self._on_message_callback = on_message_callback
+        self.protocol = None
+        # Messages are also stored so that they can be retrieved by calling
+        # read_message(): only keep the most recent ones.
+        self.read_queue = deque(maxlen=READ_QUEUE_SIZE)
+
+    def _create_stream(self, addrinfo):
+        """See tornado.simple_httpclient._HTTPConnection._create_stream.
+
+        Tornado does not allow customizing the stream class: turn the stream
+        into a pausable one before it is connected.
+        """
+        stream = super(WebSocketClientConnection, self)._create_stream(
+            addrinfo)
+        stream.__class__ = _PAUSABLE_STREAMS[stream.__class__]
+        return stream
+
+    def _handle_1xx(self, code):
+        """See tornado.websocket.WebSocketClientConnection._handle_1xx.
+
+        This is a copy of the Tornado 3.2 implementation, using the GUI
+        server WebSocket protocol and handling compression negotiation.
+        """
+        assert code == 101
+        assert self.headers['Upgrade'].lower() == 'websocket'
+        assert self.headers['Connection'].lower() == 'upgrade'
+        accept = websocket.WebSocketProtocol13.compute_accept_value(self.key)
+        assert self.headers['Sec-Websocket-Accept'] == accept
+        deflate_params = negotiate_client(
+            self.headers.get('Sec-WebSocket-Extensions'),
+            self._compression_options)
+        self.protocol = WebSocketProtocol(
+            self, mask_outgoing=True,
+            compression_options=self._compression_options,
+            deflate_params=deflate_params, raw_text=self._raw_text)
+        self.protocol._receive_frame()
+        self._keepalive.start()
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self.connect_future.set_result(self)
+
+    @property
+    def reading_paused(self):
+        """Return True if reading from the server is paused."""
+        return (self.protocol is not None) and self.protocol.paused
+
+    def pause_reading(self):
+        """Stop reading messages from the WebSocket server."""
+        if self.protocol is not None:
+            self.protocol.pause()
+            self.stream.pause_reading()
+
+    def resume_reading(self):
+        """Restart reading messages from the WebSocket server."""
+        if self.protocol is not None:
+            self.stream.resume_reading()
+            self.protocol.resume()
+
+    def write_buffer_size(self):
+        """Return the number of bytes waiting to be sent to the server."""
+        return get_write_buffer_size(self.stream)
+
+    def close(self):
+        """Close the WebSocket connection.
+
+        Reading is resumed so that the closing handshake can be completed.
+        """
+        self.resume_reading()
+        super(WebSocketClientConnection, self).close()
 
     def on_message(self, message):
         """Hook called when a new message is received.
 
         The on_message_callback is called passing it the message.
         """
+        if message is None:
+            # The connection has been closed.
+            self._keepalive.stop()
+        else:
+            self._keepalive.received()
         super(WebSocketClientConnection, self).on_message(message)
         self._on_message_callback(message)
+
+    def on_pong(self, data):
+        """Hook called when a pong is received from the server."""
+        self._keepalive.received()
+
+    def _ping(self):
+        """Send a ping frame to the server."""
+        try:
+            self.protocol.write_ping(b'')
+        except StreamClosedError:
+            pass
+
+    def _on_expired(self, reason):
+        """Abort the connection if the server is not responding."""
+        logging.warning('websocket: closing connection to {}: {}'.format(
+            self.request.url, reason))
+        self.protocol._abort()
+
+
+class ConnectionPool(object):
+    """Keep WebSocket connections to the Juju API ready to be used.
+
+    Connections are established in advance, but are not logged in: they are
+    keyed by WebSocket URL (which includes the model uuid) and Origin header.
+    When a connection is requested, an idle one is returned if available,
+    and the pool is refilled in the background. The pool for a target is
+    only filled after a first connection to that target is requested.
+    When a target is not requested for idle_timeout seconds, its idle
+    connections are closed and the target is forgotten.
+    """
+
+    def __init__(
+            self, io_loop=None, size=DEFAULT_POOL_SIZE,
+            compression_options=None, raw_text=False, keepalive_options=None,
+            idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        """Initialize the pool.
+
+        Receive the maximum number of idle connections kept for each target,
+        the compression options, raw text flag and keepalive options used
+        when connecting (see websocket_connect), and the number of seconds
+        after which the connections to a target no longer requested are
+        closed.
+        """
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._size = size
+        self._compression_options = compression_options
+        self._raw_text = raw_text
+        self._keepalive_options = keepalive_options
+        self._idle_timeout = idle_timeout
+        self._idle = {}
+        self._warming = Counter()
+        # Map targets to the last time a connection was requested.
+        self._last_used = {}
+        # The sweep callback only runs while targets are known.
+        self._sweeper = None
+        # Collect pool statistics.
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._latencies = deque(maxlen=1000)
+
+    def connect(self, url, on_message_callback, headers=None):
+        """Return a Future whose result is a WebSocketClientConnection.
+
+        Arguments are the same as websocket_connect, except for the IO loop,
+        the compression options, the raw text flag and the keepalive options,
+        which are the ones of the pool.
+        """
+        key = _pool_key(url, headers)
+        self._last_used[key] = self._io_loop.time()
+        self._start_sweeper()
+        idle = self._idle.get(key, ())
+        while idle:
+            connection = idle.popleft()
+            if connection.stream.closed():
+                continue
+            connection._on_message_callback = on_message_callback
+            self.hits += 1
+            self._latencies.append(0)
+            POOL_REQUESTS.inc(result='hit')
+            POOL_CONNECT_TIME.observe(0)
+            self._fill(key, url, headers)
+            return maybe_future(connection)
+        self.misses += 1
+        POOL_REQUESTS.inc(result='miss')
+        future = websocket_connect(
+            self._io_loop, url, on_message_callback, headers=headers,
+            compression_options=self._compression_options,
+            raw_text=self._raw_text,
+            keepalive_options=self._keepalive_options)
+        add_future(
+            self._io_loop, future, self._on_connected, self._io_loop.time())
+        self._fill(key, url, headers)
+        return future
+
+    def _on_connected(self, start, future):
+        """Record the latency of a connection requested by a browser."""
+        if future.exception() is None:
+            latency = self._io_loop.time() - start
+            self._latencies.append(latency)
+            POOL_CONNECT_TIME.observe(latency)
+
+    def _fill(self, key, url, headers):
+        """Start connecting so that the pool for the given key is full."""
+        missing = self._size - len(self._idle.get(key, ())) - (
+            self._warming[key])
+        for _ in range(missing):
+            self._warming[key] += 1
+            future = websocket_connect(
+                self._io_loop, url, None, headers=headers,
+                compression_options=self._compression_options,
+                raw_text=self._raw_text,
+                keepalive_options=self._keepalive_options)
+            add_future(self._io_loop, future, self._on_warmed, key)
+
+    def _on_warmed(self, key, future):
+        """Add the resulting connection to the idle ones."""
+        self._warming[key] -= 1
+        if not self._warming[key]:
+            del self._warming[key]
+        try:
+            connection = future.result()
+        except Exception as err:
+            logging.warning(
+                'connection pool: unable to connect to {}: {}'.format(
+                    key[0], err))
+            return
+        if key not in self._last_used:
+            # The target expired or the pool was closed while connecting.
+            connection.close()
+            return
+        connection._on_message_callback = functools.partial(
+            self._on_idle_message, key, connection)
+        self._idle.setdefault(key, deque()).append(connection)
+
+    def _on_idle_message(self, key, connection, message):
+        """Handle messages received by idle connections."""
+        if message is not None:
+            logging.warning(
+                'connection pool: discarding message: {!r}'.format(message))
+            return
+        # The server closed the idle connection.
+        idle = self._idle.get(key, ())
+        if connection in idle:
+            idle.remove(connection)
+            if not idle:
+                del self._idle[key]
+
+    def sweep(self):
+        """Close the idle connections to targets no longer requested."""
+        oldest = self._io_loop.time() - self._idle_timeout
+        for key, last_used in self._last_used.items():
+            if last_used > oldest:
+                continue
+            del self._last_used[key]
+            connections = self._idle.pop(key, ())
+            for connection in connections:
+                connection.close()
+            self.expired += len(connections)
+            logging.info(
+                'connection pool: closed {} idle connections to {}'.format(
+                    len(connections), key[0]))
+        if not self._last_used:
+            self._stop_sweeper()
+
+    def _start_sweeper(self):
+        """Start closing expired connections periodically, if not running."""
+        if self._idle_timeout and (self._sweeper is None):
+            self._sweeper = PeriodicCallback(
+                self.sweep, POOL_SWEEP_INTERVAL * 1000, self._io_loop)
+            self._sweeper.start()
+
+    def _stop_sweeper(self):
+        """Stop closing expired connections."""
+        if self._sweeper is not None:
+            self._sweeper.stop()
+            self._sweeper = None
+
+    def get_info(self):
+        """Return a dict including the pool size and statistics.
+
+        Connect latencies, in seconds, are the ones observed by browsers for
+        the most recent connections.
+        """
+        requests = self.hits + self.misses
+        latencies = self._latencies
+        return {
+            'size': self._size,
+            'idle': sum(len(idle) for idle in self._idle.values()),
+            'connecting': sum(self._warming.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'hit_rate': float(self.hits) / requests if requests else 0,
+            'connect_latency_avg': (
+                sum(latencies) / len(latencies) if latencies else 0),
+            'connect_latency_max': max(latencies) if latencies else 0,
+        }
+
+    def close(self):
+        """Close all the idle connections."""
+        self._stop_sweeper()
+        self._last_used = {}
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+def _pool_key(url, headers):
+    """Return the pool key for the given URL and connection headers."""
+    return url, (headers or {}).get('Origin')
@@ -0,0 +1,196 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server AllWatcher delta coalescing.
+
+When a browser does not keep up with the model changes, sending it every
+AllWatcher Next response wastes bandwidth and GUI render passes: only the
+latest state of each entity is relevant. This module defines the following
+objects:
+
+    - coalesce(deltas, pending): merge deltas keeping only the latest one for
+      each entity;
+    - CoalesceMiddleware: while the browser connection is congested, answer
+      the browser Next requests with coalesced deltas. In the meanwhile, Next
+      requests are sent again to the Juju API on behalf of the browser, so
+      that the deltas are collected as soon as they are available.
+"""
+
+from collections import OrderedDict
+import logging
+
+
+# Map delta entity kinds to the entity field used as identifier. The name is
+# used for all the other kinds. Juju 2 uses lower case field names.
+_ENTITY_ID_FIELDS = {
+    'action': 'Id',
+    'annotation': 'Tag',
+    'block': 'Id',
+    'machine': 'Id',
+    'relation': 'Key',
+}
+
+
+def entity_key(kind, entity):
+    """Return the key identifying the given delta entity in a model."""
+    field = _ENTITY_ID_FIELDS.get(kind, 'Name')
+    return kind, entity.get(field, entity.get(field.lower()))
+
+
+def coalesce(deltas, pending=None):
+    """Merge the given deltas into the pending ones.
+
+    The pending deltas are an ordered dict mapping entity keys to deltas: if
+    not provided, a new one is created. Only the latest delta for each entity
+    is kept, in the position where it was received. Return the pending deltas.
+    """
+    if pending is None:
+        pending = OrderedDict()
+    for delta in deltas:
+        key = entity_key(delta[0], delta[2])
+        pending.pop(key, None)
+        pending[key] = delta
+    return pending
+
+
+class _Watcher(object):
+    """The coalescing state of a single AllWatcher."""
+
+    def __init__(self):
+        # The Next request data, used to send the request again.
+        self.request = None
+        # The id of the Next request sent to the Juju API, if any.
+        self.upstream_id = None
+        # The id of the Next request the browser is waiting a response for.
+        self.browser_id = None
+        # The last response and the deltas not yet sent to the browser.
+        self.response = None
+        self.pending = None
+
+
+class CoalesceMiddleware(object):
+    """Coalesce the AllWatcher deltas sent to a congested browser.
+
+    The write_browser and write_juju callables send a data dict to the
+    browser and to the Juju API respectively. The congested callable returns
+    True if the browser is not keeping up with the messages sent to it.
+    """
+
+    def __init__(self, write_browser, write_juju, congested):
+        self._write_browser = write_browser
+        self._write_juju = write_juju
+        self._congested = congested
+        # Map watcher ids to watchers, and ids of the Next requests sent to
+        # the Juju API to their watchers.
+        self._watchers = {}
+        self._requests = {}
+        # Count the Next responses coalesced so far.
+        self.coalesced = 0
+
+    def requested(self, data):
+        """Return True if data represents an AllWatcher Next request."""
+        return (
+            data.get('Type') == 'AllWatcher' and
+            data.get('Request') == 'Next' and
+            data.get('RequestId') is not None)
+
+    def process_request(self, data):
+        """Process a browser Next request.
+
+        Return True if the request must be sent to the Juju API, False if it
+        is handled here.
+        """
+        request_id = data['RequestId']
+        watcher = self._watchers.setdefault(data.get('Id'), _Watcher())
+        watcher.request = data
+        watcher.browser_id = request_id
+        if watcher.upstream_id is None:
+            # The watcher is not being coalesced: propagate the request.
+            watcher.upstream_id = request_id
+            self._requests[request_id] = watcher
+            return True
+        # A Next request sent on behalf of the browser is still pending.
+        if watcher.pending:
+            self._respond(watcher)
+        return False
+
+    def handles(self, request_id):
+        """Return True if the given response must be processed here."""
+        return request_id in self._requests
+
+    def process_response(self, data):
+        """Process a Juju API response to a Next request."""
+        request_id = data.get('RequestId')
+        watcher = self._requests.pop(request_id)
+        watcher.upstream_id = None
+        if 'Error' in data:
+            self._watchers.pop(watcher.request.get('Id'), None)
+            if watcher.browser_id is not None:
+                self._write_browser(dict(data, RequestId=watcher.browser_id))
+            return
+        response = data.get('Response') or {}
+        field = 'deltas' if 'deltas' in response else 'Deltas'
+        deltas = response.get(field) or []
+        if watcher.pending is not None:
+            self.coalesced += 1
+        watcher.response = data
+        watcher.pending = coalesce(deltas, watcher.pending)
+        if (watcher.browser_id is not None) and not self._congested():
+            self._respond(watcher)
+            return
+        # Ask for more deltas on behalf of the browser.
+        watcher.upstream_id = request_id
+        self._requests[request_id] = watcher
+        self._write_juju(dict(watcher.request, RequestId=request_id))
+
+    def waiting(self):
+        """Return True if coalesced deltas are waiting to be sent."""
+        return any(
+            watcher.pending and (watcher.browser_id is not None)
+            for watcher in self._watchers.values())
+
+    def flush(self):
+        """Send the coalesced deltas if the browser is no longer congested."""
+        if self._congested():
+            return
+        for watcher in self._watchers.values():
+            if watcher.pending and (watcher.browser_id is not None):
+                self._respond(watcher)
+
+    def reset(self):
+        """Forget all the watchers, e.g. when the Juju API is disconnected.
+
+        Return the ids of the browser Next requests still waiting for deltas.
+        """
+        waiting = [
+            watcher.browser_id for watcher in self._watchers.values()
+            if watcher.browser_id is not None]
+        self._watchers.clear()
+        self._requests.clear()
+        return waiting
+
+    def _respond(self, watcher):
+        """Send the pending deltas to the browser."""
+        data = watcher.response
+        response = dict(data.get('Response') or {})
+        field = 'deltas' if 'deltas' in response else 'Deltas'
+        response[field] = watcher.pending.values()
+        logging.debug('coalescing: sending {} deltas'.format(len(
+            watcher.pending)))
+        self._write_browser(
+            dict(data, RequestId=watcher.browser_id, Response=response))
+        watcher.browser_id = None
+        watcher.pending = None
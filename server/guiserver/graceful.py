@@ -0,0 +1,304 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server graceful shutdown and restart.
+
+Stopping the GUI server disconnects all the browsers at once, and all of them
+then retrieve the whole model from the Juju API at the same time. This module
+defines the following objects, used to avoid that:
+
+    - Drainer: stop accepting connections, close the WebSocket connections at
+      random times within a spread interval, using the 1012 "Service Restart"
+      close code, so that browsers do not reconnect all at once, and wait for
+      the running bundle deployments to complete;
+    - spawn_successor: start a new server process inheriting the listening
+      sockets, so that new connections are accepted while the current process
+      drains;
+    - inherited_sockets: return the listening sockets passed to the current
+      process;
+    - notify: send a state notification to systemd;
+    - install_signal_handlers: drain the server when receiving SIGTERM, and
+      also start a successor process before draining when receiving SIGHUP.
+
+Listening sockets are passed using the systemd socket activation protocol:
+the LISTEN_FDS, LISTEN_PID and LISTEN_FDNAMES environment variables describe
+the file descriptors starting from 3.
+"""
+
+import functools
+import logging
+import os
+import random
+import signal
+import socket
+import subprocess
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.platform.auto import set_close_exec
+
+from guiserver.bundles.utils import (
+    SCHEDULED,
+    STARTED,
+)
+from guiserver.utils import maybe_future
+
+
+# Define the WebSocket close code sent to browsers when draining.
+CLOSE_SERVICE_RESTART = 1012
+# Define the default number of seconds within which WebSocket connections are
+# closed, and the default maximum duration of the drain, in seconds.
+DEFAULT_DRAIN_SPREAD = 10
+DEFAULT_DRAIN_TIMEOUT = 60
+# Define the interval in seconds between checks for the drain completion.
+DRAIN_CHECK_INTERVAL = 0.5
+# Define the number of seconds a successor process must survive before the
+# current process starts draining.
+SUCCESSOR_CHECK_DELAY = 2
+# Define the first file descriptor used for passing listening sockets, and the
+# name used for sockets passed without a name.
+LISTEN_FDS_START = 3
+UNKNOWN_SOCKET = 'unknown'
+
+
+def inherited_sockets():
+    """Return the listening sockets passed to the current process.
+
+    Return a dict mapping socket names to lists of sockets. The environment
+    variables describing the sockets are removed, so that they are not
+    passed to child processes.
+    """
+    num_fds = os.environ.pop('LISTEN_FDS', None)
+    pid = os.environ.pop('LISTEN_PID', None)
+    names = os.environ.pop('LISTEN_FDNAMES', '').split(':')
+    if (num_fds is None) or (pid != str(os.getpid())):
+        return {}
+    sockets = {}
+    for num in range(int(num_fds)):
+        fd = LISTEN_FDS_START + num
+        name = (names[num] if num < len(names) else '') or UNKNOWN_SOCKET
+        sockets.setdefault(name, []).append(_socket_from_fd(fd))
+    return sockets
+
+
+def _socket_from_fd(fd):
+    """Return a non-blocking socket object for the given file descriptor.
+
+    The file descriptor is closed, as the socket object uses a duplicate.
+    """
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    # The address family is not known in advance: the address returned by
+    # getsockname only depends on the actual socket family.
+    if len(sock.getsockname()) == 4:
+        sock.close()
+        sock = socket.fromfd(fd, socket.AF_INET6, socket.SOCK_STREAM)
+    os.close(fd)
+    set_close_exec(sock.fileno())
+    sock.setblocking(0)
+    return sock
+
+
+def spawn_successor(command, named_sockets):
+    """Start the given command passing it the given listening sockets.
+
+    The sockets are provided as a list of (name, socket) tuples. All the other
+    file descriptors, including the ones of the active connections, are not
+    inherited by the new process. Return the subprocess.Popen instance.
+    """
+    fds = [sock.fileno() for _, sock in named_sockets]
+    names = ':'.join(name for name, _ in named_sockets)
+    first_free = LISTEN_FDS_START + len(fds)
+
+    def prepare():
+        # Move the listening sockets to the expected file descriptors, first
+        # duplicating them above the target range so that none is overwritten.
+        # This is executed in the new process before the command is executed.
+        base = max(fds + [first_free]) + 1
+        moved = []
+        for num, fd in enumerate(fds):
+            os.dup2(fd, base + num)
+            moved.append(base + num)
+        for num, fd in enumerate(moved):
+            os.dup2(fd, LISTEN_FDS_START + num)
+        os.closerange(first_free, subprocess.MAXFD)
+        os.environ['LISTEN_FDS'] = str(len(fds))
+        os.environ['LISTEN_PID'] = str(os.getpid())
+        os.environ['LISTEN_FDNAMES'] = names
+
+    return subprocess.Popen(command, preexec_fn=prepare)
+
+
+def notify(state):
+    """Send the given state to systemd, e.g. "READY=1".
+
+    Return True if the notification has been sent, False if the process is not
+    run by a systemd notify service.
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # This is an abstract namespace socket.
+        address = '\0' + address[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(state, address)
+    except socket.error as err:
+        logging.warning('unable to notify systemd: {}'.format(err))
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class Drainer(object):
+    """Drain the server before stopping it.
+
+    Receive the HTTP servers to stop, the set of active WebSocket handlers
+    and the bundle deployer. WebSocket connections are closed at random times
+    within spread seconds. The drain completes when all the connections are
+    closed and no deployments are running, or after timeout seconds.
+    """
+
+    def __init__(
+            self, servers, connections, deployer, io_loop=None,
+            spread=DEFAULT_DRAIN_SPREAD, timeout=DEFAULT_DRAIN_TIMEOUT):
+        self._servers = servers
+        self._connections = connections
+        self._deployer = deployer
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._spread = spread
+        self._timeout = timeout
+        self.draining = False
+
+    @gen.coroutine
+    def drain(self):
+        """Drain the server. Return a Future fired when done."""
+        self.draining = True
+        io_loop = self._io_loop
+        for server in self._servers:
+            server.stop()
+        connections = list(self._connections)
+        logging.info('draining: closing {} WebSocket connections'.format(
+            len(connections)))
+        now = io_loop.time()
+        for connection in connections:
+            close = functools.partial(
+                connection.close, CLOSE_SERVICE_RESTART, 'service restart')
+            io_loop.add_timeout(now + random.uniform(0, self._spread), close)
+        deadline = now + self._timeout
+        while True:
+            busy = yield self._busy()
+            if not busy:
+                logging.info('draining: completed')
+                return
+            if io_loop.time() >= deadline:
+                logging.warning('draining: timed out: {}'.format(busy))
+                return
+            yield gen.Task(
+                io_loop.add_timeout, io_loop.time() + DRAIN_CHECK_INTERVAL)
+
+    @gen.coroutine
+    def _busy(self):
+        """Return a Future whose result describes what is still running.
+
+        The result is an empty string if the drain is completed.
+        """
+        reasons = []
+        if len(self._connections):
+            reasons.append('{} WebSocket connections'.format(
+                len(self._connections)))
+        try:
+            status = yield maybe_future(self._deployer.status())
+        except Exception as err:
+            logging.warning(
+                'draining: unable to retrieve the deployments: {}'.format(err))
+            status = []
+        running = [
+            change for change in status
+            if change.get('Status') in (SCHEDULED, STARTED)]
+        if running:
+            reasons.append('{} deployments'.format(len(running)))
+        raise gen.Return(', '.join(reasons))
+
+
+@gen.coroutine
+def shutdown(drainer, io_loop, command=None, named_sockets=()):
+    """Drain the server and then stop the given IO loop.
+
+    If a command is provided, start it as the successor of the current
+    process, passing it the given (name, socket) listening sockets. In this
+    case the server is not drained if the successor exits immediately, e.g.
+    because its options are not valid. Return a Future fired when done.
+    """
+    if command is not None:
+        process = spawn_successor(command, named_sockets)
+        yield gen.Task(
+            io_loop.add_timeout, io_loop.time() + SUCCESSOR_CHECK_DELAY)
+        if process.poll() is not None:
+            logging.error(
+                'the new server process exited with code {}: '
+                'not restarting'.format(process.returncode))
+            raise gen.Return(False)
+    else:
+        notify('STOPPING=1')
+    yield drainer.drain()
+    io_loop.stop()
+    raise gen.Return(True)
+
+
+def install_signal_handlers(drainer, io_loop, command=None, named_sockets=()):
+    """Shut down the server when SIGTERM or SIGHUP are received.
+
+    On SIGTERM, drain the server and stop the IO loop. On SIGHUP, if a command
+    is provided, also start a successor process inheriting the given (name,
+    socket) listening sockets (see the shutdown function above). If a command
+    is not provided, SIGHUP is ignored.
+    """
+    # Store the shutdown in progress, if any.
+    running = []
+
+    def done(future):
+        if not future.result():
+            # The restart failed: another one can be requested.
+            del running[:]
+
+    def start(restart):
+        if running:
+            logging.info('shutdown already in progress')
+            return
+        if restart:
+            logging.info('restarting the server')
+            future = shutdown(drainer, io_loop, command, named_sockets)
+        else:
+            logging.info('stopping the server')
+            future = shutdown(drainer, io_loop)
+        running.append(future)
+        io_loop.add_future(future, done)
+
+    def handle_sigterm(signum, frame):
+        io_loop.add_callback_from_signal(start, False)
+
+    def handle_sighup(signum, frame):
+        io_loop.add_callback_from_signal(start, True)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if command is None:
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    else:
+        signal.signal(signal.SIGHUP, handle_sighup)
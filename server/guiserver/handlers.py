@@ -16,7 +16,10 @@
 
 """Juju GUI server HTTP/HTTPS handlers."""
 
-from collections import deque
+from collections import (
+    deque,
+    OrderedDict,
+)
 import logging
 import os
 import time
@@ -29,7 +32,9 @@ from tornado import (
     web,
     websocket,
 )
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 
 from guiserver import get_version
 from guiserver.auth import (
@@ -41,12 +46,44 @@ from guiserver.bundles.base import (
     DeployMiddleware,
 )
 from guiserver.clients import websocket_connect
+from guiserver.coalescing import CoalesceMiddleware
+from guiserver.keepalive import (
+    EXPIRED_NO_RESPONSE,
+    Keepalive,
+)
+from guiserver.metrics import (
+    CLIENT_TO_JUJU,
+    CONTENT_TYPE,
+    JUJU_REQUEST_TIME,
+    JUJU_TO_CLIENT,
+    WEBSOCKET_BYTES,
+    WEBSOCKET_CONNECTIONS,
+    WEBSOCKET_DECODE_TIME,
+    WEBSOCKET_FRAME_SIZE,
+    WEBSOCKET_FRAMES,
+    WEBSOCKET_PROCESSING_TIME,
+    WEBSOCKET_QUEUE_TIME,
+)
+from guiserver.protocols import WebSocketProtocol
+from guiserver.snapshots import (
+    model_key,
+    SnapshotMiddleware,
+)
 from guiserver.utils import (
     clone_request,
+    get_api_urls,
     get_headers,
     get_juju_api_url,
+    get_write_buffer_size,
+    is_json_object,
     join_url,
     json_decode_dict,
+    json_encode,
+    leading_request_id,
+    log_frame,
+    maybe_future,
+    message_types,
+    request_info,
     request_summary,
     wrap_write_message,
 )
@@ -54,10 +91,128 @@ from guiserver.utils import (
 
 # Define the path to the fallback charm icon hosted by charmworld.
 DEFAULT_CHARM_ICON_PATH = '/static/img/charm_160.svg'
+# Define the types of the browser requests handled by the GUI server itself.
+INTERCEPTED_TYPES = frozenset(['ChangeSet', 'Deployer', 'GUIToken'])
+# Before the user is authenticated, login requests are intercepted as well.
+INTERCEPTED_TYPES_ANONYMOUS = INTERCEPTED_TYPES.union(['Admin'])
+# When coalescing deltas or caching model snapshots, AllWatcher requests are
+# intercepted as well.
+WATCHER_TYPES = frozenset(['AllWatcher'])
+# Define the default number of bytes buffered for the browser above which
+# reading from the Juju API is paused (high watermark), and below which it is
+# resumed (low watermark).
+DEFAULT_HIGH_WATERMARK = 4 * 1024 * 1024
+DEFAULT_LOW_WATERMARK = 1024 * 1024
+# Define the default maximum number of browser messages queued while the
+# connection to the Juju API is being established.
+DEFAULT_QUEUE_SIZE = 1000
+# Define the policies applied when the message queue is full: either the
+# oldest queued message is dropped or the browser is disconnected.
+OVERFLOW_DROP = 'drop'
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_DISCONNECT)
+# Define the interval in seconds between browser buffer checks while reading
+# from the Juju API is paused.
+BUFFER_CHECK_INTERVAL = 0.1
+# Define the delays in seconds between attempts to reconnect to the Juju API
+# (doubled after each failure), and the maximum number of attempts.
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+RECONNECT_MAX_ATTEMPTS = 10
+# Define the error sent to the browser for the requests lost when the Juju API
+# connection is closed.
+JUJU_CONNECTION_LOST_ERROR = 'Juju API connection lost'
+# Define the request id used when logging in again after a reconnection.
+RELOGIN_REQUEST_ID = 0
+# Define the maximum number of pending requests tracked for each browser in
+# order to measure the Juju API latency.
+MAX_TRACKED_REQUESTS = 1000
+# Define the number of seconds browsers are asked to wait before connecting
+# again when their WebSocket connection is refused.
+REJECTION_RETRY_AFTER = 5
+
+
+def _record_frame(direction, message):
+    """Update the frame metrics for the given message."""
+    size = len(message)
+    WEBSOCKET_FRAMES.inc(direction=direction)
+    WEBSOCKET_BYTES.inc(size, direction=direction)
+    WEBSOCKET_FRAME_SIZE.observe(size, direction=direction)
 
 
 class _WebSocketBaseHandler(websocket.WebSocketHandler):
-    """Base WebSocket handler defining shared methods."""
+    """Base WebSocket handler defining shared methods.
+
+    Subclasses can enable message compression by setting compression_options
+    (see guiserver.protocols) before the connection is accepted. They can
+    also set raw_text to True to receive text messages as UTF-8 encoded byte
+    strings, or set rejection to a reason string in order to refuse the
+    connection with a "503 Service Unavailable" response.
+    """
+
+    compression_options = None
+    raw_text = False
+    rejection = None
+
+    def _execute(self, transforms, *args, **kwargs):
+        """See tornado.websocket.WebSocketHandler._execute.
+
+        This is a copy of the Tornado 3.2 implementation, using the GUI
+        server WebSocket protocol for RFC 6455 connections.
+        """
+        self.open_args = args
+        self.open_kwargs = kwargs
+        headers = self.request.headers
+        error = None
+        # The connection is refused if the server is overloaded.
+        if self.rejection is not None:
+            error = ('503 Service Unavailable\r\nRetry-After: {}\r\n\r\n'
+                     '{}'.format(REJECTION_RETRY_AFTER, self.rejection))
+        # WebSocket only supports the GET method.
+        elif self.request.method != 'GET':
+            error = '405 Method Not Allowed\r\n\r\n'
+        # The Upgrade header should be present and equal to WebSocket.
+        elif headers.get('Upgrade', '').lower() != 'websocket':
+            error = ('400 Bad Request\r\n\r\n'
+                     'Can "Upgrade" only to "WebSocket".')
+        # The Connection header should be upgrade. Some proxy servers and
+        # load balancers might mess with it.
+        elif 'upgrade' not in [
+                value.strip().lower()
+                for value in headers.get('Connection', '').split(',')]:
+            error = ('400 Bad Request\r\n\r\n'
+                     '"Connection" must be "Upgrade".')
+        if error is not None:
+            self.stream.write(escape.utf8('HTTP/1.1 ' + error))
+            self.stream.close()
+            return
+        if headers.get('Sec-WebSocket-Version') in ('7', '8', '13'):
+            self.ws_connection = WebSocketProtocol(
+                self, compression_options=self.compression_options,
+                raw_text=self.raw_text)
+            self.ws_connection.accept_connection()
+        elif (self.allow_draft76() and
+              'Sec-WebSocket-Version' not in headers):
+            self.ws_connection = websocket.WebSocketProtocol76(self)
+            self.ws_connection.accept_connection()
+        else:
+            self.stream.write(escape.utf8(
+                'HTTP/1.1 426 Upgrade Required\r\n'
+                'Sec-WebSocket-Version: 8\r\n\r\n'))
+            self.stream.close()
+
+    def close(self, code=None, reason=None):
+        """Close the WebSocket connection.
+
+        The optional status code and reason are sent to the browser, unless
+        the connection uses the draft76 protocol.
+        """
+        if self.ws_connection:
+            if isinstance(self.ws_connection, WebSocketProtocol):
+                self.ws_connection.close(code, reason)
+            else:
+                self.ws_connection.close()
+            self.ws_connection = None
 
     def select_subprotocol(self, subprotocols):
         """Return the first sub-protocol sent by the client.
@@ -94,47 +249,201 @@ class WebSocketHandler(_WebSocketBaseHandler):
 
     Methods:
       - write_message(message): send a message to the browser;
-      - close(): terminate the browser connection.
+      - close(): terminate the browser connection;
+      - get_buffer_info(): return information about the connection buffers.
+
+    When the browser does not keep up with the messages sent by Juju, i.e.
+    more than high_watermark bytes are waiting to be sent to the browser,
+    reading from the Juju API is paused until the buffered data drops below
+    low_watermark bytes. Messages sent by the browser before the Juju API
+    connection is established are queued: when more than queue_size messages
+    are queued, the overflow_policy is applied, either dropping the oldest
+    queued message or disconnecting the browser.
+
+    When reconnection is enabled, a lost Juju API connection is established
+    again, trying all the API server addresses received when logging in, and
+    the user is logged in again with the stored credentials. Browser messages
+    are queued as described above until the user is logged in again.
+
+    When coalescing is enabled and more than low_watermark bytes are waiting
+    to be sent to the browser, AllWatcher deltas are not sent as soon as they
+    are received: only the latest delta for each entity is sent when the
+    browser catches up (see guiserver.coalescing).
+
+    When a model cache is provided, the first AllWatcher Next request is
+    answered using the cached model snapshot, if available, while the Juju
+    API retrieves the whole model (see guiserver.snapshots).
+
+    When an admission control is provided, new sessions exceeding its limits
+    are refused before connecting to the Juju API (see guiserver.admission).
+
+    When keepalive options are provided, both the browser and the Juju API
+    are pinged when silent, and connections whose peer does not respond are
+    closed. When an idle timeout is set, sessions with no browser messages
+    for that many seconds are closed (see guiserver.keepalive).
     """
 
     @gen.coroutine
     def initialize(
             self, apiurl, auth_backend, deployer, tokens, ws_source_template,
-            ws_target_template, io_loop=None):
+            ws_target_template, io_loop=None, connections=None,
+            high_watermark=DEFAULT_HIGH_WATERMARK,
+            low_watermark=DEFAULT_LOW_WATERMARK, queue_size=DEFAULT_QUEUE_SIZE,
+            overflow_policy=OVERFLOW_DISCONNECT, compression_options=None,
+            multiplexer=None, pool=None, reconnect=False, coalesce=False,
+            model_cache=None, passthrough=False, admission=None,
+            keepalive_options=None, idle_timeout=0, changesets=None):
         """Initialize the WebSocket server.
 
         Create a new WebSocket client and connect it to the Juju API.
         Set up the authentication system.
         Handle the queued messages.
+        If a connections set is provided, register this handler there for as
+        long as the browser is connected.
+        If compression options are provided, messages exchanged with both the
+        browser and the Juju API are compressed, if the peers support it.
+        If a multiplexer is provided, the connection to the Juju API is
+        established when the first message is received from the browser, so
+        that browsers logging in to the same model with the same credentials
+        can share the same upstream connection.
+        If a connection pool is provided, dedicated connections to the Juju
+        API are retrieved from the pool.
+        If reconnect is True, the Juju API connection is established again
+        when lost after the user logged in, possibly using another API server
+        address, without disconnecting the browser.
+        If coalesce is True, AllWatcher deltas sent to a congested browser are
+        coalesced.
+        If a model cache is provided, model snapshots are stored there and
+        used to answer the first AllWatcher Next requests.
+        If passthrough is True, text messages are proxied as UTF-8 encoded
+        byte strings, without decoding and encoding them again.
+        If an admission control is provided, the connection is refused if
+        the limits on the active and new sessions are exceeded.
+        If keepalive options are provided, they are used to detect dead
+        browser and Juju API connections. If idle_timeout is not zero, the
+        session is closed when the browser does not send messages for that
+        many seconds.
+        If provided, changesets is the token store where bundle change sets
+        are kept (see guiserver.bundles.views).
         """
+        self.compression_options = compression_options
+        self.raw_text = passthrough
         if io_loop is None:
             io_loop = IOLoop.current()
         self._io_loop = io_loop
         self._summary = request_summary(self.request) + ' '
+        # Apply the limits on active and new sessions.
+        self._admission = admission
+        self._admitted = False
+        if admission is not None:
+            self.rejection = admission.acquire(self.request.remote_ip)
+            if self.rejection is not None:
+                logging.warning(
+                    self._summary + 'client refused: ' + self.rejection)
+                return
+            self._admitted = True
         logging.info(self._summary + 'client connected')
         self.connected = True
         self.juju_connected = False
-        self._juju_message_queue = queue = deque()
+        self.juju_connection = None
+        self._juju_message_queue = deque()
+        # Store when queued messages were received, and when pending requests
+        # were sent to Juju, in order to collect metrics.
+        self._juju_message_times = deque()
+        self._request_times = OrderedDict()
+        # Set up the buffering limits.
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        self._queue_size = queue_size
+        self._overflow_policy = overflow_policy
+        # Set up the dead and idle connections detection. Checks start when
+        # the browser connection is established.
+        self._keepalive_options = keepalive_options
+        self._keepalive = Keepalive(
+            io_loop, self._ping_browser, self._on_browser_expired,
+            keepalive_options, idle_timeout)
+        self._connections = connections
+        if connections is not None:
+            connections.add(self)
         # Set up the authentication infrastructure.
         self.tokens = tokens
         write_message = wrap_write_message(self)
         self.user = User()
         self.auth = AuthMiddleware(
             self.user, auth_backend, tokens, write_message)
-        # Set up the bundle deployment and change set infrastructure.
-        self.deployment = DeployMiddleware(self.user, deployer, write_message)
-        self.changeset = ChangeSetMiddleware(self.user, write_message)
+        self._auth_backend = auth_backend
+        # Set up the bundle change set infrastructure.
+        self.changeset = ChangeSetMiddleware(
+            self.user, write_message, changesets)
+        # Set up the AllWatcher deltas coalescing.
+        self._coalescer = None
+        self._coalesce_check_scheduled = False
+        if coalesce:
+            self._coalescer = CoalesceMiddleware(
+                write_message, self._write_juju, self._browser_congested)
         apiurl = get_juju_api_url(
             self.request.path, ws_source_template, ws_target_template, apiurl)
         # Juju requires the Origin header to be included in the WebSocket
         # client handshake request. Propagate the client origin if present;
         # use the Juju API server as origin otherwise.
-        headers = get_headers(self.request, apiurl)
-        # Connect the WebSocket client to the Juju API server.
-        self._juju_connected_future = websocket_connect(
-            io_loop, apiurl, self.on_juju_message, headers=headers)
+        self._apiurl = apiurl
+        self._headers = get_headers(self.request, apiurl)
+        # Set up the bundle deployment infrastructure. Bundles are deployed to
+        # the model the browser is connected to.
+        self.deployment = DeployMiddleware(
+            self.user, deployer, write_message, apiurl=apiurl)
+        # Set up the model snapshots cache.
+        self._snapshots = None
+        if model_cache is not None:
+            self._snapshots = SnapshotMiddleware(
+                model_cache, model_key(apiurl), write_message)
+        self._multiplexer = multiplexer
+        self._pool = pool
+        self._juju_connected_future = None
+        # Set up the reconnection infrastructure.
+        self._reconnect = reconnect
+        self._apiurls = [apiurl]
+        self._relogin_future = None
+        # Set up the browser requests dispatch table.
+        self._routes = self._make_routes()
+        if multiplexer is None:
+            # Connect the WebSocket client to the Juju API server.
+            yield self._connect_juju(None)
+
+    def _connect_juju(self, data):
+        """Start connecting to the Juju API server.
+
+        When multiplexing, use the given first browser request (decoded, or
+        None) to look for a shared connection to the Juju API.
+        """
+        future = None
+        if self._multiplexer is not None:
+            future = self._multiplexer.connect(
+                self._apiurl, data, self.on_juju_message,
+                headers=self._headers,
+                compression_options=self.compression_options,
+                keepalive_options=self._keepalive_options)
+        if future is None:
+            future = self._open_juju_connection(self._apiurl)
+        self._juju_connected_future = future
+        return self._wait_for_juju(future)
+
+    def _open_juju_connection(self, apiurl):
+        """Return a Future whose result is a dedicated Juju API connection."""
+        if self._pool is not None:
+            return self._pool.connect(
+                apiurl, self.on_juju_message, headers=self._headers)
+        return websocket_connect(
+            self._io_loop, apiurl, self.on_juju_message,
+            headers=self._headers,
+            compression_options=self.compression_options,
+            raw_text=self.raw_text, keepalive_options=self._keepalive_options)
+
+    @gen.coroutine
+    def _wait_for_juju(self, future):
+        """Wait for the Juju API connection, then handle queued messages."""
         try:
-            self.juju_connection = yield self._juju_connected_future
+            self.juju_connection = yield future
         except Exception as err:
             logging.error(self._summary + 'unable to connect to the Juju API')
             logging.exception(err)
@@ -142,15 +451,46 @@ class WebSocketHandler(_WebSocketBaseHandler):
             return
         # At this point the Juju API is successfully connected.
         self.juju_connected = True
-        logging.info(self._summary + 'Juju API connected: {}'.format(apiurl))
-        # Send all the messages that have been enqueued before the connection
-        # to the Juju API server was established.
+        logging.info(
+            self._summary + 'Juju API connected: {}'.format(self._apiurl))
+        self._flush_queue()
+
+    def _flush_queue(self):
+        """Send the messages queued while the Juju API was not connected."""
+        queue = self._juju_message_queue
+        now = time.time()
         while self.connected and self.juju_connected and len(queue):
             message = queue.popleft()
-            encoded = message.encode('utf-8')
-            logging.debug(self._summary + 'queue -> juju: {}'.format(encoded))
+            WEBSOCKET_QUEUE_TIME.observe(
+                now - self._juju_message_times.popleft())
+            log_frame(self._summary, 'queue -> juju', message)
             self.juju_connection.write_message(message)
 
+    def open(self):
+        """Hook called when the browser connection is established."""
+        self._keepalive.start()
+
+    def on_pong(self, data):
+        """Hook called when a pong is received from the browser."""
+        self._keepalive.received()
+
+    def _ping_browser(self):
+        """Send a ping frame to the browser."""
+        try:
+            self.ping(b'')
+        except StreamClosedError:
+            pass
+
+    def _on_browser_expired(self, reason):
+        """Close the session if the browser is dead or idle."""
+        logging.warning(self._summary + 'closing session: ' + reason)
+        if reason == EXPIRED_NO_RESPONSE:
+            # The connection is likely half-open: do not wait for the closing
+            # handshake to complete.
+            self.ws_connection._abort()
+            return
+        self.close()
+
     def on_message(self, message):
         """Hook called when a new message is received from the browser.
 
@@ -159,71 +499,445 @@ class WebSocketHandler(_WebSocketBaseHandler):
         Otherwise the message is propagated to the Juju API server.
         Messages sent before the client connection to the Juju API server is
         established are queued for later delivery.
+        Only messages possibly handled by the GUI server are decoded: all the
+        others are propagated as they are.
         """
-        data = json_decode_dict(message)
-        encoded = None
-        if data is not None:
-            # Handle change set requests.
-            if self.changeset.requested(data):
-                return self.changeset.process_request(data)
-            # Handle deployment requests.
-            if self.deployment.requested(data):
-                return self.deployment.process_request(data)
-            # Handle authentication requests.
-            if not self.user.is_authenticated:
-                new_data = self.auth.process_request(data)
+        start = time.time()
+        _record_frame(CLIENT_TO_JUJU, message)
+        self._keepalive.activity()
+        try:
+            return self._process_browser_message(message)
+        finally:
+            WEBSOCKET_PROCESSING_TIME.observe(
+                time.time() - start, direction=CLIENT_TO_JUJU)
+
+    def _make_routes(self):
+        """Return the browser requests dispatch table.
+
+        The table maps (Type, Request) pairs to the methods handling the
+        corresponding requests. Those methods receive the decoded request and
+        return a (data, result) tuple: data is the request to be propagated
+        to the Juju API server, or None if the request has been handled by
+        the GUI server, in which case result is returned by on_message.
+        """
+        routes = {}
+        for request in self.changeset.routes:
+            routes['ChangeSet', request] = self._route_changeset
+        for request in self.deployment.routes:
+            routes['Deployer', request] = self._route_deployment
+        routes['GUIToken', 'Create'] = self._route_token
+        routes['Admin', 'Login'] = self._route_login
+        routes['GUIToken', 'Login'] = self._route_login
+        if (self._snapshots is not None) or (self._coalescer is not None):
+            routes['AllWatcher', 'Next'] = self._route_watcher_next
+        return routes
+
+    def _route_changeset(self, data):
+        """Handle change set requests."""
+        return None, self.changeset.process_request(data)
+
+    def _route_deployment(self, data):
+        """Handle deployment requests."""
+        return None, self.deployment.process_request(data)
+
+    def _route_token(self, data):
+        """Handle authentication token requests."""
+        return None, self.tokens.process_token_request(
+            data, self.user, wrap_write_message(self))
+
+    def _route_login(self, data):
+        """Handle authentication requests.
+
+        The login request can be modified, e.g. when authenticating with a
+        token. No request is propagated if a response has been already sent.
+        """
+        if self.user.is_authenticated:
+            return data, None
+        return self.auth.process_request(data), None
+
+    def _route_watcher_next(self, data):
+        """Handle AllWatcher Next requests.
+
+        Requests are processed by the model snapshots cache if enabled, and
+        then by the deltas coalescer if enabled.
+        """
+        if data.get('RequestId') is None:
+            return data, None
+        snapshots = self._snapshots
+        if (snapshots is not None) and self.user.is_authenticated:
+            if not snapshots.process_request(data):
+                return None, None
+        coalescer = self._coalescer
+        if (coalescer is not None) and not coalescer.process_request(data):
+            return None, None
+        return data, None
+
+    def _process_browser_message(self, message):
+        """Handle the given browser message as described in on_message.
+
+        Decoded requests are dispatched to the GUI server handlers in one
+        lookup (see _make_routes): all the other messages are propagated.
+        """
+        data = None
+        if self._must_inspect(message):
+            data = self._decode(message, CLIENT_TO_JUJU)
+        if (data is not None) and ('RequestId' in data):
+            route = self._routes.get((data.get('Type'), data.get('Request')))
+            if route is not None:
+                new_data, result = route(data)
                 if new_data is None:
-                    # The None marker indicates that a response was sent.
-                    return
-                elif new_data != data:
-                    encoded = escape.json_encode(new_data)
-                    message = encoded.decode('utf8')
-            # Handle authentication token requests.
-            if self.tokens.token_requested(data):
-                return self.tokens.process_token_request(
-                    data, self.user, wrap_write_message(self))
+                    # The request has been handled by the GUI server.
+                    return result
+                elif new_data is not data:
+                    data = new_data
+                    message = json_encode(data).decode('utf8')
         # Propagate messages to the Juju API server.
-        if encoded is None:
-            encoded = message.encode('utf-8')
+        self._track_request(message, data)
         if self.juju_connected:
-            logging.debug(self._summary + 'client -> juju: {}'.format(encoded))
+            log_frame(self._summary, 'client -> juju', message)
             return self.juju_connection.write_message(message)
-        logging.debug(self._summary + 'client -> queue: {}'.format(encoded))
-        self._juju_message_queue.append(message)
+        queue = self._juju_message_queue
+        if len(queue) >= self._queue_size:
+            if self._overflow_policy == OVERFLOW_DISCONNECT:
+                logging.error(
+                    self._summary + 'message queue full: disconnecting')
+                return self.close()
+            queue.popleft()
+            self._juju_message_times.popleft()
+            logging.warning(
+                self._summary + 'message queue full: dropping oldest message')
+        log_frame(self._summary, 'client -> queue', message)
+        queue.append(message)
+        self._juju_message_times.append(time.time())
+        if self._juju_connected_future is None:
+            # The connection is established lazily when multiplexing.
+            self._connect_juju(data)
+
+    def _decode(self, message, direction):
+        """Decode the given JSON message, recording the time spent."""
+        start = time.time()
+        data = json_decode_dict(message)
+        WEBSOCKET_DECODE_TIME.observe(
+            time.time() - start, direction=direction)
+        return data
+
+    def _track_request(self, message, data):
+        """Record when the given request is sent to Juju.
+
+        The request data is used if the message was decoded.
+        """
+        if data is None:
+            request_id, request_type, request = request_info(message)
+        else:
+            request_id = data.get('RequestId')
+            request_type, request = data.get('Type'), data.get('Request')
+        if request_id is None:
+            return
+        times = self._request_times
+        if len(times) >= MAX_TRACKED_REQUESTS:
+            # Responses to the oldest requests are probably never arriving.
+            times.popitem(last=False)
+        times[request_id] = time.time(), request_type or '', request or ''
+
+    def _must_inspect(self, message):
+        """Return True if the given browser message must be decoded.
+
+        The message types are collected without decoding the whole message.
+        Messages not looking like JSON objects are decoded anyway, so that the
+        decoding error is reported.
+        """
+        if not is_json_object(message):
+            return True
+        if self.user.is_authenticated:
+            intercepted = INTERCEPTED_TYPES
+        else:
+            intercepted = INTERCEPTED_TYPES_ANONYMOUS
+        if (self._coalescer is not None) or (self._snapshots is not None):
+            intercepted = intercepted.union(WATCHER_TYPES)
+        return not intercepted.isdisjoint(message_types(message))
 
     def on_juju_message(self, message):
         """Hook called when a new message is received from the Juju API server.
 
-        The message is propagated to the browser.
+        The message is propagated to the browser. Only responses to pending
+        login requests are decoded, together with AllWatcher responses when
+        coalescing deltas or caching model snapshots: all the other messages,
+        including the possibly huge AllWatcher deltas, are propagated as they
+        are.
         """
+        if self._relogin_future is not None:
+            # This is the response to the login request sent after
+            # reconnecting, or None if the new connection was lost.
+            future, self._relogin_future = self._relogin_future, None
+            return future.set_result(message)
         if message is None:
             # The Juju API closed the connection.
             return self.on_juju_close()
-        data = json_decode_dict(message)
-        if (data is not None) and self.auth.in_progress():
-            encoded = escape.json_encode(
-                self.auth.process_response(data))
-            message = encoded.decode('utf8')
-        else:
-            encoded = message.encode('utf-8')
-        logging.debug(self._summary + 'juju -> client: {}'.format(encoded))
+        start = time.time()
+        _record_frame(JUJU_TO_CLIENT, message)
+        request_id = leading_request_id(message)
+        data = None
+        snapshots = self._snapshots
+        if (snapshots is not None) and snapshots.handles(request_id):
+            data = self._decode(message, JUJU_TO_CLIENT)
+            if (data is not None) and not snapshots.process_response(
+                    data, len(message)):
+                return self._record_response(request_id, start)
+        coalescer = self._coalescer
+        if (coalescer is not None) and coalescer.handles(request_id):
+            if data is None:
+                data = self._decode(message, JUJU_TO_CLIENT)
+            if data is not None:
+                coalescer.process_response(data)
+                self._check_coalesced()
+                return self._record_response(request_id, start)
+        data = None
+        if self.auth.in_progress():
+            # If the request id is not found at the beginning of the message,
+            # fall back to decoding the whole message.
+            if (request_id is None) or self.auth.in_progress(request_id):
+                data = self._decode(message, JUJU_TO_CLIENT)
+        if data is not None:
+            request_id = data.get('RequestId')
+            data = self.auth.process_response(data)
+            if self._reconnect and self.user.is_authenticated:
+                self._update_api_urls(data)
+            message = json_encode(data).decode('utf8')
+        log_frame(self._summary, 'juju -> client', message)
         self.write_message(message)
+        self._check_browser_buffer()
+        self._record_response(request_id, start)
+
+    def _record_response(self, request_id, start):
+        """Update the metrics for a Juju message processed since start."""
+        now = time.time()
+        sent = self._request_times.pop(request_id, None)
+        if sent is not None:
+            sent_time, request_type, request = sent
+            JUJU_REQUEST_TIME.observe(
+                now - sent_time, type=request_type, request=request)
+        WEBSOCKET_PROCESSING_TIME.observe(
+            now - start, direction=JUJU_TO_CLIENT)
+
+    def _check_browser_buffer(self):
+        """Pause reading from Juju if the browser is falling behind."""
+        connection = self.juju_connection
+        if (connection is None) or connection.reading_paused:
+            return
+        size = get_write_buffer_size(self.stream)
+        if size > self._high_watermark:
+            logging.warning(
+                self._summary + 'browser falling behind ({} bytes buffered): '
+                'pausing Juju API reads'.format(size))
+            connection.pause_reading()
+            self._schedule_buffer_check()
+
+    def _schedule_buffer_check(self):
+        """Check the browser buffer again after a short delay."""
+        self._io_loop.add_timeout(
+            self._io_loop.time() + BUFFER_CHECK_INTERVAL,
+            self._check_browser_drained)
+
+    def _check_browser_drained(self):
+        """Resume reading from Juju if the browser buffer is drained enough."""
+        if not (self.connected and self.juju_connected):
+            return
+        size = get_write_buffer_size(self.stream)
+        if size > self._low_watermark:
+            return self._schedule_buffer_check()
+        logging.info(self._summary + 'resuming Juju API reads')
+        self.juju_connection.resume_reading()
+
+    def _browser_congested(self):
+        """Return True if data is waiting to be sent to the browser."""
+        return get_write_buffer_size(self.stream) > self._low_watermark
+
+    def _write_juju(self, data):
+        """Send the given data to the Juju API, if connected."""
+        if self.juju_connected:
+            self.juju_connection.write_message(json_encode(data))
+
+    def _check_coalesced(self):
+        """Send the coalesced deltas as soon as the browser catches up."""
+        if self._coalesce_check_scheduled or not self._coalescer.waiting():
+            return
+        self._coalesce_check_scheduled = True
+        self._io_loop.add_timeout(
+            self._io_loop.time() + BUFFER_CHECK_INTERVAL,
+            self._flush_coalesced)
+
+    def _flush_coalesced(self):
+        """Send the coalesced deltas if the browser is no longer congested."""
+        self._coalesce_check_scheduled = False
+        if not self.connected:
+            return
+        self._coalescer.flush()
+        self._check_coalesced()
+
+    def get_buffer_info(self):
+        """Return a dict describing the current state of connection buffers.
+
+        The resulting dict includes the number of bytes waiting to be sent to
+        the browser and to Juju, the number of queued messages and whether
+        reading from Juju is paused.
+        """
+        connection = self.juju_connection
+        return {
+            'browser_buffer': get_write_buffer_size(self.stream),
+            'juju_buffer': (
+                0 if connection is None else connection.write_buffer_size()),
+            'queued_messages': len(self._juju_message_queue),
+            'juju_paused': (
+                False if connection is None else connection.reading_paused),
+        }
+
+    def _update_api_urls(self, data):
+        """Store the API server addresses included in a login response."""
+        response = data.get('Response', data.get('response')) or {}
+        servers = response.get('Servers', response.get('servers'))
+        if servers:
+            self._apiurls = get_api_urls(self._apiurl, servers)
+
+    @gen.coroutine
+    def _reconnect_juju(self):
+        """Connect to the Juju API again, logging in as the current user.
+
+        Try the known API server addresses in turn, waiting longer after each
+        failure. Browser messages are queued in the meanwhile. Disconnect the
+        browser if the connection cannot be established or the login fails.
+        """
+        delay = RECONNECT_MIN_DELAY
+        for attempt in range(RECONNECT_MAX_ATTEMPTS):
+            if attempt:
+                yield gen.Task(
+                    self._io_loop.add_timeout, self._io_loop.time() + delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            if not self.connected:
+                return
+            apiurl = self._apiurls[attempt % len(self._apiurls)]
+            try:
+                connection = yield self._open_juju_connection(apiurl)
+            except Exception as err:
+                logging.warning(
+                    self._summary + 'unable to reconnect to {}: {}'.format(
+                        apiurl, err))
+                continue
+            if not self.connected:
+                connection.close()
+                return
+            logged_in = yield self._relogin(connection)
+            if not self.connected:
+                connection.close()
+                return
+            if logged_in is None:
+                # The connection was lost again.
+                continue
+            if not logged_in:
+                logging.error(self._summary + 'unable to log in again')
+                connection.close()
+                break
+            self.juju_connection = connection
+            self.juju_connected = True
+            logging.info(
+                self._summary + 'Juju API reconnected: {}'.format(apiurl))
+            self._flush_queue()
+            return
+        else:
+            logging.error(self._summary + 'unable to reconnect to Juju')
+        self.close()
+
+    @gen.coroutine
+    def _relogin(self, connection):
+        """Log in again using the given connection.
+
+        Return a Future whose result is True if the login succeeded, False if
+        it failed and None if the connection was lost in the meanwhile.
+        """
+        backend = self._auth_backend
+        request = backend.make_request(
+            RELOGIN_REQUEST_ID, self.user.username, self.user.password)
+        self._relogin_future = future = Future()
+        connection.write_message(json_encode(request))
+        message = yield future
+        if message is None:
+            raise gen.Return(None)
+        data = json_decode_dict(message)
+        raise gen.Return(
+            (data is not None) and backend.login_succeeded(data))
 
     def on_close(self):
         """Hook called when the WebSocket connection is terminated."""
         logging.info(self._summary + 'client connection closed')
         self.connected = False
+        self._keepalive.stop()
+        self._release_admission()
+        if self._connections is not None:
+            self._connections.discard(self)
+        if self._snapshots is not None:
+            self._snapshots.close()
         # At this point the WebSocket client connection to the Juju API server
         # might not yet be established. For this reason the connection is
         # terminated adding a callback to the corresponding future.
-        callback = lambda _: self.juju_connection.close()
-        self._io_loop.add_future(self._juju_connected_future, callback)
+        future = self._juju_connected_future
+        if future is None:
+            # No message was sent to the Juju API.
+            return
+
+        def callback(_):
+            if self.juju_connection is not None:
+                self.juju_connection.close()
+        self._io_loop.add_future(future, callback)
+
+    def on_connection_close(self):
+        """See tornado.websocket.WebSocketHandler.on_connection_close.
+
+        Also release the session when the browser disconnects before the
+        WebSocket connection is established.
+        """
+        super(WebSocketHandler, self).on_connection_close()
+        self._release_admission()
+
+    def _release_admission(self):
+        """Release the session acquired from the admission control, if any."""
+        if self._admitted:
+            self._admitted = False
+            self._admission.release(self.request.remote_ip)
+
+    def _fail_requests(self, waiting):
+        """Send an error response for the requests lost with the Juju API.
+
+        The responses to the requests sent to the closed connection will never
+        arrive, so the browser is notified instead of waiting forever, e.g.
+        for the next AllWatcher deltas. The waiting argument includes the ids
+        of the Next requests parked by the middlewares.
+        """
+        request_ids = list(self._request_times)
+        request_ids.extend(i for i in waiting if i not in self._request_times)
+        self._request_times.clear()
+        for request_id in request_ids:
+            self.write_message(json_encode({
+                'RequestId': request_id,
+                'Error': JUJU_CONNECTION_LOST_ERROR,
+                'Response': {},
+            }))
 
     def on_juju_close(self):
         """Hook called when the WebSocket connection to Juju is terminated."""
         logging.info(self._summary + 'Juju API connection closed')
         self.juju_connected = False
         self.juju_connection = None
+        # Pending Next requests are lost with the connection.
+        waiting = []
+        if self._coalescer is not None:
+            waiting.extend(self._coalescer.reset())
+        if self._snapshots is not None:
+            waiting.extend(self._snapshots.close())
+        if self.connected and self._reconnect and self.user.is_authenticated:
+            logging.warning(self._summary + 'Juju API connection lost: '
+                            'reconnecting')
+            self._fail_requests(waiting)
+            self._reconnect_juju()
+            return
         # Usually the Juju API connection is terminated as a consequence of a
         # browser disconnection. A server disconnection is unexpected and
         # unlikely to happen. In the future Juju will support HA and we will
@@ -401,34 +1115,92 @@ class JujuProxyHandler(ProxyHandler):
 class InfoHandler(web.RequestHandler):
     """Return information about the GUI server."""
 
-    def initialize(self, apiurl, apiversion, deployer, sandbox, start_time):
-        """Initialize the handler."""
+    def initialize(
+            self, apiurl, apiversion, deployer, sandbox, start_time,
+            connections=None, pool=None, model_cache=None, admission=None,
+            tokens=None, changesets=None):
+        """Initialize the handler.
+
+        If provided, connections is the set of active WebSocket handlers,
+        used to report their buffers, pool is the Juju API connection pool,
+        used to report its statistics, model_cache is the cache of model
+        snapshots, used to report its size, and admission is the WebSocket
+        admission control, used to report the current occupancy. The tokens
+        handler and the change sets store are used to report the number of
+        stored tokens.
+        """
         self.apiurl = apiurl
         self.apiversion = apiversion
         self.deployer = deployer
         self.sandbox = sandbox
         self.start_time = start_time
+        self.connections = connections
+        self.pool = pool
+        self.model_cache = model_cache
+        self.admission = admission
+        self.tokens = tokens
+        self.changesets = changesets
 
+    @gen.coroutine
     def get_info(self, settings):
-        return {
+        """Return a Future whose result is the GUI server info dict."""
+        deployer_status = yield maybe_future(self.deployer.status())
+        connections = self.connections or ()
+        raise gen.Return({
+            'admission': (
+                None if self.admission is None
+                else self.admission.get_info()),
             'apiurl': self.apiurl,
             'apiversion': self.apiversion,
+            'changesets': (
+                None if self.changesets is None
+                else self.changesets.get_info()),
+            'connection_pool': (
+                None if self.pool is None else self.pool.get_info()),
+            'connections': [
+                connection.get_buffer_info() for connection in connections],
             'debug': settings.get('debug', False),
-            'deployer': self.deployer.status(),
+            'deployer': deployer_status,
+            'model_cache': (
+                None if self.model_cache is None
+                else self.model_cache.get_info()),
             'sandbox': self.sandbox,
+            'tokens': None if self.tokens is None else self.tokens.get_info(),
             'uptime': int(time.time()) - self.start_time,
             'version': get_version(),
-        }
+        })
 
+    @gen.coroutine
     def get(self):
         """Handle GET requests."""
-        info = self.get_info(self.application.settings)
+        info = yield self.get_info(self.application.settings)
         # In Tornado Web handlers, just writing a dict JSON encodes the
         # response contents and sets the proper content type header
         # (application/json; charset=UTF-8).
         self.write(info)
 
 
+class MetricsHandler(web.RequestHandler):
+    """Return the GUI server metrics using the Prometheus text format."""
+
+    def initialize(self, registry, connections=None):
+        """Initialize the handler.
+
+        The registry includes the metrics to be exposed (see
+        guiserver.metrics). If provided, connections is the set of active
+        WebSocket handlers, used to report the number of connected browsers.
+        """
+        self.registry = registry
+        self.connections = connections
+
+    def get(self):
+        """Handle GET requests."""
+        if self.connections is not None:
+            WEBSOCKET_CONNECTIONS.set(len(self.connections))
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(self.registry.render())
+
+
 class HttpsRedirectHandler(web.RequestHandler):
     """Permanently redirect all the requests to the equivalent HTTPS URL."""
 
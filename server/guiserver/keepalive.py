@@ -0,0 +1,122 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server WebSocket keepalive.
+
+Stale browser tabs and half-open TCP connections can keep both the browser
+and the Juju API connections open indefinitely. The Keepalive defined here
+periodically pings silent WebSocket peers, and reports connections whose
+peer did not respond in time, or which did not receive messages for too long.
+
+Keepalive is configured using a dict like the following:
+
+    {'interval': 30, 'timeout': 10}
+
+where interval is the number of seconds without incoming frames after which
+a ping is sent, and timeout is the number of seconds the peer has to respond
+before the connection is considered dead.
+"""
+
+from tornado.ioloop import PeriodicCallback
+
+
+# Define the reasons why a connection is expired.
+EXPIRED_NO_RESPONSE = 'no response to keepalive pings'
+EXPIRED_IDLE = 'idle timeout'
+
+
+class Keepalive(object):
+    """Ping a WebSocket peer and detect dead or idle connections.
+
+    Receive the IO loop, a ping callable sending a ping frame to the peer, and
+    an on_expired callable, called passing the reason why the connection
+    expired. If keepalive options are provided (see the module docstring),
+    pings are sent to peers with no incoming frames. If idle_timeout is not
+    zero, connections with no activity for idle_timeout seconds are expired.
+    If provided, the paused callable returns True when reading from the peer
+    is paused: in this case the peer is assumed to be alive.
+    """
+
+    def __init__(
+            self, io_loop, ping, on_expired, keepalive_options=None,
+            idle_timeout=0, paused=None):
+        self._io_loop = io_loop
+        self._ping = ping
+        self._on_expired = on_expired
+        options = keepalive_options or {}
+        self.interval = options.get('interval', 0)
+        self.timeout = options.get('timeout', 0)
+        self.idle_timeout = idle_timeout
+        self._paused = paused
+        now = io_loop.time()
+        self._last_received = self._last_activity = now
+        self._pinged = False
+        self._callback = None
+        period = min(
+            [value for value in (self.interval, self.timeout, idle_timeout)
+             if value] or [0])
+        if period:
+            self._callback = PeriodicCallback(
+                self._check, period * 1000, io_loop=io_loop)
+
+    @property
+    def enabled(self):
+        """Return True if either pings or the idle timeout are enabled."""
+        return self._callback is not None
+
+    def start(self):
+        """Start checking the connection."""
+        if self._callback is not None:
+            self._callback.start()
+
+    def stop(self):
+        """Stop checking the connection, e.g. when it is closed."""
+        if self._callback is not None:
+            self._callback.stop()
+
+    def received(self):
+        """Record that a frame (including pongs) was received from the peer."""
+        self._last_received = self._io_loop.time()
+        self._pinged = False
+
+    def activity(self):
+        """Record that a message was received from the peer."""
+        self.received()
+        self._last_activity = self._last_received
+
+    def _check(self):
+        """Ping the peer if required, or expire the connection."""
+        now = self._io_loop.time()
+        if (self._paused is not None) and self._paused():
+            # Pongs cannot be received while reading is paused.
+            self.received()
+        if self.idle_timeout and (
+                now - self._last_activity >= self.idle_timeout):
+            self._expire(EXPIRED_IDLE)
+            return
+        if not self.interval:
+            return
+        silence = now - self._last_received
+        if self._pinged and (silence >= self.interval + self.timeout):
+            self._expire(EXPIRED_NO_RESPONSE)
+        elif (not self._pinged) and (silence >= self.interval):
+            self._pinged = True
+            self._ping()
+
+    def _expire(self, reason):
+        """Stop checking the connection and report its expiration."""
+        self.stop()
+        self._on_expired(reason)
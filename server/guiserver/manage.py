@@ -16,27 +16,69 @@
 
 """Juju GUI server management."""
 
+import atexit
 import logging
 import os
+import shlex
+import shutil
+import signal
 import sys
+import tempfile
+import weakref
 
 from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import (
+    bind_sockets,
+    bind_unix_socket,
+)
 from tornado.options import (
     define,
     options,
     parse_command_line,
 )
+from tornado.process import fork_processes
 
 import guiserver
 from guiserver.apps import (
     redirector,
     server,
 )
+from guiserver.bundles.base import (
+    DEFAULT_HISTORY_AGE,
+    DEFAULT_HISTORY_SIZE,
+    DEFAULT_VALIDATION_CACHE_SIZE,
+    make_deployer,
+)
+from guiserver.bundles.ipc import (
+    DeployerClient,
+    DeployerServer,
+)
+from guiserver import (
+    clients,
+    graceful,
+    protocols,
+    tokens,
+    utils,
+)
+from guiserver.handlers import (
+    DEFAULT_HIGH_WATERMARK,
+    DEFAULT_LOW_WATERMARK,
+    DEFAULT_QUEUE_SIZE,
+    OVERFLOW_DISCONNECT,
+    OVERFLOW_POLICIES,
+)
 
 
 DEFAULT_API_VERSION = 'go'
 DEFAULT_SSL_PATH = '/etc/ssl/juju-gui'
+MAX_WORKERS = 64
+# Define the names of the listening sockets passed to successor processes.
+SERVER_SOCKETS = 'server'
+REDIRECTOR_SOCKETS = 'redirector'
+# Define the memory file system where workers share tokens by default.
+SHARED_MEMORY_PATH = '/dev/shm'
 
 
 def _add_debug(logger):
@@ -161,20 +203,403 @@ def setup():
         'gzip', type=bool, default=False,
         help='Enable gzip compression in the gui.')
     define('gtm', type=bool, default=False, help='Enable Google tag manager.')
+    define(
+        'workers', type=int, default=1,
+        help='The number of server processes to fork. Workers share the '
+             'listening sockets, and bundle deployments are coordinated by '
+             'the first worker. Defaults to a single process.')
+    define(
+        'wshighwatermark', type=int, default=DEFAULT_HIGH_WATERMARK,
+        help='The number of bytes waiting to be sent to a browser above which '
+             'the server stops reading from the Juju API connection.')
+    define(
+        'wslowwatermark', type=int, default=DEFAULT_LOW_WATERMARK,
+        help='The number of bytes waiting to be sent to a browser below which '
+             'the server restarts reading from the Juju API connection.')
+    define(
+        'wsqueuesize', type=int, default=DEFAULT_QUEUE_SIZE,
+        help='The maximum number of browser messages queued while the '
+             'connection to the Juju API is established.')
+    define(
+        'wsoverflowpolicy', type=str, default=OVERFLOW_DISCONNECT,
+        help='What to do when the browser message queue is full: "drop" the '
+             'oldest message or "disconnect" (default) the browser.')
+    define(
+        'wscompression', type=bool, default=False,
+        help='Set to True to enable the permessage-deflate compression of '
+             'WebSocket messages exchanged with browsers and the Juju API. '
+             'This reduces bandwidth at the cost of CPU time and memory: '
+             'with the default window size, each proxied connection keeps '
+             'compression and decompression contexts of about 300KB for '
+             'each side.')
+    define(
+        'wscompressionlevel', type=int,
+        default=protocols.DEFAULT_COMPRESSION_LEVEL,
+        help='The zlib compression level (1-9) of WebSocket messages.')
+    define(
+        'wscompressionwindowbits', type=int,
+        default=protocols.DEFAULT_WINDOW_BITS,
+        help='The base two logarithm of the compression window size (9-15). '
+             'Lower values reduce the memory used by each connection.')
+    define(
+        'wscompressionminsize', type=int, default=protocols.DEFAULT_MIN_SIZE,
+        help='The size in bytes below which WebSocket messages are not '
+             'compressed.')
+    define(
+        'wsmultiplex', type=bool, default=False,
+        help='Set to True to share a single Juju API connection between '
+             'browsers logged in to the same model as the same user.')
+    define(
+        'wslogincache', type=int, default=0,
+        help='The number of seconds shared Juju API connections are kept '
+             'logged in after the last browser using them disconnects, so '
+             'that returning users are not logged in to Juju again. Only '
+             'used when wsmultiplex is enabled. Set to 0 to disable.')
+    define(
+        'wspoolsize', type=int, default=0,
+        help='The number of connections to each Juju API model kept ready '
+             'for new browser connections (e.g. {}). By default the pool is '
+             'disabled.'.format(clients.DEFAULT_POOL_SIZE))
+    define(
+        'wspoolidletimeout', type=int,
+        default=clients.DEFAULT_POOL_IDLE_TIMEOUT,
+        help='The number of seconds after which the pooled connections to a '
+             'Juju API model no longer requested are closed. Set to 0 to '
+             'keep them open.')
+    define(
+        'wsreconnect', type=bool, default=False,
+        help='Set to True to reconnect to the Juju API, possibly using '
+             'another API server, when the connection is lost, instead of '
+             'disconnecting the browser.')
+    define(
+        'wscachesize', type=int, default=0,
+        help='The maximum memory in MB used to cache model snapshots, used '
+             'to send the model to new browser sessions without waiting for '
+             'the Juju API. Set to 0 to disable the cache.')
+    define(
+        'wscoalesce', type=bool, default=False,
+        help='Set to True to only send the latest change of each model '
+             'entity to browsers not keeping up with the model changes.')
+    define(
+        'wspassthrough', type=bool, default=False,
+        help='Set to True to proxy WebSocket text messages as raw bytes, '
+             'without decoding and validating their UTF-8 encoding.')
+    define(
+        'wsmaxsessions', type=int, default=0,
+        help='The maximum number of concurrent WebSocket sessions handled by '
+             'each worker. Set to 0 for no limit.')
+    define(
+        'wsmaxsessionsperip', type=int, default=0,
+        help='The maximum number of concurrent WebSocket sessions from the '
+             'same remote address handled by each worker. Set to 0 for no '
+             'limit.')
+    define(
+        'wssessionrate', type=int, default=0,
+        help='The maximum number of new WebSocket sessions accepted per '
+             'second by each worker. Set to 0 for no limit.')
+    define(
+        'wspinginterval', type=int, default=0,
+        help='The number of seconds without incoming frames after which the '
+             'browser and the Juju API are pinged. Set to 0 to disable '
+             'keepalive pings.')
+    define(
+        'wspingtimeout', type=int, default=10,
+        help='The number of seconds the browser and the Juju API have to '
+             'respond to a ping before their connection is closed.')
+    define(
+        'wsidletimeout', type=int, default=0,
+        help='The number of seconds after which sessions with no messages '
+             'from the browser are closed. Set to 0 to disable.')
+    define(
+        'wslogsize', type=int, default=0,
+        help='The maximum number of characters logged for each WebSocket '
+             'frame when debug logging is enabled. Set to 0 to log whole '
+             'frames.')
+    define(
+        'wslogsample', type=int, default=1,
+        help='Only log one WebSocket frame every wslogsample frames when '
+             'debug logging is enabled.')
+    define(
+        'deployworkers', type=int, default=1,
+        help='The maximum number of bundle deployments run in parallel, each '
+             'one in a separate process. Deployments to the same model are '
+             'always run one at a time.')
+    define(
+        'validateworkers', type=int, default=1,
+        help='The maximum number of bundle validations run in parallel, each '
+             'one in a separate process.')
+    define(
+        'validatecache', type=int, default=DEFAULT_VALIDATION_CACHE_SIZE,
+        help='The maximum number of bundle validation results cached for a '
+             'short time, so that importing the same bundle again into the '
+             'same model is faster. Set to 0 to disable the cache.')
+    define(
+        'deployjournal', type=str,
+        help='The directory where bundle deployments are recorded, so that '
+             'their history is preserved and unfinished deployments are '
+             'resumed when the server is restarted. The journal includes the '
+             'credentials used to deploy bundles. If not set, deployments '
+             'are only kept in memory.')
+    define(
+        'deployhistoryage', type=int, default=DEFAULT_HISTORY_AGE,
+        help='The number of seconds the status of completed and cancelled '
+             'bundle deployments is kept. Set to 0 for no limit.')
+    define(
+        'deployhistory', type=int, default=DEFAULT_HISTORY_SIZE,
+        help='The maximum number of completed and cancelled bundle '
+             'deployments whose status is kept. When the limit is reached, '
+             'the oldest ones are discarded. Set to 0 for no limit.')
+    define(
+        'tokencapacity', type=int, default=tokens.DEFAULT_CAPACITY,
+        help='The maximum number of authentication tokens and of bundle '
+             'change sets stored by each worker. When the limit is reached, '
+             'the oldest ones are discarded. Set to 0 for no limit.')
+    define(
+        'tokenstore', type=str,
+        help='The directory where authentication tokens and bundle change '
+             'sets are stored, so that they can be shared by multiple GUI '
+             'server processes on this host. A directory in a memory file '
+             'system (e.g. /dev/shm/guiserver) is recommended. By default '
+             'tokens are kept in memory, or in a temporary directory in {} '
+             'when running multiple workers.'.format(SHARED_MEMORY_PATH))
+    define(
+        'graceful', type=bool, default=False,
+        help='Set to True to drain the server on SIGTERM: new connections are '
+             'refused, WebSocket connections are closed at random times and '
+             'running bundle deployments are completed before exiting. On '
+             'SIGHUP, a new server process inheriting the listening sockets '
+             'is started before draining. Restarting on SIGHUP is not '
+             'supported when running multiple workers.')
+    define(
+        'drainspread', type=int, default=graceful.DEFAULT_DRAIN_SPREAD,
+        help='The number of seconds within which WebSocket connections are '
+             'closed when draining the server.')
+    define(
+        'draintimeout', type=int, default=graceful.DEFAULT_DRAIN_TIMEOUT,
+        help='The maximum number of seconds spent draining the server.')
+    define(
+        'restartcommand', type=str,
+        help='The command used to start the new server process on SIGHUP. '
+             'By default the server is started again with the same '
+             'arguments.')
+    define(
+        'jsoncodec', type=str, default=utils.JSON_CODEC_AUTO,
+        help='The JSON codec used to encode and decode messages: one of '
+             '{}. By default the fastest installed codec is used.'.format(
+                 ', '.join(utils.JSON_CODECS)))
     # In Tornado, parsing the options also sets up the default logger.
     parse_command_line()
     _validate_choices('apiversion', ('go', 'python'))
+    _validate_choices('wsoverflowpolicy', OVERFLOW_POLICIES)
+    _validate_choices(
+        'jsoncodec', (utils.JSON_CODEC_AUTO,) + utils.JSON_CODECS)
     _validate_range('port', 1, 65535)
+    _validate_range('workers', 1, MAX_WORKERS)
+    _validate_range('wshighwatermark', 1, sys.maxint)
+    _validate_range('wslowwatermark', 0, options.wshighwatermark)
+    _validate_range('wsqueuesize', 1, sys.maxint)
+    _validate_range('wscompressionlevel', 1, 9)
+    _validate_range(
+        'wscompressionwindowbits',
+        protocols.MIN_WINDOW_BITS, protocols.MAX_WINDOW_BITS)
+    _validate_range('wscompressionminsize', 0, sys.maxint)
+    _validate_range('wspoolsize', 0, sys.maxint)
+    _validate_range('wspoolidletimeout', 0, sys.maxint)
+    _validate_range('wscachesize', 0, sys.maxint)
+    _validate_range('wslogincache', 0, sys.maxint)
+    _validate_range('wsmaxsessions', 0, sys.maxint)
+    _validate_range('wsmaxsessionsperip', 0, sys.maxint)
+    _validate_range('wssessionrate', 0, sys.maxint)
+    _validate_range('wspinginterval', 0, sys.maxint)
+    _validate_range('wspingtimeout', 1, sys.maxint)
+    _validate_range('wsidletimeout', 0, sys.maxint)
+    _validate_range('wslogsize', 0, sys.maxint)
+    _validate_range('wslogsample', 1, sys.maxint)
+    _validate_range('deployworkers', 1, sys.maxint)
+    _validate_range('validateworkers', 1, sys.maxint)
+    _validate_range('validatecache', 0, sys.maxint)
+    _validate_range('deployhistoryage', 0, sys.maxint)
+    _validate_range('deployhistory', 0, sys.maxint)
+    _validate_range('tokencapacity', 0, sys.maxint)
+    _validate_range('drainspread', 0, sys.maxint)
+    _validate_range('draintimeout', 0, sys.maxint)
     _add_debug(logging.getLogger())
+    try:
+        codec = utils.set_json_codec(options.jsoncodec)
+    except ImportError:
+        sys.exit('error: the {} JSON codec is not installed'.format(
+            options.jsoncodec))
+    logging.info('using the {} JSON codec'.format(codec))
+    utils.set_frame_logging(options.wslogsize, options.wslogsample)
     # Configure the asynchronous HTTP client used by proxy handlers.
     AsyncHTTPClient.configure(
         'tornado.curl_httpclient.CurlAsyncHTTPClient', max_clients=20)
 
 
+def _remove_on_exit(path):
+    """Remove the given directory when the current process exits.
+
+    Processes forked after calling this function do not remove it.
+    """
+    pid = os.getpid()
+
+    def remove():
+        if os.getpid() == pid:
+            shutil.rmtree(path, ignore_errors=True)
+
+    atexit.register(remove)
+
+
+def _exit(signum, frame):
+    """Exit the process, running the registered exit functions."""
+    sys.exit(0)
+
+
+def _start_workers(port, ssl_options, redirect):
+    """Fork the worker processes and start the applications in each of them.
+
+    The listening sockets are bound before forking, so that all the workers
+    share them and the kernel distributes incoming connections among them.
+    The first worker owns the bundle Deployer, which is exposed to the other
+    workers through a UNIX socket (see guiserver.bundles.ipc). Unless a token
+    store directory is specified, the workers share authentication tokens and
+    change sets in a temporary directory in a memory file system, so that
+    user credentials are never written to disk (see guiserver.tokens).
+
+    This function returns in each child process. The parent process only
+    monitors the children, restarting them if they exit unexpectedly, and
+    removes the temporary directories when exiting.
+
+    In graceful mode, each worker is drained when receiving SIGTERM, and the
+    parent process exits when all the workers are done: in this case SIGTERM
+    must be sent to all the processes in the group, as systemd does.
+    """
+    sockets = bind_sockets(port)
+    redirector_sockets = bind_sockets(80) if redirect else []
+    tmpdir = tempfile.mkdtemp()
+    _remove_on_exit(tmpdir)
+    deployer_path = os.path.join(tmpdir, 'deployer.sock')
+    if not options.tokenstore:
+        # Tokens created by a worker must be usable by the others.
+        if os.path.isdir(SHARED_MEMORY_PATH):
+            options.tokenstore = tempfile.mkdtemp(
+                prefix='guiserver-', dir=SHARED_MEMORY_PATH)
+            _remove_on_exit(options.tokenstore)
+        else:
+            options.tokenstore = os.path.join(tmpdir, 'tokens')
+            logging.warning(
+                '{} not found: storing tokens in {}: use --tokenstore to '
+                'specify a directory in a memory file system'.format(
+                    SHARED_MEMORY_PATH, options.tokenstore))
+    deployer_socket = bind_unix_socket(deployer_path)
+    if options.graceful:
+        # The parent process must survive reload and drain requests.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    else:
+        signal.signal(signal.SIGTERM, _exit)
+    task_id = fork_processes(options.workers)
+    # In graceful mode, the drainer handles SIGTERM in the workers.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if task_id == 0:
+        deployer = make_deployer(options)
+        DeployerServer(deployer).add_socket(deployer_socket)
+    else:
+        deployer_socket.close()
+        deployer = DeployerClient(deployer_path)
+    connections = weakref.WeakSet()
+    servers = [HTTPServer(
+        server(deployer=deployer, connections=connections),
+        ssl_options=ssl_options)]
+    servers[0].add_sockets(sockets)
+    if redirect:
+        servers.append(HTTPServer(redirector()))
+        servers[1].add_sockets(redirector_sockets)
+    if options.graceful:
+        _install_drainer(servers, connections, deployer)
+    logging.info('worker {} started'.format(task_id))
+
+
+def _get_sockets(inherited, name, port):
+    """Return the listening sockets with the given name bound to port.
+
+    Use the sockets inherited from the previous server process if they are
+    bound to the given port, otherwise bind new sockets.
+    """
+    sockets = inherited.pop(name, [])
+    if sockets and all(sock.getsockname()[1] == port for sock in sockets):
+        logging.info('using inherited {} sockets'.format(name))
+        return sockets
+    for sock in sockets:
+        sock.close()
+    return bind_sockets(port)
+
+
+def _install_drainer(servers, connections, deployer, named_sockets=None):
+    """Drain the given servers on SIGTERM.
+
+    If the listening sockets are provided as (name, socket) tuples, also
+    start a new server process inheriting them on SIGHUP.
+    """
+    io_loop = IOLoop.instance()
+    drainer = graceful.Drainer(
+        servers, connections, deployer, io_loop=io_loop,
+        spread=options.drainspread, timeout=options.draintimeout)
+    command = None
+    if named_sockets is not None:
+        if options.restartcommand:
+            command = shlex.split(options.restartcommand)
+        else:
+            command = [sys.executable] + sys.argv
+    graceful.install_signal_handlers(
+        drainer, io_loop, command=command, named_sockets=named_sockets or ())
+
+
+def _start_graceful(port, ssl_options, redirect):
+    """Start the applications in a process supporting graceful restarts.
+
+    Listening sockets inherited from a previous server process are reused, so
+    that no connections are refused while that process is drained.
+    """
+    inherited = graceful.inherited_sockets()
+    deployer = make_deployer(options)
+    connections = weakref.WeakSet()
+    sockets = _get_sockets(inherited, SERVER_SOCKETS, port)
+    servers = [HTTPServer(
+        server(deployer=deployer, connections=connections),
+        ssl_options=ssl_options)]
+    servers[0].add_sockets(sockets)
+    named_sockets = [(SERVER_SOCKETS, sock) for sock in sockets]
+    if redirect:
+        redirector_sockets = _get_sockets(inherited, REDIRECTOR_SOCKETS, 80)
+        servers.append(HTTPServer(redirector()))
+        servers[1].add_sockets(redirector_sockets)
+        named_sockets.extend(
+            (REDIRECTOR_SOCKETS, sock) for sock in redirector_sockets)
+    # Close the inherited sockets no longer used, e.g. if the port changed.
+    for sockets in inherited.values():
+        for sock in sockets:
+            sock.close()
+    _install_drainer(servers, connections, deployer, named_sockets)
+
+
 def run():
     """Run the server"""
     port = options.port
-    if options.insecure:
+    # Notify systemd that this process is the service main process. Workers
+    # are not the main process, the parent monitoring them is.
+    ready = 'MAINPID={}\nREADY=1'.format(os.getpid())
+    if (options.workers > 1) or options.graceful:
+        ssl_options = None if options.insecure else _get_ssl_options()
+        redirect = (port is None) and not options.insecure
+        if port is None:
+            port = 80 if options.insecure else 443
+        if options.workers > 1:
+            _start_workers(port, ssl_options, redirect)
+            ready = 'READY=1'
+        else:
+            _start_graceful(port, ssl_options, redirect)
+    elif options.insecure:
         # Run the server over an insecure HTTP connection.
         if port is None:
             port = 80
@@ -188,4 +613,5 @@ def run():
     version = guiserver.get_version()
     logging.info('starting Juju GUI server v{}'.format(version))
     logging.info('listening on port {}'.format(port))
+    graceful.notify(ready)
     IOLoop.instance().start()
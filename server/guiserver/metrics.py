@@ -0,0 +1,275 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server metrics.
+
+This module defines simple counters, gauges and histograms, and a registry
+able to render them using the Prometheus text exposition format, e.g.:
+
+    REQUESTS = REGISTRY.counter(
+        'requests_total', 'Number of requests.', ('method',))
+    REQUESTS.inc(method='GET')
+    text = REGISTRY.render()
+
+The metrics collected by the GUI server are defined at the bottom of this
+module. Values are collected per process: when running multiple workers,
+each worker exposes its own metrics.
+"""
+
+import bisect
+from collections import OrderedDict
+
+
+# Define the Prometheus text format content type.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Define the default histogram buckets, in seconds.
+LATENCY_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+# Define the maximum number of label combinations collected for each metric,
+# and the label value used for the exceeding ones. This way memory usage is
+# bounded even if label values are provided by clients.
+MAX_SERIES = 500
+OTHER = 'other'
+# Define the histogram buckets used for message sizes, in bytes.
+SIZE_BUCKETS = (
+    128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _format_labels(names, values, extra=()):
+    """Return the Prometheus representation of the given labels."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _escape(value):
+    """Escape the given label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_value(value):
+    """Return the Prometheus representation of the given number."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    """Base class for metrics, storing values keyed by label values."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), max_series=MAX_SERIES):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._max_series = max_series
+        self._values = OrderedDict()
+
+    def _key(self, labels):
+        """Return the label values for the given label keyword arguments.
+
+        When the maximum number of series is reached, values for new label
+        combinations are collected using OTHER as value for all the labels.
+        Raise a ValueError if the labels do not match the metric ones.
+        """
+        if set(labels) != set(self.labels):
+            raise ValueError('{}: invalid labels: {}'.format(
+                self.name, ', '.join(sorted(labels))))
+        key = tuple(labels[name] for name in self.labels)
+        values = self._values
+        if (key not in values) and (len(values) >= self._max_series):
+            return (OTHER,) * len(key)
+        return key
+
+    def clear(self):
+        """Remove all the collected values."""
+        self._values.clear()
+
+    def render(self):
+        """Return the lines representing this metric."""
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        for key, value in self._values.items():
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        """Return the lines representing the value with the given key."""
+        return ['{}{} {}'.format(
+            self.name, _format_labels(self.labels, key), _format_value(value))]
+
+
+class Counter(_Metric):
+    """A value that can only increase."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter by the given amount."""
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Return the current value of the counter."""
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that can be arbitrarily set."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge to the given value."""
+        self._values[self._key(labels)] = value
+
+    def get(self, **labels):
+        """Return the current value of the gauge."""
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """A distribution of observed values, counted in buckets."""
+
+    kind = 'histogram'
+
+    def __init__(
+            self, name, help, labels=(), buckets=LATENCY_BUCKETS,
+            max_series=MAX_SERIES):
+        super(Histogram, self).__init__(name, help, labels, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Record the given value."""
+        key = self._key(labels)
+        counts, total = self._values.get(key, (None, 0))
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = counts, total + value
+
+    def get(self, **labels):
+        """Return the number and the sum of the observed values."""
+        counts, total = self._values.get(self._key(labels), ((), 0))
+        return sum(counts), total
+
+    def _render_value(self, key, value):
+        """See _Metric._render_value."""
+        counts, total = value
+        labels = self.labels
+        lines = []
+        cumulative = 0
+        bounds = self.buckets + (float('inf'),)
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                _format_labels(labels, key, [('le', _format_value(bound))]),
+                cumulative))
+        lines.append('{}_sum{} {}'.format(
+            self.name, _format_labels(labels, key), _format_value(total)))
+        lines.append('{}_count{} {}'.format(
+            self.name, _format_labels(labels, key), cumulative))
+        return lines
+
+
+class Registry(object):
+    """A collection of metrics."""
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def _add(self, metric):
+        """Register and return the given metric."""
+        if metric.name in self._metrics:
+            raise ValueError('metric already registered: ' + metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        """Create, register and return a counter."""
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        """Create, register and return a gauge."""
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """Create, register and return a histogram."""
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def clear(self):
+        """Remove all the values collected by the registered metrics."""
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render(self):
+        """Return the metrics using the Prometheus text format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Define the registry including all the GUI server metrics.
+REGISTRY = Registry()
+
+# Define the WebSocket proxy metrics. The direction label is either
+# "client_to_juju" or "juju_to_client".
+CLIENT_TO_JUJU = 'client_to_juju'
+JUJU_TO_CLIENT = 'juju_to_client'
+WEBSOCKET_CONNECTIONS = REGISTRY.gauge(
+    'guiserver_websocket_connections',
+    'Number of connected browsers.')
+WEBSOCKET_FRAMES = REGISTRY.counter(
+    'guiserver_websocket_frames_total',
+    'Number of WebSocket frames proxied.', ('direction',))
+WEBSOCKET_BYTES = REGISTRY.counter(
+    'guiserver_websocket_bytes_total',
+    'Number of bytes (decoded characters) proxied.', ('direction',))
+WEBSOCKET_FRAME_SIZE = REGISTRY.histogram(
+    'guiserver_websocket_frame_size_bytes',
+    'Size of the WebSocket frames proxied.', ('direction',), SIZE_BUCKETS)
+WEBSOCKET_DECODE_TIME = REGISTRY.histogram(
+    'guiserver_websocket_decode_seconds',
+    'Time spent decoding the JSON frames inspected by the GUI server.',
+    ('direction',))
+WEBSOCKET_PROCESSING_TIME = REGISTRY.histogram(
+    'guiserver_websocket_processing_seconds',
+    'Time spent in the GUI server handling a frame, including decoding and '
+    'middlewares.', ('direction',))
+WEBSOCKET_QUEUE_TIME = REGISTRY.histogram(
+    'guiserver_websocket_queue_seconds',
+    'Time browser frames waited for the Juju API connection.')
+JUJU_REQUEST_TIME = REGISTRY.histogram(
+    'guiserver_juju_request_seconds',
+    'Time between a browser request and the corresponding Juju response.',
+    ('type', 'request'))
+
+# Define the Juju API connection pool metrics. The result label is either
+# "hit" or "miss".
+POOL_REQUESTS = REGISTRY.counter(
+    'guiserver_pool_requests_total',
+    'Number of Juju API connections requested to the pool.', ('result',))
+POOL_CONNECT_TIME = REGISTRY.histogram(
+    'guiserver_pool_connect_seconds',
+    'Time browsers waited for a Juju API connection from the pool.')
@@ -0,0 +1,561 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server Juju API connection multiplexing.
+
+When multiplexing is enabled, browsers logged in to the same Juju model with
+the same credentials share a single upstream connection to the Juju API.
+This module defines the following objects:
+
+    - Multiplexer: the registry of upstream connections, keyed by Juju API
+      URL (which includes the model uuid) and credentials;
+    - Session: the view of a shared upstream connection assigned to a single
+      browser. A session exposes the same interface as a WebSocket client
+      connection (see guiserver.clients), so that WebSocket handlers can use
+      it in place of a dedicated connection to the Juju API.
+
+The upstream connection is logged in only once: login requests sent by
+browsers are answered using the original login response. Upstream connections
+are identified by a salted hash of the model, username and password, so that
+passwords are not kept in memory once the connection is logged in. If a login
+cache time to live is configured, successfully logged in connections are
+kept open for that time after the last browser session is closed, so that
+users reconnecting shortly after (e.g. reloading the page, or when many
+browsers reconnect at once) do not log in to the Juju API again. Request
+identifiers sent by browsers are rewritten so that they do not collide on the
+shared connection, and responses are routed back to the requesting browser
+with their original identifiers.
+
+All the browsers also share a single AllWatcher: each browser is given its
+own watcher identifier, its first Next call returns a snapshot of the whole
+model, and subsequent calls return the deltas received since the previous
+call. Other watchers are not shared.
+"""
+
+from collections import OrderedDict
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from guiserver.clients import websocket_connect
+from guiserver.coalescing import (
+    coalesce,
+    entity_key,
+)
+from guiserver.utils import (
+    add_future,
+    json_decode_dict,
+    json_encode,
+    leading_request_id,
+    replace_leading_request_id,
+)
+
+
+class Multiplexer(object):
+    """Keep one upstream Juju API connection per model and credentials.
+
+    If login_ttl is not zero, logged in connections are kept open for
+    login_ttl seconds after their last session is closed.
+    """
+
+    def __init__(self, auth_backend, io_loop=None, login_ttl=0):
+        self._backend = auth_backend
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self.login_ttl = login_ttl
+        # The salt used to hash credentials is never shared.
+        self._salt = os.urandom(16)
+        self._upstreams = {}
+
+    def connect(
+            self, apiurl, data, callback, headers=None,
+            compression_options=None, keepalive_options=None):
+        """Return a Future whose result is a Session on a shared connection.
+
+        Receive the Juju API URL, the first message sent by the browser
+        (decoded, or None if it was not decoded), the callback to be called
+        each time a message is received for the browser, and the optional
+        headers, compression and keepalive options used when connecting to
+        Juju.
+        Only browsers sending a password login request as first message can
+        share upstream connections: return None otherwise.
+        """
+        if (data is None) or not self._backend.request_is_login(data):
+            return None
+        key = self.make_key(apiurl, *self._backend.get_credentials(data))
+        upstream = self._upstreams.get(key)
+        if upstream is None:
+            upstream = _Upstream(
+                self, key, data, self._backend, self._io_loop)
+            self._upstreams[key] = upstream
+            upstream.connect(
+                apiurl, headers, compression_options, keepalive_options)
+        return upstream.add_session(callback)
+
+    def make_key(self, apiurl, username, password):
+        """Return the key identifying an upstream connection.
+
+        The key is an (apiurl, username, digest) tuple, in which digest is a
+        salted hash of the given Juju API URL (including the model uuid),
+        username and password.
+        """
+        message = u'\0'.join([apiurl, username, password]).encode('utf-8')
+        digest = hmac.new(self._salt, message, hashlib.sha256).hexdigest()
+        return apiurl, username, digest
+
+    def discard(self, upstream):
+        """Stop sharing the given upstream connection."""
+        if self._upstreams.get(upstream.key) is upstream:
+            del self._upstreams[upstream.key]
+
+    def get_info(self):
+        """Return a list of dicts describing the shared connections."""
+        return [{
+            'apiurl': upstream.key[0],
+            'username': upstream.key[1],
+            'sessions': len(upstream.sessions),
+        } for upstream in self._upstreams.values()]
+
+
+class Session(object):
+    """A browser session on a shared upstream connection.
+
+    Messages received for the browser are passed to the callback, and None is
+    passed when the upstream connection is closed.
+    """
+
+    def __init__(self, upstream, callback):
+        self._upstream = upstream
+        self._callback = callback
+        self.closed = False
+        # Reading cannot be paused on behalf of a single browser, since the
+        # upstream connection is shared: only keep track of the request.
+        self.reading_paused = False
+
+    def write_message(self, message):
+        """Send the given browser message to the Juju API."""
+        data = json_decode_dict(message)
+        if (data is None) or ('RequestId' not in data):
+            logging.warning(
+                'multiplexer: discarding message: {!r}'.format(message))
+            return
+        self._upstream.handle_request(self, data)
+
+    def deliver(self, message):
+        """Send the given message to the browser."""
+        if not self.closed:
+            self._callback(message)
+
+    def respond(self, request_id, response=None, error=None):
+        """Send a response to the browser request with the given id."""
+        data = {'RequestId': request_id, 'Response': response or {}}
+        if error is not None:
+            data['Error'] = error
+        self.deliver(json_encode(data))
+
+    def pause_reading(self):
+        """See guiserver.clients.WebSocketClientConnection.pause_reading."""
+        self.reading_paused = True
+
+    def resume_reading(self):
+        """See guiserver.clients.WebSocketClientConnection.resume_reading."""
+        self.reading_paused = False
+
+    def write_buffer_size(self):
+        """Return the number of bytes waiting to be sent to the Juju API."""
+        return self._upstream.write_buffer_size()
+
+    def close(self):
+        """Close the session."""
+        if not self.closed:
+            self.closed = True
+            self._upstream.remove_session(self)
+
+
+class _Upstream(object):
+    """A logged in connection to the Juju API shared by multiple sessions."""
+
+    def __init__(self, multiplexer, key, login_data, backend, io_loop):
+        self.key = key
+        self.sessions = set()
+        self.watcher = _AllWatcher(self)
+        self._multiplexer = multiplexer
+        self._login_data = login_data
+        self._login_response = None
+        self._backend = backend
+        self._io_loop = io_loop
+        self._connection = None
+        self._closed = False
+        # The ready Future is resolved when the login completes.
+        self._ready = Future()
+        # The timeout handle used to close the connection when unused.
+        self._expiration = None
+        self._counter = itertools.count(1)
+        # Map upstream request identifiers to (session, browser request id)
+        # pairs, or to callbacks for requests made by the upstream itself.
+        self._routes = {}
+        self._callbacks = {}
+
+    @gen.coroutine
+    def connect(
+            self, apiurl, headers, compression_options,
+            keepalive_options=None):
+        """Connect to the Juju API and log in."""
+        try:
+            self._connection = yield websocket_connect(
+                self._io_loop, apiurl, self._on_message, headers=headers,
+                compression_options=compression_options,
+                keepalive_options=keepalive_options)
+        except Exception as err:
+            self._multiplexer.discard(self)
+            self._closed = True
+            self._ready.set_exception(err)
+            return
+        logging.info('multiplexer: Juju API connected: {}'.format(apiurl))
+        # The credentials are no longer needed once sent.
+        login_data, self._login_data = self._login_data, None
+        self.send(dict(login_data), self._on_login)
+
+    def _on_login(self, data):
+        """Store the login response."""
+        self._login_response = data
+        if not self._backend.login_succeeded(data):
+            # Do not share connections which failed to log in.
+            self._multiplexer.discard(self)
+        self._ready.set_result(None)
+
+    def add_session(self, callback):
+        """Return a Future whose result is a new session.
+
+        The session is created when the upstream connection is logged in.
+        """
+        if self._expiration is not None:
+            # A user is returning to a cached connection.
+            logging.info('multiplexer: reusing logged in connection')
+            self._io_loop.remove_timeout(self._expiration)
+            self._expiration = None
+        future = Future()
+
+        def on_ready(ready):
+            if ready.exception() is not None:
+                return future.set_exception(ready.exception())
+            if self._closed:
+                return future.set_exception(
+                    ValueError('upstream connection closed'))
+            session = Session(self, callback)
+            self.sessions.add(session)
+            future.set_result(session)
+        add_future(self._io_loop, self._ready, on_ready)
+        return future
+
+    def remove_session(self, session):
+        """Remove the given session, closing the connection if unused.
+
+        If the login cache is enabled, logged in connections are closed only
+        if no sessions are added within the login cache time to live.
+        """
+        self.sessions.discard(session)
+        self.watcher.unsubscribe_session(session)
+        if self.sessions:
+            return
+        ttl = self._multiplexer.login_ttl
+        if ttl and self.logged_in():
+            self._expiration = self._io_loop.add_timeout(
+                self._io_loop.time() + ttl, self._close)
+            return
+        self._close()
+
+    def logged_in(self):
+        """Return True if the connection is open and logged in."""
+        response = self._login_response
+        return (
+            not self._closed and (response is not None) and
+            self._backend.login_succeeded(response))
+
+    def _close(self):
+        """Stop sharing the connection and close it."""
+        self._expiration = None
+        self._multiplexer.discard(self)
+        if self._connection is not None:
+            self._connection.close()
+
+    def handle_request(self, session, data):
+        """Handle the given request sent by the session's browser."""
+        request_id = data['RequestId']
+        if self._backend.request_is_login(data):
+            return self._login_session(session, data)
+        request_type, request = data.get('Type'), data.get('Request')
+        if (request_type, request) == ('Client', 'WatchAll'):
+            return self.watcher.subscribe(session, request_id)
+        watcher_id = data.get('Id')
+        if (request_type == 'AllWatcher') and self.watcher.owns(watcher_id):
+            if request == 'Next':
+                return self.watcher.next(watcher_id, request_id)
+            if request == 'Stop':
+                self.watcher.unsubscribe(watcher_id)
+                return session.respond(request_id)
+        self._routes[self._next_id(data)] = (session, request_id)
+        self._write(data)
+
+    def _login_session(self, session, data):
+        """Answer a session login request using the stored login response."""
+        request_id = data['RequestId']
+        key = self._multiplexer.make_key(
+            self.key[0], *self._backend.get_credentials(data))
+        if key != self.key:
+            return session.respond(
+                request_id, error='already logged in as another user')
+        response = dict(self._login_response, RequestId=request_id)
+        session.deliver(json_encode(response))
+
+    def send(self, data, callback):
+        """Send a request on behalf of the upstream itself.
+
+        The callback is called passing the decoded response.
+        """
+        self._callbacks[self._next_id(data)] = callback
+        self._write(data)
+
+    def _next_id(self, data):
+        """Assign a new upstream request id to the given request data."""
+        request_id = data['RequestId'] = self._counter.next()
+        return request_id
+
+    def _write(self, data):
+        """Send the given request to the Juju API."""
+        if self._connection is not None:
+            self._connection.write_message(json_encode(data))
+
+    def write_buffer_size(self):
+        """Return the number of bytes waiting to be sent to the Juju API."""
+        if self._connection is None:
+            return 0
+        return self._connection.write_buffer_size()
+
+    def _on_message(self, message):
+        """Route the given message received from the Juju API."""
+        if message is None:
+            return self._on_close()
+        data = None
+        request_id = leading_request_id(message)
+        if request_id is None:
+            # Fall back to decoding the whole message.
+            data = json_decode_dict(message)
+            if data is None:
+                return
+            request_id = data.get('RequestId')
+        callback = self._callbacks.pop(request_id, None)
+        if callback is not None:
+            if data is None:
+                data = json_decode_dict(message)
+            return callback(data)
+        session, browser_request_id = self._routes.pop(
+            request_id, (None, None))
+        if session is None:
+            logging.warning('multiplexer: discarding response to unknown '
+                            'request {}'.format(request_id))
+            return
+        if data is None:
+            message = replace_leading_request_id(message, browser_request_id)
+        else:
+            data['RequestId'] = browser_request_id
+            message = json_encode(data)
+        session.deliver(message)
+
+    def _on_close(self):
+        """Handle the upstream connection termination."""
+        logging.info('multiplexer: Juju API connection closed')
+        self._closed = True
+        self._connection = None
+        self._multiplexer.discard(self)
+        if not self._ready.done():
+            self._ready.set_exception(
+                ValueError('upstream connection closed'))
+        for session in list(self.sessions):
+            session.deliver(None)
+
+
+class _AllWatcher(object):
+    """An AllWatcher shared by all the sessions of an upstream connection.
+
+    The watcher keeps the current state of the model, so that new subscribers
+    can be sent a snapshot of the whole model.
+    """
+
+    def __init__(self, upstream):
+        self._upstream = upstream
+        self._subscriptions = {}
+        self._counter = itertools.count(1)
+        self._watcher_id = None
+        self._started = False
+        self._waiting = []
+        # Juju 2 uses lower case field names.
+        self._id_field = 'AllWatcherId'
+        self.deltas_field = 'Deltas'
+        self.initialized = False
+        self.state = OrderedDict()
+
+    def owns(self, watcher_id):
+        """Return True if the given watcher id identifies a subscription."""
+        return watcher_id in self._subscriptions
+
+    def subscribe(self, session, request_id):
+        """Subscribe the given session, answering its WatchAll request."""
+        if self._watcher_id is not None:
+            return self._add(session, request_id)
+        self._waiting.append((session, request_id))
+        if not self._started:
+            self._started = True
+            request = {'Type': 'Client', 'Request': 'WatchAll', 'Params': {}}
+            self._upstream.send(request, self._on_watch_all)
+
+    def _on_watch_all(self, data):
+        """Start watching the model, and add the waiting subscriptions."""
+        waiting, self._waiting = self._waiting, []
+        if 'Error' in data:
+            self._started = False
+            for session, request_id in waiting:
+                session.deliver(
+                    json_encode(dict(data, RequestId=request_id)))
+            return
+        response = data.get('Response') or {}
+        if 'watcher-id' in response:
+            self._id_field = 'watcher-id'
+        self._watcher_id = response.get(self._id_field)
+        for session, request_id in waiting:
+            self._add(session, request_id)
+        self._next()
+
+    def _add(self, session, request_id):
+        """Add a new subscription for the given session."""
+        watcher_id = str(self._counter.next())
+        self._subscriptions[watcher_id] = _Subscription(self, session)
+        session.respond(request_id, {self._id_field: watcher_id})
+
+    def _next(self):
+        """Ask the Juju API for the next deltas."""
+        request = {
+            'Type': 'AllWatcher',
+            'Request': 'Next',
+            'Id': self._watcher_id,
+            'Params': {},
+        }
+        self._upstream.send(request, self._on_next)
+
+    def _on_next(self, data):
+        """Update the model state and notify subscriptions."""
+        if 'Error' in data:
+            logging.error('multiplexer: AllWatcher error: {}'.format(
+                data['Error']))
+            subscriptions, self._subscriptions = self._subscriptions, {}
+            self._watcher_id = None
+            self._started = self.initialized = False
+            self.state.clear()
+            for subscription in subscriptions.values():
+                subscription.fail(data)
+            return
+        response = data.get('Response') or {}
+        if 'deltas' in response:
+            self.deltas_field = 'deltas'
+        deltas = response.get(self.deltas_field) or []
+        for kind, operation, entity in deltas:
+            key = entity_key(kind, entity)
+            if operation == 'remove':
+                self.state.pop(key, None)
+            else:
+                self.state[key] = entity
+        self.initialized = True
+        for subscription in self._subscriptions.values():
+            subscription.push(deltas)
+        self._next()
+
+    def snapshot(self):
+        """Return deltas describing the whole model."""
+        return [
+            [kind, 'change', entity]
+            for (kind, _), entity in self.state.items()]
+
+    def next(self, watcher_id, request_id):
+        """Handle a Next request for the given subscription."""
+        self._subscriptions[watcher_id].next(request_id)
+
+    def unsubscribe(self, watcher_id):
+        """Remove the given subscription."""
+        self._subscriptions.pop(watcher_id, None)
+
+    def unsubscribe_session(self, session):
+        """Remove all the subscriptions of the given session."""
+        for watcher_id, subscription in self._subscriptions.items():
+            if subscription.session is session:
+                del self._subscriptions[watcher_id]
+        self._waiting = [
+            (waiting_session, request_id)
+            for waiting_session, request_id in self._waiting
+            if waiting_session is not session]
+
+
+class _Subscription(object):
+    """A session subscribed to the shared AllWatcher."""
+
+    def __init__(self, watcher, session):
+        self.session = session
+        self._watcher = watcher
+        # The pending deltas are None until the model snapshot is sent.
+        self._pending = None
+        self._request_id = None
+
+    def next(self, request_id):
+        """Handle a Next request, sending deltas as soon as available."""
+        self._request_id = request_id
+        self._flush()
+
+    def push(self, deltas):
+        """Add the given deltas to the ones to be sent.
+
+        Only the latest delta for each entity is kept.
+        """
+        if self._pending is not None:
+            coalesce(deltas, self._pending)
+        self._flush()
+
+    def fail(self, data):
+        """Forward the given error response to the parked Next request."""
+        if self._request_id is not None:
+            self.session.deliver(
+                json_encode(dict(data, RequestId=self._request_id)))
+            self._request_id = None
+
+    def _flush(self):
+        """Answer the parked Next request if there are deltas to send."""
+        watcher = self._watcher
+        if (self._request_id is None) or not watcher.initialized:
+            return
+        if self._pending is None:
+            deltas = watcher.snapshot()
+        elif self._pending:
+            deltas = self._pending.values()
+        else:
+            return
+        self._pending = OrderedDict()
+        request_id, self._request_id = self._request_id, None
+        self.session.respond(request_id, {watcher.deltas_field: deltas})
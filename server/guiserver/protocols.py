@@ -0,0 +1,425 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server WebSocket protocol.
+
+The protocol defined here extends the Tornado RFC 6455 implementation, and it
+is used by both the server side (browser) and the client side (Juju API)
+WebSocket connections. It adds the following features:
+
+    - frame processing can be paused and resumed;
+    - messages can be compressed using the permessage-deflate extension
+      (RFC 7692), if successfully negotiated during the opening handshake;
+    - text messages can be delivered as UTF-8 encoded byte strings, so that
+      they can be proxied without decoding and encoding them again.
+
+Compression is configured using a dict like the following:
+
+    {'level': 6, 'window_bits': 15, 'min_size': 256}
+
+where level is the zlib compression level (1-9), window_bits is the base two
+logarithm of the LZ77 sliding window size used when compressing (9-15), and
+min_size is the size in bytes below which messages are sent uncompressed.
+
+Compression contexts are kept for the whole connection lifetime: with a 15
+bits window, the deflate context alone uses about 256KB per connection.
+"""
+
+import logging
+import os
+import struct
+import zlib
+
+from tornado import websocket
+from tornado.escape import utf8
+from tornado.iostream import StreamClosedError
+from tornado.util import _websocket_mask
+
+
+# Define the name of the per-message compression extension.
+DEFLATE_EXTENSION = 'permessage-deflate'
+# Define the default compression options.
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_WINDOW_BITS = zlib.MAX_WBITS
+DEFAULT_MIN_SIZE = 256
+# Define the accepted window bits range. The zlib library does not support
+# raw deflate streams with a window size of 256 bytes (8 bits).
+MIN_WINDOW_BITS = 9
+MAX_WINDOW_BITS = zlib.MAX_WBITS
+# Define the maximum size of a decompressed message.
+MAX_MESSAGE_SIZE = 100 * 1024 * 1024
+# Define the frame header bit marking compressed messages.
+_RSV1 = 0x40
+# Define the bytes removed from the end of compressed messages.
+_DEFLATE_TAIL = b'\x00\x00\xff\xff'
+# Define the payload size above which frame headers and payloads are written
+# separately, so that the payload is not copied to build the frame.
+_SPLIT_WRITE_SIZE = 64 * 1024
+
+
+def parse_extensions(header):
+    """Parse the given Sec-WebSocket-Extensions header value.
+
+    Return a list of (name, params) tuples, in which params is a dict mapping
+    extension parameter names to their values (None if a value is missing).
+    """
+    extensions = []
+    for extension in (header or '').split(','):
+        parts = [part.strip() for part in extension.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            key, _, value = part.partition('=')
+            params[key.strip()] = value.strip().strip('"') or None
+        extensions.append((parts[0], params))
+    return extensions
+
+
+def _window_bits(value):
+    """Return the window bits corresponding to the given parameter value.
+
+    Raise a ValueError if the value is not valid.
+    """
+    window_bits = int(value)
+    if not (MIN_WINDOW_BITS <= window_bits <= MAX_WINDOW_BITS):
+        raise ValueError('unsupported window bits: {}'.format(value))
+    return window_bits
+
+
+def negotiate_server(header, options):
+    """Negotiate compression on the server side of a WebSocket connection.
+
+    Receive the Sec-WebSocket-Extensions header value sent by the client and
+    the compression options. Return a tuple (response, params) where response
+    is the Sec-WebSocket-Extensions header value to send back to the client
+    and params is the dict of accepted extension parameters. Return
+    (None, None) if compression is disabled or no offer can be accepted.
+    """
+    if options is None:
+        return None, None
+    for name, offer in parse_extensions(header):
+        if name != DEFLATE_EXTENSION:
+            continue
+        params = {}
+        try:
+            for key, value in offer.items():
+                if key == 'server_no_context_takeover':
+                    params[key] = None
+                elif key == 'server_max_window_bits':
+                    params[key] = min(
+                        _window_bits(value), options['window_bits'])
+                elif key not in (
+                        'client_no_context_takeover',
+                        'client_max_window_bits'):
+                    raise ValueError('unsupported parameter: {}'.format(key))
+        except (TypeError, ValueError):
+            # Try the next offer.
+            continue
+        return _format_extension(params), params
+    return None, None
+
+
+def make_client_offer(options):
+    """Return the Sec-WebSocket-Extensions header value to send to servers.
+
+    Return None if compression is disabled.
+    """
+    if options is None:
+        return None
+    return '{}; client_max_window_bits={}'.format(
+        DEFLATE_EXTENSION, options['window_bits'])
+
+
+def negotiate_client(header, options):
+    """Handle the compression negotiation response on the client side.
+
+    Receive the Sec-WebSocket-Extensions header value sent by the server and
+    the compression options. Return the dict of accepted extension parameters,
+    or None if compression was not accepted by the server.
+    Raise a ValueError if the server response is not valid.
+    """
+    extensions = parse_extensions(header)
+    if not extensions:
+        return None
+    if (options is None) or (len(extensions) > 1):
+        raise ValueError('unexpected extensions: {}'.format(header))
+    name, params = extensions[0]
+    if name != DEFLATE_EXTENSION:
+        raise ValueError('unexpected extension: {}'.format(name))
+    for key, value in params.items():
+        if key == 'client_max_window_bits':
+            params[key] = _window_bits(value)
+        elif key == 'server_max_window_bits':
+            _window_bits(value)
+        elif key not in (
+                'client_no_context_takeover', 'server_no_context_takeover'):
+            raise ValueError('unsupported parameter: {}'.format(key))
+    return params
+
+
+def _format_extension(params):
+    """Return the permessage-deflate header value for the given params."""
+    parts = [DEFLATE_EXTENSION]
+    for key, value in sorted(params.items()):
+        if value is None:
+            parts.append(key)
+        else:
+            parts.append('{}={}'.format(key, value))
+    return '; '.join(parts)
+
+
+class _Compressor(object):
+    """Compress outgoing messages."""
+
+    def __init__(self, level, window_bits, persistent):
+        self._level = level
+        self._window_bits = window_bits
+        self._compressor = None
+        if persistent:
+            self._compressor = self._create()
+
+    def _create(self):
+        """Return a new raw deflate compression object."""
+        return zlib.compressobj(
+            self._level, zlib.DEFLATED, -self._window_bits)
+
+    def compress(self, data):
+        """Compress and return the given message."""
+        compressor = self._compressor or self._create()
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-len(_DEFLATE_TAIL)]
+
+
+class _Decompressor(object):
+    """Decompress incoming messages."""
+
+    def __init__(self, persistent):
+        self._decompressor = None
+        if persistent:
+            self._decompressor = self._create()
+
+    def _create(self):
+        """Return a new raw deflate decompression object.
+
+        The maximum window size is used, so that messages compressed using any
+        smaller window can be decompressed.
+        """
+        return zlib.decompressobj(-MAX_WINDOW_BITS)
+
+    def decompress(self, data):
+        """Decompress and return the given message.
+
+        Raise a ValueError if the resulting message is too big.
+        """
+        decompressor = self._decompressor or self._create()
+        data = decompressor.decompress(data + _DEFLATE_TAIL, MAX_MESSAGE_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError('decompressed message too big')
+        return data
+
+
+class WebSocketProtocol(websocket.WebSocketProtocol13):
+    """A WebSocket protocol supporting pausing and compression.
+
+    Receive the handler, whether outgoing frames must be masked (this is True
+    on the client side of a connection), the compression options and the
+    negotiated permessage-deflate parameters. If the latter is None, messages
+    are not compressed. If raw_text is True, text messages are passed to the
+    handler as byte strings: in this case the UTF-8 encoding of the payload is
+    not validated, leaving that to the final recipient of the message.
+    """
+
+    def __init__(
+            self, handler, mask_outgoing=False, compression_options=None,
+            deflate_params=None, raw_text=False):
+        super(WebSocketProtocol, self).__init__(
+            handler, mask_outgoing=mask_outgoing)
+        self.raw_text = raw_text
+        self.paused = False
+        self._receive_pending = False
+        self._compression_options = compression_options
+        self._message_compressed = False
+        self._compressor = self._decompressor = None
+        if deflate_params is not None:
+            self._set_up_compression(deflate_params)
+
+    @property
+    def compressed(self):
+        """Return True if messages can be compressed, False otherwise."""
+        return self._compressor is not None
+
+    def _set_up_compression(self, params):
+        """Set up compression using the given negotiated parameters."""
+        options = self._compression_options
+        if self.mask_outgoing:
+            side, other_side = 'client', 'server'
+        else:
+            side, other_side = 'server', 'client'
+        window_bits = min(
+            options['window_bits'],
+            params.get(side + '_max_window_bits') or MAX_WINDOW_BITS)
+        self._compressor = _Compressor(
+            options['level'], window_bits,
+            side + '_no_context_takeover' not in params)
+        self._decompressor = _Decompressor(
+            other_side + '_no_context_takeover' not in params)
+        self._min_size = options['min_size']
+
+    def pause(self):
+        """Stop processing incoming frames."""
+        self.paused = True
+
+    def resume(self):
+        """Restart processing incoming frames."""
+        self.paused = False
+        if self._receive_pending:
+            self._receive_pending = False
+            self._receive_frame()
+
+    def close(self, code=None, reason=None):
+        """Close the WebSocket connection.
+
+        If a status code is provided, it is sent to the peer in the close
+        frame, followed by the optional reason. Tornado 3.2 always sends an
+        empty close frame.
+        """
+        if (code is not None) and not self.server_terminated:
+            if not self.stream.closed():
+                data = struct.pack('>H', code)
+                if reason is not None:
+                    data += utf8(reason)
+                self._write_frame(True, 0x8, data)
+            self.server_terminated = True
+        super(WebSocketProtocol, self).close()
+
+    def _accept_connection(self):
+        """See tornado.websocket.WebSocketProtocol13._accept_connection.
+
+        This is a copy of the Tornado 3.2 implementation, also negotiating
+        the permessage-deflate extension.
+        """
+        subprotocol_header = ''
+        subprotocols = self.request.headers.get('Sec-WebSocket-Protocol', '')
+        subprotocols = [s.strip() for s in subprotocols.split(',')]
+        if subprotocols:
+            selected = self.handler.select_subprotocol(subprotocols)
+            if selected:
+                assert selected in subprotocols
+                subprotocol_header = 'Sec-WebSocket-Protocol: {}\r\n'.format(
+                    selected)
+        extensions_header = ''
+        response, params = negotiate_server(
+            self.request.headers.get('Sec-WebSocket-Extensions'),
+            self._compression_options)
+        if response is not None:
+            self._set_up_compression(params)
+            extensions_header = 'Sec-WebSocket-Extensions: {}\r\n'.format(
+                response)
+        self.stream.write(utf8(
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: {}\r\n'
+            '{}{}'
+            '\r\n'.format(
+                self._challenge_response(), subprotocol_header,
+                extensions_header)))
+        self.async_callback(self.handler.open)(
+            *self.handler.open_args, **self.handler.open_kwargs)
+        self._receive_frame()
+
+    def _write_frame(self, fin, opcode, data, flags=0):
+        """See tornado.websocket.WebSocketProtocol13._write_frame.
+
+        This is a copy of the Tornado 3.2 implementation, also allowing for
+        setting the reserved bits of the frame header using flags. Big
+        payloads are written separately from the frame header, in order to
+        avoid copying them.
+        """
+        finbit = 0x80 if fin else 0
+        frame = struct.pack('B', finbit | flags | opcode)
+        length = len(data)
+        mask_bit = 0x80 if self.mask_outgoing else 0
+        if length < 126:
+            frame += struct.pack('B', length | mask_bit)
+        elif length <= 0xFFFF:
+            frame += struct.pack('!BH', 126 | mask_bit, length)
+        else:
+            frame += struct.pack('!BQ', 127 | mask_bit, length)
+        if self.mask_outgoing:
+            mask = os.urandom(4)
+            frame += mask
+            data = _websocket_mask(mask, data)
+        if length > _SPLIT_WRITE_SIZE:
+            self.stream.write(frame)
+            self.stream.write(data)
+            return
+        self.stream.write(frame + data)
+
+    def write_message(self, message, binary=False):
+        """Send the given message, compressing it if required."""
+        opcode = 0x2 if binary else 0x1
+        message = utf8(message)
+        flags = 0
+        if self.compressed and (len(message) >= self._min_size):
+            message = self._compressor.compress(message)
+            flags = _RSV1
+        try:
+            self._write_frame(True, opcode, message, flags=flags)
+        except StreamClosedError:
+            self._abort()
+
+    def _receive_frame(self):
+        """See tornado.websocket.WebSocketProtocol13._receive_frame."""
+        if self.paused:
+            self._receive_pending = True
+            return
+        super(WebSocketProtocol, self)._receive_frame()
+
+    def _on_frame_start(self, data):
+        """See tornado.websocket.WebSocketProtocol13._on_frame_start.
+
+        Tornado aborts the connection if any reserved bit is set: handle the
+        permessage-deflate bit, which is only valid in the first frame of
+        data messages.
+        """
+        header = ord(data[0])
+        opcode = header & 0xf
+        if opcode in (0x1, 0x2):
+            self._message_compressed = bool(header & _RSV1)
+            if self._message_compressed and self.compressed:
+                data = chr(header & ~_RSV1) + data[1:]
+        super(WebSocketProtocol, self)._on_frame_start(data)
+
+    def _handle_message(self, opcode, data):
+        """See tornado.websocket.WebSocketProtocol13._handle_message.
+
+        Decompress the message if required. When using raw text, pass text
+        messages to the handler without decoding them.
+        """
+        if (opcode in (0x1, 0x2)) and self._message_compressed:
+            try:
+                data = self._decompressor.decompress(data)
+            except (ValueError, zlib.error) as err:
+                logging.error('websocket: invalid compressed message: '
+                              '{}'.format(err))
+                self._abort()
+                return
+        if self.raw_text and (opcode == 0x1):
+            # Deliver the text message as a binary one.
+            opcode = 0x2
+        super(WebSocketProtocol, self)._handle_message(opcode, data)
@@ -0,0 +1,303 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server model snapshots cache.
+
+Retrieving the whole model from the Juju API can take seconds on big models.
+The GUI server keeps an in memory snapshot of each model, built from the
+AllWatcher deltas proxied to browsers, so that the first Next request of new
+sessions can be answered immediately. This module defines the following
+objects:
+
+    - ModelCache: the snapshots of the models, keyed by model uuid. The cache
+      is shared by all the WebSocket handlers, and it is limited in size:
+      least recently used snapshots are evicted first;
+    - SnapshotMiddleware: the per-connection middleware answering the first
+      Next request of each AllWatcher with the cached snapshot, if available.
+      The request is also propagated to the Juju API: when the real response
+      is received, it is used to update the cache, and it is sent to the
+      browser as the response to its second Next request, including removal
+      deltas for the entities which no longer exist.
+
+Each snapshot is updated by a single connection, the last one which received
+the whole model from the Juju API: its subsequent responses are applied to
+the snapshot. When that connection is closed, the snapshot is still served,
+and it is corrected as described above, until another session receives the
+whole model.
+"""
+
+from collections import OrderedDict
+import re
+
+from guiserver.coalescing import entity_key
+
+
+# Define the regular expression used to extract the model uuid from Juju API
+# URLs, e.g. "wss://1.2.3.4:17070/model/{uuid}/api".
+_MODEL_UUID_REGEX = re.compile(r'/(?:model|environment)/([^/]+)/')
+
+
+def model_key(apiurl):
+    """Return the key identifying the model served by the given API URL.
+
+    The key is the model uuid if included in the URL, the URL otherwise.
+    """
+    match = _MODEL_UUID_REGEX.search(apiurl)
+    return apiurl if match is None else match.group(1)
+
+
+class _Snapshot(object):
+    """The state of a model, and the connection keeping it up to date."""
+
+    def __init__(self):
+        # Map entity keys to (entity, estimated size) pairs.
+        self.state = OrderedDict()
+        self.size = 0
+        self.feeder = None
+
+    def apply(self, deltas, size):
+        """Apply the given deltas, whose total size is estimated as given."""
+        state = self.state
+        delta_size = size // max(len(deltas), 1)
+        for kind, operation, entity in deltas:
+            key = entity_key(kind, entity)
+            _, previous_size = state.pop(key, (None, 0))
+            self.size -= previous_size
+            if operation != 'remove':
+                state[key] = entity, delta_size
+                self.size += delta_size
+
+    def deltas(self):
+        """Return deltas describing the whole model."""
+        return [
+            [kind, 'change', entity]
+            for (kind, _), (entity, _) in self.state.items()]
+
+
+class ModelCache(object):
+    """An in memory cache of model snapshots.
+
+    The cache size, in bytes, is estimated using the size of the Juju API
+    messages the snapshots are built from. When max_size is exceeded, least
+    recently used snapshots are evicted.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._snapshots = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """Return the deltas describing the model with the given key.
+
+        Return None if the model is not cached.
+        """
+        snapshot = self._snapshots.pop(key, None)
+        if snapshot is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._snapshots[key] = snapshot
+        return snapshot.deltas()
+
+    def replace(self, key, deltas, size, feeder):
+        """Store the whole model with the given key.
+
+        The feeder becomes the only connection allowed to update the model.
+        """
+        previous = self._snapshots.pop(key, None)
+        if previous is not None:
+            self._size -= previous.size
+        snapshot = _Snapshot()
+        snapshot.feeder = feeder
+        self._store(key, snapshot, deltas, size)
+
+    def update(self, key, deltas, size, feeder):
+        """Apply the given deltas to the model with the given key.
+
+        Nothing happens if the model is not cached or if the feeder is not
+        the one allowed to update the model.
+        """
+        if not self.is_feeder(key, feeder):
+            return
+        snapshot = self._snapshots.pop(key)
+        self._size -= snapshot.size
+        self._store(key, snapshot, deltas, size)
+
+    def is_feeder(self, key, feeder):
+        """Return True if the given feeder is allowed to update the model."""
+        snapshot = self._snapshots.get(key)
+        return (snapshot is not None) and (snapshot.feeder is feeder)
+
+    def release(self, key, feeder):
+        """Stop updating the model with the given feeder."""
+        if self.is_feeder(key, feeder):
+            self._snapshots[key].feeder = None
+
+    def get_info(self):
+        """Return a dict describing the current state of the cache."""
+        return {
+            'models': len(self._snapshots),
+            'size': self._size,
+            'max_size': self.max_size,
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+    def _store(self, key, snapshot, deltas, size):
+        """Apply the deltas to the snapshot and store it as most recent."""
+        snapshot.apply(deltas, size)
+        self._snapshots[key] = snapshot
+        self._size += snapshot.size
+        while self._size > self.max_size:
+            _, evicted = self._snapshots.popitem(last=False)
+            self._size -= evicted.size
+
+
+class _Watcher(object):
+    """The state of an AllWatcher whose first response is being awaited."""
+
+    def __init__(self):
+        # Map the keys of the entities sent to the browser from the cache to
+        # the entities.
+        self.served = None
+        # The real response to the first Next request, when received.
+        self.response = None
+        # The id of the Next request the browser is waiting a response for.
+        self.browser_id = None
+
+
+class SnapshotMiddleware(object):
+    """Answer the first AllWatcher Next requests using cached snapshots.
+
+    The snapshots of the model with the given key are stored in the given
+    cache. The write_message callable sends a data dict to the browser.
+    """
+
+    def __init__(self, cache, key, write_message):
+        self._cache = cache
+        self._key = key
+        self._write_message = write_message
+        # Map watcher ids to watchers waiting for the whole model.
+        self._watchers = {}
+        # Map ids of the Next requests sent to the Juju API to a (watcher id,
+        # full) tuple, where full is True if the response includes the whole
+        # model.
+        self._requests = {}
+        self._seen = set()
+
+    def requested(self, data):
+        """Return True if data represents an AllWatcher Next request."""
+        return (
+            data.get('Type') == 'AllWatcher' and
+            data.get('Request') == 'Next' and
+            data.get('RequestId') is not None)
+
+    def process_request(self, data):
+        """Process a browser Next request.
+
+        Return True if the request must be sent to the Juju API, False if it
+        is handled here.
+        """
+        request_id, watcher_id = data['RequestId'], data.get('Id')
+        if watcher_id not in self._seen:
+            # This is the first Next request for this watcher.
+            self._seen.add(watcher_id)
+            self._requests[request_id] = watcher_id, True
+            deltas = self._cache.get(self._key)
+            if deltas is not None:
+                watcher = self._watchers[watcher_id] = _Watcher()
+                watcher.served = dict(
+                    (entity_key(kind, entity), entity)
+                    for kind, _, entity in deltas)
+                self._write_message({
+                    'RequestId': request_id,
+                    'Response': {'Deltas': deltas},
+                })
+            return True
+        watcher = self._watchers.get(watcher_id)
+        if watcher is not None:
+            # The real response to the first request is still being awaited.
+            watcher.browser_id = request_id
+            if watcher.response is not None:
+                self._respond(watcher_id)
+            return False
+        if self._cache.is_feeder(self._key, self):
+            self._requests[request_id] = watcher_id, False
+        return True
+
+    def handles(self, request_id):
+        """Return True if the given response must be processed here."""
+        return request_id in self._requests
+
+    def process_response(self, data, size):
+        """Process a Juju API response to a Next request.
+
+        The size of the response message is used to estimate the cache size.
+        Return True if the response must be sent to the browser, False if it
+        is handled here.
+        """
+        watcher_id, full = self._requests.pop(data.get('RequestId'))
+        response = data.get('Response') or {}
+        if 'Error' not in data:
+            deltas = response.get('Deltas') or []
+            if full:
+                self._cache.replace(self._key, deltas, size, self)
+            else:
+                self._cache.update(self._key, deltas, size, self)
+        watcher = self._watchers.get(watcher_id)
+        if watcher is None:
+            return True
+        watcher.response = data
+        if watcher.browser_id is not None:
+            self._respond(watcher_id)
+        return False
+
+    def close(self):
+        """Stop updating the cache, e.g. when the browser is disconnected.
+
+        Return the ids of the browser Next requests still waiting for the
+        first real response.
+        """
+        self._cache.release(self._key, self)
+        waiting = [
+            watcher.browser_id for watcher in self._watchers.values()
+            if watcher.browser_id is not None]
+        self._watchers.clear()
+        self._requests.clear()
+        self._seen.clear()
+        return waiting
+
+    def _respond(self, watcher_id):
+        """Send the real first response as a reply to a later Next request.
+
+        Removal deltas are added for the entities sent from the cache which
+        no longer exist.
+        """
+        watcher = self._watchers.pop(watcher_id)
+        data = watcher.response
+        if 'Error' not in data:
+            response = data.get('Response') or {}
+            deltas = list(response.get('Deltas') or [])
+            served = watcher.served
+            for kind, _, entity in deltas:
+                served.pop(entity_key(kind, entity), None)
+            for (kind, _), entity in served.items():
+                deltas.append([kind, 'remove', entity])
+            data = dict(data, Response=dict(response, Deltas=deltas))
+        self._write_message(dict(data, RequestId=watcher.browser_id))
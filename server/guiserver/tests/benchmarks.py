@@ -0,0 +1,358 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server micro-benchmarks.
+
+These benchmarks are not part of the test suite. Run them from the server
+directory, optionally passing the names of the benchmarks to execute, e.g.:
+
+    python -m guiserver.tests.benchmarks [proxy_inspection ...]
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import sys
+import time
+
+import mock
+from tornado.ioloop import IOLoop
+
+from guiserver import (
+    auth,
+    utils,
+)
+from guiserver.bundles.base import (
+    ChangeSetMiddleware,
+    Deployer,
+    DeployMiddleware,
+)
+from guiserver.coalescing import CoalesceMiddleware
+
+
+# Define the size of a megabyte, used to normalize the results.
+MB = 1024 * 1024
+# Map benchmark names to benchmark functions.
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register the decorated function as a benchmark."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def cpu_time():
+    """Return the user and system CPU time consumed by this process."""
+    user, system = os.times()[:2]
+    return user + system
+
+
+def measure(func, messages, size=None):
+    """Call func with each one of the given messages.
+
+    Return the CPU seconds spent per MB of processed messages. If the messages
+    are not strings, the size in bytes they represent must be provided.
+    """
+    if size is None:
+        size = sum(len(message) for message in messages)
+    start = cpu_time()
+    for message in messages:
+        func(message)
+    return (cpu_time() - start) * MB / size
+
+
+def report(name, before, after):
+    """Print the results of a benchmark comparing two implementations."""
+    print('{}: {:.4f} -> {:.4f} CPU seconds per MB'.format(
+        name, before, after))
+
+
+def make_deltas_message(request_id, num_deltas):
+    """Return a JSON encoded AllWatcher Next response.
+
+    The response includes the given number of unit deltas.
+    """
+    deltas = []
+    for num in range(num_deltas):
+        deltas.append(['unit', 'change', {
+            'Name': 'service-{}/{}'.format(num // 10, num),
+            'Service': 'service-{}'.format(num // 10),
+            'Series': 'trusty',
+            'CharmURL': 'cs:trusty/service-{}-42'.format(num // 10),
+            'PublicAddress': '10.0.3.{}'.format(num % 256),
+            'PrivateAddress': '10.0.3.{}'.format(num % 256),
+            'MachineId': str(num),
+            'Ports': [{'Protocol': 'tcp', 'Number': 80}],
+            'Status': 'started',
+            'StatusInfo': '',
+        }])
+    # Juju-core always sends the request id as the first key.
+    return u'{{"RequestId":{},"Response":{}}}'.format(
+        request_id, json.dumps({'Deltas': deltas}))
+
+
+def make_bundle_message(request_id, num_services):
+    """Return a JSON encoded bundle deployment request.
+
+    The bundle includes the given number of services, each one related to the
+    previous one.
+    """
+    services = {}
+    relations = []
+    for num in range(num_services):
+        name = 'service-{}'.format(num)
+        services[name] = {
+            'charm': 'cs:trusty/{}-42'.format(name),
+            'num_units': num % 5 + 1,
+            'options': dict(
+                ('option-{}'.format(i), 'value' * 10) for i in range(20)),
+            'annotations': {'gui-x': str(num * 100), 'gui-y': '200'},
+        }
+        if num:
+            relations.append(['service-{}:db'.format(num - 1), name + ':db'])
+    bundle = {'services': services, 'relations': relations}
+    return json.dumps({
+        'RequestId': request_id,
+        'Type': 'Deployer',
+        'Request': 'Import',
+        'Params': {'YAML': json.dumps({'bundle': bundle}), 'Version': 4},
+    })
+
+
+@benchmark
+def json_codecs():
+    """Compare the installed JSON codecs with the stdlib json module.
+
+    Payloads are AllWatcher responses and bundle deployment requests.
+    """
+    deltas_messages = [make_deltas_message(num, 1000) for num in range(20)]
+    bundle_messages = [make_bundle_message(num, 100) for num in range(200)]
+    codecs = []
+    for name in utils.JSON_CODECS:
+        try:
+            codecs.append((name, utils._load_json_codec(name)))
+        except ImportError:
+            print('{}: not installed'.format(name))
+    stdlib_encode, stdlib_decode = utils._load_json_codec('json')
+    for label, messages in (
+            ('deltas', deltas_messages), ('bundles', bundle_messages)):
+        values = [stdlib_decode(message) for message in messages]
+        size = sum(len(message) for message in messages)
+        decode_before = measure(stdlib_decode, messages)
+        encode_before = measure(stdlib_encode, values, size)
+        print('{} (json): decode {:.4f}, encode {:.4f} CPU seconds per '
+              'MB'.format(label, decode_before, encode_before))
+        for name, (encode, decode) in codecs:
+            if name == 'json':
+                continue
+            report('{} decode ({})'.format(label, name),
+                   decode_before, measure(decode, messages))
+            report('{} encode ({})'.format(label, name),
+                   encode_before, measure(encode, values, size))
+
+
+@benchmark
+def proxy_inspection():
+    """Compare full decoding of proxied frames with their pre-classification.
+
+    Frames from juju-core are only inspected for the leading request id (the
+    worst case, happening while authentication is in progress), browser
+    frames only for their types.
+    """
+    juju_messages = [make_deltas_message(num, 1000) for num in range(50)]
+    report(
+        'juju -> client',
+        measure(utils.json_decode_dict, juju_messages),
+        measure(utils.leading_request_id, juju_messages))
+    client_messages = [json.dumps({
+        'RequestId': num,
+        'Type': 'Client',
+        'Request': 'ServiceSet',
+        'Params': {
+            'ServiceName': 'service-{}'.format(num),
+            'Options': dict(('option-{}'.format(i), 'value' * 10)
+                            for i in range(100)),
+        },
+    }) for num in range(5000)]
+    report(
+        'client -> juju',
+        measure(utils.json_decode_dict, client_messages),
+        measure(utils.message_types, client_messages))
+
+
+@benchmark
+def frame_logging():
+    """Compare eager frame logging with log_frame when debug is disabled.
+
+    Before, each proxied frame was encoded and formatted even if the
+    resulting debug message was then discarded.
+    """
+    logging.getLogger().setLevel(logging.INFO)
+    messages = [make_deltas_message(num, 1000) for num in range(50)] * 20
+
+    def eager(message):
+        encoded = message.encode('utf-8')
+        logging.debug('ws: ' + 'juju -> client: {}'.format(encoded))
+
+    def lazy(message):
+        utils.log_frame('ws: ', 'juju -> client', message)
+
+    report('debug disabled', measure(eager, messages), measure(lazy, messages))
+    # With debug enabled, compare whole frames with truncated and sampled
+    # ones. Log records are discarded by a null handler.
+    logger = logging.getLogger()
+    handlers = logger.handlers
+    logger.handlers = [logging.NullHandler()]
+    logger.setLevel(logging.DEBUG)
+    try:
+        before = measure(lazy, messages)
+        utils.set_frame_logging(max_size=1000, sample_rate=10)
+        after = measure(lazy, messages)
+    finally:
+        utils.set_frame_logging()
+        logger.handlers = handlers
+        logger.setLevel(logging.INFO)
+    report('debug enabled (1000 chars, 1 in 10)', before, after)
+
+
+@benchmark
+def passthrough():
+    """Compare decoded text frames with raw pass-through forwarding.
+
+    Before, text frames received from the Juju API were decoded to unicode,
+    encoded again and concatenated to the outgoing frame header.
+    """
+    messages = [
+        make_deltas_message(num, 1000).encode('utf-8') for num in range(50)]
+    header = b'\x81\x7f' + b'\x00' * 8
+    written = []
+
+    def decoded(data):
+        message = data.decode('utf-8')
+        written.append(header + message.encode('utf-8'))
+
+    def raw(data):
+        written.append(header)
+        written.append(data)
+
+    before = measure(decoded, messages * 20)
+    del written[:]
+    report('juju -> client', before, measure(raw, messages * 20))
+
+
+@benchmark
+def dispatch():
+    """Compare the chain of middleware checks with the routes table.
+
+    Before, each decoded browser request was checked in turn by the change
+    set, deployment, token and AllWatcher middlewares, each one performing
+    several dict lookups. Results are in microseconds per request.
+    """
+    user = auth.User(is_authenticated=True)
+    changeset = ChangeSetMiddleware(user, None)
+    deployment = DeployMiddleware(user, None, None)
+    tokens = auth.AuthenticationTokenHandler()
+    coalescer = CoalesceMiddleware(None, None, None)
+    routes = {}
+    for request in changeset.routes:
+        routes['ChangeSet', request] = changeset.process_request
+    for request in deployment.routes:
+        routes['Deployer', request] = deployment.process_request
+    routes['GUIToken', 'Create'] = tokens.process_token_request
+    routes['AllWatcher', 'Next'] = coalescer.process_request
+    requests = [
+        {'RequestId': num, 'Type': request_type, 'Request': request,
+         'Params': {}}
+        for num in range(10000)
+        for request_type, request in (
+            ('AllWatcher', 'Next'),
+            ('Client', 'FullStatus'),
+            ('Deployer', 'Status'),
+        )
+    ]
+
+    def chain(data):
+        (changeset.requested(data) or deployment.requested(data) or
+         tokens.token_requested(data) or coalescer.requested(data))
+
+    def table(data):
+        if 'RequestId' in data:
+            routes.get((data.get('Type'), data.get('Request')))
+
+    # Requests are not strings: use their number as size, and convert the
+    # resulting CPU seconds per MB to microseconds per request.
+    scale = 1000000.0 / MB
+    before = measure(chain, requests, len(requests)) * scale
+    after = measure(table, requests, len(requests)) * scale
+    print('client -> juju: {:.3f} -> {:.3f} microseconds per request'.format(
+        before, after))
+
+
+def import_bundle(
+        apiurl, username, password, name, bundle, version, options):
+    """Replace the blocking bundle import when benchmarking deployments.
+
+    This function is defined at module level so that it can be pickled and
+    run by the Deployer worker processes.
+    """
+
+
+@benchmark
+def deployment_queue():
+    """Measure the wall clock time spent deploying queued bundles.
+
+    The bundle import itself is replaced by a no-op, so that the results only
+    include the Deployer scheduling and process hand off. Before, a one
+    second sleep was executed after each deployment.
+    """
+    num_bundles = 20
+    io_loop = IOLoop()
+    deployer = Deployer('wss://example.com:17070', 'go', io_loop=io_loop)
+    user = auth.User(
+        username='admin', password='secret', is_authenticated=True)
+    completed = []
+
+    def callback(future):
+        completed.append(future)
+        if len(completed) == num_bundles:
+            io_loop.stop()
+
+    import_bundle_path = 'guiserver.bundles.base.blocking.import_bundle'
+    with mock.patch(import_bundle_path, import_bundle):
+        start = time.time()
+        for _ in range(num_bundles):
+            deployer.import_bundle(
+                user, 'bundle', {'services': {}}, 4, None,
+                test_callback=callback)
+        io_loop.start()
+        elapsed = time.time() - start
+    io_loop.close()
+    print('{} queued bundles deployed in {:.3f} seconds'.format(
+        num_bundles, elapsed))
+
+
+def main(names):
+    """Run the benchmarks with the given names, or all of them."""
+    for name in names or sorted(BENCHMARKS):
+        print('{}:'.format(name))
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -16,6 +16,11 @@
 
 """Tests for the bundle deployment base objects."""
 
+import os
+import shutil
+import tempfile
+import unittest
+
 from deployer import cli as deployer_cli
 import jujuclient
 import mock
@@ -29,6 +34,7 @@ from tornado.testing import(
 from guiserver import auth
 from guiserver.bundles import (
     base,
+    journal,
     utils,
 )
 from guiserver.tests import helpers
@@ -83,6 +89,12 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
             expected['Error'] = error
         self.assertEqual(expected, changes[0])
 
+    def add_started(self, deployer, deployment_id):
+        """Simulate the given deployment is started on the default model."""
+        deployer._queues[self.apiurl] = [deployment_id]
+        deployer._targets[deployment_id] = self.apiurl
+        deployer._futures[deployment_id] = None
+
     @gen_test
     def test_validation_success(self):
         # None is returned if the validation succeeds.
@@ -110,6 +122,69 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
             self.apiurl, self.user.username, self.user.password, self.bundle)
         mock_validate.assert_called_in_a_separate_process()
 
+    @gen_test
+    def test_validation_cache(self):
+        # Validation results are reused when the same bundle is validated
+        # again on the same model.
+        deployer = self.make_deployer()
+        with self.patch_validate() as mock_validate:
+            result1 = yield deployer.validate(self.user, self.bundle)
+            result2 = yield deployer.validate(self.user, {'foo': 'bar'})
+        self.assertIsNone(result1)
+        self.assertIsNone(result2)
+        self.assertEqual(1, mock_validate.call_count)
+
+    @gen_test
+    def test_validation_cache_failure(self):
+        # Failed validations are not cached.
+        deployer = self.make_deployer()
+        error = ValueError('network error')
+        with self.patch_validate(side_effect=error) as mock_validate:
+            result = yield deployer.validate(self.user, self.bundle)
+        self.assertEqual(str(error), result)
+        with self.patch_validate() as mock_validate:
+            result = yield deployer.validate(self.user, self.bundle)
+        self.assertIsNone(result)
+        self.assertEqual(1, mock_validate.call_count)
+
+    @gen_test
+    def test_validation_cache_model(self):
+        # Bundles are validated again when deployed to a different model.
+        deployer = self.make_deployer()
+        apiurl = 'wss://example.com:17070/model/another-uuid/api'
+        with self.patch_validate() as mock_validate:
+            yield deployer.validate(self.user, self.bundle)
+            yield deployer.validate(self.user, self.bundle, apiurl=apiurl)
+        expected = [
+            ((url, self.user.username, self.user.password, self.bundle), {})
+            for url in (self.apiurl, apiurl)
+        ]
+        self.assertEqual(expected, mock_validate.call_args_list)
+
+    @gen_test
+    def test_validation_cache_expired(self):
+        # Bundles are validated again when the cached result is expired.
+        deployer = self.make_deployer()
+        clock = mock.Mock(return_value=1000)
+        deployer._validation_cache._clock = clock
+        with self.patch_validate() as mock_validate:
+            yield deployer.validate(self.user, self.bundle)
+            clock.return_value = 1000 + base.VALIDATION_CACHE_TTL - 1
+            yield deployer.validate(self.user, self.bundle)
+            self.assertEqual(1, mock_validate.call_count)
+            clock.return_value = 1000 + base.VALIDATION_CACHE_TTL
+            yield deployer.validate(self.user, self.bundle)
+        self.assertEqual(2, mock_validate.call_count)
+
+    @gen_test
+    def test_validation_cache_disabled(self):
+        # Bundles are always validated if the cache is disabled.
+        deployer = base.Deployer(self.apiurl, 'go', validation_cache_size=0)
+        with self.patch_validate() as mock_validate:
+            yield deployer.validate(self.user, self.bundle)
+            yield deployer.validate(self.user, self.bundle)
+        self.assertEqual(2, mock_validate.call_count)
+
     @gen_test
     def test_unsupported_api_version(self):
         # An error message is returned the API version is not supported.
@@ -286,6 +361,119 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         # Wait for the deployment to be completed.
         self.wait()
 
+    @gen_test
+    def test_parallel_deployments(self):
+        # Deployments to different models are queued separately.
+        deployer = self.make_deployer()
+        apiurl = 'wss://example.com:17070/model/another-uuid/api'
+        with self.patch_import_bundle() as mock_import_bundle:
+            deployment1 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None)
+            deployment2 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                apiurl=apiurl)
+            deployment3 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                apiurl=apiurl, test_callback=self.stop)
+        # The first deployment to each model is started.
+        for deployment_id in (deployment1, deployment2):
+            changes = yield deployer.next(deployer.watch(deployment_id))
+            self.assert_change(
+                changes, deployment_id, utils.STARTED, queue=0)
+        # The third deployment waits for the second one.
+        watcher3 = deployer.watch(deployment3)
+        changes = yield deployer.next(watcher3)
+        self.assert_change(changes, deployment3, utils.SCHEDULED, queue=1)
+        changes = yield deployer.next(watcher3)
+        self.assert_change(changes, deployment3, utils.STARTED, queue=0)
+        changes = yield deployer.next(watcher3)
+        self.assert_change(changes, deployment3, utils.COMPLETED)
+        # The deployment test callback has been called.
+        self.wait()
+        # Deployments to different models may start in any order.
+        expected = [
+            ((url, self.user.username, self.user.password, 'bundle',
+              self.bundle, self.version, deployer.importer_options), {})
+            for url in (self.apiurl, apiurl, apiurl)
+        ]
+        self.assertItemsEqual(expected, mock_import_bundle.call_args_list)
+        self.assertEqual({}, deployer._queues)
+
+    def test_cancel_pending_deployment(self):
+        # Deployments waiting for their model queue are cancelled without
+        # affecting the queue of other models.
+        deployer = self.make_deployer()
+        apiurl = 'wss://example.com:17070/model/another-uuid/api'
+        with self.patch_import_bundle():
+            deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None)
+            deployment2 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                apiurl=apiurl, test_callback=self.stop)
+            deployment3 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None)
+        self.assertIsNone(deployer.cancel(deployment3))
+        change = deployer._observer.deployments[deployment3].getlast()
+        self.assertEqual(utils.CANCELLED, change['Status'])
+        self.assertEqual([deployment2], deployer._queues[apiurl])
+        self.assertNotIn(deployment3, deployer._targets)
+        # Wait for the deployments to be completed.
+        self.wait()
+
+    def test_worker_handoff(self):
+        # Deployments are only submitted when a worker is free, and the next
+        # ready deployment starts as soon as the previous one completes.
+        deployer = self.make_deployer()
+        apiurl = 'wss://example.com:17070/model/another-uuid/api'
+        with self.patch_import_bundle() as mock_import_bundle:
+            deployment1 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None)
+            deployment2 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                apiurl=apiurl, test_callback=self.stop)
+            self.assertEqual([deployment1], deployer._futures.keys())
+            self.assertEqual([deployment2], list(deployer._ready))
+            # Wait for the deployments to be completed.
+            self.wait()
+        self.assertEqual(2, mock_import_bundle.call_count)
+        self.assertEqual({}, deployer._futures)
+        self.assertEqual(0, len(deployer._ready))
+
+    def test_multiple_workers(self):
+        # Deployments to different models are started at the same time if
+        # enough workers are available.
+        deployer = base.Deployer(self.apiurl, 'go', workers=2)
+        apiurl = 'wss://example.com:17070/model/another-uuid/api'
+        with self.patch_import_bundle():
+            deployment1 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None)
+            deployment2 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                apiurl=apiurl, test_callback=self.stop)
+            self.assertEqual(
+                [deployment1, deployment2], sorted(deployer._futures))
+            self.assertEqual(0, len(deployer._ready))
+            # Wait for the deployments to be completed.
+            self.wait()
+
+    def test_cancel_ready_deployment(self):
+        # Deployments waiting for a free worker can be cancelled.
+        deployer = self.make_deployer()
+        apiurl = 'wss://example.com:17070/model/another-uuid/api'
+        with self.patch_import_bundle() as mock_import_bundle:
+            deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                test_callback=self.stop)
+            deployment2 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                apiurl=apiurl)
+            self.assertIsNone(deployer.cancel(deployment2))
+            self.assertEqual(0, len(deployer._ready))
+            self.assertNotIn(apiurl, deployer._queues)
+            # Wait for the first deployment to be completed.
+            self.wait()
+        self.assertEqual(1, mock_import_bundle.call_count)
+
     def test_cancel_unknown_deployment(self):
         # An error is returned when trying to cancel an invalid deployment.
         deployer = self.make_deployer()
@@ -330,6 +518,113 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         yield deployer.next(watcher_id)
         self.wait()
 
+    def make_journal_path(self, *deployments):
+        """Return a journal directory including the given deployments.
+
+        Each deployment is a (deployment_id, status) tuple, recorded by a
+        server process no longer running.
+        """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        previous = journal.Journal(path, io_loop=mock.Mock())
+        for deployment_id, status in deployments:
+            previous.add_import(
+                deployment_id, self.apiurl, self.user, 'bundle', self.bundle,
+                self.version, None)
+            previous.add_change(utils.create_change(deployment_id, status))
+        previous.close()
+        return path
+
+    def make_journal_deployer(self, path):
+        """Create and return a Deployer recording deployments in path."""
+        deployer = base.Deployer(self.apiurl, 'go', journal_path=path)
+        self.addCleanup(deployer._adopter.stop)
+        return deployer
+
+    @gen_test
+    def test_journal_resume(self):
+        # Unfinished deployments recorded in the journal are resumed.
+        path = self.make_journal_path((0, utils.COMPLETED), (1, utils.STARTED))
+        with self.patch_import_bundle() as mock_import_bundle:
+            deployer = self.make_journal_deployer(path)
+            watcher_id = deployer.watch(1)
+            while True:
+                changes = yield deployer.next(watcher_id)
+                if changes[-1]['Status'] == utils.COMPLETED:
+                    break
+        mock_import_bundle.assert_called_once_with(
+            self.apiurl, self.user.username, self.user.password, 'bundle',
+            self.bundle, self.version, deployer.importer_options)
+        # The adopted journal has been removed.
+        self.assertEqual(
+            [os.path.basename(deployer._journal.filename)], os.listdir(path))
+
+    def test_journal_history(self):
+        # The status of deployments recorded in the journal is reported.
+        path = self.make_journal_path(
+            (0, utils.COMPLETED), (1, utils.CANCELLED))
+        deployer = self.make_journal_deployer(path)
+        status = deployer.status()
+        self.assertEqual(
+            [(0, utils.COMPLETED), (1, utils.CANCELLED)],
+            sorted((change['DeploymentId'], change['Status'])
+                   for change in status))
+        # New deployments do not reuse recorded identifiers.
+        with self.patch_import_bundle():
+            deployment_id = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                test_callback=self.stop)
+        self.assertEqual(2, deployment_id)
+        # Wait for the deployment to be completed.
+        self.wait()
+
+    def test_journal_records(self):
+        # Deployments are recorded in the journal.
+        path = self.make_journal_path()
+        deployer = self.make_journal_deployer(path)
+        with self.patch_import_bundle():
+            deployment_id = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                test_callback=self.stop)
+        # Wait for the deployment to be completed.
+        self.wait()
+        deployments = journal.read(deployer._journal.filename)
+        self.assertEqual(1, len(deployments))
+        change, params = deployments[0]
+        self.assertEqual(deployment_id, change['DeploymentId'])
+        self.assertEqual(utils.COMPLETED, change['Status'])
+        self.assertIsNone(params)
+
+    def test_history_expired(self):
+        # The history of old deployments is removed, and an error is returned
+        # when watching their changes.
+        deployer = base.Deployer(self.apiurl, 'go', history_size=1)
+        with self.patch_import_bundle():
+            deployment1 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None)
+            deployment2 = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                test_callback=self.stop)
+        watcher1 = deployer.watch(deployment1)
+        # Wait for the deployments to be completed.
+        self.wait()
+        status = deployer.status()
+        self.assertEqual([deployment2], [i['DeploymentId'] for i in status])
+        self.assertIsNone(deployer.watch(deployment1))
+        error = deployer.next(watcher1)
+        self.assertEqual(
+            'watcher {} expired: the deployment history is no longer '
+            'available'.format(watcher1), error)
+
+    def test_history_journal(self):
+        # Deployments whose history is removed are no longer tracked by the
+        # journal.
+        deployer = self.make_journal_deployer(self.make_journal_path(
+            (0, utils.COMPLETED), (1, utils.COMPLETED)))
+        deployer._observer.max_count = 1
+        deployer.status()
+        self.assertEqual([1], deployer._journal._state.keys())
+
     def test_initial_status(self):
         # The initial deployer status is an empty list.
         deployer = self.make_deployer()
@@ -356,8 +651,7 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
     def test_import_callback_cancelled(self):
         deployer = self.make_deployer()
         deployer_id = 123
-        deployer._queue.append(deployer_id)
-        deployer._futures[deployer_id] = None
+        self.add_started(deployer, deployer_id)
         mock_path = 'guiserver.bundles.utils.increment_deployment_counter'
         future = FakeFuture(True)
         with mock.patch.object(
@@ -370,8 +664,7 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
     def test_import_callback_error(self):
         deployer = self.make_deployer()
         deployer_id = 123
-        deployer._queue.append(deployer_id)
-        deployer._futures[deployer_id] = None
+        self.add_started(deployer, deployer_id)
         mock_path = 'guiserver.bundles.utils.increment_deployment_counter'
         future = FakeFuture(exception='aiiee')
         with mock.patch.object(
@@ -384,8 +677,7 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
     def test_import_callback_no_bundleid(self):
         deployer = self.make_deployer()
         deployer_id = 123
-        deployer._queue.append(deployer_id)
-        deployer._futures[deployer_id] = None
+        self.add_started(deployer, deployer_id)
         mock_path = 'guiserver.bundles.utils.increment_deployment_counter'
         future = FakeFuture()
         with mock.patch.object(
@@ -400,8 +692,7 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         deployer_id = 123
         bundle_id = '~jorge/basket/bundle'
         deployer._charmworldurl = 'http://cw.example.com'
-        deployer._queue.append(deployer_id)
-        deployer._futures[deployer_id] = None
+        self.add_started(deployer, deployer_id)
         mock_path = 'guiserver.bundles.utils.increment_deployment_counter'
         future = FakeFuture()
         with mock.patch.object(
@@ -412,6 +703,24 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         mock_incrementer.assert_called_with(bundle_id, deployer._charmworldurl)
 
 
+class TestMakeDeployer(unittest.TestCase):
+
+    def test_deployer(self):
+        # The Deployer is created using the given options.
+        options = mock.Mock(
+            apiurl='wss://example.com:17070', apiversion='go',
+            charmworldurl='http://cw.example.com', deployworkers=2,
+            validateworkers=3, validatecache=10, deployjournal=None,
+            deployhistoryage=600, deployhistory=50)
+        with mock.patch('guiserver.bundles.base.Deployer') as mock_deployer:
+            deployer = base.make_deployer(options)
+        mock_deployer.assert_called_once_with(
+            'wss://example.com:17070', 'go', 'http://cw.example.com',
+            workers=2, validate_workers=3, validation_cache_size=10,
+            journal_path=None, history_age=600, history_size=50)
+        self.assertEqual(mock_deployer.return_value, deployer)
+
+
 class TestDeployMiddleware(helpers.BundlesTestMixin, AsyncTestCase):
 
     def setUp(self):
@@ -550,6 +859,24 @@ class TestDeployMiddleware(helpers.BundlesTestMixin, AsyncTestCase):
         response = self.responses[0]
         self.assertEqual({'RequestId': 42, 'Response': 'ok'}, response)
 
+    @gen_test
+    def test_process_request_model(self):
+        # The model the client is connected to is passed to views.
+        apiurl = 'wss://example.com:17070/model/uuid/api'
+        deployment = base.DeployMiddleware(
+            self.user, self.deployer, self.responses.append, apiurl=apiurl)
+        requests = []
+
+        @gen.coroutine
+        def view(request, deployer):
+            requests.append(request)
+            return {'Response': 'ok'}
+
+        deployment.routes['Import'] = view
+        yield deployment.process_request(
+            self.make_deployment_request('Import'))
+        self.assertEqual(apiurl, requests[0].apiurl)
+
     @gen_test
     def test_process_request_v4(self):
         # A deployment request is correctly processed.
@@ -0,0 +1,189 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the bundle deployment inter-process communication."""
+
+import os
+import shutil
+import tempfile
+
+import mock
+from tornado import concurrent
+from tornado.netutil import bind_unix_socket
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    gen_test,
+    LogTrapTestCase,
+)
+
+from guiserver import auth
+from guiserver.bundles import ipc
+
+
+class TestDeployerIPC(LogTrapTestCase, AsyncTestCase):
+
+    user = auth.User(
+        username='myuser', password='mypasswd', is_authenticated=True)
+
+    def setUp(self):
+        # Set up a Deployer server listening on a UNIX socket, and a client
+        # connected to it.
+        super(TestDeployerIPC, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'deployer.sock')
+        self.deployer = mock.Mock()
+        self.server = ipc.DeployerServer(self.deployer, io_loop=self.io_loop)
+        self.server.add_socket(bind_unix_socket(path))
+        self.addCleanup(self.server.stop)
+        self.client = ipc.DeployerClient(path, io_loop=self.io_loop)
+
+    def make_future(self, result):
+        """Create and return a Future containing the given result."""
+        future = concurrent.Future()
+        future.set_result(result)
+        return future
+
+    @gen_test
+    def test_validate(self):
+        # Bundles are validated by the remote Deployer on behalf of the user.
+        self.deployer.validate.return_value = self.make_future('bad wolf')
+        error = yield self.client.validate(self.user, {'services': {}})
+        self.assertEqual('bad wolf', error)
+        self.assertEqual(1, self.deployer.validate.call_count)
+        user, bundle = self.deployer.validate.call_args[0]
+        self.assertEqual('myuser', user.username)
+        self.assertEqual('mypasswd', user.password)
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual({'services': {}}, bundle)
+
+    @gen_test
+    def test_import_bundle(self):
+        # Bundles are imported by the remote Deployer.
+        self.deployer.import_bundle.return_value = 42
+        deployment_id = yield self.client.import_bundle(
+            self.user, 'bundle', {'services': {}}, 4, '~who/bundle')
+        self.assertEqual(42, deployment_id)
+        user, name, bundle, version, bundle_id = (
+            self.deployer.import_bundle.call_args[0])
+        self.assertEqual('myuser', user.username)
+        self.assertEqual(
+            ('bundle', {'services': {}}, 4, '~who/bundle'),
+            (name, bundle, version, bundle_id))
+        self.assertIsNone(self.deployer.import_bundle.call_args[1]['apiurl'])
+
+    @gen_test
+    def test_model(self):
+        # The target model is passed to the remote Deployer.
+        apiurl = 'wss://example.com:17070/model/uuid/api'
+        self.deployer.validate.return_value = self.make_future(None)
+        self.deployer.import_bundle.return_value = 42
+        yield self.client.validate(self.user, {'services': {}}, apiurl=apiurl)
+        yield self.client.import_bundle(
+            self.user, 'bundle', {'services': {}}, 4, None, apiurl=apiurl)
+        self.assertEqual(
+            apiurl, self.deployer.validate.call_args[1]['apiurl'])
+        self.assertEqual(
+            apiurl, self.deployer.import_bundle.call_args[1]['apiurl'])
+
+    @gen_test
+    def test_watch_and_next(self):
+        # Deployments can be observed remotely.
+        self.deployer.watch.return_value = 47
+        self.deployer.next.return_value = self.make_future(['change'])
+        watcher_id = yield self.client.watch(42)
+        self.assertEqual(47, watcher_id)
+        changes = yield self.client.next(watcher_id)
+        self.assertEqual(['change'], changes)
+        self.deployer.watch.assert_called_once_with(42)
+        self.deployer.next.assert_called_once_with(47)
+
+    @gen_test
+    def test_invalid_watcher(self):
+        # None is returned if the remote watcher is not valid.
+        self.deployer.next.return_value = None
+        changes = yield self.client.next(47)
+        self.assertIsNone(changes)
+
+    @gen_test
+    def test_cancel_and_status(self):
+        # Deployments can be cancelled remotely and their status retrieved.
+        self.deployer.cancel.return_value = 'unable to cancel the deployment'
+        self.deployer.status.return_value = [{'DeploymentId': 42}]
+        error = yield self.client.cancel(42)
+        self.assertEqual('unable to cancel the deployment', error)
+        status = yield self.client.status()
+        self.assertEqual([{'DeploymentId': 42}], status)
+
+    @gen_test
+    def test_concurrent_calls(self):
+        # Multiple calls can be pending at the same time.
+        pending = concurrent.Future()
+        self.deployer.next.side_effect = [pending, self.make_future(['b'])]
+        first = self.client.next(1)
+        second = yield self.client.next(2)
+        self.assertEqual(['b'], second)
+        self.assertFalse(first.done())
+        pending.set_result(['a'])
+        changes = yield first
+        self.assertEqual(['a'], changes)
+
+    @gen_test
+    def test_remote_error(self):
+        # The failure value is returned if the remote call raises an error.
+        self.deployer.status.side_effect = ValueError('bad wolf')
+        expected_log = 'deployer client: 0 failure: bad wolf'
+        with ExpectLog('', expected_log, required=True):
+            status = yield self.client.status()
+        self.assertEqual([], status)
+
+    @gen_test
+    def test_connection_lost(self):
+        # Pending calls are resolved with their failure values when the
+        # connection to the server is lost.
+        self.deployer.next.return_value = concurrent.Future()
+        self.deployer.watch.return_value = 47
+        yield self.client.watch(42)
+        future = self.client.next(47)
+        expected_log = 'deployer client: connection to the deployer lost'
+        with ExpectLog('', expected_log, required=True):
+            self.client._stream.close()
+            changes = yield future
+        self.assertIsNone(changes)
+        # The client connects again when needed.
+        watcher_id = yield self.client.watch(42)
+        self.assertEqual(47, watcher_id)
+
+    @gen_test
+    def test_invalid_response(self):
+        # Pending calls are resolved with their failure values when an
+        # invalid response is received.
+        self.deployer.next.return_value = concurrent.Future()
+        future = self.client.next(47)
+        send = self.server._send
+        self.server._send = lambda stream, data: stream.write(b'{"Id": 1\n')
+        expected_log = 'deployer client: invalid response'
+        with ExpectLog('', expected_log, required=True):
+            status = yield self.client.status()
+            changes = yield future
+        self.assertEqual([], status)
+        self.assertIsNone(changes)
+        # The client connects again when needed.
+        self.server._send = send
+        self.deployer.watch.return_value = 47
+        watcher_id = yield self.client.watch(42)
+        self.assertEqual(47, watcher_id)
@@ -0,0 +1,257 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the bundle deployments journal."""
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mock
+from tornado.testing import LogTrapTestCase
+
+from guiserver import auth
+from guiserver.bundles import (
+    journal,
+    utils,
+)
+
+
+mock_time = mock.patch('time.time', mock.Mock(return_value=12345))
+user = auth.User(username='who', password='secret', is_authenticated=True)
+
+
+def make_import(deployment_id):
+    """Return the import parameters recorded for the given deployment."""
+    return {
+        'DeploymentId': deployment_id,
+        'ApiUrl': 'wss://example.com:17070',
+        'Username': 'who',
+        'Password': 'secret',
+        'Name': 'bundle',
+        'Bundle': {'services': {}},
+        'Version': 4,
+        'BundleId': None,
+    }
+
+
+@mock_time
+class TestRead(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        journal_file = tempfile.NamedTemporaryFile(delete=False)
+        journal_file.close()
+        self.path = journal_file.name
+        self.addCleanup(os.remove, self.path)
+
+    def write(self, *records):
+        """Write the given records to the journal."""
+        with open(self.path, 'ab') as journal_file:
+            for record in records:
+                journal_file.write(json.dumps(record) + '\n')
+
+    def test_empty(self):
+        # No deployments are returned if the journal is empty.
+        self.assertEqual([], journal.read(self.path))
+
+    def test_deployments(self):
+        # The last change of each deployment is returned, and the import
+        # parameters are only included for unfinished deployments.
+        scheduled = utils.create_change(1, utils.SCHEDULED, queue=1)
+        started = utils.create_change(0, utils.STARTED, queue=0)
+        completed = utils.create_change(0, utils.COMPLETED)
+        self.write(
+            {'Import': make_import(0)},
+            {'Change': started},
+            {'Import': make_import(1)},
+            {'Change': scheduled},
+            {'Change': completed},
+        )
+        expected = [(completed, None), (scheduled, make_import(1))]
+        self.assertEqual(expected, journal.read(self.path))
+
+    def test_import_without_changes(self):
+        # Imports with no recorded changes are scheduled.
+        self.write({'Import': make_import(0)})
+        expected = [
+            (utils.create_change(0, utils.SCHEDULED), make_import(0))]
+        self.assertEqual(expected, journal.read(self.path))
+
+    def test_missing_import(self):
+        # Unfinished deployments cannot be resumed without import parameters.
+        self.write({'Change': utils.create_change(0, utils.STARTED, queue=0)})
+        change = utils.create_change(
+            0, utils.COMPLETED, error='unable to resume the deployment')
+        self.assertEqual([(change, None)], journal.read(self.path))
+
+    def test_invalid_records(self):
+        # Invalid records are ignored.
+        change = utils.create_change(0, utils.CANCELLED)
+        self.write({'Change': change})
+        with open(self.path, 'ab') as journal_file:
+            journal_file.write('{"Change": {"Deploym')
+        self.assertEqual([(change, None)], journal.read(self.path))
+
+
+class TestJournal(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.io_loop = mock.Mock()
+
+    def make_journal(self):
+        """Create and return a journal in the test directory."""
+        result = journal.Journal(self.path, io_loop=self.io_loop)
+        self.addCleanup(result._file.close)
+        return result
+
+    def read_records(self, journal_instance):
+        """Return the records written to the given journal."""
+        with open(journal_instance.filename, 'rb') as journal_file:
+            return [json.loads(line) for line in journal_file]
+
+    def test_journal_file(self):
+        # Each journal has its own file, only readable by the owner.
+        journal1 = self.make_journal()
+        journal2 = self.make_journal()
+        self.assertNotEqual(journal1.filename, journal2.filename)
+        self.assertEqual(
+            sorted([journal1.filename, journal2.filename]),
+            sorted(os.path.join(self.path, name)
+                   for name in os.listdir(self.path)))
+        mode = stat.S_IMODE(os.stat(journal1.filename).st_mode)
+        self.assertEqual(0o600, mode)
+
+    def test_create_directory(self):
+        # The journal directory is created if it does not exist.
+        self.path = os.path.join(self.path, 'journal')
+        self.make_journal()
+        self.assertTrue(os.path.isdir(self.path))
+
+    def test_add_import(self):
+        # Imports are written immediately.
+        journal_instance = self.make_journal()
+        journal_instance.add_import(
+            0, 'wss://example.com:17070', user, 'bundle', {'services': {}},
+            4, None)
+        self.assertEqual(
+            [{'Import': make_import(0)}], self.read_records(journal_instance))
+
+    def test_add_change_batched(self):
+        # Position changes are written after a delay.
+        journal_instance = self.make_journal()
+        change1 = utils.create_change(0, utils.STARTED, queue=0)
+        change2 = utils.create_change(1, utils.SCHEDULED, queue=1)
+        journal_instance.add_change(change1)
+        journal_instance.add_change(change2)
+        self.assertEqual([], self.read_records(journal_instance))
+        self.assertEqual(1, self.io_loop.add_timeout.call_count)
+        flush = self.io_loop.add_timeout.call_args[0][1]
+        flush()
+        self.assertEqual(
+            [{'Change': change1}, {'Change': change2}],
+            self.read_records(journal_instance))
+
+    def test_add_change_final(self):
+        # Final changes are written immediately, with the buffered ones.
+        journal_instance = self.make_journal()
+        change1 = utils.create_change(0, utils.STARTED, queue=0)
+        change2 = utils.create_change(0, utils.COMPLETED)
+        journal_instance.add_change(change1)
+        journal_instance.add_change(change2)
+        self.assertEqual(
+            [{'Change': change1}, {'Change': change2}],
+            self.read_records(journal_instance))
+        self.io_loop.remove_timeout.assert_called_once_with(
+            self.io_loop.add_timeout())
+
+    def test_compact(self):
+        # The journal is compacted when most records refer to forgotten
+        # deployments.
+        journal_instance = self.make_journal()
+        with mock.patch('guiserver.bundles.journal.COMPACT_THRESHOLD', 6):
+            for deployment_id in range(3):
+                journal_instance.add_import(
+                    deployment_id, 'wss://example.com:17070', user, 'bundle',
+                    {'services': {}}, 4, None)
+                journal_instance.add_change(
+                    utils.create_change(deployment_id, utils.COMPLETED))
+                if deployment_id < 2:
+                    journal_instance.forget(deployment_id)
+        change = utils.create_change(2, utils.COMPLETED)
+        self.assertEqual(
+            [{'Change': change}], self.read_records(journal_instance))
+        self.assertEqual([os.path.basename(journal_instance.filename)],
+                         os.listdir(self.path))
+
+    def test_compact_unfinished(self):
+        # Compacted journals include the parameters of unfinished imports.
+        journal_instance = self.make_journal()
+        change = utils.create_change(0, utils.STARTED, queue=0)
+        journal_instance.add_import(
+            0, 'wss://example.com:17070', user, 'bundle', {'services': {}},
+            4, None)
+        journal_instance.add_change(change)
+        journal_instance.compact()
+        self.assertEqual(
+            [{'Import': make_import(0)}, {'Change': change}],
+            self.read_records(journal_instance))
+
+    def test_adopt(self):
+        # Journals left by processes no longer running are adopted.
+        previous = self.make_journal()
+        previous.add_import(
+            0, 'wss://example.com:17070', user, 'bundle', {'services': {}},
+            4, None)
+        previous.close()
+        current = self.make_journal()
+        restore = mock.Mock()
+        self.assertEqual(1, current.adopt(restore))
+        restore.assert_called_once_with([(mock.ANY, make_import(0))])
+        self.assertEqual([os.path.basename(current.filename)],
+                         os.listdir(self.path))
+
+    def test_adopt_flush(self):
+        # Deployments recorded when restoring are written before removing the
+        # adopted journal.
+        self.make_journal().close()
+        current = self.make_journal()
+        change = utils.create_change(0, utils.STARTED, queue=0)
+        current.adopt(lambda deployments: current.add_change(change))
+        self.assertEqual([{'Change': change}], self.read_records(current))
+
+    def test_adopt_running(self):
+        # Journals of running processes are not adopted.
+        previous = self.make_journal()
+        current = self.make_journal()
+        restore = mock.Mock()
+        self.assertEqual(0, current.adopt(restore))
+        self.assertFalse(restore.called)
+        self.assertTrue(os.path.exists(previous.filename))
+
+    def test_adopt_new(self):
+        # Journals left by processes failed while starting are removed.
+        path = os.path.join(self.path, journal.NEW_PREFIX + 'bad-wolf')
+        open(path, 'w').close()
+        current = self.make_journal()
+        restore = mock.Mock()
+        self.assertEqual(0, current.adopt(restore))
+        self.assertFalse(restore.called)
+        self.assertFalse(os.path.exists(path))
@@ -268,6 +268,197 @@ class TestObserver(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(expected, watcher.getlast())
         self.assertTrue(watcher.closed)
 
+    @mock_time
+    def test_listener(self):
+        # The listener is called with each deployment change.
+        changes = []
+        observer = utils.Observer(listener=changes.append)
+        deployment_id = observer.add_deployment()
+        observer.notify_position(deployment_id, 1)
+        observer.notify_position(deployment_id, 0)
+        observer.notify_completed(deployment_id)
+        self.assertEqual(
+            [utils.SCHEDULED, utils.STARTED, utils.COMPLETED],
+            [change['Status'] for change in changes])
+        self.assertEqual(
+            observer.deployments[deployment_id].getlast(), changes[-1])
+
+    def test_restore(self):
+        # Deployments can be restored using their last change.
+        change = utils.create_change(3, utils.SCHEDULED, queue=1)
+        deployment_id = self.observer.restore(change)
+        self.assertEqual(3, deployment_id)
+        watcher = self.assert_deployment(deployment_id)
+        self.assertEqual(change, watcher.getlast())
+        self.assertFalse(watcher.closed)
+        # New deployments do not reuse restored identifiers.
+        self.assertEqual(4, self.observer.add_deployment())
+
+    def test_restore_completed(self):
+        # Completed deployments are restored closed.
+        change = utils.create_change(0, utils.COMPLETED, error='bad wolf')
+        deployment_id = self.observer.restore(change)
+        watcher = self.assert_deployment(deployment_id)
+        self.assertEqual(change, watcher.getlast())
+        self.assertTrue(watcher.closed)
+
+    def test_restore_existing(self):
+        # A new identifier is assigned if the restored one is already used.
+        changes = []
+        observer = utils.Observer(listener=changes.append)
+        observer.add_deployment()
+        deployment_id = observer.restore(
+            utils.create_change(0, utils.CANCELLED))
+        self.assertEqual(1, deployment_id)
+        change = observer.deployments[deployment_id].getlast()
+        self.assertEqual(1, change['DeploymentId'])
+        self.assertEqual([change], changes)
+
+    def test_collect_count(self):
+        # Only the last max_count finished deployments are kept.
+        observer = utils.Observer(max_count=2)
+        deployments = [observer.add_deployment() for _ in range(4)]
+        watchers = [observer.add_watcher(i) for i in deployments]
+        observer.notify_completed(deployments[0])
+        observer.notify_cancelled(deployments[2])
+        observer.notify_completed(deployments[3])
+        self.assertEqual([deployments[0]], observer.collect())
+        self.assertEqual(deployments[1:], sorted(observer.deployments))
+        self.assertNotIn(watchers[0], observer.watchers)
+        self.assertEqual(watchers[1:], sorted(observer.watchers))
+        self.assertEqual([], observer.collect())
+
+    def test_collect_age(self):
+        # Finished deployments are removed after max_age seconds.
+        observer = utils.Observer(max_age=60)
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            deployment1 = observer.add_deployment()
+            deployment2 = observer.add_deployment()
+            observer.notify_completed(deployment1)
+        with mock.patch('time.time', mock.Mock(return_value=1059)):
+            self.assertEqual([], observer.collect())
+            observer.notify_completed(deployment2)
+        with mock.patch('time.time', mock.Mock(return_value=1060)):
+            self.assertEqual([deployment1], observer.collect())
+        self.assertEqual([deployment2], observer.deployments.keys())
+
+    def test_collect_unfinished(self):
+        # Deployments in progress are never removed.
+        observer = utils.Observer(max_age=1, max_count=1)
+        deployment_id = observer.add_deployment()
+        observer.notify_position(deployment_id, 1)
+        self.assertEqual([], observer.collect())
+        self.assertIn(deployment_id, observer.deployments)
+
+    def test_collect_no_limits(self):
+        # Finished deployments are kept if no limits are provided.
+        deployment_id = self.observer.add_deployment()
+        self.observer.notify_completed(deployment_id)
+        self.assertEqual([], self.observer.collect())
+
+    def test_expired(self):
+        # Watchers of removed deployments are reported as expired.
+        observer = utils.Observer(max_count=1)
+        deployment1 = observer.add_deployment()
+        deployment2 = observer.add_deployment()
+        watcher1 = observer.add_watcher(deployment1)
+        watcher2 = observer.add_watcher(deployment2)
+        observer.notify_completed(deployment1)
+        observer.notify_completed(deployment2)
+        observer.collect()
+        self.assertTrue(observer.expired(watcher1))
+        self.assertFalse(observer.expired(watcher2))
+        # Watchers never assigned are not expired.
+        self.assertFalse(observer.expired(watcher2 + 1))
+        self.assertFalse(observer.expired('invalid'))
+
+
+class TestValidationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100
+
+    def make_cache(self, capacity=2):
+        """Return a validation cache whose entries expire after 30 seconds."""
+        return utils.ValidationCache(capacity, 30, clock=lambda: self.now)
+
+    def test_put_and_get(self):
+        # Stored results can be retrieved multiple times.
+        cache = self.make_cache()
+        cache.put('key', 'result')
+        self.assertEqual('result', cache.get('key'))
+        self.assertEqual('result', cache.get('key'))
+        self.assertIsNone(cache.get('no-such'))
+
+    def test_expired(self):
+        # Expired results are not returned and are removed from the cache.
+        cache = self.make_cache()
+        cache.put('key', 'result')
+        self.now += 30
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(0, len(cache))
+
+    def test_least_recently_used(self):
+        # The least recently used result is discarded when the cache is full.
+        cache = self.make_cache()
+        cache.put('key1', 'result1')
+        cache.put('key2', 'result2')
+        cache.get('key1')
+        cache.put('key3', 'result3')
+        self.assertEqual(2, len(cache))
+        self.assertEqual('result1', cache.get('key1'))
+        self.assertIsNone(cache.get('key2'))
+        self.assertEqual('result3', cache.get('key3'))
+
+    def test_discard(self):
+        # Results can be removed, unless replaced by a later result.
+        cache = self.make_cache()
+        result1, result2 = object(), object()
+        cache.put('key1', result1)
+        cache.discard('key1', result1)
+        self.assertIsNone(cache.get('key1'))
+        cache.put('key2', result2)
+        cache.discard('key2', result1)
+        self.assertIs(result2, cache.get('key2'))
+        cache.discard('no-such', result1)
+
+    def test_disabled(self):
+        # Nothing is stored if the capacity is 0.
+        cache = self.make_cache(capacity=0)
+        cache.put('key', 'result')
+        self.assertIsNone(cache.get('key'))
+
+
+class TestValidationKey(unittest.TestCase):
+
+    apiurl = 'wss://example.com:17070/model/uuid/api'
+
+    def test_same_bundle(self):
+        # Equal bundles produce the same key, regardless of the keys order.
+        bundle1 = {'services': {'django': {}, 'haproxy': {}}}
+        bundle2 = {'services': {'haproxy': {}, 'django': {}}}
+        self.assertEqual(
+            utils.validation_key(self.apiurl, 'who', bundle1),
+            utils.validation_key(self.apiurl, 'who', bundle2))
+
+    def test_different(self):
+        # Keys differ if the bundle, the model or the user are different.
+        bundle = {'services': {'django': {}}}
+        key = utils.validation_key(self.apiurl, 'who', bundle)
+        others = (
+            utils.validation_key(
+                self.apiurl, 'who', {'services': {'haproxy': {}}}),
+            utils.validation_key('wss://example.com:17070', 'who', bundle),
+            utils.validation_key(self.apiurl, 'dalek', bundle),
+        )
+        for other in others:
+            self.assertNotEqual(key, other)
+
+    def test_not_serializable(self):
+        # None is returned if the bundle cannot be hashed.
+        bundle = {'services': {'django': {'options': {'debug': object()}}}}
+        self.assertIsNone(utils.validation_key(self.apiurl, 'who', bundle))
+
 
 class TestPrepareBundle(unittest.TestCase):
 
@@ -190,7 +190,7 @@ class TestImportBundleV3(
         self.assertEqual(expected_response, response)
         # The Deployer validate method has been called.
         self.deployer.validate.assert_called_once_with(
-            request.user, {'services': {}})
+            request.user, {'services': {}}, apiurl=None)
 
     @gen_test
     def test_success(self):
@@ -206,9 +206,48 @@ class TestImportBundleV3(
         self.assertEqual(expected_response, response)
         # Ensure the Deployer methods have been correctly called.
         args = (request.user, {'services': {}})
-        self.deployer.validate.assert_called_once_with(*args)
+        self.deployer.validate.assert_called_once_with(*args, apiurl=None)
         args = (request.user, 'mybundle', {'services': {}}, 3, None)
-        self.deployer.import_bundle.assert_called_once_with(*args)
+        self.deployer.import_bundle.assert_called_once_with(*args, apiurl=None)
+
+    @gen_test
+    def test_model(self):
+        # Bundles are validated and deployed to the model the user is
+        # connected to.
+        params = {'Name': 'mybundle', 'YAML': 'mybundle: {services: {}}'}
+        apiurl = 'wss://example.com:17070/model/uuid/api'
+        request = self.make_view_request(params=params, apiurl=apiurl)
+        self.deployer.validate.return_value = self.make_future(None)
+        self.deployer.import_bundle.return_value = 42
+        yield self.view(request, self.deployer)
+        self.assertEqual(
+            apiurl, self.deployer.validate.call_args[1]['apiurl'])
+        self.assertEqual(
+            apiurl, self.deployer.import_bundle.call_args[1]['apiurl'])
+
+    @gen_test
+    def test_success_remote_deployer(self):
+        # The view also works with Deployers returning Futures.
+        params = {'Name': 'mybundle', 'YAML': 'mybundle: {services: {}}'}
+        request = self.make_view_request(params=params)
+        self.deployer.validate.return_value = self.make_future(None)
+        self.deployer.import_bundle.return_value = self.make_future(42)
+        response = yield self.view(request, self.deployer)
+        self.assertEqual({'Response': {'DeploymentId': 42}}, response)
+
+    @gen_test
+    def test_scheduling_failure(self):
+        # An error response is returned if the deployment cannot be scheduled.
+        params = {'Name': 'mybundle', 'YAML': 'mybundle: {services: {}}'}
+        request = self.make_view_request(params=params)
+        self.deployer.validate.return_value = self.make_future(None)
+        self.deployer.import_bundle.return_value = self.make_future(None)
+        response = yield self.view(request, self.deployer)
+        expected_response = {
+            'Response': {},
+            'Error': 'unable to schedule the deployment',
+        }
+        self.assertEqual(expected_response, response)
 
     @gen_test
     def test_logging(self):
@@ -261,10 +300,10 @@ class TestImportBundleV3(
         yield self.view(request, self.deployer)
         # Ensure the Deployer methods have been correctly called.
         self.deployer.validate.assert_called_once_with(
-            request.user, {'services': {}})
+            request.user, {'services': {}}, apiurl=None)
         self.deployer.import_bundle.assert_called_once_with(
             request.user, 'mybundle', {'services': {}}, 3,
-            '~jorge/wiki/3/smallwiki')
+            '~jorge/wiki/3/smallwiki', apiurl=None)
 
 
 class TestImportBundleV4(
@@ -341,7 +380,7 @@ class TestImportBundleV4(
         self.assertEqual(expected_response, response)
         # The Deployer validate method has been called.
         self.deployer.validate.assert_called_once_with(
-            request.user, {'services': {}})
+            request.user, {'services': {}}, apiurl=None)
 
     @gen_test
     def test_success(self):
@@ -357,9 +396,9 @@ class TestImportBundleV4(
         self.assertEqual(expected_response, response)
         # Ensure the Deployer methods have been correctly called.
         args = (request.user, {'services': {}})
-        self.deployer.validate.assert_called_once_with(*args)
+        self.deployer.validate.assert_called_once_with(*args, apiurl=None)
         args = (request.user, 'bundle-v4', {'services': {}}, 4, 'foo')
-        self.deployer.import_bundle.assert_called_once_with(*args)
+        self.deployer.import_bundle.assert_called_once_with(*args, apiurl=None)
 
     @gen_test
     def test_logging(self):
@@ -397,10 +436,10 @@ class TestImportBundleV4(
         yield self.view(request, self.deployer)
         # Ensure the Deployer methods have been correctly called.
         self.deployer.validate.assert_called_once_with(
-            request.user, {'services': {}})
+            request.user, {'services': {}}, apiurl=None)
         self.deployer.import_bundle.assert_called_once_with(
             request.user, 'bundle-v4', {'services': {}}, 4,
-            '~jorge/wiki/3/smallwiki')
+            '~jorge/wiki/3/smallwiki', apiurl=None)
 
 
 class TestWatch(
@@ -475,6 +514,19 @@ class TestNext(
         # Ensure the Deployer methods have been correctly called.
         self.deployer.next.assert_called_once_with(42)
 
+    @gen_test
+    def test_expired_watcher(self):
+        # An error response is returned if the deployment history is no
+        # longer available.
+        request = self.make_view_request(params={'WatcherId': 42})
+        self.deployer.next.return_value = self.make_future('watcher expired')
+        response = yield self.view(request, self.deployer)
+        expected_response = {
+            'Response': {},
+            'Error': 'invalid request: watcher expired',
+        }
+        self.assertEqual(expected_response, response)
+
     @gen_test
     def test_success(self):
         # The response includes the deployment changes.
@@ -792,3 +844,23 @@ class TestSetChanges(
         }
         response = yield self.view(request)
         self.assertEqual(expected_response, response)
+
+    @mock.patch('uuid.uuid4', mock.Mock(return_value=mock.Mock(hex='DEFACED')))
+    @gen_test
+    def test_changesets_store(self):
+        # The change set is kept in the provided store.
+        content = yaml.safe_dump({
+            'services': {
+                'django': {'charm': 'cs:trusty/django-42', 'num_units': 0},
+            },
+        })
+        changesets = views.make_changeset_store(capacity=1)
+        request = self.make_view_request(params={'YAML': content})
+        response = yield self.view(request, changesets)
+        self.assertEqual('DEFACED', response['Response']['Token'])
+        self.assertIn('DEFACED', changesets)
+        self.assertNotIn('DEFACED', views._bundle_changesets)
+        request = self.make_view_request(params={'Token': 'DEFACED'})
+        response = yield views.get_changes(request, changesets)
+        self.assertEqual(2, len(response['Response']['Changes']))
+        self.assertEqual(0, len(changesets))
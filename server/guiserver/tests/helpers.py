@@ -119,8 +119,8 @@ class GoAPITestMixin(object):
                                  token='DEFACED', username=None,
                                  password=None):
         if username is not None and password is not None:
-            tokens._data[token] = dict(
-                username=username, password=password, handle="handle")
+            tokens._store.add(
+                dict(username=username, password=password), token=token)
         return dict(
             RequestId=request_id, Type='GUIToken', Request='Login',
             Params={'Token': token})
@@ -135,11 +135,12 @@ class BundlesTestMixin(object):
         """Create and return a Deployer instance."""
         return base.Deployer(self.apiurl, apiversion)
 
-    def make_view_request(self, params=None, is_authenticated=True):
+    def make_view_request(
+            self, params=None, is_authenticated=True, apiurl=None):
         """Create and return a mock request to be passed to bundle views.
 
-        The resulting request contains the given parameters and a
-        guiserver.auth.User instance.
+        The resulting request contains the given parameters, a
+        guiserver.auth.User instance and the Juju API URL of the model.
         If is_authenticated is True, the user in the request is logged in.
         """
         if params is None:
@@ -147,7 +148,7 @@ class BundlesTestMixin(object):
         user = auth.User(
             username='user', password='passwd',
             is_authenticated=is_authenticated)
-        return mock.Mock(params=params, user=user)
+        return mock.Mock(params=params, user=user, apiurl=apiurl)
 
     def make_deployment_request(
             self, request, request_id=42, params=None, encoded=False,
@@ -268,6 +269,14 @@ class MultiProcessMock(object):
         self._consume_queue()
         return list(self._call_args)
 
+    @property
+    def call_args_list(self):
+        """Return a list of (args, kwargs) tuples, one for each call.
+
+        This is an alias for self.call_args, matching the mock.Mock API.
+        """
+        return self.call_args
+
     @property
     def call_count(self):
         """Return the number of times this mock has been called."""
@@ -370,6 +379,7 @@ class TestMultiProcessMock(unittest.TestCase):
             ((2,), {'foo': None})
         ]
         self.assertEqual(expected, mock_callable.call_args)
+        self.assertEqual(expected, mock_callable.call_args_list)
 
     def test_call_count(self):
         # The number of calls are correctly tracked.
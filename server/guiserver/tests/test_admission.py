@@ -0,0 +1,111 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server WebSocket admission control."""
+
+import unittest
+
+import mock
+
+from guiserver import admission
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst(self):
+        # Up to burst tokens can be consumed at once.
+        clock = mock.Mock(return_value=100)
+        bucket = admission.TokenBucket(1, 3, clock)
+        self.assertEqual([True, True, True, False], [
+            bucket.consume() for _ in range(4)])
+
+    def test_refill(self):
+        # Tokens are added at the given rate, up to burst tokens.
+        clock = mock.Mock(return_value=100)
+        bucket = admission.TokenBucket(2, 2, clock)
+        bucket.consume()
+        bucket.consume()
+        clock.return_value = 100.5
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        clock.return_value = 200
+        self.assertEqual([True, True, False], [
+            bucket.consume() for _ in range(3)])
+
+
+class TestAdmission(unittest.TestCase):
+
+    def test_no_limits(self):
+        # All sessions are accepted if no limits are set.
+        limits = admission.Admission()
+        for _ in range(100):
+            self.assertIsNone(limits.acquire('1.2.3.4'))
+        self.assertEqual(100, limits.get_info()['sessions'])
+
+    def test_max_sessions(self):
+        # The number of concurrent sessions is limited.
+        limits = admission.Admission(max_sessions=2)
+        self.assertIsNone(limits.acquire('1.2.3.4'))
+        self.assertIsNone(limits.acquire('1.2.3.5'))
+        self.assertEqual(
+            admission.REJECTED_MAX_SESSIONS, limits.acquire('1.2.3.6'))
+        limits.release('1.2.3.4')
+        self.assertIsNone(limits.acquire('1.2.3.6'))
+
+    def test_max_sessions_per_ip(self):
+        # The number of concurrent sessions from the same address is limited.
+        limits = admission.Admission(max_sessions_per_ip=1)
+        self.assertIsNone(limits.acquire('1.2.3.4'))
+        self.assertEqual(
+            admission.REJECTED_MAX_SESSIONS_PER_IP,
+            limits.acquire('1.2.3.4'))
+        self.assertIsNone(limits.acquire('1.2.3.5'))
+        limits.release('1.2.3.4')
+        self.assertIsNone(limits.acquire('1.2.3.4'))
+
+    def test_rate(self):
+        # The rate of new sessions is limited.
+        clock = mock.Mock(return_value=100)
+        limits = admission.Admission(rate=2, clock=clock)
+        self.assertIsNone(limits.acquire('1.2.3.4'))
+        self.assertIsNone(limits.acquire('1.2.3.4'))
+        self.assertEqual(admission.REJECTED_RATE, limits.acquire('1.2.3.4'))
+        clock.return_value = 101
+        self.assertIsNone(limits.acquire('1.2.3.4'))
+
+    def test_release_unknown(self):
+        # Releasing sessions never acquired has no effect.
+        limits = admission.Admission()
+        limits.acquire('1.2.3.4')
+        limits.release('1.2.3.5')
+        self.assertEqual(1, limits.get_info()['sessions'])
+
+    def test_get_info(self):
+        # The current occupancy is reported.
+        limits = admission.Admission(
+            max_sessions=10, max_sessions_per_ip=2, rate=5)
+        limits.acquire('1.2.3.4')
+        limits.acquire('1.2.3.4')
+        limits.acquire('1.2.3.4')
+        limits.acquire('1.2.3.5')
+        self.assertEqual({
+            'sessions': 3,
+            'max_sessions': 10,
+            'addresses': 2,
+            'max_sessions_per_ip': 2,
+            'rate': 5,
+            'rejected': 1,
+        }, limits.get_info())
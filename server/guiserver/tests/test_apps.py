@@ -16,17 +16,30 @@
 
 """Tests for the Juju GUI server applications."""
 
+import os
+import shutil
+import tempfile
 import unittest
+import weakref
 
 import mock
 
 from guiserver import (
+    admission,
     apps,
     auth,
+    clients,
     handlers,
     manage,
+    metrics,
+    snapshots,
 )
 from guiserver.bundles import base
+from guiserver.multiplexer import Multiplexer
+from guiserver.tokens import (
+    DirectoryTokenStore,
+    TokenStore,
+)
 
 
 class AppsTestMixin(object):
@@ -71,7 +84,7 @@ class AppsTestMixin(object):
 
 class TestServer(AppsTestMixin, unittest.TestCase):
 
-    def get_app(self, **kwargs):
+    def get_app(self, connections=None, **kwargs):
         """Create and return the server application.
 
         Use the options provided in kwargs.
@@ -83,15 +96,45 @@ class TestServer(AppsTestMixin, unittest.TestCase):
             'jujuguidebug': False,
             'jujuversion': '2.0.0',
             'sandbox': False,
+            'tokencapacity': 100,
+            'tokenstore': None,
             'charmstoreurl': 'https://api.jujucharms.com/charmstore/',
+            'deployhistory': 50,
+            'deployhistoryage': 600,
+            'deployjournal': None,
+            'deployworkers': 2,
+            'validatecache': 10,
+            'validateworkers': 3,
             'charmstoreversion': 'v4',
             'jemlocation': '',
             'jemversion': 'v1',
+            'wscachesize': 0,
+            'wscoalesce': True,
+            'wscompression': True,
+            'wscompressionlevel': 9,
+            'wscompressionminsize': 100,
+            'wscompressionwindowbits': 10,
+            'wshighwatermark': 4096,
+            'wsidletimeout': 0,
+            'wslogincache': 30,
+            'wslowwatermark': 1024,
+            'wsmaxsessions': 0,
+            'wsmaxsessionsperip': 0,
+            'wsmultiplex': False,
+            'wsoverflowpolicy': 'drop',
+            'wspassthrough': False,
+            'wspinginterval': 0,
+            'wspingtimeout': 10,
+            'wspoolidletimeout': 60,
+            'wspoolsize': 0,
+            'wsqueuesize': 10,
+            'wsreconnect': True,
+            'wssessionrate': 0,
         }
         options_dict.update(kwargs)
         options = mock.Mock(**options_dict)
         with mock.patch('guiserver.apps.options', options):
-            return apps.server()
+            return apps.server(connections=connections)
 
     def get_gui_config(self, app):
         """Return the GUI config as a dictionary, given an app object."""
@@ -114,6 +157,11 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
         deployer = self.assert_in_spec(spec, 'deployer')
         self.assertIsInstance(deployer, base.Deployer)
+        self.assertEqual(2, deployer._run_executor._max_workers)
+        self.assertEqual(3, deployer._validate_executor._max_workers)
+        self.assertEqual(10, deployer._validation_cache.capacity)
+        self.assertEqual(600, deployer._observer.max_age)
+        self.assertEqual(50, deployer._observer.max_count)
 
     def test_ws_templates(self):
         # The WebSocket templates are properly passed to the WebSocket handler.
@@ -141,6 +189,188 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
         tokens = self.assert_in_spec(spec, 'tokens')
         self.assertIsInstance(tokens, auth.AuthenticationTokenHandler)
+        self.assertEqual(100, tokens.get_info()['capacity'])
+        info_spec = self.get_url_spec(app, r'^/gui-server-info$')
+        self.assert_in_spec(info_spec, 'tokens', tokens)
+
+    def test_changesets(self):
+        # The change sets store is shared by the WebSocket and info handlers.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        changesets = self.assert_in_spec(spec, 'changesets')
+        self.assertIsInstance(changesets, TokenStore)
+        self.assertEqual(100, changesets.capacity)
+        info_spec = self.get_url_spec(app, r'^/gui-server-info$')
+        self.assertIs(
+            changesets, self.assert_in_spec(info_spec, 'changesets'))
+
+    def test_token_store(self):
+        # Tokens and change sets are stored in the token store directory.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        app = self.get_app(tokenstore=path)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        tokens = self.assert_in_spec(spec, 'tokens')
+        self.assertEqual(os.path.join(path, 'auth'), tokens._store.path)
+        changesets = self.assert_in_spec(spec, 'changesets')
+        self.assertIsInstance(changesets, DirectoryTokenStore)
+        self.assertEqual(os.path.join(path, 'changesets'), changesets.path)
+
+    def test_buffering(self):
+        # The buffering options are correctly passed to the WebSocket handler.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assert_in_spec(spec, 'high_watermark', 4096)
+        self.assert_in_spec(spec, 'low_watermark', 1024)
+        self.assert_in_spec(spec, 'queue_size', 10)
+        self.assert_in_spec(spec, 'overflow_policy', 'drop')
+
+    def test_reconnect(self):
+        # The reconnect option is correctly passed to the WebSocket handler.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assert_in_spec(spec, 'reconnect', True)
+
+    def test_coalesce(self):
+        # The coalesce option is correctly passed to the WebSocket handler.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assert_in_spec(spec, 'coalesce', True)
+
+    def test_model_cache(self):
+        # The same model cache is shared by the WebSocket and the info
+        # handlers.
+        app = self.get_app(wscachesize=2)
+        ws_spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        info_spec = self.get_url_spec(app, r'^/gui-server-info$')
+        model_cache = self.assert_in_spec(ws_spec, 'model_cache')
+        self.assertIsInstance(model_cache, snapshots.ModelCache)
+        self.assertEqual(2 * 1024 * 1024, model_cache.max_size)
+        self.assert_in_spec(info_spec, 'model_cache', model_cache)
+
+    def test_model_cache_disabled(self):
+        # The model cache is None if disabled.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'model_cache'))
+
+    def test_admission(self):
+        # The same admission control is shared by the WebSocket and the info
+        # handlers.
+        app = self.get_app(
+            wsmaxsessions=100, wsmaxsessionsperip=10, wssessionrate=5)
+        ws_spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        info_spec = self.get_url_spec(app, r'^/gui-server-info$')
+        ws_admission = self.assert_in_spec(ws_spec, 'admission')
+        self.assertIsInstance(ws_admission, admission.Admission)
+        info = ws_admission.get_info()
+        self.assertEqual(100, info['max_sessions'])
+        self.assertEqual(10, info['max_sessions_per_ip'])
+        self.assertEqual(5, info['rate'])
+        self.assert_in_spec(info_spec, 'admission', ws_admission)
+
+    def test_admission_disabled(self):
+        # The admission control is None if no limits are set.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'admission'))
+
+    def test_keepalive(self):
+        # The keepalive options and idle timeout are correctly passed to the
+        # WebSocket handler.
+        app = self.get_app(wspinginterval=30, wsidletimeout=3600)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assert_in_spec(
+            spec, 'keepalive_options', {'interval': 30, 'timeout': 10})
+        self.assert_in_spec(spec, 'idle_timeout', 3600)
+
+    def test_keepalive_disabled(self):
+        # Pings are disabled if the ping interval is 0.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'keepalive_options'))
+
+    def test_passthrough(self):
+        # The passthrough option is correctly passed to the WebSocket handler.
+        app = self.get_app(wspassthrough=True)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assert_in_spec(spec, 'passthrough', True)
+
+    def test_compression(self):
+        # The compression options are correctly passed to the WebSocket
+        # handler.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        expected = {'level': 9, 'window_bits': 10, 'min_size': 100}
+        self.assert_in_spec(spec, 'compression_options', expected)
+
+    def test_compression_disabled(self):
+        # Compression options are None if compression is disabled.
+        app = self.get_app(wscompression=False)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'compression_options'))
+
+    def test_multiplexer(self):
+        # A multiplexer sharing the authentication backend is created if
+        # multiplexing is enabled.
+        app = self.get_app(wsmultiplex=True)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        multiplexer = self.assert_in_spec(spec, 'multiplexer')
+        self.assertIsInstance(multiplexer, Multiplexer)
+        backend = self.assert_in_spec(spec, 'auth_backend')
+        self.assertIs(backend, multiplexer._backend)
+        self.assertEqual(30, multiplexer.login_ttl)
+
+    def test_multiplexer_disabled(self):
+        # The multiplexer is None if multiplexing is disabled.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'multiplexer'))
+
+    def test_pool(self):
+        # The same connection pool is shared by the WebSocket and the info
+        # handlers.
+        app = self.get_app(wspoolsize=3)
+        ws_spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        info_spec = self.get_url_spec(app, r'^/gui-server-info$')
+        pool = self.assert_in_spec(ws_spec, 'pool')
+        self.assertIsInstance(pool, clients.ConnectionPool)
+        self.assertEqual(3, pool.get_info()['size'])
+        self.assertEqual(60, pool._idle_timeout)
+        self.assert_in_spec(info_spec, 'pool', pool)
+
+    def test_pool_disabled(self):
+        # The connection pool is None if disabled.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'pool'))
+
+    def test_connections(self):
+        # The same connections set is shared by the WebSocket and the info
+        # handlers.
+        app = self.get_app()
+        ws_spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        info_spec = self.get_url_spec(app, r'^/gui-server-info$')
+        connections = self.assert_in_spec(ws_spec, 'connections')
+        self.assert_in_spec(info_spec, 'connections', connections)
+
+    def test_provided_connections(self):
+        # The provided connections set is used by the WebSocket handler.
+        connections = weakref.WeakSet()
+        app = self.get_app(connections=connections)
+        ws_spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIs(
+            connections, self.assert_in_spec(ws_spec, 'connections'))
+
+    def test_metrics(self):
+        # The metrics handler exposes the GUI server metrics registry and
+        # shares the connections set with the WebSocket handler.
+        app = self.get_app()
+        ws_spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        metrics_spec = self.get_url_spec(app, r'^/gui-server-metrics$')
+        connections = self.assert_in_spec(ws_spec, 'connections')
+        self.assert_in_spec(metrics_spec, 'connections', connections)
+        self.assert_in_spec(metrics_spec, 'registry', metrics.REGISTRY)
 
     def test_websocket_in_sandbox_mode(self):
         # The sandbox WebSocket handler is used if sandbox mode is enabled.
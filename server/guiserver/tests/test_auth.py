@@ -24,6 +24,7 @@ from tornado.testing import LogTrapTestCase
 
 from guiserver import auth
 from guiserver.tests import helpers
+from guiserver.tokens import DEFAULT_CAPACITY
 
 
 class TestUser(unittest.TestCase):
@@ -61,6 +62,10 @@ class AuthMiddlewareTestMixin(object):
     """
 
     def setUp(self):
+        # Do not sweep tokens using the mock IO loop.
+        patcher = mock.patch('guiserver.tokens.PeriodicCallback')
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.user = auth.User()
         self.io_loop = mock.Mock()
         self.write_message = mock.Mock()
@@ -136,6 +141,15 @@ class AuthMiddlewareTestMixin(object):
         self.assert_user('user2', 'passwd2', True)
         self.assertFalse(self.auth.in_progress())
 
+    def test_pending_request_id(self):
+        # It is possible to check whether a specific login request is pending.
+        request = self.make_login_request(request_id=42)
+        self.auth.process_request(request)
+        self.assertTrue(self.auth.in_progress(42))
+        self.assertFalse(self.auth.in_progress(47))
+        self.auth.process_response(self.make_login_response(request_id=42))
+        self.assertFalse(self.auth.in_progress(42))
+
     def test_request_id_is_zero(self):
         # The authentication process starts if a login request is processed
         # and the request id is zero.
@@ -286,6 +300,10 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
 
     def setUp(self):
         super(TestAuthenticationTokenHandler, self).setUp()
+        # Do not sweep tokens using the mock IO loop.
+        patcher = mock.patch('guiserver.tokens.PeriodicCallback')
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.io_loop = mock.Mock()
         self.max_life = datetime.timedelta(minutes=1)
         self.tokens = auth.AuthenticationTokenHandler(
@@ -295,7 +313,8 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         # The class accepted the explicit initialization.
         self.assertEqual(self.max_life, self.tokens._max_life)
         self.assertEqual(self.io_loop, self.tokens._io_loop)
-        self.assertEqual({}, self.tokens._data)
+        self.assertEqual(0, len(self.tokens._store))
+        self.assertEqual(self.max_life, self.tokens._store.max_life)
 
     @mock.patch('tornado.ioloop.IOLoop.current',
                 mock.Mock(return_value='mockloop'))
@@ -305,6 +324,8 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             datetime.timedelta(minutes=2), tokens._max_life)
         self.assertEqual('mockloop', tokens._io_loop)
+        self.assertEqual(
+            DEFAULT_CAPACITY, tokens.get_info()['capacity'])
 
     def test_token_requested(self):
         # It recognizes a token request.
@@ -342,20 +363,10 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
                 Expires='2013-11-21T21:01:00Z'
             )
         ))
-        self.assertTrue('DEFACED' in self.tokens._data)
-        self.assertEqual(
-            {'username', 'password', 'handle'},
-            set(self.tokens._data['DEFACED'].keys()))
+        self.assertTrue('DEFACED' in self.tokens._store)
         self.assertEqual(
-            user.username, self.tokens._data['DEFACED']['username'])
-        self.assertEqual(
-            user.password, self.tokens._data['DEFACED']['password'])
-        self.assertEqual(
-            self.max_life, self.io_loop.add_timeout.call_args[0][0])
-        self.assertTrue('DEFACED' in self.tokens._data)
-        expire_token = self.io_loop.add_timeout.call_args[0][1]
-        expire_token()
-        self.assertFalse('DEFACED' in self.tokens._data)
+            {'username': user.username, 'password': user.password},
+            self.tokens._store.pop('DEFACED'))
 
     def test_unauthenticated_process_token_request(self):
         # Unauthenticated token requests get an informative error.
@@ -369,7 +380,7 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
             ErrorCode='unauthorized access',
             Response={}
         ))
-        self.assertEqual({}, self.tokens._data)
+        self.assertEqual(0, len(self.tokens._store))
         self.assertFalse(self.io_loop.add_timeout.called)
 
     def test_authentication_requested(self):
@@ -397,8 +408,8 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         # It correctly responds to authentication requests with known tokens.
         username = 'user-admin'
         password = 'ADMINSECRET'
-        self.tokens._data['DEFACED'] = dict(
-            handle='handle marker', username=username, password=password)
+        self.tokens._store.add(
+            dict(username=username, password=password), token='DEFACED')
         request = dict(
             RequestId=42, Type='GUIToken', Request='Login',
             Params={'Token': 'DEFACED'})
@@ -406,9 +417,8 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             (username, password),
             self.tokens.process_authentication_request(request, write_message))
-        self.io_loop.remove_timeout.assert_called_once_with('handle marker')
         self.assertFalse(write_message.called)
-        self.assertFalse('DEFACED' in self.tokens._data)
+        self.assertFalse('DEFACED' in self.tokens._store)
 
     def test_unknown_authentication_request(self):
         # It correctly rejects authentication requests with unknown tokens.
@@ -442,6 +452,19 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
             (user.username, user.password),
             self.tokens.process_authentication_request(request, write_message))
 
+    def test_capacity(self):
+        # The oldest tokens are discarded when the capacity is reached.
+        tokens = auth.AuthenticationTokenHandler(
+            self.max_life, self.io_loop, capacity=1)
+        user = auth.User('user-admin', 'ADMINSECRET', True)
+        data = dict(RequestId=42, Type='GUIToken', Request='Create')
+        tokens.process_token_request(data, user, mock.Mock())
+        tokens.process_token_request(data, user, mock.Mock())
+        info = tokens.get_info()
+        self.assertEqual(1, info['tokens'])
+        self.assertEqual(2, info['created'])
+        self.assertEqual(1, info['evicted'])
+
     def test_process_authentication_response(self):
         # It translates a normal authentication success.
         user = auth.User('user-admin', 'ADMINSECRET', True)
@@ -16,12 +16,17 @@
 
 """Tests for the Juju GUI server clients."""
 
+from datetime import timedelta
+
+import mock
 from tornado import (
     concurrent,
+    gen,
     web,
 )
 from tornado.testing import (
     AsyncHTTPSTestCase,
+    ExpectLog,
     gen_test,
 )
 
@@ -42,11 +47,11 @@ class TestWebSocketClientConnection(AsyncHTTPSTestCase, helpers.WSSTestMixin):
         }
         return web.Application([(r'/', helpers.EchoWebSocketHandler, options)])
 
-    def connect(self, headers=None):
+    def connect(self, headers=None, keepalive_options=None):
         """Return a future whose result is a connected client."""
         return clients.websocket_connect(
             self.io_loop, self.get_wss_url('/'), self.received.append,
-            headers=headers)
+            headers=headers, keepalive_options=keepalive_options)
 
     @gen_test
     def test_initial_connection(self):
@@ -84,6 +89,64 @@ class TestWebSocketClientConnection(AsyncHTTPSTestCase, helpers.WSSTestMixin):
         self.assertIn('Origin', headers)
         self.assertEqual(origin, headers['Origin'])
 
+    @gen_test
+    def test_pause_reading(self):
+        # Messages are not received while reading is paused.
+        client = yield self.connect()
+        self.assertFalse(client.reading_paused)
+        client.pause_reading()
+        self.assertTrue(client.reading_paused)
+        client.write_message('hello')
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.1))
+        self.assertEqual([], self.received)
+        # The socket is not even read.
+        self.assertFalse(client.stream._state & self.io_loop.READ)
+        # Messages are delivered when reading is resumed.
+        client.resume_reading()
+        self.assertFalse(client.reading_paused)
+        message = yield client.read_message()
+        self.assertEqual('hello', message)
+        self.assertEqual(['hello'], self.received)
+
+    @gen_test
+    def test_write_buffer_size(self):
+        # The size of the data waiting to be sent can be retrieved.
+        client = yield self.connect()
+        self.assertEqual(0, client.write_buffer_size())
+
+    @gen_test
+    def test_read_queue_size(self):
+        # Only the most recent messages are stored for read_message().
+        client = yield self.connect()
+        for num in range(clients.READ_QUEUE_SIZE + 1):
+            client.on_message(str(num))
+        self.assertEqual(clients.READ_QUEUE_SIZE, len(client.read_queue))
+        message = yield client.read_message()
+        self.assertEqual('1', message)
+
+    @gen_test
+    def test_keepalive_pong(self):
+        # The server responds to keepalive pings.
+        client = yield self.connect(
+            keepalive_options={'interval': 30, 'timeout': 10})
+        self.assertTrue(client._keepalive.enabled)
+        client._keepalive._pinged = True
+        client._ping()
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.1))
+        self.assertFalse(client._keepalive._pinged)
+
+    @gen_test
+    def test_keepalive_expired(self):
+        # The connection is closed if the server does not respond.
+        client = yield self.connect(
+            keepalive_options={'interval': 30, 'timeout': 10})
+        expected_log = '.*closing connection to .*: no response'
+        with ExpectLog('', expected_log, required=True):
+            client._on_expired('no response')
+        message = yield client.read_message()
+        self.assertIsNone(message)
+        self.assertEqual([None], self.received)
+
     @gen_test
     def test_connection_close(self):
         # The client connection is correctly terminated.
@@ -92,3 +155,135 @@ class TestWebSocketClientConnection(AsyncHTTPSTestCase, helpers.WSSTestMixin):
         message = yield client.read_message()
         self.assertIsNone(message)
         yield self.server_closed_future
+
+
+class TestConnectionPool(AsyncHTTPSTestCase, helpers.WSSTestMixin):
+
+    def get_app(self):
+        # In this test case pooled connections are established to a WebSocket
+        # echo server returning received messages.
+        options = {
+            'close_future': concurrent.Future(),
+            'io_loop': self.io_loop,
+        }
+        return web.Application([(r'/', helpers.EchoWebSocketHandler, options)])
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.pool = clients.ConnectionPool(io_loop=self.io_loop, size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        super(TestConnectionPool, self).tearDown()
+
+    @gen.coroutine
+    def wait_for_pool(self):
+        """Wait for the pool connections to be established."""
+        while self.pool.get_info()['connecting']:
+            yield gen.Task(
+                self.io_loop.add_timeout, timedelta(milliseconds=10))
+
+    @gen_test
+    def test_miss_and_fill(self):
+        # The first connection to a target is established on request, and
+        # the pool is then filled for that target.
+        received = []
+        url = self.get_wss_url('/')
+        client = yield self.pool.connect(url, received.append)
+        client.write_message('hello')
+        yield client.read_message()
+        self.assertEqual(['hello'], received)
+        yield self.wait_for_pool()
+        info = self.pool.get_info()
+        self.assertEqual(0, info['hits'])
+        self.assertEqual(1, info['misses'])
+        self.assertEqual(2, info['idle'])
+
+    @gen_test
+    def test_hit(self):
+        # Idle connections are returned when available, using the given
+        # message callback.
+        url = self.get_wss_url('/')
+        yield self.pool.connect(url, lambda message: None)
+        yield self.wait_for_pool()
+        received = []
+        client = yield self.pool.connect(url, received.append)
+        client.write_message('hello')
+        yield client.read_message()
+        self.assertEqual(['hello'], received)
+        yield self.wait_for_pool()
+        info = self.pool.get_info()
+        self.assertEqual(1, info['hits'])
+        self.assertEqual(1, info['misses'])
+        self.assertEqual(2, info['idle'])
+        self.assertEqual(0.5, info['hit_rate'])
+
+    @gen_test
+    def test_keyed_by_origin(self):
+        # Pooled connections are not shared between different origins.
+        url = self.get_wss_url('/')
+        yield self.pool.connect(url, lambda message: None)
+        yield self.wait_for_pool()
+        yield self.pool.connect(
+            url, lambda message: None, headers={'Origin': 'https://1.2.3.4'})
+        info = self.pool.get_info()
+        self.assertEqual((0, 2), (info['hits'], info['misses']))
+
+    @gen_test
+    def test_closed_idle_connections(self):
+        # Idle connections closed by the server are removed from the pool.
+        url = self.get_wss_url('/')
+        yield self.pool.connect(url, lambda message: None)
+        yield self.wait_for_pool()
+        for connection in list(self.pool._idle.values()[0]):
+            connection.close()
+            yield connection.read_message()
+        self.assertEqual(0, self.pool.get_info()['idle'])
+        self.assertEqual({}, self.pool._idle)
+        yield self.pool.connect(url, lambda message: None)
+        self.assertEqual(2, self.pool.get_info()['misses'])
+
+    @gen_test
+    def test_expired_targets(self):
+        # Idle connections to targets no longer requested are closed.
+        url = self.get_wss_url('/')
+        yield self.pool.connect(url, lambda message: None)
+        yield self.wait_for_pool()
+        connections = list(self.pool._idle.values()[0])
+        self.pool.sweep()
+        self.assertEqual(2, self.pool.get_info()['idle'])
+        now = self.io_loop.time() + clients.DEFAULT_POOL_IDLE_TIMEOUT
+        with mock.patch.object(self.io_loop, 'time', return_value=now):
+            self.pool.sweep()
+        info = self.pool.get_info()
+        self.assertEqual(0, info['idle'])
+        self.assertEqual(2, info['expired'])
+        self.assertEqual({}, self.pool._idle)
+        self.assertEqual({}, self.pool._last_used)
+        self.assertIsNone(self.pool._sweeper)
+        for connection in connections:
+            message = yield connection.read_message()
+            self.assertIsNone(message)
+
+    @gen_test
+    def test_expired_while_connecting(self):
+        # Connections established after their target expired are closed.
+        url = self.get_wss_url('/')
+        yield self.pool.connect(url, lambda message: None)
+        self.pool.close()
+        yield self.wait_for_pool()
+        self.assertEqual(0, self.pool.get_info()['idle'])
+
+    def test_sweeper(self):
+        # Targets are swept periodically only while targets are known.
+        with mock.patch('guiserver.clients.PeriodicCallback') as mock_callback:
+            with mock.patch(
+                    'guiserver.clients.websocket_connect',
+                    mock.Mock(return_value=concurrent.Future())):
+                self.pool.connect('wss://example.com', None)
+            mock_callback.assert_called_once_with(
+                self.pool.sweep, clients.POOL_SWEEP_INTERVAL * 1000,
+                self.io_loop)
+            mock_callback().start.assert_called_once_with()
+            self.pool.close()
+            mock_callback().stop.assert_called_once_with()
@@ -0,0 +1,181 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server AllWatcher delta coalescing."""
+
+import unittest
+
+import mock
+
+from guiserver import coalescing
+
+
+class TestEntityKey(unittest.TestCase):
+
+    def test_name(self):
+        # Most entities are identified by their name.
+        key = coalescing.entity_key('unit', {'Name': 'django/0'})
+        self.assertEqual(('unit', 'django/0'), key)
+
+    def test_other_fields(self):
+        # Some entities are identified by other fields.
+        key = coalescing.entity_key('machine', {'Id': '0', 'Name': 'bad'})
+        self.assertEqual(('machine', '0'), key)
+
+    def test_lower_case(self):
+        # Juju 2 lower case field names are supported.
+        key = coalescing.entity_key('relation', {'key': 'django:db mysql:db'})
+        self.assertEqual(('relation', 'django:db mysql:db'), key)
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def test_latest(self):
+        # Only the latest delta for each entity is kept, in the position
+        # where it was received.
+        pending = coalescing.coalesce([
+            ['service', 'change', {'Name': 'django', 'Exposed': False}],
+            ['unit', 'change', {'Name': 'django/0'}],
+        ])
+        coalescing.coalesce([
+            ['service', 'change', {'Name': 'django', 'Exposed': True}],
+            ['unit', 'remove', {'Name': 'django/1'}],
+        ], pending)
+        self.assertEqual([
+            ['unit', 'change', {'Name': 'django/0'}],
+            ['service', 'change', {'Name': 'django', 'Exposed': True}],
+            ['unit', 'remove', {'Name': 'django/1'}],
+        ], pending.values())
+
+    def test_removal(self):
+        # Removals replace previous changes.
+        pending = coalescing.coalesce([
+            ['unit', 'change', {'Name': 'django/0'}],
+            ['unit', 'remove', {'Name': 'django/0'}],
+        ])
+        self.assertEqual(
+            [['unit', 'remove', {'Name': 'django/0'}]], pending.values())
+
+
+class TestCoalesceMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.write_browser = mock.Mock()
+        self.write_juju = mock.Mock()
+        self.congested = mock.Mock(return_value=False)
+        self.middleware = coalescing.CoalesceMiddleware(
+            self.write_browser, self.write_juju, self.congested)
+
+    def make_request(self, request_id, watcher_id='1'):
+        """Return an AllWatcher Next request."""
+        return {
+            'RequestId': request_id,
+            'Type': 'AllWatcher',
+            'Request': 'Next',
+            'Id': watcher_id,
+            'Params': {},
+        }
+
+    def make_response(self, request_id, *deltas):
+        """Return a Next response including the given unit statuses."""
+        return {'RequestId': request_id, 'Response': {'Deltas': [
+            ['unit', 'change', {'Name': name, 'Status': status}]
+            for name, status in deltas]}}
+
+    def test_requested(self):
+        # Only AllWatcher Next requests are handled.
+        self.assertTrue(self.middleware.requested(self.make_request(1)))
+        self.assertFalse(self.middleware.requested(
+            {'RequestId': 1, 'Type': 'AllWatcher', 'Request': 'Stop'}))
+        self.assertFalse(self.middleware.requested(
+            {'RequestId': 1, 'Type': 'Client', 'Request': 'Next'}))
+
+    def test_not_congested(self):
+        # Requests and responses are propagated if the browser keeps up.
+        request = self.make_request(1)
+        self.assertTrue(self.middleware.process_request(request))
+        self.assertTrue(self.middleware.handles(1))
+        self.middleware.process_response(
+            self.make_response(1, ('django/0', 'started')))
+        self.write_browser.assert_called_once_with(
+            self.make_response(1, ('django/0', 'started')))
+        self.assertFalse(self.write_juju.called)
+        self.assertFalse(self.middleware.handles(1))
+        self.assertEqual(0, self.middleware.coalesced)
+
+    def test_congested(self):
+        # Deltas are coalesced while the browser is congested.
+        self.middleware.process_request(self.make_request(1))
+        self.congested.return_value = True
+        self.middleware.process_response(self.make_response(
+            1, ('django/0', 'pending'), ('django/1', 'pending')))
+        self.write_juju.assert_called_once_with(self.make_request(1))
+        self.middleware.process_response(
+            self.make_response(1, ('django/0', 'started')))
+        self.assertEqual(2, self.write_juju.call_count)
+        self.assertTrue(self.middleware.waiting())
+        self.middleware.flush()
+        self.assertFalse(self.write_browser.called)
+        self.congested.return_value = False
+        self.middleware.flush()
+        self.write_browser.assert_called_once_with(self.make_response(
+            1, ('django/1', 'pending'), ('django/0', 'started')))
+        self.assertFalse(self.middleware.waiting())
+        self.assertEqual(1, self.middleware.coalesced)
+
+    def test_parked_request(self):
+        # Browser requests are not propagated while a Next request sent on
+        # behalf of the browser is pending.
+        self.middleware.process_request(self.make_request(1))
+        self.congested.return_value = True
+        self.middleware.process_response(
+            self.make_response(1, ('django/0', 'pending')))
+        self.congested.return_value = False
+        self.middleware.flush()
+        self.write_browser.reset_mock()
+        self.assertFalse(self.middleware.process_request(self.make_request(2)))
+        self.assertFalse(self.write_browser.called)
+        self.middleware.process_response(
+            self.make_response(1, ('django/0', 'started')))
+        self.write_browser.assert_called_once_with(
+            self.make_response(2, ('django/0', 'started')))
+        # The watcher is no longer coalesced.
+        self.assertTrue(self.middleware.process_request(self.make_request(3)))
+
+    def test_reset(self):
+        # The ids of the parked browser requests are returned when resetting.
+        self.middleware.process_request(self.make_request(1))
+        self.congested.return_value = True
+        self.middleware.process_response(
+            self.make_response(1, ('django/0', 'pending')))
+        self.congested.return_value = False
+        self.middleware.flush()
+        self.middleware.process_request(self.make_request(2))
+        self.assertEqual([2], self.middleware.reset())
+        self.assertFalse(self.middleware.handles(1))
+        self.assertFalse(self.middleware.waiting())
+
+    def test_error(self):
+        # Errors are forwarded to the browser.
+        self.middleware.process_request(self.make_request(1))
+        self.congested.return_value = True
+        self.middleware.process_response(
+            self.make_response(1, ('django/0', 'pending')))
+        self.middleware.flush()
+        self.middleware.process_response({'RequestId': 1, 'Error': 'stopped'})
+        self.write_browser.assert_called_once_with(
+            {'RequestId': 1, 'Error': 'stopped'})
+        self.assertFalse(self.middleware.handles(1))
@@ -0,0 +1,347 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server graceful shutdown and restart."""
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+import mock
+from tornado import concurrent
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    gen_test,
+    LogTrapTestCase,
+)
+
+from guiserver import graceful
+
+
+def make_listening_socket():
+    """Return a listening socket bound to a free local port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    return sock
+
+
+def make_future(result=None):
+    """Return a Future whose result is the given one."""
+    future = concurrent.Future()
+    future.set_result(result)
+    return future
+
+
+class TestInheritedSockets(unittest.TestCase):
+
+    def patch_environ(self, **kwargs):
+        """Patch the environment including the given variables."""
+        environ = dict(os.environ, **kwargs)
+        patcher = mock.patch.dict('os.environ', environ, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_sockets(self):
+        # An empty dict is returned if no sockets are passed.
+        self.patch_environ()
+        os.environ.pop('LISTEN_FDS', None)
+        self.assertEqual({}, graceful.inherited_sockets())
+
+    def test_other_process(self):
+        # Sockets passed to another process are ignored.
+        self.patch_environ(LISTEN_FDS='1', LISTEN_PID='1')
+        self.assertEqual({}, graceful.inherited_sockets())
+        self.assertNotIn('LISTEN_FDS', os.environ)
+
+    def test_named_sockets(self):
+        # Sockets are grouped by name.
+        self.patch_environ(
+            LISTEN_FDS='3', LISTEN_PID=str(os.getpid()),
+            LISTEN_FDNAMES='server:server:redirector')
+        with mock.patch('guiserver.graceful._socket_from_fd', str):
+            sockets = graceful.inherited_sockets()
+        self.assertEqual({'server': ['3', '4'], 'redirector': ['5']}, sockets)
+        for name in ('LISTEN_FDS', 'LISTEN_PID', 'LISTEN_FDNAMES'):
+            self.assertNotIn(name, os.environ)
+
+    def test_unnamed_sockets(self):
+        # Sockets without a name are returned as unknown.
+        self.patch_environ(LISTEN_FDS='2', LISTEN_PID=str(os.getpid()))
+        with mock.patch('guiserver.graceful._socket_from_fd', str):
+            sockets = graceful.inherited_sockets()
+        self.assertEqual({graceful.UNKNOWN_SOCKET: ['3', '4']}, sockets)
+
+
+class TestSocketFromFd(unittest.TestCase):
+
+    def test_socket(self):
+        # A non-blocking socket is returned, and the descriptor is closed.
+        sock = make_listening_socket()
+        self.addCleanup(sock.close)
+        fd = os.dup(sock.fileno())
+        obtained = graceful._socket_from_fd(fd)
+        self.addCleanup(obtained.close)
+        self.assertEqual(sock.getsockname(), obtained.getsockname())
+        self.assertEqual(0, obtained.gettimeout())
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+
+class TestSpawnSuccessor(unittest.TestCase):
+
+    # The successor process writes what it inherited to a file.
+    script = '\n'.join([
+        'import json, os, socket, sys',
+        'sock = socket.fromfd(3, socket.AF_INET, socket.SOCK_STREAM)',
+        'json.dump({',
+        '    "fds": os.environ["LISTEN_FDS"],',
+        '    "pid": os.environ["LISTEN_PID"] == str(os.getpid()),',
+        '    "names": os.environ["LISTEN_FDNAMES"],',
+        '    "port": sock.getsockname()[1],',
+        '}, open(sys.argv[1], "w"))',
+    ])
+
+    def test_successor(self):
+        # The successor process inherits the listening sockets.
+        sock = make_listening_socket()
+        self.addCleanup(sock.close)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        output = os.path.join(path, 'output.json')
+        process = graceful.spawn_successor(
+            [sys.executable, '-c', self.script, output], [('server', sock)])
+        self.assertEqual(0, process.wait())
+        with open(output) as fp:
+            data = json.load(fp)
+        expected = {
+            'fds': '1',
+            'pid': True,
+            'names': 'server',
+            'port': sock.getsockname()[1],
+        }
+        self.assertEqual(expected, data)
+
+
+class TestNotify(unittest.TestCase):
+
+    def test_not_notify_service(self):
+        # Nothing is sent if the process is not run by a notify service.
+        with mock.patch.dict('os.environ', {}, clear=True):
+            self.assertFalse(graceful.notify('READY=1'))
+
+    def test_notify(self):
+        # The state is sent to the notification socket.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        address = os.path.join(path, 'notify')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(address)
+        with mock.patch.dict('os.environ', {'NOTIFY_SOCKET': address}):
+            self.assertTrue(graceful.notify('READY=1'))
+        self.assertEqual('READY=1', sock.recv(1024))
+
+
+class TestDrainer(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestDrainer, self).setUp()
+        self.servers = [mock.Mock(), mock.Mock()]
+        self.connections = set()
+        self.deployer = mock.Mock()
+        self.deployer.status.return_value = []
+
+    def make_connection(self, closes=True):
+        """Add and return a WebSocket connection.
+
+        If closes is True, the connection is removed when closed.
+        """
+        connection = mock.Mock()
+        if closes:
+            connection.close.side_effect = (
+                lambda *args: self.connections.discard(connection))
+        self.connections.add(connection)
+        return connection
+
+    def make_drainer(self, timeout=10):
+        """Return a drainer closing the connections immediately."""
+        return graceful.Drainer(
+            self.servers, self.connections, self.deployer,
+            io_loop=self.io_loop, spread=0, timeout=timeout)
+
+    @gen_test
+    def test_drain(self):
+        # The servers are stopped and the connections are closed.
+        connections = [self.make_connection(), self.make_connection()]
+        drainer = self.make_drainer()
+        yield drainer.drain()
+        self.assertTrue(drainer.draining)
+        for server in self.servers:
+            server.stop.assert_called_once_with()
+        for connection in connections:
+            connection.close.assert_called_once_with(
+                graceful.CLOSE_SERVICE_RESTART, 'service restart')
+        self.assertEqual(0, len(self.connections))
+
+    @gen_test
+    def test_running_deployments(self):
+        # The drain waits for the running deployments to complete.
+        self.deployer.status.side_effect = [
+            [{'Status': 'started'}, {'Status': 'completed'}],
+            [{'Status': 'completed'}],
+        ]
+        with mock.patch('guiserver.graceful.DRAIN_CHECK_INTERVAL', 0):
+            yield self.make_drainer().drain()
+        self.assertEqual(2, self.deployer.status.call_count)
+
+    @gen_test
+    def test_timeout(self):
+        # The drain stops waiting after the timeout.
+        self.make_connection(closes=False)
+        expected_log = 'draining: timed out: 1 WebSocket connections'
+        with ExpectLog('', expected_log, required=True):
+            yield self.make_drainer(timeout=0).drain()
+
+    @gen_test
+    def test_deployer_error(self):
+        # Errors retrieving the deployments are logged.
+        self.deployer.status.side_effect = ValueError('bad wolf')
+        expected_log = '.*unable to retrieve the deployments: bad wolf'
+        with ExpectLog('', expected_log, required=True):
+            yield self.make_drainer().drain()
+
+
+class TestShutdown(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestShutdown, self).setUp()
+        self.drainer = mock.Mock()
+        self.drainer.drain.return_value = make_future()
+        patcher = mock.patch('guiserver.graceful.SUCCESSOR_CHECK_DELAY', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @gen_test
+    def test_stop(self):
+        # The server is drained and the IO loop stopped.
+        with \
+                mock.patch.object(self.io_loop, 'stop') as mock_stop, \
+                mock.patch('guiserver.graceful.notify') as mock_notify:
+            result = yield graceful.shutdown(self.drainer, self.io_loop)
+        self.assertTrue(result)
+        self.drainer.drain.assert_called_once_with()
+        mock_stop.assert_called_once_with()
+        mock_notify.assert_called_once_with('STOPPING=1')
+
+    @gen_test
+    def test_restart(self):
+        # The successor is started before draining.
+        named_sockets = [('server', mock.Mock())]
+        with \
+                mock.patch.object(self.io_loop, 'stop') as mock_stop, \
+                mock.patch('guiserver.graceful.spawn_successor') as spawn:
+            spawn().poll.return_value = None
+            result = yield graceful.shutdown(
+                self.drainer, self.io_loop, ['runserver'], named_sockets)
+        self.assertTrue(result)
+        spawn.assert_called_with(['runserver'], named_sockets)
+        self.drainer.drain.assert_called_once_with()
+        mock_stop.assert_called_once_with()
+
+    @gen_test
+    def test_restart_failure(self):
+        # The server is not drained if the successor exits immediately.
+        expected_log = 'the new server process exited with code 2'
+        with \
+                mock.patch.object(self.io_loop, 'stop') as mock_stop, \
+                mock.patch('guiserver.graceful.spawn_successor') as spawn, \
+                ExpectLog('', expected_log, required=True):
+            spawn().poll.return_value = spawn().returncode = 2
+            result = yield graceful.shutdown(
+                self.drainer, self.io_loop, ['runserver'])
+        self.assertFalse(result)
+        self.assertFalse(self.drainer.drain.called)
+        self.assertFalse(mock_stop.called)
+
+
+@mock.patch('guiserver.graceful.signal')
+class TestInstallSignalHandlers(LogTrapTestCase, unittest.TestCase):
+
+    def get_handler(self, mock_signal, signum):
+        """Return the handler installed for the given signal."""
+        for args, _ in mock_signal.signal.call_args_list:
+            if args[0] == signum:
+                return args[1]
+        self.fail('handler not installed')
+
+    def test_handlers(self, mock_signal):
+        # SIGTERM and SIGHUP handlers schedule a shutdown.
+        io_loop = mock.Mock()
+        graceful.install_signal_handlers(
+            mock.Mock(), io_loop, command=['runserver'])
+        self.get_handler(mock_signal, mock_signal.SIGTERM)(15, None)
+        self.get_handler(mock_signal, mock_signal.SIGHUP)(1, None)
+        calls = io_loop.add_callback_from_signal.call_args_list
+        self.assertEqual(False, calls[0][0][1])
+        self.assertEqual(True, calls[1][0][1])
+
+    def test_sighup_ignored(self, mock_signal):
+        # SIGHUP is ignored if a successor command is not provided.
+        graceful.install_signal_handlers(mock.Mock(), mock.Mock())
+        handler = self.get_handler(mock_signal, mock_signal.SIGHUP)
+        self.assertEqual(mock_signal.SIG_IGN, handler)
+
+    def start(self, mock_signal, io_loop, restart):
+        """Simulate the given signal is received."""
+        signum = mock_signal.SIGHUP if restart else mock_signal.SIGTERM
+        self.get_handler(mock_signal, signum)(signum, None)
+        start, restart_arg = io_loop.add_callback_from_signal.call_args[0]
+        start(restart_arg)
+
+    def test_single_shutdown(self, mock_signal):
+        # Only one shutdown is performed at the same time.
+        io_loop = mock.Mock()
+        drainer = mock.Mock()
+        named_sockets = [('server', mock.Mock())]
+        graceful.install_signal_handlers(
+            drainer, io_loop, command=['runserver'],
+            named_sockets=named_sockets)
+        with mock.patch('guiserver.graceful.shutdown') as mock_shutdown:
+            self.start(mock_signal, io_loop, True)
+            self.start(mock_signal, io_loop, False)
+        mock_shutdown.assert_called_once_with(
+            drainer, io_loop, ['runserver'], named_sockets)
+
+    def test_failed_restart(self, mock_signal):
+        # Another shutdown can be requested if the restart fails.
+        io_loop = mock.Mock()
+        drainer = mock.Mock()
+        graceful.install_signal_handlers(
+            drainer, io_loop, command=['runserver'])
+        with mock.patch('guiserver.graceful.shutdown') as mock_shutdown:
+            self.start(mock_signal, io_loop, True)
+            future, done = io_loop.add_future.call_args[0]
+            future.result.return_value = False
+            done(future)
+            self.start(mock_signal, io_loop, False)
+        self.assertEqual(2, mock_shutdown.call_count)
+        mock_shutdown.assert_called_with(drainer, io_loop)
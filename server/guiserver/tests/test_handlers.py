@@ -16,6 +16,7 @@
 
 """Tests for the Juju GUI server handlers."""
 
+import datetime
 import json
 import os
 import shutil
@@ -40,12 +41,18 @@ from tornado.testing import (
 import yaml
 
 from guiserver import (
+    admission,
     apps,
     auth,
     clients,
     get_version,
     handlers,
+    keepalive,
     manage,
+    metrics,
+    protocols,
+    snapshots,
+    tokens,
 )
 from guiserver.bundles import base
 from guiserver.tests import helpers
@@ -231,11 +238,222 @@ class TestWebSocketHandlerConnection(
         subprotocol = handler.select_subprotocol(['foo', 'bar'])
         self.assertEqual('foo', subprotocol)
 
+    def test_close_code(self):
+        # The close status code and reason are sent to the browser.
+        handler = self.make_handler()
+        protocol = handler.ws_connection = mock.Mock(
+            spec=protocols.WebSocketProtocol)
+        handler.close(1012, 'service restart')
+        protocol.close.assert_called_once_with(1012, 'service restart')
+        self.assertIsNone(handler.ws_connection)
+
+    def test_close_draft76(self):
+        # Draft76 connections are closed without a status code.
+        handler = self.make_handler()
+        protocol = handler.ws_connection = mock.Mock()
+        handler.close(1012, 'service restart')
+        protocol.close.assert_called_once_with()
+
+    def test_compression_options(self):
+        # Compression options are used for both the browser and the Juju API
+        # connections.
+        options = {'level': 1, 'window_bits': 9, 'min_size': 0}
+        handler = self.make_handler()
+        with mock.patch('guiserver.handlers.websocket_connect') as connect:
+            connect.return_value = concurrent.Future()
+            handler.initialize(
+                self.apiurl, self.auth_backend, self.deployer, self.tokens,
+                apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+                io_loop=self.io_loop, compression_options=options)
+        self.assertEqual(options, handler.compression_options)
+        self.assertEqual(options, connect.call_args[1]['compression_options'])
+
+    def test_passthrough(self):
+        # In pass-through mode, raw text is used for both the browser and the
+        # Juju API connections.
+        handler = self.make_handler()
+        with mock.patch('guiserver.handlers.websocket_connect') as connect:
+            connect.return_value = concurrent.Future()
+            handler.initialize(
+                self.apiurl, self.auth_backend, self.deployer, self.tokens,
+                apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+                io_loop=self.io_loop, passthrough=True)
+        self.assertTrue(handler.raw_text)
+        self.assertTrue(connect.call_args[1]['raw_text'])
+
+    def test_admission_accepted(self):
+        # The session is released when the browser disconnects.
+        limits = admission.Admission(max_sessions=1)
+        handler = self.make_handler()
+        with self.mock_websocket_connect() as mock_websocket_connect:
+            handler.initialize(
+                self.apiurl, self.auth_backend, self.deployer, self.tokens,
+                apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+                io_loop=self.io_loop, admission=limits)
+        self.assertIsNone(handler.rejection)
+        self.assertEqual(1, mock_websocket_connect.call_count)
+        self.assertEqual(1, limits.get_info()['sessions'])
+        handler.on_close()
+        handler.on_connection_close()
+        self.assertEqual(0, limits.get_info()['sessions'])
+
+    def test_admission_refused(self):
+        # Sessions exceeding the limits are refused before connecting to the
+        # Juju API.
+        limits = admission.Admission(max_sessions=1)
+        limits.acquire('1.2.3.4')
+        handler = self.make_handler()
+        expected_log = '.*client refused: too many sessions'
+        with ExpectLog('', expected_log, required=True):
+            with self.mock_websocket_connect() as mock_websocket_connect:
+                handler.initialize(
+                    self.apiurl, self.auth_backend, self.deployer,
+                    self.tokens, apps.WEBSOCKET_SOURCE_TEMPLATE,
+                    apps.WEBSOCKET_TARGET_TEMPLATE, io_loop=self.io_loop,
+                    admission=limits)
+        self.assertFalse(mock_websocket_connect.called)
+        self.assertEqual('too many sessions', handler.rejection)
+        # A "503 Service Unavailable" response is sent to the browser.
+        handler._execute([])
+        response = handler.stream.write.call_args[0][0]
+        self.assertTrue(response.startswith(
+            'HTTP/1.1 503 Service Unavailable\r\n'))
+        self.assertTrue(handler.stream.close.called)
+        # Refused sessions are not released.
+        handler.on_connection_close()
+        self.assertEqual(1, limits.get_info()['sessions'])
+
+    @gen_test
+    def test_keepalive_options(self):
+        # Keepalive options are used for both the browser and the Juju API
+        # connections.
+        options = {'interval': 30, 'timeout': 10}
+        handler = self.make_handler()
+        with self.mock_websocket_connect() as mock_websocket_connect:
+            yield handler.initialize(
+                self.apiurl, self.auth_backend, self.deployer, self.tokens,
+                apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+                io_loop=self.io_loop, keepalive_options=options,
+                idle_timeout=60)
+        self.assertEqual(
+            options, mock_websocket_connect.call_args[1]['keepalive_options'])
+        self.assertEqual(30, handler._keepalive.interval)
+        self.assertEqual(60, handler._keepalive.idle_timeout)
+
+    @gen_test
+    def test_keepalive_idle(self):
+        # Idle sessions are closed.
+        handler = yield self.make_initialized_handler(mock_protocol=True)
+        ws_connection = handler.ws_connection
+        expected_log = '.*closing session: idle timeout'
+        with ExpectLog('', expected_log, required=True):
+            handler._on_browser_expired(keepalive.EXPIRED_IDLE)
+        ws_connection.close.assert_called_once_with()
+        self.assertFalse(ws_connection._abort.called)
+
+    @gen_test
+    def test_keepalive_no_response(self):
+        # Browser connections are aborted if the browser does not respond.
+        handler = yield self.make_initialized_handler(mock_protocol=True)
+        ws_connection = handler.ws_connection
+        expected_log = '.*closing session: no response to keepalive pings'
+        with ExpectLog('', expected_log, required=True):
+            handler._on_browser_expired(keepalive.EXPIRED_NO_RESPONSE)
+        ws_connection._abort.assert_called_once_with()
+
+    def make_multiplexed_handler(self, session):
+        """Create and return a handler sharing Juju API connections.
+
+        The multiplexer connects the handler to the given session.
+        """
+        multiplexer = mock.Mock()
+        if session is None:
+            multiplexer.connect.return_value = None
+        else:
+            future = concurrent.Future()
+            future.set_result(session)
+            multiplexer.connect.return_value = future
+        handler = self.make_handler(mock_protocol=True)
+        with self.mock_websocket_connect() as mock_websocket_connect:
+            handler.initialize(
+                self.apiurl, self.auth_backend, self.deployer, self.tokens,
+                apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+                io_loop=self.io_loop, multiplexer=multiplexer)
+        self.assertFalse(mock_websocket_connect.called)
+        return handler, multiplexer
+
+    def test_multiplexer_lazy_connection(self):
+        # When multiplexing, the Juju API connection is established when the
+        # first message is received from the browser.
+        session = mock.Mock()
+        handler, multiplexer = self.make_multiplexed_handler(session)
+        self.assertFalse(multiplexer.connect.called)
+        login = json.dumps({
+            'RequestId': 1,
+            'Type': 'Admin',
+            'Request': 'Login',
+            'Params': {'AuthTag': 'user-who', 'Password': 'passwd'},
+        })
+        handler.on_message(login)
+        self.assertEqual(1, multiplexer.connect.call_count)
+        apiurl, data, callback = multiplexer.connect.call_args[0]
+        self.assertEqual(self.apiurl, apiurl)
+        self.assertEqual(json.loads(login), data)
+        self.assertEqual(handler.on_juju_message, callback)
+        # The queued login request is sent using the shared connection.
+        self.assertTrue(handler.juju_connected)
+        self.assertIs(session, handler.juju_connection)
+        session.write_message.assert_called_once_with(login)
+        # Subsequent messages are sent directly.
+        handler.on_message(self.hello_message)
+        session.write_message.assert_called_with(self.hello_message)
+        self.assertEqual(1, multiplexer.connect.call_count)
+
+    def test_multiplexer_not_shared(self):
+        # A dedicated connection is used if the multiplexer cannot share an
+        # upstream connection.
+        handler, multiplexer = self.make_multiplexed_handler(None)
+        with self.mock_websocket_connect() as mock_websocket_connect:
+            handler.on_message(self.hello_message)
+        multiplexer.connect.assert_called_once_with(
+            self.apiurl, None, handler.on_juju_message, headers=mock.ANY,
+            compression_options=None, keepalive_options=None)
+        self.assertEqual(1, mock_websocket_connect.call_count)
+        self.assertTrue(handler.juju_connected)
+        handler.juju_connection.write_message.assert_called_once_with(
+            self.hello_message)
+
+    def test_pool(self):
+        # Dedicated Juju API connections are retrieved from the pool if
+        # provided.
+        pool = mock.Mock()
+        pool.connect.return_value = concurrent.Future()
+        handler = self.make_handler()
+        with self.mock_websocket_connect() as mock_websocket_connect:
+            handler.initialize(
+                self.apiurl, self.auth_backend, self.deployer, self.tokens,
+                apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+                io_loop=self.io_loop, pool=pool)
+        self.assertFalse(mock_websocket_connect.called)
+        pool.connect.assert_called_once_with(
+            self.apiurl, handler.on_juju_message, headers=mock.ANY)
+        self.assertIs(
+            pool.connect.return_value, handler._juju_connected_future)
+
+    def test_multiplexer_closed_before_connection(self):
+        # No connection is established if the browser disconnects before
+        # sending messages.
+        handler, multiplexer = self.make_multiplexed_handler(mock.Mock())
+        handler.on_close()
+        self.assertFalse(multiplexer.connect.called)
+
 
 class TestWebSocketHandlerProxy(
         WebSocketHandlerTestMixin, helpers.WSSTestMixin, LogTrapTestCase,
         AsyncHTTPSTestCase):
 
+    decode_path = 'guiserver.handlers.json_decode_dict'
+
     @mock.patch('guiserver.clients.WebSocketClientConnection')
     def test_from_browser_to_juju(self, mock_juju_connection):
         # A message from the browser is forwarded to the remote server.
@@ -252,6 +470,59 @@ class TestWebSocketHandlerProxy(
             handler.on_juju_message(self.hello_message)
             handler.write_message.assert_called_once_with(self.hello_message)
 
+    @gen_test
+    def test_juju_messages_not_decoded(self):
+        # Messages from the remote server are propagated without decoding them
+        # if authentication is not in progress.
+        handler = yield self.make_initialized_handler()
+        message = json.dumps({'RequestId': 1, 'Response': {'Deltas': []}})
+        with mock.patch('guiserver.handlers.WebSocketHandler.write_message'):
+            with mock.patch(self.decode_path) as mock_decode:
+                handler.on_juju_message(message)
+            self.assertFalse(mock_decode.called)
+            handler.write_message.assert_called_once_with(message)
+
+    @gen_test
+    def test_browser_messages_not_decoded(self):
+        # Messages from the browser not handled by the GUI server are
+        # propagated without decoding them.
+        handler = yield self.make_initialized_handler()
+        message = json.dumps({
+            'RequestId': 1, 'Type': 'Client', 'Request': 'FullStatus'})
+        mock_path = 'guiserver.clients.WebSocketClientConnection.write_message'
+        with mock.patch(mock_path) as mock_write_message:
+            with mock.patch(self.decode_path) as mock_decode:
+                handler.on_message(message)
+        self.assertFalse(mock_decode.called)
+        mock_write_message.assert_called_once_with(message)
+
+    @gen_test
+    def test_metrics(self):
+        # Frames and Juju API request latencies are recorded.
+        handler = yield self.make_initialized_handler()
+        frames = metrics.WEBSOCKET_FRAMES
+        before = (
+            frames.get(direction=metrics.CLIENT_TO_JUJU),
+            frames.get(direction=metrics.JUJU_TO_CLIENT))
+        requests, _ = metrics.JUJU_REQUEST_TIME.get(
+            type='Client', request='FullStatus')
+        request = json.dumps({
+            'RequestId': 42, 'Type': 'Client', 'Request': 'FullStatus'})
+        response = json.dumps({'RequestId': 42, 'Response': {}})
+        mock_path = 'guiserver.clients.WebSocketClientConnection.write_message'
+        with mock.patch(mock_path):
+            handler.on_message(request)
+        with mock.patch('guiserver.handlers.WebSocketHandler.write_message'):
+            handler.on_juju_message(response)
+        self.assertEqual(
+            (before[0] + 1, before[1] + 1),
+            (frames.get(direction=metrics.CLIENT_TO_JUJU),
+             frames.get(direction=metrics.JUJU_TO_CLIENT)))
+        count, _ = metrics.JUJU_REQUEST_TIME.get(
+            type='Client', request='FullStatus')
+        self.assertEqual(requests + 1, count)
+        self.assertEqual({}, handler._request_times)
+
     @gen_test
     def test_queued_messages(self):
         # Messages sent before the client connection is established are
@@ -306,6 +577,346 @@ class TestWebSocketHandlerProxy(
             yield client.read_message()
 
 
+class TestWebSocketHandlerBuffering(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin, LogTrapTestCase,
+        AsyncHTTPSTestCase):
+
+    buffer_size_path = 'guiserver.handlers.get_write_buffer_size'
+
+    def make_buffering_handler(self, **kwargs):
+        """Create and return a handler initialized with the given options.
+
+        The returned handler is not connected to the Juju API.
+        """
+        handler = self.make_handler(mock_protocol=True)
+        with mock.patch('guiserver.handlers.websocket_connect') as connect:
+            connect.return_value = concurrent.Future()
+            handler.initialize(
+                self.apiurl, self.auth_backend, self.deployer, self.tokens,
+                apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+                io_loop=self.io_loop, **kwargs)
+        return handler
+
+    def test_queue_overflow_drop(self):
+        # The oldest message is dropped when the queue is full and the drop
+        # policy is used.
+        handler = self.make_buffering_handler(
+            queue_size=2, overflow_policy=handlers.OVERFLOW_DROP)
+        expected_log = '.*message queue full: dropping oldest message'
+        with ExpectLog('', expected_log, required=True):
+            for message in ('1', '2', '3'):
+                handler.on_message(message)
+        self.assertEqual(['2', '3'], list(handler._juju_message_queue))
+        self.assertFalse(handler.ws_connection.close.called)
+
+    def test_queue_overflow_disconnect(self):
+        # The browser is disconnected when the queue is full and the
+        # disconnect policy is used.
+        handler = self.make_buffering_handler(
+            queue_size=2, overflow_policy=handlers.OVERFLOW_DISCONNECT)
+        ws_connection = handler.ws_connection
+        expected_log = '.*message queue full: disconnecting'
+        with ExpectLog('', expected_log, required=True):
+            for message in ('1', '2', '3'):
+                handler.on_message(message)
+        self.assertEqual(['1', '2'], list(handler._juju_message_queue))
+        ws_connection.close.assert_called_once_with()
+
+    def test_backpressure(self):
+        # Reading from Juju is paused when the browser buffer grows above the
+        # high watermark, and resumed when it drops below the low watermark.
+        handler = self.make_buffering_handler(
+            high_watermark=100, low_watermark=10)
+        handler.juju_connected = True
+        handler.juju_connection = juju_connection = mock.Mock(
+            reading_paused=False)
+        with mock.patch(self.buffer_size_path, mock.Mock(return_value=100)):
+            handler.on_juju_message(self.hello_message)
+        self.assertFalse(juju_connection.pause_reading.called)
+        expected_log = '.*browser falling behind \\(101 bytes buffered\\)'
+        with mock.patch(self.buffer_size_path, mock.Mock(return_value=101)):
+            with ExpectLog('', expected_log, required=True):
+                handler.on_juju_message(self.hello_message)
+            juju_connection.pause_reading.assert_called_once_with()
+            juju_connection.reading_paused = True
+            # The buffer is still too big.
+            handler._check_browser_drained()
+        self.assertFalse(juju_connection.resume_reading.called)
+        with mock.patch(self.buffer_size_path, mock.Mock(return_value=10)):
+            handler._check_browser_drained()
+        juju_connection.resume_reading.assert_called_once_with()
+
+    def test_coalescing(self):
+        # AllWatcher deltas received while the browser is congested are
+        # coalesced and sent when the browser catches up.
+        handler = self.make_buffering_handler(low_watermark=10, coalesce=True)
+        handler.user.is_authenticated = True
+        handler.juju_connected = True
+        handler.juju_connection = juju_connection = mock.Mock(
+            reading_paused=False)
+        request = json.dumps({
+            'RequestId': 5, 'Type': 'AllWatcher', 'Request': 'Next',
+            'Id': '1', 'Params': {}})
+        handler.on_message(request)
+        juju_connection.write_message.assert_called_once_with(request)
+        juju_connection.write_message.reset_mock()
+
+        def respond(status):
+            handler.on_juju_message(json.dumps({
+                'RequestId': 5,
+                'Response': {'Deltas': [
+                    ['unit', 'change', {'Name': 'django/0', 'Status': status}],
+                ]},
+            }))
+
+        write_path = 'guiserver.handlers.WebSocketHandler.write_message'
+        with mock.patch(write_path) as mock_write:
+            with mock.patch(self.buffer_size_path, mock.Mock(return_value=50)):
+                respond('pending')
+                respond('started')
+                handler._flush_coalesced()
+            self.assertFalse(mock_write.called)
+            # The Next request is sent again on behalf of the browser.
+            self.assertEqual(2, juju_connection.write_message.call_count)
+            sent = json.loads(juju_connection.write_message.call_args[0][0])
+            self.assertEqual(json.loads(request), sent)
+            with mock.patch(self.buffer_size_path, mock.Mock(return_value=0)):
+                handler._flush_coalesced()
+        mock_write.assert_called_once_with(mock.ANY)
+        self.assertEqual({
+            'RequestId': 5,
+            'Response': {'Deltas': [
+                ['unit', 'change', {'Name': 'django/0', 'Status': 'started'}],
+            ]},
+        }, json.loads(mock_write.call_args[0][0]))
+
+    def test_model_cache(self):
+        # The first AllWatcher Next request is answered using the cached
+        # model, and the real response is sent as the second response.
+        model_cache = snapshots.ModelCache(1024 * 1024)
+        key = snapshots.model_key(self.apiurl)
+        model_cache.replace(key, [
+            ['unit', 'change', {'Name': 'django/0'}],
+            ['unit', 'change', {'Name': 'django/1'}],
+        ], 100, None)
+        handler = self.make_buffering_handler(model_cache=model_cache)
+        handler.user.is_authenticated = True
+        handler.juju_connected = True
+        handler.juju_connection = juju_connection = mock.Mock(
+            reading_paused=False)
+
+        def request(request_id):
+            handler.on_message(json.dumps({
+                'RequestId': request_id, 'Type': 'AllWatcher',
+                'Request': 'Next', 'Id': '1', 'Params': {}}))
+
+        write_path = 'guiserver.handlers.WebSocketHandler.write_message'
+        with mock.patch(write_path) as mock_write:
+            request(1)
+            self.assertEqual(1, juju_connection.write_message.call_count)
+            self.assertEqual({'RequestId': 1, 'Response': {'Deltas': [
+                ['unit', 'change', {'Name': 'django/0'}],
+                ['unit', 'change', {'Name': 'django/1'}],
+            ]}}, json.loads(mock_write.call_args[0][0]))
+            handler.on_juju_message(json.dumps({
+                'RequestId': 1, 'Response': {'Deltas': [
+                    ['unit', 'change', {'Name': 'django/0'}],
+                ]}}))
+            self.assertEqual(1, mock_write.call_count)
+            # The second request is answered using the real response.
+            request(2)
+            self.assertEqual(1, juju_connection.write_message.call_count)
+            self.assertEqual({'RequestId': 2, 'Response': {'Deltas': [
+                ['unit', 'change', {'Name': 'django/0'}],
+                ['unit', 'remove', {'Name': 'django/1'}],
+            ]}}, json.loads(mock_write.call_args[0][0]))
+        # The cache is updated by this connection.
+        self.assertEqual(
+            [['unit', 'change', {'Name': 'django/0'}]], model_cache.get(key))
+        self.assertTrue(model_cache.is_feeder(key, handler._snapshots))
+
+    def test_buffer_info(self):
+        # Information about the connection buffers can be retrieved.
+        handler = self.make_buffering_handler()
+        handler.on_message(self.hello_message)
+        expected = {
+            'browser_buffer': 0,
+            'juju_buffer': 0,
+            'queued_messages': 1,
+            'juju_paused': False,
+        }
+        self.assertEqual(expected, handler.get_buffer_info())
+
+    def test_connections(self):
+        # Handlers are registered in the connections set while connected.
+        connections = set()
+        handler = self.make_buffering_handler(connections=connections)
+        self.assertEqual(set([handler]), connections)
+        handler.on_close()
+        self.assertEqual(set(), connections)
+
+
+class TestWebSocketHandlerReconnection(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    servers = [[{'Value': '10.0.0.2', 'Port': 17070, 'Scope': 'public'}]]
+
+    def setUp(self):
+        # Set up a handler connected to a mock Juju API, with a logged in
+        # user.
+        super(TestWebSocketHandlerReconnection, self).setUp()
+        self.connections = []
+        patcher = mock.patch(
+            'guiserver.handlers.websocket_connect', self.websocket_connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = self.make_handler(mock_protocol=True)
+        self.handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+            io_loop=self.io_loop, reconnect=True)
+        self.handler.on_message(self.make_login_request(encoded=True))
+        self.handler.on_juju_message(json.dumps({
+            'RequestId': 42,
+            'Response': {'Servers': self.servers},
+        }))
+        self.assertTrue(self.handler.user.is_authenticated)
+        self.other_url = 'wss://10.0.0.2:17070/echo'
+        # Keep a reference to the browser connection, which is removed when
+        # the handler is closed.
+        self.ws_connection = self.handler.ws_connection
+        self.ws_connection.reset_mock()
+
+    def websocket_connect(self, io_loop, url, callback, **kwargs):
+        """Simulate a connection to the Juju API.
+
+        Store the URL and the connection in self.connections. The connection
+        fails if the URL is included in self.failing_urls.
+        """
+        connection = mock.Mock()
+        self.connections.append((url, connection))
+        future = concurrent.Future()
+        if url in getattr(self, 'failing_urls', ()):
+            future.set_exception(ValueError('bad wolf'))
+        else:
+            future.set_result(connection)
+        return future
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        """Wait for the given condition to be satisfied."""
+        while not condition():
+            yield gen.Task(
+                self.io_loop.add_timeout, self.io_loop.time() + 0.01)
+
+    @gen_test
+    def test_reconnect_and_login(self):
+        # The connection is established again and the user logged in again
+        # when the Juju API connection is lost.
+        handler = self.handler
+        expected_log = '.*Juju API connection lost: reconnecting'
+        with ExpectLog('', expected_log, required=True):
+            handler.on_juju_message(None)
+        self.assertFalse(handler.juju_connected)
+        self.assertFalse(self.ws_connection.close.called)
+        # Messages are queued in the meanwhile.
+        handler.on_message(self.hello_message)
+        self.assertEqual(2, len(self.connections))
+        url, connection = self.connections[-1]
+        self.assertEqual(self.apiurl, url)
+        expected = self.make_login_request(
+            request_id=handlers.RELOGIN_REQUEST_ID)
+        self.assertEqual(
+            expected, json.loads(connection.write_message.call_args[0][0]))
+        # The login response is not propagated to the browser.
+        handler.on_juju_message(json.dumps({'RequestId': 0, 'Response': {}}))
+        yield self.wait_for(lambda: handler.juju_connected)
+        self.assertFalse(self.ws_connection.write_message.called)
+        self.assertIs(connection, handler.juju_connection)
+        connection.write_message.assert_called_with(self.hello_message)
+
+    def test_pending_requests(self):
+        # The browser receives an error for the requests pending when the
+        # Juju API connection is lost, including AllWatcher Next requests.
+        handler = self.handler
+        handler.on_message(json.dumps({
+            'RequestId': 43,
+            'Type': 'AllWatcher',
+            'Request': 'Next',
+            'Id': '1',
+            'Params': {},
+        }))
+        expected_log = '.*Juju API connection lost: reconnecting'
+        with ExpectLog('', expected_log, required=True):
+            handler.on_juju_message(None)
+        self.assertEqual(1, self.ws_connection.write_message.call_count)
+        message = self.ws_connection.write_message.call_args[0][0]
+        self.assertEqual({
+            'RequestId': 43,
+            'Error': handlers.JUJU_CONNECTION_LOST_ERROR,
+            'Response': {},
+        }, json.loads(message))
+        self.assertFalse(self.ws_connection.close.called)
+
+    def test_pending_requests_coalesced(self):
+        # Next requests parked while coalescing deltas are failed once.
+        handler = self.handler
+        handler._coalescer = mock.Mock()
+        handler._coalescer.reset.return_value = [43, 44]
+        handler._track_request(None, {'RequestId': 43})
+        with ExpectLog('', '.*Juju API connection lost', required=True):
+            handler.on_juju_message(None)
+        self.assertEqual(2, self.ws_connection.write_message.call_count)
+        calls = self.ws_connection.write_message.call_args_list
+        self.assertEqual(
+            [43, 44], [json.loads(c[0][0])['RequestId'] for c in calls])
+
+    @gen_test
+    def test_other_servers(self):
+        # Other API servers are tried if the connection cannot be
+        # established.
+        self.failing_urls = [self.apiurl]
+        with mock.patch('guiserver.handlers.RECONNECT_MIN_DELAY', 0.01):
+            self.handler.on_juju_message(None)
+            yield self.wait_for(lambda: len(self.connections) == 3)
+        url, connection = self.connections[-1]
+        self.assertEqual(self.other_url, url)
+        self.assertTrue(connection.write_message.called)
+
+    @gen_test
+    def test_attempts_exhausted(self):
+        # The browser is disconnected if the connection cannot be established.
+        self.failing_urls = [self.apiurl, self.other_url]
+        expected_log = '.*unable to reconnect to Juju'
+        with ExpectLog('', expected_log, required=True):
+            with mock.patch('guiserver.handlers.RECONNECT_MIN_DELAY', 0):
+                self.handler.on_juju_message(None)
+                yield self.wait_for(lambda: self.ws_connection.close.called)
+        self.assertEqual(
+            handlers.RECONNECT_MAX_ATTEMPTS + 1, len(self.connections))
+
+    @gen_test
+    def test_login_failure(self):
+        # The browser is disconnected if the user cannot log in again.
+        self.handler.on_juju_message(None)
+        expected_log = '.*unable to log in again'
+        with ExpectLog('', expected_log, required=True):
+            self.handler.on_juju_message(json.dumps({
+                'RequestId': 0, 'Error': 'invalid entity name or password'}))
+            yield self.wait_for(lambda: self.ws_connection.close.called)
+        self.assertFalse(self.handler.juju_connected)
+
+    def test_not_logged_in(self):
+        # The browser is disconnected if the user is not logged in.
+        self.handler.user.is_authenticated = False
+        expected_log = '.*Juju API unexpectedly disconnected'
+        with ExpectLog('', expected_log, required=True):
+            self.handler.on_juju_message(None)
+        self.assertTrue(self.ws_connection.close.called)
+        self.assertEqual(1, len(self.connections))
+
+
 class TestWebSocketHandlerAuthentication(
         WebSocketHandlerTestMixin, helpers.WSSTestMixin,
         helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
@@ -361,6 +972,18 @@ class TestWebSocketHandlerAuthentication(
         self.assertFalse(self.handler.user.is_authenticated)
         self.assertFalse(self.handler.auth.in_progress())
 
+    def test_unrelated_response(self):
+        # Responses not related to the pending login request are propagated
+        # without being decoded.
+        self.send_login_request()
+        message = '{"RequestId": 47, "Response": {}}'
+        with mock.patch('guiserver.handlers.json_decode_dict') as mock_decode:
+            self.handler.on_juju_message(message)
+        self.assertFalse(mock_decode.called)
+        self.assertTrue(self.handler.auth.in_progress())
+        self.send_login_response(True)
+        self.assertTrue(self.handler.user.is_authenticated)
+
     @mock.patch('uuid.uuid4', mock.Mock(return_value=mock.Mock(hex='DEFACED')))
     @helpers.patch_time
     def test_token_request(self):
@@ -407,10 +1030,8 @@ class TestWebSocketHandlerAuthentication(
         # It supports authenticating with a token.
         request = self.make_token_login_request(
             self.tokens, username='user', password='passwd')
-        with mock.patch.object(self.io_loop,
-                               'remove_timeout') as mock_remove_timeout:
-            self.handler.on_message(json.dumps(request))
-            mock_remove_timeout.assert_called_once_with('handle')
+        self.handler.on_message(json.dumps(request))
+        self.assertEqual(0, self.tokens.get_info()['tokens'])
         self.assertEqual(
             self.make_login_request(
                 request_id=42, username='user', password='passwd'),
@@ -427,10 +1048,8 @@ class TestWebSocketHandlerAuthentication(
         # It correctly handles a token that will not authenticate.
         request = self.make_token_login_request(
             self.tokens, username='user', password='passwd')
-        with mock.patch.object(self.io_loop,
-                               'remove_timeout') as mock_remove_timeout:
-            self.handler.on_message(json.dumps(request))
-            mock_remove_timeout.assert_called_once_with('handle')
+        self.handler.on_message(json.dumps(request))
+        self.assertEqual(0, self.tokens.get_info()['tokens'])
         self.send_login_response(False)
         message = self.handler.ws_connection.write_message.call_args[0][0]
         self.assertEqual(
@@ -449,6 +1068,64 @@ class TestWebSocketHandlerAuthentication(
         self.assertEqual(0, len(self.handler._juju_message_queue))
 
 
+class TestWebSocketHandlerRoutes(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    def make_routed_handler(self, **kwargs):
+        """Create and return an initialized handler.
+
+        The kwargs are passed to the handler initialize method.
+        """
+        handler = self.make_handler(mock_protocol=True)
+        handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_SOURCE_TEMPLATE, apps.WEBSOCKET_TARGET_TEMPLATE,
+            io_loop=self.io_loop, **kwargs)
+        return handler
+
+    def test_routes(self):
+        # Requests are dispatched based on their type and request name.
+        handler = self.make_routed_handler()
+        expected = set([
+            ('Admin', 'Login'),
+            ('ChangeSet', 'GetChanges'),
+            ('ChangeSet', 'SetChanges'),
+            ('Deployer', 'Cancel'),
+            ('Deployer', 'Import'),
+            ('Deployer', 'Next'),
+            ('Deployer', 'Status'),
+            ('Deployer', 'Watch'),
+            ('GUIToken', 'Create'),
+            ('GUIToken', 'Login'),
+        ])
+        self.assertEqual(expected, set(handler._routes))
+
+    def test_watcher_routes(self):
+        # AllWatcher Next requests are routed when coalescing deltas.
+        handler = self.make_routed_handler(coalesce=True)
+        self.assertEqual(
+            handler._route_watcher_next,
+            handler._routes['AllWatcher', 'Next'])
+
+    def test_unrouted_request(self):
+        # Decoded requests not handled by the GUI server are propagated.
+        handler = self.make_routed_handler()
+        handler.user.is_authenticated = True
+        request = json.dumps(
+            {'RequestId': 1, 'Type': 'ChangeSet', 'Request': 'Unknown'})
+        handler.on_message(request)
+        self.assertEqual([request], list(handler._juju_message_queue))
+
+    def test_login_request_when_authenticated(self):
+        # Login requests are propagated if the user is already logged in.
+        handler = self.make_routed_handler()
+        handler.user.is_authenticated = True
+        handler.on_message(self.make_login_request(encoded=True))
+        self.assertEqual(1, len(handler._juju_message_queue))
+        self.assertFalse(handler.auth.in_progress())
+
+
 class TestWebSocketHandlerBundles(
         WebSocketHandlerTestMixin, helpers.WSSTestMixin,
         helpers.BundlesTestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
@@ -832,26 +1509,50 @@ class TestJujuProxyHandler(TestProxyHandler):
 class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
     def get_app(self):
-        mock_deployer = mock.Mock()
-        mock_deployer.status.return_value = 'deployments status'
+        self.mock_deployer = mock.Mock()
+        self.mock_deployer.status.return_value = 'deployments status'
+        self.connections = set()
         options = {
             'apiurl': 'wss://api.example.com:17070',
             'apiversion': 'clojure',
-            'deployer': mock_deployer,
+            'connections': self.connections,
+            'deployer': self.mock_deployer,
             'sandbox': False,
             'start_time': 10,
         }
-        return web.Application([(r'^/info', handlers.InfoHandler, options)])
+        self.pool = mock.Mock()
+        self.pool.get_info.return_value = {'hits': 47}
+        pool_options = dict(options, pool=self.pool)
+        self.admission = admission.Admission(max_sessions=10)
+        admission_options = dict(options, admission=self.admission)
+        self.tokens = auth.AuthenticationTokenHandler(
+            io_loop=self.io_loop, capacity=5)
+        self.changesets = tokens.TokenStore(
+            datetime.timedelta(minutes=1), io_loop=self.io_loop)
+        tokens_options = dict(
+            options, tokens=self.tokens, changesets=self.changesets)
+        return web.Application([
+            (r'^/info', handlers.InfoHandler, options),
+            (r'^/pool-info', handlers.InfoHandler, pool_options),
+            (r'^/admission-info', handlers.InfoHandler, admission_options),
+            (r'^/tokens-info', handlers.InfoHandler, tokens_options),
+        ])
 
     @mock.patch('time.time', mock.Mock(return_value=52))
     def test_info(self):
         # The handler correctly returns information about the GUI server.
         expected = {
+            'admission': None,
             'apiurl': 'wss://api.example.com:17070',
             'apiversion': 'clojure',
+            'changesets': None,
+            'connection_pool': None,
+            'connections': [],
             'debug': False,
             'deployer': 'deployments status',
+            'model_cache': None,
             'sandbox': False,
+            'tokens': None,
             'uptime': 42,
             'version': get_version(),
         }
@@ -863,6 +1564,82 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
         info = escape.json_decode(response.body)
         self.assertEqual(expected, info)
 
+    def test_remote_deployer_status(self):
+        # The deployer status can also be retrieved asynchronously.
+        future = concurrent.Future()
+        future.set_result(['remote status'])
+        self.mock_deployer.status.return_value = future
+        response = self.fetch('/info')
+        info = escape.json_decode(response.body)
+        self.assertEqual(['remote status'], info['deployer'])
+
+    def test_connections(self):
+        # The buffers of active WebSocket connections are reported.
+        connection = mock.Mock()
+        connection.get_buffer_info.return_value = {'browser_buffer': 42}
+        self.connections.add(connection)
+        response = self.fetch('/info')
+        info = escape.json_decode(response.body)
+        self.assertEqual([{'browser_buffer': 42}], info['connections'])
+
+    def test_connection_pool(self):
+        # The Juju API connection pool statistics are reported.
+        response = self.fetch('/pool-info')
+        info = escape.json_decode(response.body)
+        self.assertEqual({'hits': 47}, info['connection_pool'])
+
+    def test_admission(self):
+        # The WebSocket sessions occupancy is reported.
+        self.admission.acquire('1.2.3.4')
+        response = self.fetch('/admission-info')
+        info = escape.json_decode(response.body)
+        self.assertEqual(1, info['admission']['sessions'])
+        self.assertEqual(10, info['admission']['max_sessions'])
+
+    def test_tokens(self):
+        # The number of stored tokens and change sets is reported.
+        self.changesets.add(['change'])
+        response = self.fetch('/tokens-info')
+        info = escape.json_decode(response.body)
+        self.assertEqual(0, info['tokens']['tokens'])
+        self.assertEqual(5, info['tokens']['capacity'])
+        self.assertEqual(1, info['changesets']['tokens'])
+        self.assertEqual(1, info['changesets']['created'])
+
+
+class TestMetricsHandler(LogTrapTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.registry = metrics.Registry()
+        self.counter = self.registry.counter('requests_total', 'Requests.')
+        self.connections = set([mock.Mock(), mock.Mock()])
+        options = {'registry': self.registry, 'connections': self.connections}
+        return web.Application([
+            (r'^/metrics', handlers.MetricsHandler, options),
+        ])
+
+    def tearDown(self):
+        metrics.WEBSOCKET_CONNECTIONS.clear()
+        super(TestMetricsHandler, self).tearDown()
+
+    def test_metrics(self):
+        # The handler returns the metrics using the Prometheus text format.
+        self.counter.inc(3)
+        response = self.fetch('/metrics')
+        self.assertEqual(200, response.code)
+        self.assertEqual(
+            metrics.CONTENT_TYPE, response.headers['Content-Type'])
+        expected = (
+            '# HELP requests_total Requests.\n'
+            '# TYPE requests_total counter\n'
+            'requests_total 3\n')
+        self.assertEqual(expected, response.body)
+
+    def test_connections(self):
+        # The number of connected browsers is updated.
+        self.fetch('/metrics')
+        self.assertEqual(2, metrics.WEBSOCKET_CONNECTIONS.get())
+
 
 class TestHttpsRedirectHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
@@ -0,0 +1,110 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server WebSocket keepalive."""
+
+import unittest
+
+import mock
+
+from guiserver import keepalive
+
+
+class TestKeepalive(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = mock.Mock()
+        self.io_loop.time.return_value = 100
+        self.ping = mock.Mock()
+        self.on_expired = mock.Mock()
+
+    def make_keepalive(self, idle_timeout=0, paused=None, interval=30):
+        """Return a Keepalive pinging every interval seconds."""
+        options = None
+        if interval:
+            options = {'interval': interval, 'timeout': 10}
+        return keepalive.Keepalive(
+            self.io_loop, self.ping, self.on_expired, options,
+            idle_timeout=idle_timeout, paused=paused)
+
+    def check_at(self, ka, now):
+        """Check the connection at the given time."""
+        self.io_loop.time.return_value = now
+        ka._check()
+
+    def test_disabled(self):
+        # Nothing is checked if pings and the idle timeout are disabled.
+        ka = self.make_keepalive(interval=0)
+        self.assertFalse(ka.enabled)
+        ka.start()
+        ka.stop()
+
+    def test_period(self):
+        # The connection is checked at the shortest configured interval.
+        ka = self.make_keepalive(idle_timeout=5)
+        self.assertTrue(ka.enabled)
+        self.assertEqual(5000, ka._callback.callback_time)
+
+    def test_ping(self):
+        # Silent peers are pinged.
+        ka = self.make_keepalive()
+        self.check_at(ka, 120)
+        self.assertFalse(self.ping.called)
+        self.check_at(ka, 130)
+        self.ping.assert_called_once_with()
+        # Only one ping is sent while the response is awaited.
+        self.check_at(ka, 135)
+        self.assertEqual(1, self.ping.call_count)
+        self.assertFalse(self.on_expired.called)
+
+    def test_pong(self):
+        # The connection is alive if the peer responds.
+        ka = self.make_keepalive()
+        self.check_at(ka, 130)
+        ka.received()
+        self.check_at(ka, 145)
+        self.assertFalse(self.on_expired.called)
+        self.check_at(ka, 160)
+        self.assertEqual(2, self.ping.call_count)
+
+    def test_no_response(self):
+        # The connection expires if the peer does not respond in time.
+        ka = self.make_keepalive()
+        self.check_at(ka, 130)
+        self.check_at(ka, 140)
+        self.on_expired.assert_called_once_with(
+            keepalive.EXPIRED_NO_RESPONSE)
+
+    def test_paused(self):
+        # Peers are assumed to be alive while reading is paused.
+        paused = mock.Mock(return_value=True)
+        ka = self.make_keepalive(paused=paused)
+        self.check_at(ka, 130)
+        self.check_at(ka, 200)
+        self.assertFalse(self.ping.called)
+        self.assertFalse(self.on_expired.called)
+
+    def test_idle(self):
+        # The connection expires if no messages are received.
+        ka = self.make_keepalive(idle_timeout=60)
+        self.check_at(ka, 130)
+        ka.received()
+        self.check_at(ka, 150)
+        ka.activity()
+        self.check_at(ka, 200)
+        self.assertFalse(self.on_expired.called)
+        self.check_at(ka, 210)
+        self.on_expired.assert_called_once_with(keepalive.EXPIRED_IDLE)
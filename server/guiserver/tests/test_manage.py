@@ -18,10 +18,17 @@
 
 from contextlib import contextmanager
 import logging
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 
 import mock
-from tornado.testing import LogTrapTestCase
+from tornado.testing import (
+    ExpectLog,
+    LogTrapTestCase,
+)
 
 from guiserver import manage
 
@@ -178,8 +185,10 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
         """
         options = {
             'apiversion': 'go',
+            'graceful': False,
             'port': None,
             'sslpath': '/my/sslpath',
+            'workers': 1,
         }
         options.update(kwargs)
         with \
@@ -224,3 +233,278 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
         # The IO loop instance is started when the application is run.
         ioloop_start, _, _ = self.mock_and_run()
         ioloop_start.assert_called_once_with()
+
+
+class TestRunWorkers(LogTrapTestCase, unittest.TestCase):
+
+    def mock_and_run(self, task_id, **kwargs):
+        """Run the application in multiple workers mode.
+
+        Mock the IO loop, the options, the applications, the process forking
+        and the sockets binding. Simulate the current process is the worker
+        identified by the given task_id. Additional options can be specified
+        using kwargs.
+
+        Return a mocks object exposing the mocked functions and classes.
+        """
+        options = {
+            'apiurl': 'wss://example.com:17070',
+            'apiversion': 'go',
+            'charmworldurl': None,
+            'graceful': False,
+            'insecure': False,
+            'port': None,
+            'sslpath': '/my/sslpath',
+            'tokenstore': None,
+            'workers': 4,
+        }
+        options.update(kwargs)
+        names = (
+            'bind_sockets', 'bind_unix_socket', 'DeployerClient',
+            'DeployerServer', 'HTTPServer', 'IOLoop', 'make_deployer',
+            'redirector', 'server')
+        patchers = dict(
+            (name, mock.patch('guiserver.manage.' + name)) for name in names)
+        mocks = mock.Mock(**dict(
+            (name, patcher.start()) for name, patcher in patchers.items()))
+        for patcher in patchers.values():
+            self.addCleanup(patcher.stop)
+        mock_fork = mock.Mock(return_value=task_id)
+        mocks.options = mock.Mock(**options)
+        with \
+                mock.patch('guiserver.manage.options', mocks.options), \
+                mock.patch('guiserver.manage.fork_processes', mock_fork), \
+                mock.patch('guiserver.manage.atexit') as mocks.atexit, \
+                mock.patch('guiserver.manage.signal') as mocks.signal:
+            manage.run()
+        mock_fork.assert_called_once_with(4)
+        # Remove the temporary directory.
+        for args, _ in mocks.atexit.register.call_args_list:
+            self.addCleanup(*args)
+        return mocks
+
+    def test_secure_mode(self):
+        # The HTTPS and redirector sockets are bound before forking.
+        mocks = self.mock_and_run(1)
+        self.assertEqual(
+            [mock.call(443), mock.call(80)], mocks.bind_sockets.call_args_list)
+        mocks.HTTPServer.assert_any_call(
+            mocks.server(),
+            ssl_options={
+                'certfile': '/my/sslpath/juju.crt',
+                'keyfile': '/my/sslpath/juju.key',
+            })
+        mocks.HTTPServer.assert_any_call(mocks.redirector())
+        mocks.IOLoop.instance().start.assert_called_once_with()
+
+    def test_insecure_mode(self):
+        # In insecure mode, the workers share the HTTP socket.
+        mocks = self.mock_and_run(1, insecure=True, port=8080)
+        mocks.bind_sockets.assert_called_once_with(8080)
+        mocks.HTTPServer.assert_called_once_with(
+            mocks.server(), ssl_options=None)
+        mocks.HTTPServer().add_sockets.assert_called_once_with(
+            mocks.bind_sockets())
+
+    def test_coordinator(self):
+        # The first worker owns the Deployer and exposes it to the others.
+        mocks = self.mock_and_run(0)
+        mocks.make_deployer.assert_called_once_with(mocks.options)
+        mocks.DeployerServer.assert_called_once_with(mocks.make_deployer())
+        mocks.DeployerServer().add_socket.assert_called_once_with(
+            mocks.bind_unix_socket())
+        self.assertFalse(mocks.DeployerClient.called)
+        mocks.server.assert_called_with(
+            deployer=mocks.make_deployer(), connections=mock.ANY)
+
+    def test_worker(self):
+        # Other workers use a Deployer client connected to the coordinator.
+        mocks = self.mock_and_run(3)
+        self.assertFalse(mocks.make_deployer.called)
+        self.assertFalse(mocks.DeployerServer.called)
+        path = mocks.bind_unix_socket.call_args[0][0]
+        mocks.DeployerClient.assert_called_once_with(path)
+        mocks.bind_unix_socket().close.assert_called_once_with()
+        mocks.server.assert_called_with(
+            deployer=mocks.DeployerClient(), connections=mock.ANY)
+
+    def test_shared_tokens(self):
+        # By default, the workers share tokens in a temporary directory in a
+        # memory file system, removed when the parent process exits.
+        shared_memory_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_memory_path)
+        with mock.patch(
+                'guiserver.manage.SHARED_MEMORY_PATH', shared_memory_path):
+            mocks = self.mock_and_run(2)
+        path = mocks.options.tokenstore
+        self.assertEqual(shared_memory_path, os.path.dirname(path))
+        self.assertTrue(os.path.isdir(path))
+        for args, _ in mocks.atexit.register.call_args_list:
+            args[0]()
+        self.assertFalse(os.path.exists(path))
+
+    def test_shared_tokens_no_shared_memory(self):
+        # The workers share tokens in the temporary directory if a memory
+        # file system is not available.
+        with mock.patch('guiserver.manage.SHARED_MEMORY_PATH', '/no/such'):
+            with ExpectLog('', '/no/such not found', required=True):
+                mocks = self.mock_and_run(2)
+        path = mocks.bind_unix_socket.call_args[0][0]
+        self.assertEqual(
+            os.path.join(os.path.dirname(path), 'tokens'),
+            mocks.options.tokenstore)
+
+    def test_token_store(self):
+        # The workers share tokens in the provided token store directory.
+        mocks = self.mock_and_run(2, tokenstore='/dev/shm/guiserver')
+        self.assertEqual('/dev/shm/guiserver', mocks.options.tokenstore)
+
+    def test_temporary_directory_removed(self):
+        # The temporary directory is removed when the parent process exits.
+        mocks = self.mock_and_run(1)
+        path = os.path.dirname(mocks.bind_unix_socket.call_args[0][0])
+        self.assertTrue(os.path.isdir(path))
+        remove = mocks.atexit.register.call_args_list[0][0][0]
+        with mock.patch('os.getpid', mock.Mock(return_value=-1)):
+            # Forked processes do not remove the directory.
+            remove()
+        self.assertTrue(os.path.isdir(path))
+        remove()
+        self.assertFalse(os.path.exists(path))
+
+    def test_exit_on_sigterm(self):
+        # The parent process exits on SIGTERM, so that the temporary
+        # directory is removed, while workers are terminated.
+        mocks = self.mock_and_run(1)
+        signal = mocks.signal
+        self.assertEqual([
+            mock.call(signal.SIGTERM, manage._exit),
+            mock.call(signal.SIGTERM, signal.SIG_DFL),
+        ], signal.signal.call_args_list)
+        with self.assertRaises(SystemExit):
+            manage._exit(signal.SIGTERM, None)
+
+    def test_graceful(self):
+        # In graceful mode, the parent process ignores SIGHUP and SIGTERM,
+        # and the workers are drained on SIGTERM.
+        with mock.patch('guiserver.manage._install_drainer') as install:
+            mocks = self.mock_and_run(2, graceful=True)
+        signal = mocks.signal
+        self.assertEqual([
+            mock.call(signal.SIGHUP, signal.SIG_IGN),
+            mock.call(signal.SIGTERM, signal.SIG_IGN),
+            mock.call(signal.SIGTERM, signal.SIG_DFL),
+        ], signal.signal.call_args_list)
+        servers, connections, deployer = install.call_args[0]
+        self.assertEqual([mocks.HTTPServer(), mocks.HTTPServer()], servers)
+        mocks.server.assert_called_with(
+            deployer=mocks.DeployerClient(), connections=connections)
+        self.assertEqual(mocks.DeployerClient(), deployer)
+
+
+class TestRunGraceful(LogTrapTestCase, unittest.TestCase):
+
+    def make_socket(self, port):
+        """Return a mock listening socket bound to the given port."""
+        sock = mock.Mock()
+        sock.getsockname.return_value = ('0.0.0.0', port)
+        return sock
+
+    def mock_and_run(self, inherited=None, **kwargs):
+        """Run the application in graceful mode.
+
+        Mock the IO loop, the options, the applications, the sockets binding
+        and the graceful module. Simulate the given sockets are inherited
+        from a previous server process. Additional options can be specified
+        using kwargs.
+
+        Return a mocks object exposing the mocked functions and classes.
+        """
+        options = {
+            'apiurl': 'wss://example.com:17070',
+            'apiversion': 'go',
+            'charmworldurl': None,
+            'drainspread': 5,
+            'draintimeout': 30,
+            'graceful': True,
+            'insecure': False,
+            'port': None,
+            'restartcommand': None,
+            'sslpath': '/my/sslpath',
+            'workers': 1,
+        }
+        options.update(kwargs)
+        names = (
+            'bind_sockets', 'graceful', 'HTTPServer', 'IOLoop',
+            'make_deployer', 'redirector', 'server')
+        patchers = dict(
+            (name, mock.patch('guiserver.manage.' + name)) for name in names)
+        mocks = mock.Mock(**dict(
+            (name, patcher.start()) for name, patcher in patchers.items()))
+        for patcher in patchers.values():
+            self.addCleanup(patcher.stop)
+        mocks.bind_sockets.side_effect = lambda port: [self.make_socket(port)]
+        mocks.graceful.inherited_sockets.return_value = inherited or {}
+        with mock.patch('guiserver.manage.options', mock.Mock(**options)):
+            manage.run()
+        return mocks
+
+    def test_sockets_bound(self):
+        # The listening sockets are bound if they are not inherited.
+        mocks = self.mock_and_run()
+        self.assertEqual(
+            [mock.call(443), mock.call(80)], mocks.bind_sockets.call_args_list)
+        mocks.server.assert_called_once_with(
+            deployer=mocks.make_deployer(), connections=mock.ANY)
+        mocks.IOLoop.instance().start.assert_called_once_with()
+
+    def test_inherited_sockets(self):
+        # The sockets inherited from the previous process are reused.
+        server_socket = self.make_socket(443)
+        mocks = self.mock_and_run(inherited={'server': [server_socket]})
+        mocks.bind_sockets.assert_called_once_with(80)
+        mocks.HTTPServer().add_sockets.assert_any_call([server_socket])
+        self.assertFalse(server_socket.close.called)
+
+    def test_inherited_sockets_port_changed(self):
+        # Inherited sockets bound to another port are closed.
+        server_socket = self.make_socket(8080)
+        unknown_socket = self.make_socket(8081)
+        mocks = self.mock_and_run(
+            inherited={'server': [server_socket], 'other': [unknown_socket]},
+            insecure=True, port=9000)
+        mocks.bind_sockets.assert_called_once_with(9000)
+        server_socket.close.assert_called_once_with()
+        unknown_socket.close.assert_called_once_with()
+
+    def test_drainer(self):
+        # The drainer is installed with the configured options.
+        mocks = self.mock_and_run()
+        mocks.graceful.Drainer.assert_called_once_with(
+            [mocks.HTTPServer(), mocks.HTTPServer()],
+            mocks.server.call_args[1]['connections'], mocks.make_deployer(),
+            io_loop=mocks.IOLoop.instance(), spread=5, timeout=30)
+
+    def test_successor(self):
+        # By default, the successor process is started with the same
+        # arguments as the current process, inheriting the listening sockets.
+        mocks = self.mock_and_run()
+        args, kwargs = mocks.graceful.install_signal_handlers.call_args
+        self.assertEqual(
+            (mocks.graceful.Drainer(), mocks.IOLoop.instance()), args)
+        self.assertEqual([sys.executable] + sys.argv, kwargs['command'])
+        names = [name for name, _ in kwargs['named_sockets']]
+        self.assertEqual(['server', 'redirector'], names)
+
+    def test_restart_command(self):
+        # The command used to start the successor process can be customized.
+        mocks = self.mock_and_run(restartcommand='/usr/bin/runserver -x "a b"')
+        kwargs = mocks.graceful.install_signal_handlers.call_args[1]
+        self.assertEqual(
+            ['/usr/bin/runserver', '-x', 'a b'], kwargs['command'])
+
+    def test_systemd_notified(self):
+        # The process notifies systemd it is the main service process.
+        mocks = self.mock_and_run()
+        mocks.graceful.notify.assert_called_once_with(
+            'MAINPID={}\nREADY=1'.format(os.getpid()))
@@ -0,0 +1,128 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server metrics."""
+
+import unittest
+
+from guiserver import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        # Counters are increased and rendered for each label value.
+        counter = metrics.Counter('frames_total', 'Frames.', ('direction',))
+        counter.inc(direction='in')
+        counter.inc(2, direction='in')
+        counter.inc(direction='out')
+        self.assertEqual(3, counter.get(direction='in'))
+        self.assertEqual(0, counter.get(direction='other'))
+        expected = [
+            '# HELP frames_total Frames.',
+            '# TYPE frames_total counter',
+            'frames_total{direction="in"} 3',
+            'frames_total{direction="out"} 1',
+        ]
+        self.assertEqual(expected, counter.render())
+
+    def test_gauge(self):
+        # Gauges can be set to arbitrary values.
+        gauge = metrics.Gauge('connections', 'Connections.')
+        gauge.set(10)
+        gauge.set(4)
+        self.assertEqual(4, gauge.get())
+        self.assertEqual('connections 4', gauge.render()[-1])
+
+    def test_histogram(self):
+        # Histograms render cumulative buckets, the sum and the count.
+        histogram = metrics.Histogram('latency', 'Latency.', buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual((4, 14.5), histogram.get())
+        expected = [
+            '# HELP latency Latency.',
+            '# TYPE latency histogram',
+            'latency_bucket{le="1"} 2',
+            'latency_bucket{le="5"} 3',
+            'latency_bucket{le="+Inf"} 4',
+            'latency_sum 14.5',
+            'latency_count 4',
+        ]
+        self.assertEqual(expected, histogram.render())
+
+    def test_escaped_labels(self):
+        # Label values are escaped.
+        counter = metrics.Counter('requests', 'Requests.', ('name',))
+        counter.inc(name='a "quoted"\\name')
+        self.assertEqual(
+            'requests{name="a \\"quoted\\"\\\\name"} 1', counter.render()[-1])
+
+    def test_invalid_labels(self):
+        # A ValueError is raised if the labels do not match.
+        counter = metrics.Counter('requests', 'Requests.', ('name',))
+        with self.assertRaises(ValueError) as context_manager:
+            counter.inc(type='bad')
+        self.assertEqual(
+            'requests: invalid labels: type',
+            str(context_manager.exception))
+
+    def test_max_series(self):
+        # New label combinations exceeding the maximum are collected together.
+        counter = metrics.Counter(
+            'requests', 'Requests.', ('name',), max_series=2)
+        for name in ('a', 'b', 'c', 'd', 'a'):
+            counter.inc(name=name)
+        self.assertEqual(2, counter.get(name='a'))
+        self.assertEqual(1, counter.get(name='b'))
+        self.assertEqual(2, counter.get(name='other'))
+        self.assertEqual(5, len(counter.render()))
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_render(self):
+        # All the registered metrics are rendered.
+        self.registry.counter('requests', 'Requests.').inc()
+        self.registry.gauge('connections', 'Connections.').set(2)
+        expected = (
+            '# HELP requests Requests.\n'
+            '# TYPE requests counter\n'
+            'requests 1\n'
+            '# HELP connections Connections.\n'
+            '# TYPE connections gauge\n'
+            'connections 2\n'
+        )
+        self.assertEqual(expected, self.registry.render())
+
+    def test_clear(self):
+        # Collected values can be removed.
+        counter = self.registry.counter('requests', 'Requests.')
+        counter.inc()
+        self.registry.clear()
+        self.assertEqual(0, counter.get())
+
+    def test_already_registered(self):
+        # A ValueError is raised if a metric is registered twice.
+        self.registry.counter('requests', 'Requests.')
+        with self.assertRaises(ValueError) as context_manager:
+            self.registry.gauge('requests', 'Requests.')
+        self.assertEqual(
+            'metric already registered: requests',
+            str(context_manager.exception))
@@ -0,0 +1,361 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server Juju API connection multiplexing."""
+
+import json
+
+import mock
+from tornado import concurrent
+from tornado.testing import (
+    AsyncTestCase,
+    gen_test,
+    LogTrapTestCase,
+)
+
+from guiserver import (
+    auth,
+    multiplexer,
+)
+from guiserver.tests import helpers
+
+
+class MultiplexerTestMixin(helpers.GoAPITestMixin):
+    """Set up a multiplexer whose upstream connections are mocked."""
+
+    apiurl = 'wss://example.com:17070/model/uuid/api'
+
+    def setUp(self):
+        super(MultiplexerTestMixin, self).setUp()
+        self.multiplexer = multiplexer.Multiplexer(
+            auth.get_backend('go'), io_loop=self.io_loop)
+        self.upstreams = []
+        patcher = mock.patch(
+            'guiserver.multiplexer.websocket_connect', self.websocket_connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def websocket_connect(self, io_loop, url, callback, **kwargs):
+        """Simulate a connection to the Juju API.
+
+        Store the connection and its message callback in self.upstreams.
+        """
+        connection = mock.Mock()
+        self.upstreams.append((connection, callback))
+        future = concurrent.Future()
+        future.set_result(connection)
+        return future
+
+    def sent(self, connection):
+        """Return the decoded messages sent to the given connection."""
+        return [
+            json.loads(call[0][0])
+            for call in connection.write_message.call_args_list]
+
+    def respond(self, callback, request_id, response=None, error=None):
+        """Send a Juju API response using the given message callback."""
+        data = {'RequestId': request_id, 'Response': response or {}}
+        if error is not None:
+            data['Error'] = error
+        callback(json.dumps(data))
+
+    def connect(self, request_id=1, username='user', password='passwd'):
+        """Connect a new browser session using the given credentials.
+
+        Return the session Future and the mock message callback.
+        """
+        login = self.make_login_request(
+            request_id=request_id, username=username, password=password)
+        callback = mock.Mock()
+        future = self.multiplexer.connect(self.apiurl, login, callback)
+        return future, callback
+
+    def connect_logged_in(self, num_sessions=1):
+        """Return a list of (session, callback) pairs sharing a connection.
+
+        The upstream connection is logged in, and its mock is reset.
+        """
+        futures = [self.connect(request_id=num) for num in range(num_sessions)]
+        connection, upstream_callback = self.upstreams[0]
+        self.respond(upstream_callback, 1, {'Facades': []})
+        results = []
+        for future, callback in futures:
+            session = self.io_loop.run_sync(lambda: future)
+            results.append((session, callback))
+        connection.write_message.reset_mock()
+        return results
+
+
+class TestMultiplexer(MultiplexerTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    def test_not_login(self):
+        # Browsers not logging in with a password do not share connections.
+        future = self.multiplexer.connect(
+            self.apiurl, {'RequestId': 1, 'Type': 'Client'}, mock.Mock())
+        self.assertIsNone(future)
+        self.assertIsNone(
+            self.multiplexer.connect(self.apiurl, None, mock.Mock()))
+        self.assertEqual([], self.upstreams)
+
+    @gen_test
+    def test_shared_login(self):
+        # Browsers using the same credentials share the same connection, which
+        # is logged in only once.
+        future1, callback1 = self.connect(request_id=42)
+        future2, callback2 = self.connect(request_id=47)
+        self.assertEqual(1, len(self.upstreams))
+        connection, upstream_callback = self.upstreams[0]
+        expected = self.make_login_request(request_id=1)
+        self.assertEqual([expected], self.sent(connection))
+        self.respond(upstream_callback, 1, {'Facades': ['Client']})
+        session1 = yield future1
+        session2 = yield future2
+        # The browser login requests are answered using the original response.
+        for session, callback, request_id in (
+                (session1, callback1, 42), (session2, callback2, 47)):
+            session.write_message(
+                self.make_login_request(request_id=request_id, encoded=True))
+            callback.assert_called_once_with(mock.ANY)
+            response = json.loads(callback.call_args[0][0])
+            self.assertEqual(
+                {'RequestId': request_id, 'Response': {'Facades': ['Client']}},
+                response)
+        self.assertEqual(1, connection.write_message.call_count)
+        self.assertEqual(
+            [{'apiurl': self.apiurl, 'username': 'user', 'sessions': 2}],
+            self.multiplexer.get_info())
+
+    def test_different_credentials(self):
+        # Browsers using different credentials do not share connections.
+        self.connect(username='user')
+        self.connect(username='another')
+        self.connect(password='another')
+        self.assertEqual(3, len(self.upstreams))
+
+    @gen_test
+    def test_login_failure(self):
+        # Connections failing to log in are not shared.
+        future, callback = self.connect()
+        connection, upstream_callback = self.upstreams[0]
+        self.respond(upstream_callback, 1, error='invalid entity name')
+        session = yield future
+        session.write_message(self.make_login_request(encoded=True))
+        response = json.loads(callback.call_args[0][0])
+        self.assertEqual('invalid entity name', response['Error'])
+        self.connect()
+        self.assertEqual(2, len(self.upstreams))
+
+    def test_request_routing(self):
+        # Request ids are rewritten upstream, and responses are routed back
+        # to the requesting browser with the original request id.
+        (session1, callback1), (session2, callback2) = self.connect_logged_in(
+            num_sessions=2)
+        connection, upstream_callback = self.upstreams[0]
+        request = {'RequestId': 5, 'Type': 'Client', 'Request': 'FullStatus'}
+        session1.write_message(json.dumps(request))
+        session2.write_message(json.dumps(request))
+        upstream_ids = [data['RequestId'] for data in self.sent(connection)]
+        self.assertEqual([2, 3], upstream_ids)
+        self.respond(upstream_callback, 3, {'session': 2})
+        self.respond(upstream_callback, 2, {'session': 1})
+        for callback, num in ((callback1, 1), (callback2, 2)):
+            self.assertEqual(
+                {'RequestId': 5, 'Response': {'session': num}},
+                json.loads(callback.call_args[0][0]))
+
+    def test_upstream_closed(self):
+        # All the sessions are notified when the upstream connection closes.
+        results = self.connect_logged_in(num_sessions=2)
+        connection, upstream_callback = self.upstreams[0]
+        upstream_callback(None)
+        for _, callback in results:
+            callback.assert_called_once_with(None)
+        self.assertEqual([], self.multiplexer.get_info())
+
+    def test_sessions_closed(self):
+        # The upstream connection is closed when the last session is closed.
+        (session1, _), (session2, _) = self.connect_logged_in(num_sessions=2)
+        connection, _ = self.upstreams[0]
+        session1.close()
+        self.assertFalse(connection.close.called)
+        session2.close()
+        connection.close.assert_called_once_with()
+        self.assertEqual([], self.multiplexer.get_info())
+
+    def test_credentials_not_stored(self):
+        # Passwords are not kept once the upstream connection is logged in.
+        self.connect_logged_in()
+        [upstream] = self.multiplexer._upstreams.values()
+        self.assertIsNone(upstream._login_data)
+        self.assertNotIn('passwd', upstream.key)
+
+    def test_salted_keys(self):
+        # Different multiplexers hash the same credentials differently.
+        another = multiplexer.Multiplexer(
+            auth.get_backend('go'), io_loop=self.io_loop)
+        key1 = self.multiplexer.make_key(self.apiurl, 'user', 'passwd')
+        key2 = another.make_key(self.apiurl, 'user', 'passwd')
+        self.assertEqual(key1[:2], key2[:2])
+        self.assertNotEqual(key1[2], key2[2])
+        self.assertEqual(
+            key1, self.multiplexer.make_key(self.apiurl, 'user', 'passwd'))
+
+    def test_login_cache(self):
+        # Logged in connections are kept open for returning users.
+        self.multiplexer.login_ttl = 30
+        [(session, _)] = self.connect_logged_in()
+        connection, _ = self.upstreams[0]
+        with mock.patch.object(self.io_loop, 'add_timeout') as add_timeout:
+            session.close()
+        self.assertFalse(connection.close.called)
+        self.assertEqual(
+            [{'apiurl': self.apiurl, 'username': 'user', 'sessions': 0}],
+            self.multiplexer.get_info())
+        deadline, _ = add_timeout.call_args[0]
+        self.assertAlmostEqual(self.io_loop.time() + 30, deadline, places=0)
+        # A returning user reuses the logged in connection.
+        future, callback = self.connect(request_id=47)
+        session = self.io_loop.run_sync(lambda: future)
+        self.assertEqual(1, len(self.upstreams))
+        session.write_message(
+            self.make_login_request(request_id=47, encoded=True))
+        self.assertEqual(
+            {'RequestId': 47, 'Response': {'Facades': []}},
+            json.loads(callback.call_args[0][0]))
+        self.assertFalse(connection.write_message.called)
+
+    def test_login_cache_expired(self):
+        # Cached connections are closed when the time to live expires.
+        self.multiplexer.login_ttl = 30
+        [(session, _)] = self.connect_logged_in()
+        connection, _ = self.upstreams[0]
+        with mock.patch.object(self.io_loop, 'add_timeout') as add_timeout:
+            session.close()
+        _, close = add_timeout.call_args[0]
+        close()
+        connection.close.assert_called_once_with()
+        self.assertEqual([], self.multiplexer.get_info())
+
+    @gen_test
+    def test_login_cache_failure(self):
+        # Connections failing to log in are never cached.
+        self.multiplexer.login_ttl = 30
+        future, _ = self.connect()
+        connection, upstream_callback = self.upstreams[0]
+        self.respond(upstream_callback, 1, error='invalid entity name')
+        session = yield future
+        session.close()
+        connection.close.assert_called_once_with()
+
+    def test_pause_reading(self):
+        # Pausing a session does not pause the shared connection.
+        [(session, _)] = self.connect_logged_in()
+        connection, _ = self.upstreams[0]
+        session.pause_reading()
+        self.assertTrue(session.reading_paused)
+        session.resume_reading()
+        self.assertFalse(session.reading_paused)
+        self.assertFalse(connection.pause_reading.called)
+
+
+class TestAllWatcher(MultiplexerTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        # Set up a logged in upstream connection with two sessions.
+        super(TestAllWatcher, self).setUp()
+        self.sessions = self.connect_logged_in(num_sessions=2)
+        self.connection, self.upstream_callback = self.upstreams[0]
+
+    def request(self, session, request_id, request, watcher_id=None):
+        """Send a watcher related request using the given session."""
+        data = {'RequestId': request_id, 'Request': request, 'Params': {}}
+        if watcher_id is None:
+            data['Type'] = 'Client'
+        else:
+            data.update({'Type': 'AllWatcher', 'Id': watcher_id})
+        session.write_message(json.dumps(data))
+
+    def last_response(self, callback):
+        """Return the last decoded message sent to the given callback."""
+        return json.loads(callback.call_args[0][0])
+
+    def test_shared_watcher(self):
+        # A single AllWatcher is started upstream. The first Next call of
+        # each session returns the whole model, subsequent calls the deltas.
+        (session1, callback1), (session2, callback2) = self.sessions
+        self.request(session1, 10, 'WatchAll')
+        sent = self.sent(self.connection)
+        self.assertEqual(1, len(sent))
+        self.assertEqual('WatchAll', sent[0]['Request'])
+        self.respond(
+            self.upstream_callback, sent[0]['RequestId'],
+            {'AllWatcherId': '42'})
+        self.assertEqual(
+            {'RequestId': 10, 'Response': {'AllWatcherId': '1'}},
+            self.last_response(callback1))
+        # The upstream watcher is polled.
+        next_request = self.sent(self.connection)[-1]
+        self.assertEqual(
+            ('AllWatcher', 'Next', '42'),
+            (next_request['Type'], next_request['Request'],
+             next_request['Id']))
+        deltas = [
+            ['service', 'change', {'Name': 'django'}],
+            ['unit', 'change', {'Name': 'django/0'}],
+        ]
+        self.respond(
+            self.upstream_callback, next_request['RequestId'],
+            {'Deltas': deltas})
+        self.request(session1, 11, 'Next', watcher_id='1')
+        self.assertEqual(
+            {'RequestId': 11, 'Response': {'Deltas': deltas}},
+            self.last_response(callback1))
+        # A second session does not start another upstream watcher, and
+        # receives the current model state.
+        self.request(session2, 20, 'WatchAll')
+        self.request(session2, 21, 'Next', watcher_id='2')
+        self.assertEqual(
+            {'RequestId': 21, 'Response': {'Deltas': deltas}},
+            self.last_response(callback2))
+        # Next calls are parked until new deltas arrive.
+        self.request(session1, 12, 'Next', watcher_id='1')
+        self.assertEqual(11, self.last_response(callback1)['RequestId'])
+        next_request = self.sent(self.connection)[-1]
+        removal = [['unit', 'remove', {'Name': 'django/0'}]]
+        self.respond(
+            self.upstream_callback, next_request['RequestId'],
+            {'Deltas': removal})
+        self.assertEqual(
+            {'RequestId': 12, 'Response': {'Deltas': removal}},
+            self.last_response(callback1))
+        # Only the WatchAll and three Next requests were sent upstream.
+        self.assertEqual(4, len(self.sent(self.connection)))
+        watcher = session1._upstream.watcher
+        self.assertEqual(
+            [['service', 'change', {'Name': 'django'}]], watcher.snapshot())
+
+    def test_stop(self):
+        # Stopping a session watcher does not stop the shared watcher.
+        session, callback = self.sessions[0]
+        self.request(session, 10, 'WatchAll')
+        sent = self.sent(self.connection)
+        self.respond(
+            self.upstream_callback, sent[0]['RequestId'],
+            {'AllWatcherId': '42'})
+        self.request(session, 11, 'Stop', watcher_id='1')
+        self.assertEqual(
+            {'RequestId': 11, 'Response': {}}, self.last_response(callback))
+        self.assertEqual(2, len(self.sent(self.connection)))
@@ -0,0 +1,338 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server WebSocket protocol."""
+
+import json
+import unittest
+
+import mock
+from tornado import (
+    concurrent,
+    web,
+)
+from tornado.testing import (
+    AsyncHTTPSTestCase,
+    gen_test,
+    LogTrapTestCase,
+)
+
+from guiserver import (
+    clients,
+    handlers,
+    protocols,
+)
+from guiserver.tests import helpers
+
+
+COMPRESSION_OPTIONS = {'level': 6, 'window_bits': 15, 'min_size': 10}
+
+
+class TestParseExtensions(unittest.TestCase):
+
+    def test_extensions(self):
+        # Extensions and their parameters are correctly parsed.
+        header = (
+            'permessage-deflate; client_max_window_bits; '
+            'server_max_window_bits="10", x-webkit-deflate-frame')
+        expected = [
+            ('permessage-deflate', {
+                'client_max_window_bits': None,
+                'server_max_window_bits': '10',
+            }),
+            ('x-webkit-deflate-frame', {}),
+        ]
+        self.assertEqual(expected, protocols.parse_extensions(header))
+
+    def test_empty(self):
+        # An empty list is returned if the header is missing.
+        self.assertEqual([], protocols.parse_extensions(None))
+        self.assertEqual([], protocols.parse_extensions(''))
+
+
+class TestNegotiateServer(unittest.TestCase):
+
+    def negotiate(self, header, **kwargs):
+        """Negotiate compression using the given header and options."""
+        options = dict(COMPRESSION_OPTIONS, **kwargs)
+        return protocols.negotiate_server(header, options)
+
+    def test_accepted(self):
+        # The permessage-deflate extension is accepted.
+        response, params = self.negotiate(
+            'permessage-deflate; client_max_window_bits')
+        self.assertEqual('permessage-deflate', response)
+        self.assertEqual({}, params)
+
+    def test_server_parameters(self):
+        # Parameters constraining the server are honored.
+        response, params = self.negotiate(
+            'permessage-deflate; server_no_context_takeover; '
+            'server_max_window_bits=12', window_bits=10)
+        self.assertEqual(
+            'permessage-deflate; server_max_window_bits=10; '
+            'server_no_context_takeover', response)
+        self.assertEqual(
+            {'server_max_window_bits': 10, 'server_no_context_takeover': None},
+            params)
+
+    def test_invalid_offer(self):
+        # Invalid offers are skipped.
+        response, params = self.negotiate(
+            'permessage-deflate; server_max_window_bits=8, '
+            'permessage-deflate; unknown, permessage-deflate')
+        self.assertEqual('permessage-deflate', response)
+
+    def test_not_offered(self):
+        # Compression is not used if not requested by the client.
+        self.assertEqual((None, None), self.negotiate('x-webkit-deflate'))
+        self.assertEqual((None, None), self.negotiate(None))
+
+    def test_disabled(self):
+        # Compression is not used if disabled.
+        self.assertEqual(
+            (None, None),
+            protocols.negotiate_server('permessage-deflate', None))
+
+
+class TestNegotiateClient(unittest.TestCase):
+
+    def test_offer(self):
+        # The client offer includes the compression window bits.
+        self.assertEqual(
+            'permessage-deflate; client_max_window_bits=15',
+            protocols.make_client_offer(COMPRESSION_OPTIONS))
+        self.assertIsNone(protocols.make_client_offer(None))
+
+    def test_accepted(self):
+        # The server response parameters are returned.
+        params = protocols.negotiate_client(
+            'permessage-deflate; client_max_window_bits=10; '
+            'client_no_context_takeover', COMPRESSION_OPTIONS)
+        self.assertEqual(
+            {'client_max_window_bits': 10, 'client_no_context_takeover': None},
+            params)
+
+    def test_not_accepted(self):
+        # None is returned if the server did not accept compression.
+        self.assertIsNone(
+            protocols.negotiate_client(None, COMPRESSION_OPTIONS))
+
+    def test_invalid(self):
+        # A ValueError is raised if the server response is not valid.
+        with self.assertRaises(ValueError):
+            protocols.negotiate_client('permessage-deflate', None)
+        with self.assertRaises(ValueError):
+            protocols.negotiate_client('x-webkit-deflate', COMPRESSION_OPTIONS)
+        with self.assertRaises(ValueError):
+            protocols.negotiate_client(
+                'permessage-deflate; client_max_window_bits=8',
+                COMPRESSION_OPTIONS)
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_round_trip(self):
+        # Compressed messages can be decompressed, also when the context is
+        # preserved between messages.
+        compressor = protocols._Compressor(6, 15, True)
+        decompressor = protocols._Decompressor(True)
+        for message in ('hello world', 'hello world', 'bad wolf' * 100):
+            compressed = compressor.compress(message)
+            self.assertEqual(message, decompressor.decompress(compressed))
+
+    def test_no_context_takeover(self):
+        # Messages are independently compressed if context is not preserved.
+        compressor = protocols._Compressor(6, 9, False)
+        compressed = [compressor.compress('hello world') for _ in range(2)]
+        self.assertEqual(compressed[0], compressed[1])
+        self.assertEqual(
+            'hello world',
+            protocols._Decompressor(False).decompress(compressed[1]))
+
+    def test_message_too_big(self):
+        # A ValueError is raised if the decompressed message is too big.
+        compressed = protocols._Compressor(9, 15, False).compress('a' * 1024)
+        with mock.patch('guiserver.protocols.MAX_MESSAGE_SIZE', 1000):
+            with self.assertRaises(ValueError):
+                protocols._Decompressor(False).decompress(compressed)
+
+
+class TestClose(unittest.TestCase):
+
+    def make_protocol(self):
+        """Return a protocol whose frames are written to a mock."""
+        protocol = protocols.WebSocketProtocol(mock.Mock())
+        protocol.stream.closed.return_value = False
+        protocol.stream.io_loop.time.return_value = 0
+        protocol._write_frame = mock.Mock()
+        return protocol
+
+    def test_close_code(self):
+        # The status code and the reason are included in the close frame.
+        protocol = self.make_protocol()
+        protocol.close(1012, 'service restart')
+        protocol._write_frame.assert_called_once_with(
+            True, 0x8, '\x03\xf4service restart')
+        self.assertTrue(protocol.server_terminated)
+
+    def test_close_code_only(self):
+        # The reason is optional.
+        protocol = self.make_protocol()
+        protocol.close(1001)
+        protocol._write_frame.assert_called_once_with(True, 0x8, '\x03\xe9')
+
+    def test_close(self):
+        # An empty close frame is sent if the status code is not provided.
+        protocol = self.make_protocol()
+        protocol.close()
+        protocol._write_frame.assert_called_once_with(True, 0x8, b'')
+
+
+class CompressedEchoWebSocketHandler(
+        handlers._WebSocketBaseHandler, helpers.EchoWebSocketHandler):
+    """An echo WebSocket server supporting compression."""
+
+    compression_options = COMPRESSION_OPTIONS
+
+
+class TestCompressedConnection(
+        helpers.WSSTestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    def get_app(self):
+        # In this test case the WebSocket client is connected to an echo
+        # server supporting compression.
+        options = {
+            'close_future': concurrent.Future(),
+            'io_loop': self.io_loop,
+        }
+        return web.Application([
+            (r'/compressed', CompressedEchoWebSocketHandler, options),
+            (r'/plain', helpers.EchoWebSocketHandler, options),
+        ])
+
+    def connect(self, path, compression_options=COMPRESSION_OPTIONS):
+        """Return a future whose result is a connected client."""
+        return clients.websocket_connect(
+            self.io_loop, self.get_wss_url(path), lambda message: None,
+            compression_options=compression_options)
+
+    @gen_test
+    def test_compressed(self):
+        # Messages are compressed if both sides support compression.
+        client = yield self.connect('/compressed')
+        self.assertTrue(client.protocol.compressed)
+        message = json.dumps([['unit', 'change', {'Name': 'django/0'}]] * 100)
+        with mock.patch.object(
+                client.protocol, '_write_frame',
+                wraps=client.protocol._write_frame) as mock_write_frame:
+            client.write_message(message)
+            response = yield client.read_message()
+        self.assertEqual(message, response)
+        fin, opcode, data = mock_write_frame.call_args[0]
+        self.assertEqual({'flags': 0x40}, mock_write_frame.call_args[1])
+        self.assertLess(len(data), len(message) / 10)
+
+    @gen_test
+    def test_small_messages(self):
+        # Small messages are not compressed.
+        client = yield self.connect('/compressed')
+        with mock.patch.object(
+                client.protocol, '_write_frame',
+                wraps=client.protocol._write_frame) as mock_write_frame:
+            client.write_message('hello')
+            response = yield client.read_message()
+        self.assertEqual('hello', response)
+        mock_write_frame.assert_called_once_with(True, 0x1, 'hello', flags=0)
+
+    @gen_test
+    def test_server_not_supporting_compression(self):
+        # Messages are not compressed if the server does not support
+        # compression.
+        client = yield self.connect('/plain')
+        self.assertFalse(client.protocol.compressed)
+        client.write_message('hello' * 100)
+        response = yield client.read_message()
+        self.assertEqual('hello' * 100, response)
+
+    @gen_test
+    def test_client_not_requesting_compression(self):
+        # Messages are not compressed if the client does not request it.
+        client = yield self.connect('/compressed', compression_options=None)
+        self.assertFalse(client.protocol.compressed)
+        client.write_message('hello' * 100)
+        response = yield client.read_message()
+        self.assertEqual('hello' * 100, response)
+
+
+class RawEchoWebSocketHandler(
+        handlers._WebSocketBaseHandler, helpers.EchoWebSocketHandler):
+    """An echo WebSocket server receiving raw text messages."""
+
+    raw_text = True
+
+
+class TestRawTextConnection(
+        helpers.WSSTestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    def get_app(self):
+        # In this test case the WebSocket client is connected to an echo
+        # server receiving text messages as byte strings.
+        options = {
+            'close_future': concurrent.Future(),
+            'io_loop': self.io_loop,
+        }
+        return web.Application([
+            (r'/raw', RawEchoWebSocketHandler, options),
+            (r'/plain', helpers.EchoWebSocketHandler, options),
+        ])
+
+    def connect(self, path, raw_text=True):
+        """Return a future whose result is a connected client."""
+        return clients.websocket_connect(
+            self.io_loop, self.get_wss_url(path), lambda message: None,
+            raw_text=raw_text)
+
+    @gen_test
+    def test_raw_text(self):
+        # Text messages are received as UTF-8 encoded byte strings.
+        client = yield self.connect('/raw')
+        client.write_message(u'Here is a snowman: \u2603')
+        response = yield client.read_message()
+        self.assertIsInstance(response, str)
+        self.assertEqual('Here is a snowman: \xe2\x98\x83', response)
+
+    @gen_test
+    def test_decoded_text(self):
+        # Raw text is sent as text: peers not using raw text decode it.
+        client = yield self.connect('/plain', raw_text=False)
+        client.write_message('Here is a snowman: \xe2\x98\x83')
+        response = yield client.read_message()
+        self.assertEqual(u'Here is a snowman: \u2603', response)
+
+    @gen_test
+    def test_big_message(self):
+        # Big payloads are written separately from the frame header.
+        client = yield self.connect('/raw')
+        message = 'bad wolf' * 10000
+        with mock.patch.object(
+                client.protocol.stream, 'write',
+                wraps=client.protocol.stream.write) as mock_write:
+            client.write_message(message)
+        self.assertEqual(2, mock_write.call_count)
+        self.assertEqual(len(message), len(mock_write.call_args[0][0]))
+        response = yield client.read_message()
+        self.assertEqual(message, response)
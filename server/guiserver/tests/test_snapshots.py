@@ -0,0 +1,190 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server model snapshots cache."""
+
+import unittest
+
+import mock
+
+from guiserver import snapshots
+
+
+def unit(name, operation='change'):
+    """Return a unit delta."""
+    return ['unit', operation, {'Name': name}]
+
+
+class TestModelKey(unittest.TestCase):
+
+    def test_model(self):
+        # The model uuid is returned.
+        key = snapshots.model_key('wss://1.2.3.4:17070/model/uuid/api')
+        self.assertEqual('uuid', key)
+
+    def test_environment(self):
+        # Juju 1 environment URLs are supported.
+        key = snapshots.model_key('wss://1.2.3.4:17070/environment/uuid/api')
+        self.assertEqual('uuid', key)
+
+    def test_no_uuid(self):
+        # The URL is returned if it does not include the model uuid.
+        key = snapshots.model_key('wss://1.2.3.4:17070')
+        self.assertEqual('wss://1.2.3.4:17070', key)
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = snapshots.ModelCache(1000)
+        self.feeder = object()
+
+    def test_miss(self):
+        # None is returned if the model is not cached.
+        self.assertIsNone(self.cache.get('uuid'))
+        self.assertEqual(1, self.cache.get_info()['misses'])
+
+    def test_replace_and_update(self):
+        # The whole model is stored, and then updated by the feeder.
+        self.cache.replace(
+            'uuid', [unit('u/0'), unit('u/1')], 100, self.feeder)
+        self.cache.update(
+            'uuid', [unit('u/0', 'remove'), unit('u/2')], 20, self.feeder)
+        self.assertEqual([unit('u/1'), unit('u/2')], self.cache.get('uuid'))
+        info = self.cache.get_info()
+        self.assertEqual(60, info['size'])
+        self.assertEqual(1, info['hits'])
+
+    def test_other_feeder(self):
+        # Only the feeder is allowed to update the model.
+        self.cache.replace('uuid', [unit('u/0')], 100, self.feeder)
+        self.cache.update('uuid', [unit('u/1')], 100, object())
+        self.assertEqual([unit('u/0')], self.cache.get('uuid'))
+        self.assertTrue(self.cache.is_feeder('uuid', self.feeder))
+
+    def test_release(self):
+        # Released models are no longer updated, but are still cached.
+        self.cache.replace('uuid', [unit('u/0')], 100, self.feeder)
+        self.cache.release('uuid', self.feeder)
+        self.cache.update('uuid', [unit('u/1')], 100, self.feeder)
+        self.assertEqual([unit('u/0')], self.cache.get('uuid'))
+
+    def test_eviction(self):
+        # Least recently used models are evicted when the cache is full.
+        for key in ('uuid1', 'uuid2', 'uuid3'):
+            self.cache.replace(key, [unit('u/0')], 400, self.feeder)
+        self.assertIsNone(self.cache.get('uuid1'))
+        self.cache.get('uuid2')
+        self.cache.replace('uuid4', [unit('u/0')], 400, self.feeder)
+        self.assertIsNone(self.cache.get('uuid3'))
+        self.assertIsNotNone(self.cache.get('uuid2'))
+        self.assertEqual(800, self.cache.get_info()['size'])
+
+    def test_too_big(self):
+        # Models bigger than the cache are not stored.
+        self.cache.replace('uuid', [unit('u/0')], 2000, self.feeder)
+        self.assertIsNone(self.cache.get('uuid'))
+        self.assertEqual(0, self.cache.get_info()['size'])
+
+
+class TestSnapshotMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = snapshots.ModelCache(1000)
+        self.write_message = mock.Mock()
+        self.middleware = snapshots.SnapshotMiddleware(
+            self.cache, 'uuid', self.write_message)
+
+    def make_request(self, request_id, watcher_id='1'):
+        """Return an AllWatcher Next request."""
+        return {
+            'RequestId': request_id,
+            'Type': 'AllWatcher',
+            'Request': 'Next',
+            'Id': watcher_id,
+            'Params': {},
+        }
+
+    def make_response(self, request_id, *deltas):
+        """Return a Next response including the given deltas."""
+        return {'RequestId': request_id, 'Response': {'Deltas': list(deltas)}}
+
+    def test_not_cached(self):
+        # Requests and responses are propagated if the model is not cached,
+        # and the cache is populated.
+        self.assertTrue(self.middleware.process_request(self.make_request(1)))
+        self.assertTrue(self.middleware.handles(1))
+        response = self.make_response(1, unit('u/0'))
+        self.assertTrue(self.middleware.process_response(response, 100))
+        self.assertFalse(self.write_message.called)
+        self.assertEqual([unit('u/0')], self.cache.get('uuid'))
+        # Subsequent responses update the cache.
+        self.assertTrue(self.middleware.process_request(self.make_request(2)))
+        response = self.make_response(2, unit('u/1'))
+        self.assertTrue(self.middleware.process_response(response, 100))
+        self.assertEqual([unit('u/0'), unit('u/1')], self.cache.get('uuid'))
+
+    def test_cached(self):
+        # The first request is answered from the cache, the second one with
+        # the real response, including removals of stale entities.
+        self.cache.replace('uuid', [unit('u/0'), unit('u/1')], 100, None)
+        self.assertTrue(self.middleware.process_request(self.make_request(1)))
+        self.write_message.assert_called_once_with(
+            self.make_response(1, unit('u/0'), unit('u/1')))
+        self.assertFalse(self.middleware.process_response(
+            self.make_response(1, unit('u/1'), unit('u/2')), 100))
+        self.assertFalse(self.middleware.process_request(self.make_request(2)))
+        self.write_message.assert_called_with(self.make_response(
+            2, unit('u/1'), unit('u/2'), unit('u/0', 'remove')))
+        # The watcher is then propagated.
+        self.assertTrue(self.middleware.process_request(self.make_request(3)))
+
+    def test_cached_parked(self):
+        # The second request waits for the real response.
+        self.cache.replace('uuid', [unit('u/0')], 100, None)
+        self.middleware.process_request(self.make_request(1))
+        self.assertFalse(self.middleware.process_request(self.make_request(2)))
+        self.assertEqual(1, self.write_message.call_count)
+        self.middleware.process_response(
+            self.make_response(1, unit('u/0')), 100)
+        self.write_message.assert_called_with(
+            self.make_response(2, unit('u/0')))
+
+    def test_error(self):
+        # Errors are sent to the browser.
+        self.cache.replace('uuid', [unit('u/0')], 100, None)
+        self.middleware.process_request(self.make_request(1))
+        self.middleware.process_response(
+            {'RequestId': 1, 'Error': 'bad wolf'}, 100)
+        self.middleware.process_request(self.make_request(2))
+        self.write_message.assert_called_with(
+            {'RequestId': 2, 'Error': 'bad wolf'})
+
+    def test_close(self):
+        # The cache is no longer updated when the middleware is closed.
+        self.middleware.process_request(self.make_request(1))
+        self.middleware.process_response(
+            self.make_response(1, unit('u/0')), 100)
+        self.middleware.close()
+        self.assertFalse(self.cache.is_feeder('uuid', self.middleware))
+        self.assertFalse(self.middleware.handles(1))
+
+    def test_close_parked(self):
+        # The ids of the parked browser requests are returned when closing.
+        self.cache.replace('uuid', [unit('u/0')], 100, None)
+        self.middleware.process_request(self.make_request(1))
+        self.middleware.process_request(self.make_request(2))
+        self.assertEqual([2], self.middleware.close())
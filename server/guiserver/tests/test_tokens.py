@@ -0,0 +1,247 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server token store."""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from tornado.testing import LogTrapTestCase
+
+from guiserver import tokens
+
+
+class TestTokenStore(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100
+        patcher = mock.patch('guiserver.tokens.PeriodicCallback')
+        self.mock_callback = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_store(self, capacity=0):
+        """Return a token store whose tokens expire after 60 seconds."""
+        return tokens.TokenStore(
+            datetime.timedelta(minutes=1), capacity=capacity, name='test',
+            clock=lambda: self.now)
+
+    def test_add_and_pop(self):
+        # A stored value can be retrieved only once using its token.
+        store = self.make_store()
+        token = store.add('value')
+        self.assertIn(token, store)
+        self.assertEqual(1, len(store))
+        self.assertEqual('value', store.pop(token))
+        self.assertIsNone(store.pop(token))
+        self.assertEqual(0, len(store))
+
+    def test_random_tokens(self):
+        # Different tokens are created for each value.
+        store = self.make_store()
+        self.assertNotEqual(store.add('value1'), store.add('value2'))
+
+    def test_provided_token(self):
+        # Values can be stored using a provided token.
+        store = self.make_store()
+        self.assertEqual('DEFACED', store.add('value', token='DEFACED'))
+        self.assertEqual('value', store.pop('DEFACED'))
+
+    def test_expired(self):
+        # Expired tokens cannot be used, even if not yet swept.
+        store = self.make_store()
+        token = store.add('value')
+        self.now += 60
+        self.assertIsNone(store.pop(token))
+
+    def test_sweep(self):
+        # Expired tokens are removed when sweeping.
+        store = self.make_store()
+        token1 = store.add('value1')
+        self.now += 30
+        token2 = store.add('value2')
+        self.now += 30
+        store.sweep()
+        self.assertNotIn(token1, store)
+        self.assertIn(token2, store)
+        self.assertEqual(1, store.get_info()['expired'])
+
+    def test_sweeper(self):
+        # Tokens are swept periodically only while the store is not empty.
+        store = self.make_store()
+        store.add('value')
+        self.mock_callback.assert_called_once_with(
+            store.sweep, tokens.DEFAULT_SWEEP_INTERVAL * 1000, None)
+        self.mock_callback().start.assert_called_once_with()
+        store.add('value')
+        self.assertEqual(1, self.mock_callback().start.call_count)
+        self.now += 60
+        store.sweep()
+        self.mock_callback().stop.assert_called_once_with()
+
+    def test_capacity(self):
+        # The oldest tokens are evicted when the store is full.
+        store = self.make_store(capacity=2)
+        token1 = store.add('value1')
+        token2 = store.add('value2')
+        token3 = store.add('value3')
+        self.assertNotIn(token1, store)
+        self.assertIn(token2, store)
+        self.assertIn(token3, store)
+        self.assertEqual(1, store.get_info()['evicted'])
+
+    def test_info(self):
+        # The store contents and statistics are reported.
+        store = self.make_store(capacity=10)
+        token = store.add('value1')
+        store.add('value2')
+        store.pop(token)
+        store.pop('no-such')
+        expected = {
+            'tokens': 1,
+            'capacity': 10,
+            'created': 2,
+            'used': 1,
+            'missed': 1,
+            'expired': 0,
+            'evicted': 0,
+        }
+        self.assertEqual(expected, store.get_info())
+
+
+class TestDirectoryTokenStore(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        patcher = mock.patch('guiserver.tokens.PeriodicCallback')
+        self.mock_callback = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_store(self, capacity=0):
+        """Return a directory store whose tokens expire after 60 seconds."""
+        return tokens.DirectoryTokenStore(
+            datetime.timedelta(minutes=1), self.path, capacity=capacity,
+            name='test', clock=lambda: self.now)
+
+    def test_add_and_pop(self):
+        # A stored value can be retrieved only once using its token.
+        store = self.make_store()
+        token = store.add({'username': 'who', 'password': 'secret'})
+        self.assertIn(token, store)
+        self.assertEqual(1, len(store))
+        self.assertEqual(
+            {'username': 'who', 'password': 'secret'}, store.pop(token))
+        self.assertIsNone(store.pop(token))
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_shared(self):
+        # Tokens created by a store can be used by other stores sharing the
+        # same directory.
+        token = self.make_store().add(['change1', 'change2'])
+        other = self.make_store()
+        self.assertEqual(['change1', 'change2'], other.pop(token))
+        self.assertEqual(1, other.get_info()['used'])
+
+    def test_create_directory(self):
+        # The store directory is created if it does not exist.
+        path = os.path.join(self.path, 'auth')
+        tokens.DirectoryTokenStore(datetime.timedelta(minutes=1), path)
+        self.assertTrue(os.path.isdir(path))
+
+    def test_invalid_token(self):
+        # Tokens which are not valid file names are never stored.
+        store = self.make_store()
+        self.assertIsNone(store.pop('../secret'))
+        self.assertNotIn('../secret', store)
+        with self.assertRaises(ValueError):
+            store.add('value', token='../secret')
+
+    def test_expired(self):
+        # Expired tokens cannot be used, even if not yet swept.
+        store = self.make_store()
+        token = store.add('value')
+        self.now += 60
+        self.assertIsNone(store.pop(token))
+
+    def test_sweep(self):
+        # Expired tokens are removed when sweeping.
+        store = self.make_store()
+        token1 = store.add('value1')
+        self.now += 30
+        token2 = store.add('value2')
+        self.now += 30
+        store.sweep()
+        self.assertNotIn(token1, store)
+        self.assertIn(token2, store)
+        self.assertEqual(1, store.get_info()['expired'])
+        self.assertFalse(self.mock_callback().stop.called)
+        self.now += 30
+        store.sweep()
+        self.assertEqual(0, len(store))
+        self.mock_callback().stop.assert_called_once_with()
+
+    def test_sweep_stale_files(self):
+        # Temporary files left behind by killed processes are removed when
+        # older than the token max life.
+        store = self.make_store()
+        for name, mtime in (
+                ('.new-1', 40), ('.taken-1', 40), ('.new-2', 41),
+                ('.taken-2', 41), ('.other', 40)):
+            path = os.path.join(self.path, name)
+            open(path, 'w').close()
+            os.utime(path, (mtime, mtime))
+        store.sweep()
+        self.assertEqual(
+            ['.new-2', '.other', '.taken-2'], sorted(os.listdir(self.path)))
+
+    def test_capacity(self):
+        # The tokens expiring first are evicted when sweeping a full store.
+        store = self.make_store(capacity=2)
+        token1 = store.add('value1')
+        self.now += 1
+        token2 = store.add('value2')
+        self.now += 1
+        token3 = store.add('value3')
+        store.sweep()
+        self.assertNotIn(token1, store)
+        self.assertIn(token2, store)
+        self.assertIn(token3, store)
+        self.assertEqual(1, store.get_info()['evicted'])
+
+
+class TestMakeStore(unittest.TestCase):
+
+    def test_memory(self):
+        # An in memory store is returned by default.
+        store = tokens.make_store(datetime.timedelta(minutes=1), capacity=42)
+        self.assertIsInstance(store, tokens.TokenStore)
+        self.assertNotIsInstance(store, tokens.DirectoryTokenStore)
+        self.assertEqual(42, store.capacity)
+
+    def test_directory(self):
+        # A directory store is returned if a path is provided.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = tokens.make_store(
+            datetime.timedelta(minutes=1), path=path, name='auth')
+        self.assertIsInstance(store, tokens.DirectoryTokenStore)
+        self.assertEqual(path, store.path)
+        self.assertEqual('auth', store.name)
@@ -16,7 +16,10 @@
 
 """Tests for the Juju GUI server utilities."""
 
+import collections
+import itertools
 import json
+import logging
 import unittest
 
 import mock
@@ -127,6 +130,38 @@ class TestGetHeaders(unittest.TestCase):
         self.assertEqual({'Origin': 'https://server.example.com'}, headers)
 
 
+class TestGetApiUrls(unittest.TestCase):
+
+    url = 'wss://1.2.3.4:17070/model/uuid/api'
+
+    def test_urls(self):
+        # The URLs for all the API servers are returned, starting from the
+        # given one.
+        servers = [
+            [{'Value': '1.2.3.4', 'Port': 17070, 'Scope': 'public'},
+             {'Value': '10.0.0.2', 'Port': 17070, 'Scope': 'local-cloud'}],
+            [{'value': 'fe80::1', 'port': 17071, 'scope': 'public'}],
+        ]
+        expected = [
+            self.url,
+            'wss://10.0.0.2:17070/model/uuid/api',
+            'wss://[fe80::1]:17071/model/uuid/api',
+        ]
+        self.assertEqual(expected, utils.get_api_urls(self.url, servers))
+
+    def test_local_addresses(self):
+        # Machine and link local addresses are excluded.
+        servers = [[
+            {'Value': '127.0.0.1', 'Port': 17070, 'Scope': 'machine-local'},
+            {'Value': '169.254.0.1', 'Port': 17070, 'Scope': 'link-local'},
+        ]]
+        self.assertEqual([self.url], utils.get_api_urls(self.url, servers))
+
+    def test_no_servers(self):
+        # Only the given URL is returned if no servers are provided.
+        self.assertEqual([self.url], utils.get_api_urls(self.url, None))
+
+
 class TestGetJujuApiUrl(unittest.TestCase):
 
     source_template = '/api/$server/$port/$uuid'
@@ -154,6 +189,20 @@ class TestGetJujuApiUrl(unittest.TestCase):
         self.assertEqual('wss://1.2.3.4:47/model/uuid/exterminate', url)
 
 
+class TestIsJsonObject(unittest.TestCase):
+
+    def test_object(self):
+        # JSON encoded objects are recognized.
+        self.assertTrue(utils.is_json_object('{"key": "value"}'))
+        self.assertTrue(utils.is_json_object('  {}'))
+
+    def test_not_an_object(self):
+        # Other values are not considered objects.
+        self.assertFalse(utils.is_json_object('"not-a-dict"'))
+        self.assertFalse(utils.is_json_object('not-json'))
+        self.assertFalse(utils.is_json_object(''))
+
+
 class TestJoinUrl(unittest.TestCase):
 
     def test_url_parts(self):
@@ -212,6 +261,217 @@ class TestJsonDecodeDict(unittest.TestCase):
             self.assertIsNone(utils.json_decode_dict('"not-a-dict"'))
 
 
+class TestJsonCodec(unittest.TestCase):
+
+    data = {'RequestId': 1, 'Params': {'URL': 'cs:trusty/django-42'}}
+
+    def setUp(self):
+        # Restore the codec in use after each test.
+        self.addCleanup(utils.set_json_codec, utils.get_json_codec())
+
+    def installed_codecs(self):
+        """Return the names of the installed JSON codecs."""
+        names = []
+        for name in utils.JSON_CODECS:
+            try:
+                utils._load_json_codec(name)
+            except ImportError:
+                continue
+            names.append(name)
+        return names
+
+    def test_auto(self):
+        # The fastest installed codec is selected by default.
+        name = utils.set_json_codec()
+        self.assertEqual(self.installed_codecs()[0], name)
+        self.assertEqual(name, utils.get_json_codec())
+
+    def test_stdlib(self):
+        # The stdlib json module can be selected.
+        self.assertEqual('json', utils.set_json_codec('json'))
+        self.assertEqual(json.dumps(self.data), utils.json_encode(self.data))
+
+    def test_not_installed(self):
+        # An ImportError is raised if the requested codec is not installed.
+        with mock.patch('importlib.import_module', side_effect=ImportError):
+            with self.assertRaises(ImportError):
+                utils.set_json_codec('ujson')
+
+    def test_fallback(self):
+        # The stdlib json module is used if no other codecs are installed.
+        import_module = utils.importlib.import_module
+
+        def only_stdlib(name):
+            if name != 'json':
+                raise ImportError(name)
+            return import_module(name)
+        with mock.patch('importlib.import_module', only_stdlib):
+            self.assertEqual('json', utils.set_json_codec())
+
+    def test_round_trip(self):
+        # All the installed codecs produce equivalent results.
+        for name in self.installed_codecs():
+            utils.set_json_codec(name)
+            message = utils.json_encode(self.data)
+            self.assertEqual(self.data, json.loads(message))
+            self.assertEqual(self.data, utils.json_decode(message))
+            with self.assertRaises(ValueError):
+                utils.json_decode('not-json')
+
+
+class TestLeadingRequestId(unittest.TestCase):
+
+    def test_request_id(self):
+        # The request id is returned if it is the first key of the object.
+        message = '{"RequestId": 42, "Response": {"RequestId": 47}}'
+        self.assertEqual(42, utils.leading_request_id(message))
+
+    def test_whitespace(self):
+        # Whitespace is ignored.
+        message = ' { "RequestId" :42,"Response":{}}'
+        self.assertEqual(42, utils.leading_request_id(message))
+
+    def test_not_leading(self):
+        # None is returned if the request id is not the first key.
+        message = '{"Response": {}, "RequestId": 42}'
+        self.assertIsNone(utils.leading_request_id(message))
+
+    def test_invalid(self):
+        # None is returned if the message is not a JSON object.
+        self.assertIsNone(utils.leading_request_id('not-json'))
+
+
+class TestLogFrame(unittest.TestCase):
+
+    def setUp(self):
+        # Enable debug logging and capture the logged frames.
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.DEBUG)
+        self.addCleanup(utils.set_frame_logging)
+        patchers = [
+            mock.patch('guiserver.utils._frame_counter', itertools.count()),
+            mock.patch('logging.debug'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def logged(self):
+        """Return the messages logged so far."""
+        return [call[0][0] for call in logging.debug.call_args_list]
+
+    def test_frame(self):
+        # The whole encoded frame is logged by default.
+        utils.log_frame('ws: ', 'client -> juju', u'{"Name": "\u2603"}')
+        self.assertEqual(
+            ['ws: client -> juju: {"Name": "\xe2\x98\x83"}'], self.logged())
+
+    def test_truncated(self):
+        # Frames can be truncated.
+        utils.set_frame_logging(max_size=5)
+        utils.log_frame('ws: ', 'juju -> client', u'{"Deltas": []}')
+        utils.log_frame('ws: ', 'juju -> client', u'{}')
+        self.assertEqual([
+            'ws: juju -> client: {"Del... (9 characters omitted)',
+            'ws: juju -> client: {}',
+        ], self.logged())
+
+    def test_sampled(self):
+        # Only one frame every sample rate frames can be logged.
+        utils.set_frame_logging(sample_rate=3)
+        for num in range(7):
+            utils.log_frame('', 'juju -> client', str(num))
+        self.assertEqual([
+            'juju -> client: 0',
+            'juju -> client: 3',
+            'juju -> client: 6',
+        ], self.logged())
+
+    def test_debug_disabled(self):
+        # Nothing is logged, or formatted, if debug logging is disabled.
+        logging.getLogger().setLevel(logging.INFO)
+        message = mock.MagicMock()
+        utils.log_frame('', 'juju -> client', message)
+        self.assertEqual([], self.logged())
+        self.assertEqual([], message.method_calls)
+
+
+class TestMaybeFuture(unittest.TestCase):
+
+    def test_value(self):
+        # A Future is returned wrapping the given value.
+        future = utils.maybe_future(42)
+        self.assertTrue(future.done())
+        self.assertEqual(42, future.result())
+
+    def test_future(self):
+        # Futures are returned unchanged.
+        expected = concurrent.Future()
+        self.assertIs(expected, utils.maybe_future(expected))
+
+
+class TestMessageTypes(unittest.TestCase):
+
+    def test_types(self):
+        # All the types included in the message are returned.
+        message = json.dumps({
+            'Type': 'Deployer',
+            'Params': {'Nested': {'Type': 'Admin'}},
+        })
+        self.assertEqual(
+            set(['Deployer', 'Admin']), utils.message_types(message))
+
+    def test_no_types(self):
+        # An empty set is returned if the message does not include types.
+        message = json.dumps({'RequestId': 1, 'Response': {}})
+        self.assertEqual(set(), utils.message_types(message))
+
+    def test_escaped_quotes(self):
+        # Types including escaped characters are not returned.
+        message = json.dumps({'Type': 'bad "wolf"'})
+        self.assertEqual(set(), utils.message_types(message))
+
+
+class TestReplaceLeadingRequestId(unittest.TestCase):
+
+    def test_replaced(self):
+        # The leading request id is replaced, nested ones are preserved.
+        message = '{ "RequestId":42, "Response": {"RequestId": 42}}'
+        self.assertEqual(
+            '{ "RequestId":1000, "Response": {"RequestId": 42}}',
+            utils.replace_leading_request_id(message, 1000))
+
+    def test_not_leading(self):
+        # None is returned if the request id is not the first key.
+        message = '{"Response": {}, "RequestId": 42}'
+        self.assertIsNone(utils.replace_leading_request_id(message, 1))
+
+
+class TestRequestInfo(unittest.TestCase):
+
+    def test_leading_request_id(self):
+        # The request id, type and request are returned.
+        message = json.dumps(collections.OrderedDict([
+            ('RequestId', 42), ('Type', 'Client'), ('Request', 'FullStatus'),
+            ('Params', {}),
+        ]))
+        self.assertEqual(
+            (42, 'Client', 'FullStatus'), utils.request_info(message))
+
+    def test_trailing_request_id(self):
+        # The last request id is returned if it is not the first key.
+        message = (
+            '{"Type": "Client", "Request": "AddCharm", '
+            '"Params": {"RequestId": 1}, "RequestId": 47}')
+        self.assertEqual(
+            (47, 'Client', 'AddCharm'), utils.request_info(message))
+
+    def test_missing_values(self):
+        # None is returned for values not found in the message.
+        self.assertEqual((None, None, None), utils.request_info('{}'))
+
+
 class TestRequestSummary(unittest.TestCase):
 
     def test_summary(self):
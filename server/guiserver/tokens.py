@@ -0,0 +1,329 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server single-use token store.
+
+Authentication tokens (see guiserver.auth) and bundle change sets (see
+guiserver.bundles.views) are stored on the server and retrieved once using a
+token, for a limited amount of time. This module defines the stores used for
+both of them:
+
+    - TokenStore: the default store, keeping tokens in process memory;
+    - DirectoryTokenStore: a store keeping each token in a file, so that
+      multiple server processes running on the same host (for instance the
+      workers, or several servers behind a load balancer) can share tokens.
+      A token created by one process can be used by any other process.
+      Point it to a directory in a memory file system (e.g. /dev/shm) to
+      avoid disk writes.
+
+Use make_store to create the store suitable for a given configuration.
+
+Since all the tokens in a store have the same time to live, the insertion
+order is also the expiration order: tokens are kept in an ordered dict, and
+expired tokens are removed from its head by a single periodic sweep, instead
+of scheduling an IO loop timeout for each token. When the store is full, the
+oldest tokens are evicted.
+"""
+
+from collections import OrderedDict
+import errno
+import logging
+import os
+import re
+import time
+import uuid
+
+from tornado.ioloop import PeriodicCallback
+
+from guiserver.utils import (
+    json_decode,
+    json_encode,
+)
+
+
+# Define the default maximum number of tokens in a store.
+DEFAULT_CAPACITY = 10000
+# Define the default number of seconds between expired tokens sweeps.
+DEFAULT_SWEEP_INTERVAL = 1
+# Define the tokens that can be used as file names by DirectoryTokenStore.
+_valid_file_token = re.compile(r'^\w+$').match
+
+
+class TokenStore(object):
+    """Store values that can be retrieved once using a token.
+
+    Tokens expire after max_life (a datetime.timedelta). At most capacity
+    tokens are stored (use 0 for no limit): when adding a token to a full
+    store, the oldest one is evicted. The name is used in log messages.
+    Expired tokens are removed every sweep_interval seconds, and they cannot
+    be retrieved even if still stored. The clock callable returns the current
+    time in seconds.
+    """
+
+    def __init__(
+            self, max_life, capacity=DEFAULT_CAPACITY, name='tokens',
+            io_loop=None, sweep_interval=DEFAULT_SWEEP_INTERVAL,
+            clock=time.time):
+        self.max_life = max_life
+        self.capacity = capacity
+        self.name = name
+        self._io_loop = io_loop
+        self._sweep_interval = sweep_interval
+        self._clock = clock
+        self._seconds = max_life.total_seconds()
+        # Map tokens to (expiration time, value) tuples, oldest first.
+        self._data = OrderedDict()
+        # The sweep callback only runs while tokens are stored.
+        self._sweeper = None
+        self._stats = dict.fromkeys(
+            ('created', 'used', 'missed', 'expired', 'evicted'), 0)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, token):
+        return token in self._data
+
+    def add(self, value, token=None):
+        """Store the given value and return the token used to retrieve it.
+
+        A new random token is created if not provided.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        data = self._data
+        data.pop(token, None)
+        if self.capacity:
+            while len(data) >= self.capacity:
+                evicted, _ = data.popitem(last=False)
+                self._stats['evicted'] += 1
+                logging.info('{}: evicted token {}'.format(self.name, evicted))
+        data[token] = (self._clock() + self._seconds, value)
+        self._stats['created'] += 1
+        self._start_sweeper()
+        return token
+
+    def pop(self, token):
+        """Remove the given token and return its value.
+
+        Return None if the token is not known or it is expired.
+        """
+        expires, value = self._data.pop(token, (None, None))
+        if (expires is None) or (expires <= self._clock()):
+            self._stats['missed'] += 1
+            return None
+        self._stats['used'] += 1
+        return value
+
+    def sweep(self):
+        """Remove expired tokens."""
+        data = self._data
+        now = self._clock()
+        while data:
+            token, (expires, _) = next(data.iteritems())
+            if expires > now:
+                break
+            del data[token]
+            self._stats['expired'] += 1
+            logging.info('{}: expired token {}'.format(self.name, token))
+        if not data:
+            self._stop_sweeper()
+
+    def _start_sweeper(self):
+        """Start removing expired tokens periodically, if not running."""
+        if self._sweeper is None:
+            self._sweeper = PeriodicCallback(
+                self.sweep, self._sweep_interval * 1000, self._io_loop)
+            self._sweeper.start()
+
+    def _stop_sweeper(self):
+        """Stop removing expired tokens."""
+        if self._sweeper is not None:
+            self._sweeper.stop()
+            self._sweeper = None
+
+    def get_info(self):
+        """Return a dict describing the store contents and statistics."""
+        info = {
+            'tokens': len(self),
+            'capacity': self.capacity,
+        }
+        info.update(self._stats)
+        return info
+
+
+class DirectoryTokenStore(TokenStore):
+    """Store tokens as files in the given directory.
+
+    Each token is a file including the JSON encoded expiration time and
+    value, so values must be JSON serializable. The file modification time is
+    also set to the expiration time, so that sweeping does not require
+    reading the token files. Since files are atomically renamed before being
+    read, a token can be used only once even if the directory is shared by
+    multiple processes.
+
+    The capacity is enforced when sweeping, by evicting the tokens expiring
+    first. Statistics only include the operations of this process.
+    """
+
+    def __init__(self, max_life, path, **kwargs):
+        super(DirectoryTokenStore, self).__init__(max_life, **kwargs)
+        self.path = path
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def _tokens(self):
+        """Return the list of tokens currently stored."""
+        return [name for name in os.listdir(self.path)
+                if not name.startswith('.')]
+
+    def __len__(self):
+        return len(self._tokens())
+
+    def __contains__(self, token):
+        return (
+            _valid_file_token(token) is not None and
+            os.path.exists(os.path.join(self.path, token)))
+
+    def add(self, value, token=None):
+        """Store the given value and return the token used to retrieve it.
+
+        A new random token is created if not provided.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        elif _valid_file_token(token) is None:
+            raise ValueError('invalid token: {!r}'.format(token))
+        expires = self._clock() + self._seconds
+        data = json_encode({'Expires': expires, 'Value': value})
+        # Write the token to a hidden file first, so that other processes
+        # never see it partially written.
+        tmp_path = os.path.join(self.path, '.new-' + uuid.uuid4().hex)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.utime(tmp_path, (expires, expires))
+        os.rename(tmp_path, os.path.join(self.path, token))
+        self._stats['created'] += 1
+        self._start_sweeper()
+        return token
+
+    def _take(self, token):
+        """Remove the given token and return its (expiration, value) pair.
+
+        Return (None, None) if the token is not stored or another process
+        took it first.
+        """
+        if _valid_file_token(token) is None:
+            return None, None
+        path = os.path.join(self.path, token)
+        taken_path = os.path.join(self.path, '.taken-' + uuid.uuid4().hex)
+        try:
+            os.rename(path, taken_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None, None
+        # Mark the file as recently taken, so that it is not swept while
+        # being read.
+        os.utime(taken_path, None)
+        try:
+            with open(taken_path, 'rb') as taken_file:
+                data = json_decode(taken_file.read())
+        except ValueError:
+            logging.error('{}: invalid token file {}'.format(self.name, path))
+            return None, None
+        finally:
+            os.remove(taken_path)
+        return data['Expires'], data['Value']
+
+    def pop(self, token):
+        """Remove the given token and return its value.
+
+        Return None if the token is not known or it is expired.
+        """
+        expires, value = self._take(token)
+        if (expires is None) or (expires <= self._clock()):
+            self._stats['missed'] += 1
+            return None
+        self._stats['used'] += 1
+        return value
+
+    def _sweep_stale_files(self, now):
+        """Remove the temporary files left behind by killed processes.
+
+        Files being written or read are never older than the token max life.
+        """
+        for name in os.listdir(self.path):
+            if not name.startswith(('.new-', '.taken-')):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(path) <= now - self._seconds:
+                    os.remove(path)
+                    logging.info('{}: removed stale file {}'.format(
+                        self.name, name))
+            except OSError:
+                # The file has been renamed or removed by another process.
+                continue
+
+    def sweep(self):
+        """Remove expired tokens, and the oldest ones if over capacity.
+
+        Stale temporary files are removed as well.
+        """
+        now = self._clock()
+        self._sweep_stale_files(now)
+        entries = []
+        for token in self._tokens():
+            try:
+                expires = os.path.getmtime(os.path.join(self.path, token))
+            except OSError:
+                # The token has been used or removed by another process.
+                continue
+            entries.append((expires, token))
+        entries.sort()
+        excess = len(entries) - self.capacity if self.capacity else 0
+        remaining = len(entries)
+        for position, (expires, token) in enumerate(entries):
+            if expires <= now:
+                reason = 'expired'
+            elif position < excess:
+                reason = 'evicted'
+            else:
+                break
+            remaining -= 1
+            if self._take(token)[0] is not None:
+                self._stats[reason] += 1
+                logging.info('{}: {} token {}'.format(
+                    self.name, reason, token))
+        if not remaining:
+            self._stop_sweeper()
+
+
+def make_store(max_life, path=None, **kwargs):
+    """Return a token store whose tokens expire after max_life.
+
+    If a path is provided, return a DirectoryTokenStore sharing tokens in
+    that directory, otherwise return an in memory TokenStore. The keyword
+    arguments are passed to the store constructor.
+    """
+    if path:
+        return DirectoryTokenStore(max_life, path, **kwargs)
+    return TokenStore(max_life, **kwargs)
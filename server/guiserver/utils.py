@@ -18,15 +18,35 @@
 
 import collections
 import functools
+import importlib
+import itertools
 import logging
 import re
 import urlparse
 import weakref
 
-from tornado import (
-    escape,
-    httpclient,
-)
+from concurrent.futures import Future
+from tornado import httpclient
+
+
+# Define regular expressions used to inspect JSON messages without decoding.
+_JSON_OBJECT_REGEX = re.compile(r'\s*\{')
+_LEADING_REQUEST_ID_REGEX = re.compile(r'\s*\{\s*"RequestId"\s*:\s*(\d+)')
+_TYPE_REGEX = re.compile(r'"Type"\s*:\s*"([^"\\]*)"')
+_REQUEST_REGEX = re.compile(r'"Request"\s*:\s*"([^"\\]*)"')
+_REQUEST_ID_REGEX = re.compile(r'"RequestId"\s*:\s*(\d+)')
+# Define the scopes of API server addresses not reachable from other hosts.
+_LOCAL_SCOPES = ('machine-local', 'link-local')
+# Define the supported JSON codecs, in order of preference. The C accelerated
+# ones are used if installed: the stdlib json module is always available.
+JSON_CODECS = ('ujson', 'simplejson', 'json')
+JSON_CODEC_AUTO = 'auto'
+# Store the (name, encode, decode) tuple of the JSON codec in use.
+_json_codec = None
+# Store the (max size, sample rate) used when logging WebSocket frames, and
+# the number of frames logged so far.
+_frame_logging = (0, 1)
+_frame_counter = itertools.count()
 
 
 def add_future(io_loop, future, callback, *args):
@@ -62,6 +82,33 @@ def get_headers(request, websocket_url):
     return {'Origin': origin}
 
 
+def get_api_urls(url, servers):
+    """Return the Juju API URLs that can be used to reach the same model.
+
+    Receive the URL currently in use and the API server addresses included in
+    a login response, as a list of lists of host/port dicts. The returned list
+    starts with the given URL, followed by the same URL pointing to each one
+    of the other servers. Machine and link local addresses are excluded.
+    """
+    parsed = urlparse.urlsplit(url)
+    urls = [url]
+    for hostports in servers or ():
+        for hostport in hostports:
+            host = hostport.get('Value', hostport.get('value'))
+            port = hostport.get('Port', hostport.get('port'))
+            scope = hostport.get('Scope', hostport.get('scope'))
+            if (not host) or (not port) or (scope in _LOCAL_SCOPES):
+                continue
+            if ':' in host:
+                # This is an IPv6 address.
+                host = '[{}]'.format(host)
+            netloc = '{}:{}'.format(host, port)
+            candidate = urlparse.urlunsplit(parsed._replace(netloc=netloc))
+            if candidate not in urls:
+                urls.append(candidate)
+    return urls
+
+
 def get_juju_api_url(path, source_template, target_template, default):
     """Return the Juju WebSocket API fully qualified URL.
 
@@ -84,6 +131,17 @@ def get_juju_api_url(path, source_template, target_template, default):
     return target_template.format(**match.groupdict())
 
 
+def get_write_buffer_size(stream):
+    """Return the number of bytes waiting to be written to the given stream.
+
+    Tornado IOStreams do not expose the size of their write buffer, so the
+    internal buffer is inspected. Return 0 if the stream is closed.
+    """
+    if (stream is None) or stream.closed():
+        return 0
+    return sum(len(chunk) for chunk in stream._write_buffer)
+
+
 def join_url(base_url, path, query):
     """Create and return an URL string joining the given parts.
 
@@ -95,6 +153,91 @@ def join_url(base_url, path, query):
     return '{}/{}{}'.format(base_url.rstrip('/'), path.lstrip('/'), query)
 
 
+def is_json_object(message):
+    """Return True if the given message looks like a JSON encoded object.
+
+    Only the beginning of the message is inspected: the message is not
+    guaranteed to be valid JSON.
+    """
+    return _JSON_OBJECT_REGEX.match(message) is not None
+
+
+def leading_request_id(message):
+    """Return the request id of the given JSON encoded message.
+
+    The request id is only found if RequestId is the first key of the encoded
+    object, as it happens in all the responses sent by juju-core. Only the
+    beginning of the message is inspected, so that the cost of this function
+    does not depend on the message size. Return None if the request id is not
+    found at the beginning of the message.
+    """
+    match = _LEADING_REQUEST_ID_REGEX.match(message)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def message_types(message):
+    """Return a set including all the Type values in the given JSON message.
+
+    Values are collected without decoding the message, and they also include
+    the ones possibly found in nested objects. For this reason, the resulting
+    set can be used to safely exclude that a message is of a specific type.
+    """
+    return set(_TYPE_REGEX.findall(message))
+
+
+def _load_json_codec(name):
+    """Return the (encode, decode) functions of the given JSON codec.
+
+    Raise an ImportError if the codec is not installed.
+    """
+    module = importlib.import_module(name)
+    encode = module.dumps
+    if name == 'ujson':
+        # Do not escape slashes, as the other codecs do.
+        encode = functools.partial(module.dumps, escape_forward_slashes=False)
+    return encode, module.loads
+
+
+def set_json_codec(name=JSON_CODEC_AUTO):
+    """Select the JSON codec used by json_encode and json_decode.
+
+    The name is one of JSON_CODECS, or JSON_CODEC_AUTO to use the fastest
+    installed codec. Return the name of the selected codec. Raise an
+    ImportError if the requested codec is not installed.
+    """
+    global _json_codec
+    names = JSON_CODECS if name == JSON_CODEC_AUTO else (name,)
+    for codec_name in names:
+        try:
+            encode, decode = _load_json_codec(codec_name)
+        except ImportError:
+            if codec_name == name:
+                raise
+            continue
+        _json_codec = codec_name, encode, decode
+        return codec_name
+
+
+def get_json_codec():
+    """Return the name of the JSON codec currently in use."""
+    return _json_codec[0]
+
+
+def json_encode(value):
+    """JSON encode the given value using the selected codec."""
+    return _json_codec[1](value)
+
+
+def json_decode(message):
+    """Decode the given JSON message using the selected codec.
+
+    Raise a ValueError if the message is not valid JSON.
+    """
+    return _json_codec[2](message)
+
+
 def json_decode_dict(message):
     """Decode the given JSON message, returning a Python dict.
 
@@ -102,7 +245,7 @@ def json_decode_dict(message):
     not a dict-like object, log a warning and return None.
     """
     try:
-        data = escape.json_decode(message)
+        data = json_decode(message)
     except ValueError:
         msg = 'JSON decoder: message is not valid JSON: {!r}'.format(message)
         logging.warning(msg)
@@ -114,11 +257,95 @@ def json_decode_dict(message):
     return data
 
 
+def log_frame(summary, route, message):
+    """Log the given WebSocket frame at debug level.
+
+    The route describes where the frame is going, e.g. "client -> juju".
+    The message is only encoded and formatted if debug logging is enabled and
+    the frame is selected for logging (see set_frame_logging), so that calling
+    this function for each proxied frame is cheap in production.
+    """
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    max_size, sample_rate = _frame_logging
+    if (sample_rate > 1) and next(_frame_counter) % sample_rate:
+        return
+    omitted = 0
+    if max_size and (len(message) > max_size):
+        omitted = len(message) - max_size
+        message = message[:max_size]
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    if omitted:
+        message += '... ({} characters omitted)'.format(omitted)
+    logging.debug('{}{}: {}'.format(summary, route, message))
+
+
+def maybe_future(value):
+    """Return a Future whose result is the given value.
+
+    If the given value is already a Future, return it unchanged. This is useful
+    when a value can be either computed locally or retrieved asynchronously.
+    """
+    if isinstance(value, Future):
+        return value
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def replace_leading_request_id(message, request_id):
+    """Return the given JSON message with its leading request id replaced.
+
+    As in leading_request_id, the message is not decoded. Return None if the
+    request id is not found at the beginning of the message.
+    """
+    match = _LEADING_REQUEST_ID_REGEX.match(message)
+    if match is None:
+        return None
+    start, end = match.span(1)
+    return message[:start] + str(request_id) + message[end:]
+
+
+def request_info(message):
+    """Return the (request id, type, request) of the given JSON request.
+
+    The message is not decoded, so this is a best effort suitable for
+    collecting metrics: the first type and request names found in the message
+    are returned. The request id is looked for at the beginning of the
+    message, or as the last one in the message (the GUI adds it after the
+    request parameters). Missing values are returned as None.
+    """
+    request_id = leading_request_id(message)
+    if request_id is None:
+        ids = _REQUEST_ID_REGEX.findall(message)
+        if ids:
+            request_id = int(ids[-1])
+    type_match = _TYPE_REGEX.search(message)
+    request_match = _REQUEST_REGEX.search(message)
+    return (
+        request_id,
+        type_match.group(1) if type_match else None,
+        request_match.group(1) if request_match else None,
+    )
+
+
 def request_summary(request):
     """Return a string representing a summary for the given request."""
     return '{} {} ({})'.format(request.method, request.uri, request.remote_ip)
 
 
+def set_frame_logging(max_size=0, sample_rate=1):
+    """Configure how WebSocket frames are logged by log_frame.
+
+    If max_size is not zero, only the first max_size characters of each frame
+    are logged. If sample_rate is greater than one, only one frame every
+    sample_rate frames is logged.
+    """
+    global _frame_logging
+    _frame_logging = max_size, sample_rate
+
+
 def wrap_write_message(handler):
     """Wrap the write_message() method of the given handler.
 
@@ -136,7 +363,7 @@ def wrap_write_message(handler):
         if (handler is None) or (not handler.connected):
             return logging.warning(
                 'discarding message (closed connection): {!r}'.format(data))
-        message = escape.json_encode(data)
+        message = json_encode(data)
         handler.write_message(message)
 
     return wrapped
@@ -147,3 +374,7 @@ def ws_to_http(url):
     parts = urlparse.urlsplit(url)
     scheme = {'ws': 'http', 'wss': 'https'}[parts.scheme]
     return '{}://{}{}'.format(scheme, parts.netloc, parts.path)
+
+
+# Start using the fastest installed JSON codec.
+set_json_codec()
@@ -25,6 +25,7 @@ Arguments example:
     --sandbox
     --logging=debug|info|warning|error
     --charmworldurl="https://manage.jujucharms.com/"
+    --workers=4
 
 The --sslpath option is ignored if --insecure is set.
 The --apiurl and --apiversion options are ignored if --sandbox is set.
@@ -104,6 +104,7 @@ class TestBackendCommands(unittest.TestCase):
             'gzip-compression': True,
             'gtm-enabled': False,
             'gisf-enabled': False,
+            'graceful-restart': True,
         }
         if options is not None:
             config.update(options)
@@ -186,6 +187,7 @@ class TestBackendCommands(unittest.TestCase):
             charmstore_version='v4',
             gtm_enabled=False,
             gisf_enabled=False,
+            graceful=True,
             gzip=True,
             port=None,
             env_password=None)
@@ -214,6 +216,7 @@ class TestBackendCommands(unittest.TestCase):
             charmstore_version='v4',
             gtm_enabled=False,
             gisf_enabled=False,
+            graceful=True,
             gzip=True,
             port=None,
             env_password=None)
@@ -257,6 +260,7 @@ class TestBackendCommands(unittest.TestCase):
             charmstore_version='v4',
             gtm_enabled=False,
             gisf_enabled=False,
+            graceful=True,
             gzip=True,
             port=None,
             env_password=None)
@@ -284,6 +288,7 @@ class TestBackendCommands(unittest.TestCase):
             charmstore_version='v4',
             gtm_enabled=False,
             gisf_enabled=True,
+            graceful=True,
             gzip=True,
             port=None,
             env_password=None)
@@ -31,6 +31,7 @@ import tempita
 from utils import (
     JUJU_GUI_DIR,
     JUJU_PEM,
+    RELOAD,
     RESTART,
     STOP,
     _get_by_attr,
@@ -691,6 +692,22 @@ class TestStartGui(unittest.TestCase):
         self.assertNotIn('--apiurl', guiserver_conf)
         self.assertNotIn('--apiversion', guiserver_conf)
 
+    def test_write_builtin_server_startup_graceful(self):
+        # The builtin server supports reloading in graceful mode.
+        write_builtin_server_startup(self.ssl_cert_path, graceful=True)
+        self.assertIn(
+            '--graceful --restartcommand="/usr/local/bin/runserver.sh"',
+            self.files['runserver.sh'])
+        self.assertIn(
+            'ExecReload=/bin/kill -HUP $MAINPID',
+            self.files['guiserver.service'])
+
+    def test_write_builtin_server_startup_not_graceful(self):
+        # By default, the builtin server is not reloaded.
+        write_builtin_server_startup(self.ssl_cert_path)
+        self.assertNotIn('--graceful', self.files['runserver.sh'])
+        self.assertNotIn('ExecReload', self.files['guiserver.service'])
+
     def test_write_builtin_server_startup_with_jem(self):
         # The builtin server Upstart file is properly generated with JEM.
         write_builtin_server_startup(
@@ -709,6 +726,53 @@ class TestStartGui(unittest.TestCase):
         self.assertEqual(self.service_names, ['guiserver'])
         self.assertEqual(self.actions, [RESTART])
 
+    @mock.patch('utils.service_running', mock.Mock(return_value=True))
+    @mock.patch('utils.init_is_systemd', mock.Mock(return_value=True))
+    def test_start_builtin_server_graceful(self):
+        # The running server is reloaded when restarting gracefully.
+        with mock.patch('utils.service', return_value=True) as mock_service:
+            start_builtin_server(
+                self.ssl_cert_path, serve_tests=False, sandbox=False,
+                builtin_server_logging='info', insecure=False,
+                charmworld_url='http://charmworld.example.com/', port=443,
+                graceful=True)
+        mock_service.assert_called_once_with(RELOAD, 'guiserver')
+
+    @mock.patch('utils.service_running', mock.Mock(return_value=True))
+    @mock.patch('utils.init_is_systemd', mock.Mock(return_value=True))
+    def test_start_builtin_server_graceful_failure(self):
+        # The server is restarted if it cannot be reloaded.
+        with mock.patch('utils.service', return_value=False) as mock_service:
+            start_builtin_server(
+                self.ssl_cert_path, serve_tests=False, sandbox=False,
+                builtin_server_logging='info', insecure=False,
+                charmworld_url='http://charmworld.example.com/', port=443,
+                graceful=True)
+        self.assertEqual(
+            [mock.call(RELOAD, 'guiserver'), mock.call(RESTART, 'guiserver')],
+            mock_service.call_args_list)
+
+    @mock.patch('utils.service_running', mock.Mock(return_value=False))
+    @mock.patch('utils.init_is_systemd', mock.Mock(return_value=True))
+    def test_start_builtin_server_graceful_not_running(self):
+        # The server is started if it is not running.
+        start_builtin_server(
+            self.ssl_cert_path, serve_tests=False, sandbox=False,
+            builtin_server_logging='info', insecure=False,
+            charmworld_url='http://charmworld.example.com/', port=443,
+            graceful=True)
+        self.assertEqual(self.actions, [RESTART])
+
+    @mock.patch('utils.init_is_systemd', mock.Mock(return_value=False))
+    def test_start_builtin_server_graceful_upstart(self):
+        # Graceful restarts are not supported by upstart.
+        start_builtin_server(
+            self.ssl_cert_path, serve_tests=False, sandbox=False,
+            builtin_server_logging='info', insecure=False,
+            charmworld_url='http://charmworld.example.com/', port=443,
+            graceful=True)
+        self.assertEqual(self.actions, [RESTART])
+
     def test_stop_builtin_server(self):
         stop_builtin_server()
         self.assertEqual(self.svc_ctl_call_count, 1)